@@ -10,7 +10,12 @@ import io
 import pathlib
 import time
 import uuid
+import random
+import json
+import hashlib
+import threading
 import requests
+import concurrent.futures
 import binascii
 import logging
 import configparser
@@ -21,14 +26,369 @@ from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.PublicKey import RSA
 
 
+class SubmittedAsLongQuery( RuntimeError ):
+    """Raised by FASTDBClient.submit_short_sql_query when the server turned the query into a long query.
+
+    The queryid attribute is what you pass to check_long_sql_query and
+    get_long_sql_query_result.
+
+    """
+
+    def __init__( self, queryid, cost, *args, **kwargs ):
+        self.queryid = queryid
+        self.cost = cost
+        super().__init__( f"Query was too expensive for a short query (estimated cost {cost:.4g}); "
+                          f"submitted it as long query {queryid}", *args, **kwargs )
+
+
+class FASTDBCache:
+    """An on-disk cache of lightcurves and short SQL query results.
+
+    You don't usually make one of these yourself; pass cachedir to
+    FASTDBClient (or put it in ~/.fastdb.ini), and get_many_ltcvs and
+    submit_short_sql_query will use it.
+
+    Everything is in one directory.  index.sqlite3 says what's cached
+    where.  Lightcurves are in ltcvs/, one Parquet file for each batch
+    fetched from the server, with one row per lightcurve point (and a
+    rootid column).  Short query results are in queries/, as Parquet if
+    they were asked for with return_format 'arrow', and as the server's
+    json otherwise.  More than one process can use the same directory at
+    once.  Needs pyarrow.
+
+    Each lightcurve is stored with its etag (from the server) and the
+    server's import watermark (see ltcv.import_watermark on the server)
+    when it was fetched.  FASTDBClient uses a lightcurve without asking
+    the server about it if the watermark hasn't changed and it's less
+    than max_age seconds old; otherwise, it asks the server for the
+    lightcurve only if its etag has changed.  Short query results only
+    have the watermark, so they're refetched if it has changed, or if
+    they're more than max_age seconds old.  (Short queries that read
+    things other than sources can be up to max_age out of date.)
+
+    When the cache is bigger than max_bytes, the least recently used
+    files are deleted.
+
+    """
+
+    def __init__( self, directory, max_bytes=10 * 2**30, max_age=86400. ):
+        """Open (or create) a cache.
+
+        Parameters
+        ----------
+          directory : str or Path
+            The cache directory.  Created if it doesn't exist.
+
+          max_bytes : int, default 10GiB
+            Delete the least recently used files when the cache gets
+            bigger than this.
+
+          max_age : float, default 86400
+            Check with the server about anything older than this
+            (seconds), even if there haven't been any imports.
+
+        """
+        import sqlite3
+        import pyarrow.parquet   # noqa: F401
+
+        self.directory = pathlib.Path( directory )
+        self.max_bytes = int( max_bytes )
+        self.max_age = float( max_age )
+        ( self.directory / "ltcvs" ).mkdir( parents=True, exist_ok=True )
+        ( self.directory / "queries" ).mkdir( parents=True, exist_ok=True )
+
+        # The client uses the cache from more than one thread, so serialize everything through _lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect( self.directory / "index.sqlite3", timeout=60, check_same_thread=False )
+        with self._lock, self._db:
+            self._db.execute( "CREATE TABLE IF NOT EXISTS files( file TEXT PRIMARY KEY, nbytes INTEGER, "
+                              "lastused REAL )" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS ltcv( paramkey TEXT, rootid TEXT, file TEXT, etag TEXT, "
+                              "watermark TEXT, fetched REAL, PRIMARY KEY( paramkey, rootid ) )" )
+            self._db.execute( "CREATE INDEX IF NOT EXISTS ltcv_file ON ltcv(file)" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS query( key TEXT PRIMARY KEY, file TEXT, "
+                              "watermark TEXT, fetched REAL )" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS stats( kind TEXT PRIMARY KEY, hits INTEGER, "
+                              "revalidated INTEGER, misses INTEGER )" )
+
+
+    @staticmethod
+    def key( *things ):
+        """A cache key for an endpoint and its parameters."""
+        return hashlib.sha256( json.dumps( things, sort_keys=True, default=str ).encode( 'utf-8' ) ).hexdigest()
+
+
+    def is_fresh( self, entry, watermark ):
+        """True if a cache entry can be used without asking the server."""
+        return ( entry['watermark'] == watermark ) and ( time.time() - entry['fetched'] < self.max_age )
+
+
+    def _chunked( self, things, n=500 ):
+        # sqlite limits how many parameters a statement can have
+        for i in range( 0, len(things), n ):
+            yield things[i:i+n]
+
+
+    def _write( self, subdir, suffix, writer ):
+        # Write to a temp file and rename, so nobody ever sees a partial file
+        name = f"{subdir}/{uuid.uuid4().hex}{suffix}"
+        tmppath = self.directory / f"{name}.tmp"
+        writer( tmppath )
+        os.replace( tmppath, self.directory / name )
+        return name, ( self.directory / name ).stat().st_size
+
+
+    def _sweep( self ):
+        # Delete files that nothing refers to any more.  Call with _lock held, inside a transaction.
+        rows = self._db.execute( "SELECT file FROM files WHERE file NOT IN ( SELECT file FROM ltcv ) "
+                                 "AND file NOT IN ( SELECT file FROM query )" ).fetchall()
+        for row in rows:
+            self._db.execute( "DELETE FROM files WHERE file=?", ( row[0], ) )
+            ( self.directory / row[0] ).unlink( missing_ok=True )
+
+
+    def _evict( self ):
+        # Call with _lock held, inside a transaction
+        total = self._db.execute( "SELECT COALESCE(SUM(nbytes),0) FROM files" ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for name, nbytes in self._db.execute( "SELECT file, nbytes FROM files ORDER BY lastused" ).fetchall():
+            self._db.execute( "DELETE FROM ltcv WHERE file=?", ( name, ) )
+            self._db.execute( "DELETE FROM query WHERE file=?", ( name, ) )
+            self._db.execute( "DELETE FROM files WHERE file=?", ( name, ) )
+            ( self.directory / name ).unlink( missing_ok=True )
+            total -= nbytes
+            if total <= self.max_bytes:
+                break
+
+
+    def _touch( self, files ):
+        now = time.time()
+        self._db.executemany( "UPDATE files SET lastused=? WHERE file=?", [ ( now, f ) for f in files ] )
+
+
+    # ======================================================================
+    # Lightcurves
+
+    def ltcv_entries( self, paramkey, rootids ):
+        """Return { rootid: { 'file', 'etag', 'watermark', 'fetched' } } for the cached lightcurves in rootids."""
+        entries = {}
+        with self._lock:
+            for chunk in self._chunked( rootids ):
+                rows = self._db.execute( f"SELECT rootid, file, etag, watermark, fetched FROM ltcv "
+                                         f"WHERE paramkey=? AND rootid IN ({','.join( '?' * len(chunk) )})",
+                                         ( paramkey, *chunk ) ).fetchall()
+                for rootid, name, etag, watermark, fetched in rows:
+                    entries[rootid] = { 'file': name, 'etag': etag, 'watermark': watermark, 'fetched': fetched }
+        return entries
+
+
+    def load_ltcvs( self, entries ):
+        """Read lightcurves from the cache.
+
+        Parameters
+        ----------
+          entries : dict
+            { rootid: entry } from ltcv_entries
+
+        Returns
+        -------
+          dict of { rootid: lightcurve }, where each lightcurve is a
+          dict in the same form as returned by ltcv/getmanyltcvs.
+          Lightcurves whose file has disappeared (because another
+          process evicted it) aren't included.
+
+        """
+        import pyarrow.parquet
+
+        byfile = {}
+        for rootid, entry in entries.items():
+            byfile.setdefault( entry['file'], [] ).append( rootid )
+
+        ltcvs = {}
+        for name, rootids in byfile.items():
+            try:
+                tab = pyarrow.parquet.read_table( self.directory / name, filters=[ ( 'rootid', 'in', rootids ) ] )
+            except FileNotFoundError:
+                continue
+            cols = [ c for c in tab.column_names if c != 'rootid' ]
+            for rootid in rootids:
+                ltcvs[rootid] = { 'rootid': rootid, **{ c: [] for c in cols } }
+            data = tab.to_pydict()
+            for i, rootid in enumerate( data['rootid'] ):
+                lc = ltcvs[rootid]
+                for c in cols:
+                    lc[c].append( data[c][i] )
+
+        with self._lock, self._db:
+            self._touch( byfile.keys() )
+        return ltcvs
+
+
+    def store_ltcvs( self, paramkey, ltcvs, etags, watermark ):
+        """Add lightcurves to the cache, replacing any that were there.
+
+        Parameters
+        ----------
+          paramkey : str
+            From key()
+
+          ltcvs : list of dict
+            Lightcurves as returned by ltcv/getmanyltcvs
+
+          etags : dict of { rootid: etag }
+            Must have every rootid in ltcvs
+
+          watermark : str or None
+            The server's import watermark from before it got ltcvs
+
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        if len( ltcvs ) == 0:
+            return
+        columns = { 'rootid': [ str( lc['rootid'] ) for lc in ltcvs for _ in lc['mjd'] ] }
+        for col in ltcvs[0].keys():
+            if col != 'rootid':
+                columns[col] = [ v for lc in ltcvs for v in lc[col] ]
+        name, nbytes = self._write( "ltcvs", ".parquet",
+                                    lambda path: pyarrow.parquet.write_table( pyarrow.table( columns ), path ) )
+
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute( "INSERT INTO files(file, nbytes, lastused) VALUES (?,?,?)", ( name, nbytes, now ) )
+            self._db.executemany( "INSERT OR REPLACE INTO ltcv(paramkey, rootid, file, etag, watermark, fetched) "
+                                  "VALUES (?,?,?,?,?,?)",
+                                  [ ( paramkey, str( lc['rootid'] ), name, etags[str(lc['rootid'])], watermark, now )
+                                    for lc in ltcvs ] )
+            self._sweep()
+            self._evict()
+
+
+    def revalidated_ltcvs( self, paramkey, rootids, watermark ):
+        """Record that the server said these cached lightcurves haven't changed as of watermark."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany( "UPDATE ltcv SET watermark=?, fetched=? WHERE paramkey=? AND rootid=?",
+                                  [ ( watermark, now, paramkey, r ) for r in rootids ] )
+
+
+    def forget_ltcvs( self, paramkey, rootids ):
+        """Remove lightcurves from the cache (e.g. because the server doesn't have them any more)."""
+        if len( rootids ) == 0:
+            return
+        with self._lock, self._db:
+            self._db.executemany( "DELETE FROM ltcv WHERE paramkey=? AND rootid=?",
+                                  [ ( paramkey, r ) for r in rootids ] )
+            self._sweep()
+
+
+    # ======================================================================
+    # Short query results
+
+    def load_query( self, key, watermark ):
+        """Return the cached result for key, or None if it's not cached or isn't fresh (see is_fresh)."""
+        import pyarrow.parquet
+
+        with self._lock:
+            row = self._db.execute( "SELECT file, watermark, fetched FROM query WHERE key=?", ( key, ) ).fetchone()
+        if ( row is None ) or ( not self.is_fresh( { 'watermark': row[1], 'fetched': row[2] }, watermark ) ):
+            return None
+        try:
+            if row[0].endswith( ".parquet" ):
+                result = pyarrow.parquet.read_table( self.directory / row[0] )
+            else:
+                with open( self.directory / row[0] ) as ifp:
+                    result = json.load( ifp )
+        except FileNotFoundError:
+            return None
+        with self._lock, self._db:
+            self._touch( [ row[0] ] )
+        return result
+
+
+    def store_query( self, key, result, return_format, watermark ):
+        """Add a short query result to the cache, replacing what was there.
+
+        result is what FASTDBClient.submit_short_sql_query returned for
+        return_format; watermark is the server's import watermark from
+        before the query was run.
+
+        """
+        import pyarrow.parquet
+
+        if return_format == 'arrow':
+            name, nbytes = self._write( "queries", ".parquet",
+                                        lambda path: pyarrow.parquet.write_table( result, path ) )
+        else:
+            def writer( path ):
+                with open( path, "w" ) as ofp:
+                    json.dump( result, ofp )
+            name, nbytes = self._write( "queries", ".json", writer )
+
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute( "INSERT INTO files(file, nbytes, lastused) VALUES (?,?,?)", ( name, nbytes, now ) )
+            self._db.execute( "INSERT OR REPLACE INTO query(key, file, watermark, fetched) VALUES (?,?,?,?)",
+                              ( key, name, watermark, now ) )
+            self._sweep()
+            self._evict()
+
+
+    # ======================================================================
+    # Bookkeeping
+
+    def count( self, kind, hits=0, revalidated=0, misses=0 ):
+        """Add to the hit counts for kind ('ltcv' or 'query')."""
+        with self._lock, self._db:
+            self._db.execute( "INSERT INTO stats(kind, hits, revalidated, misses) VALUES (?,?,?,?) "
+                              "ON CONFLICT(kind) DO UPDATE SET hits=hits+excluded.hits, "
+                              "  revalidated=revalidated+excluded.revalidated, misses=misses+excluded.misses",
+                              ( kind, hits, revalidated, misses ) )
+
+
+    def stats( self ):
+        """Return cache statistics; see FASTDBClient.cache_stats."""
+        with self._lock:
+            files, nbytes = self._db.execute( "SELECT COUNT(*), COALESCE(SUM(nbytes),0) FROM files" ).fetchone()
+            nltcvs = self._db.execute( "SELECT COUNT(*) FROM ltcv" ).fetchone()[0]
+            nqueries = self._db.execute( "SELECT COUNT(*) FROM query" ).fetchone()[0]
+            rows = self._db.execute( "SELECT kind, hits, revalidated, misses FROM stats" ).fetchall()
+
+        retval = { 'files': files, 'bytes': nbytes, 'max_bytes': self.max_bytes, 'ltcvs': nltcvs,
+                   'queries': nqueries }
+        for kind in ( 'ltcv', 'query' ):
+            hits, revalidated, misses = next( ( r[1:] for r in rows if r[0] == kind ), ( 0, 0, 0 ) )
+            total = hits + revalidated + misses
+            retval[kind] = { 'hits': hits, 'revalidated': revalidated, 'misses': misses,
+                             'hit_rate': ( hits + revalidated ) / total if total > 0 else None }
+        return retval
+
+
+    def clear( self ):
+        """Empty the cache (and reset the statistics)."""
+        with self._lock, self._db:
+            for table in ( 'ltcv', 'query', 'stats' ):
+                self._db.execute( f"DELETE FROM {table}" )
+            self._sweep()
+
+
 class FASTDBClient:
     short_query_url = 'db/runsqlquery/'
     submit_long_query_url = 'db/submitsqlquery/'
     check_long_sql_query_url = 'db/checksqlquery/'
+    wait_long_sql_query_url = 'db/waitsqlquery/'
+    cancel_long_sql_query_url = 'db/cancelsqlquery/'
     get_long_sql_query_results_url = 'db/getsqlqueryresults/'
+    import_watermark_url = 'importwatermark'
+
+    # Reuse the server's import watermark for this many seconds before asking again
+    import_watermark_ttl = 60.
 
     def __init__( self, server, username=None, password=None, login=True,
                   verify=None, retries=None, retrysleep=None, retrysleepinc=None,
+                  cachedir=None, cache_max_gb=None, cache_max_age=None,
                   logger=None, info=True, debug=False, verify_ini_permissions=True ):
         """Create a client to connect to a fastdb server,
 
@@ -77,6 +437,22 @@ class FASTDBClient:
             default it will sleep 1, then 3, 5, 7, and 9 seconds after
             each try before finally failing.
 
+          cachedir: str or Path, default None (or what's in ~/.fastdb.ini)
+            If not None, keep a cache of lightcurves (from
+            get_many_ltcvs) and short query results (from
+            submit_short_sql_query) in this directory, so that getting
+            the same things again doesn't have to download them again
+            if they haven't changed.  See FASTDBCache.  Needs pyarrow.
+
+          cache_max_gb: float, default 10 (or what's in ~/.fastdb.ini)
+            Delete the least recently used things from the cache when
+            it's bigger than this many GiB.
+
+          cache_max_age: float, default 86400 (or what's in ~/.fastdb.ini)
+            Check with the server about anything in the cache that's
+            older than this many seconds, even if no sources have been
+            imported since it was cached.
+
           logger: logging.Logger or None
             A logger log object.  If not passed, the FASTDBClient will
             make its own.  Either way, it is accessible via the logger
@@ -116,6 +492,7 @@ class FASTDBClient:
         self.retries = 5
         self.retrysleep = 1.
         self.retrysleepinc = 2.
+        inicache = {}
 
         if ( server[:5] == "http:" ) or ( server[:6] == "https:" ):
             self.url = server
@@ -153,6 +530,9 @@ class FASTDBClient:
                 self.retrysleep = float( config[server]['retrysleep'] )
             if 'retrysleepinc' in config[server]:
                 self.retrysleepinc = float( config[server]['retrysleepinc'] )
+            for key in ( 'cachedir', 'cache_max_gb', 'cache_max_age' ):
+                if key in config[server]:
+                    inicache[key] = config[server][key]
 
         if verify is not None:
             self.verify = bool( verify )
@@ -163,12 +543,21 @@ class FASTDBClient:
         if retrysleepinc is not None:
             self.retrysleepinc = float( retrysleepinc )
 
+        cachedir = cachedir if cachedir is not None else inicache.get( 'cachedir' )
+        cache_max_gb = float( cache_max_gb if cache_max_gb is not None else inicache.get( 'cache_max_gb', 10. ) )
+        cache_max_age = float( cache_max_age if cache_max_age is not None else inicache.get( 'cache_max_age', 86400. ) )
+        self.cache = None
+        if cachedir is not None:
+            self.cache = FASTDBCache( cachedir, max_bytes=int( cache_max_gb * 2**30 ), max_age=cache_max_age )
+        self._watermark = None
+        self._watermark_time = None
+
         self.req = None
         if login:
             self.verify_logged_in()
 
 
-    def retry_send( self, url, data=None, json=None, method="post" ):
+    def retry_send( self, url, data=None, json=None, method="post", headers=None, stream=False ):
         """Send a python requests POST or GET to a web server with retries.
 
         You usually want to use .post(), or one of the more
@@ -188,6 +577,13 @@ class FASTDBClient:
           method : "get" or "post", default "post"
             Connection m ethod
 
+          headers : dict, default None
+            Extra HTTP headers to send.  Passed to python requests via headers=
+
+          stream : bool, default False
+            Passed to python requests via stream=.  If True, the body of
+            the response isn't downloaded until you read it.
+
         Returns
         -------
           Python requests Response object.  Will raise an exception if
@@ -203,12 +599,15 @@ class FASTDBClient:
             res = None
             try:
                 if method == 'post':
-                    res = self.req.post( url, data=data, json=json, verify=self.verify )
+                    res = self.req.post( url, data=data, json=json, headers=headers, stream=stream,
+                                         verify=self.verify )
                 elif method == 'get':
-                    res = self.req.get( url, data=data, json=json, verify=self.verify )
+                    res = self.req.get( url, data=data, json=json, headers=headers, stream=stream,
+                                        verify=self.verify )
                 else:
                     raise ValueError( f"Unknown method {method}, must be get or post" )
-                if res.status_code != 200:
+                # 206 is what you get back if you asked for a Range
+                if res.status_code not in ( 200, 206 ):
                     raise RuntimeError( f"Got status {res.status_code} trying to connect to {url}" )
                 if previous_fail:
                     dt = time.perf_counter() - t0
@@ -382,6 +781,55 @@ class FASTDBClient:
             raise NotImplementedError( "CSV return format not yet implemented." )
 
 
+    # ======================================================================
+    # The local cache
+
+    def import_watermark( self ):
+        """The time (an ISO string, or None) of the latest source import on the server.
+
+        Remembers what the server said for import_watermark_ttl seconds,
+        so it doesn't have to ask every time.
+
+        """
+        if ( self._watermark_time is None ) or ( time.monotonic() - self._watermark_time > self.import_watermark_ttl ):
+            data = self.post( self.import_watermark_url )
+            if ( 'status' not in data ) or ( data['status'] != 'ok' ):
+                raise RuntimeError( f"Unexpected response getting the import watermark: {data}" )
+            self._watermark = data['watermark']
+            self._watermark_time = time.monotonic()
+        return self._watermark
+
+
+    def cache_stats( self ):
+        """Statistics about the local cache.
+
+        Returns
+        -------
+          dict with keys:
+            files, bytes, max_bytes : the files in the cache, how big they
+              are in total, and how big the cache is allowed to get
+            ltcvs, queries : number of lightcurves and short query results
+              in the cache
+            ltcv, query : each a dict with keys hits (used without asking
+              the server about it), revalidated (the server said it
+              hadn't changed), misses (had to download it), and hit_rate
+              ( (hits+revalidated) / total, or None if nothing's been
+              asked for ).  These are totals since the cache was created
+              or last cleared, from all processes that use it.
+
+        """
+        if self.cache is None:
+            raise RuntimeError( "This client doesn't have a cache; pass cachedir when creating it" )
+        return self.cache.stats()
+
+
+    def clear_cache( self ):
+        """Delete everything from the local cache."""
+        if self.cache is None:
+            raise RuntimeError( "This client doesn't have a cache; pass cachedir when creating it" )
+        self.cache.clear()
+
+
     # ======================================================================
     # Methods for communicating with the db/ api for direct sql queries
 
@@ -407,7 +855,8 @@ class FASTDBClient:
         return retval
 
 
-    def submit_short_sql_query( self, query, subdict=None, return_format=0 ):
+    def submit_short_sql_query( self, query, subdict=None, return_format=0,
+                                max_rows=None, max_bytes=None, timeout=None, if_expensive=None, usecache=False ):
         """Get the results of a SQL query to FASDB that will take less than 5 minutes.
 
         Parameters
@@ -433,9 +882,40 @@ class FASTDBClient:
             with the same length as query.
 
 
-          return_format : int, default 0
+          return_format : int or str, default 0
             See "Returns" below.
 
+          max_rows, max_bytes, timeout : int, int, float, default None
+            Fail if the query returns more than max_rows rows, more than
+            (approximately) max_bytes bytes of data, or takes longer
+            than timeout seconds.  The server has its own limits on
+            these things (by default, 100000 rows, 100MB, and 300
+            seconds); you can ask for lower limits, but not higher
+            ones.  If your query needs more than that, use
+            submit_long_sql_query.
+
+          if_expensive : str, default None
+            The server estimates how expensive your query is before
+            running it, and won't run queries over some limit as short
+            queries.  If 'reject' (the server's default if this is
+            None), that's an error.  If 'long', the server submits the
+            query as a long query (with return format 'csv'), and this
+            raises a SubmittedAsLongQuery exception whose queryid
+            attribute you can use with check_long_sql_query and
+            get_long_sql_query_result.
+
+          usecache : bool, default False
+            Ignored if this client doesn't have a cache (see cachedir
+            in the constructor).  Otherwise, if you've run this exact
+            query before, and no sources have been imported since then,
+            and it was less than cache_max_age seconds ago, you get the
+            result from the cache rather than running the query again.
+            Only the import of sources is tracked, so only set this to
+            True for queries that read nothing but the source, object,
+            and lightcurve tables; the results of a query of anything
+            else (e.g. spectrum information or query_queue) could come
+            from the cache after they've changed.
+
         Returns
         -------
           Depending on the value return_format:
@@ -451,22 +931,61 @@ class FASTDBClient:
             query, or fromt he last query in the list if a list of
             queries was sent.
 
+          'arrow' : a pyarrow.Table.  (The server sends the data in a
+            compact binary form, so this is the fastest way to get
+            large results, especially numeric ones.  You need pyarrow
+            installed.)
+
         """
 
         json = self._parse_query( query, subdict, return_format )
+        for key, val in ( ( 'max_rows', max_rows ), ( 'max_bytes', max_bytes ), ( 'timeout', timeout ),
+                          ( 'if_expensive', if_expensive ) ):
+            if val is not None:
+                json[key] = val
+
+        if ( self.cache is None ) or ( not usecache ):
+            return self._run_short_sql_query( json, return_format )
+
+        key = FASTDBCache.key( self.short_query_url, json )
+        watermark = self.import_watermark()
+        result = self.cache.load_query( key, watermark )
+        if result is not None:
+            self.cache.count( 'query', hits=1 )
+            return result
+        result = self._run_short_sql_query( json, return_format )
+        self.cache.store_query( key, result, return_format, watermark )
+        self.cache.count( 'query', misses=1 )
+        return result
+
+
+    def _run_short_sql_query( self, json, return_format ):
+        if return_format == 'arrow':
+            res = self.post( self.short_query_url, json=json, return_format='raw' )
+            if res.headers.get( 'Content-Type', '' )[:16] == 'application/json':
+                data = res.json()
+                if ( 'status' in data ) and ( data['status'] == 'long' ):
+                    raise SubmittedAsLongQuery( data['queryid'], data['cost'] )
+                raise RuntimeError( f"Got an error from the server: {data['error'] if 'error' in data else data}" )
+            import pyarrow
+            return pyarrow.ipc.open_stream( res.content ).read_all()
+
         data = self.post( self.short_query_url, json=json )
 
         if 'status' not in data.keys():
             raise ValueError( "Unexpected response, no 'status' in return value" )
         elif data['status'] == 'error':
             raise RuntimeError( f"Got an error from the server: {data['error']}" )
+        elif data['status'] == 'long':
+            raise SubmittedAsLongQuery( data['queryid'], data['cost'] )
         elif data['status'] != 'ok':
             raise RuntimeError( f"status is {data['status']} and I don't know how to cope" )
         else:
             return data['rows'] if return_format == 0  else data['data']
 
 
-    def submit_long_sql_query( self, query, subdict=None, return_format='csv' ):
+    def submit_long_sql_query( self, query, subdict=None, return_format='csv', usecache=False, parallel=None,
+                               priority=None, timeout=None, work_mem=None ):
         """Submit a long SQL query to FASTDB
 
         FASTDB will queue the query and run it sometime.  Run
@@ -480,6 +999,48 @@ class FASTDBClient:
           return_format : str, default 'csv'
             The format of the returned data.  Right now, must be 'csv'.
 
+          usecache : bool, default False
+            If True, and somebody has recently run the same query (and
+            no new sources have been imported since), FASTDB gives you
+            the results of that query rather than running it again.
+            Only the import of sources is tracked, so only set this for
+            queries that read nothing but the source, object, and
+            lightcurve tables, and that don't use things like now() or
+            random(); otherwise, you could get out-of-date results.
+
+          parallel : dict, default None
+            For queries that go through all (or a lot) of a big table.
+            If given, the server splits the query into parts that are
+            run at the same time (all seeing the same state of the
+            database).  The last query must have {FASTDB_PARTITION}
+            where the condition that selects each part's rows goes,
+            e.g. "SELECT * FROM diasource WHERE {FASTDB_PARTITION}".
+            The dict has:
+              nworkers : int ; number of parts (2 to 8, default 8)
+              splitby : str ; 'rootid' (default) to split by a hash of
+                rootid, or 'q3c' to split by ranges of q3c ipix
+              column : str ; the column (or expression) to split by;
+                defaults to 'rootid' or 'q3c_ang2ipix(ra,dec)'
+            get_long_sql_query_result() returns the parts separately.
+            (csv parts don't have the pandas index column that the csv
+            results of ordinary long queries have.)
+
+          priority : str, default None
+            'low', 'normal', or 'high'.  Higher priority queries are run
+            first.  If None, the server uses 'normal'.  Most users
+            aren't allowed to ask for 'high'.
+
+          timeout : float, default None
+            The query will be cancelled if any one SQL statement takes
+            longer than this many seconds.  If None, the server uses
+            its default (an hour).  There's a maximum that depends on
+            the user.
+
+          work_mem : int, default None
+            Memory (MB) the database may use for each sort or hash
+            operation in the query.  If None, the database default.
+            There's a maximum that depends on the user.
+
         Returns
         -------
           queryid: str
@@ -491,6 +1052,13 @@ class FASTDBClient:
         """
 
         json = self._parse_query( query, subdict, return_format )
+        if usecache:
+            json['usecache'] = True
+        if parallel is not None:
+            json['parallel'] = parallel
+        for key, val in ( ( 'priority', priority ), ( 'timeout', timeout ), ( 'work_mem', work_mem ) ):
+            if val is not None:
+                json[key] = val
         data = self.post( self.submit_long_query_url, json=json )
 
         if 'status' not in data.keys():
@@ -531,6 +1099,15 @@ class FASTDBClient:
                 error: an error message
                 ...there may also, but won't always, be a key 'started' with the time the query started
 
+            Once the query has started, there's also a key 'progress',
+            a dict with:
+                rows: number of rows fetched so far
+                bytes: number of bytes of results written so far
+                estimated_rows: the database's guess at the total number of rows (or None)
+                fraction: rows / estimated_rows (or None); only as good as the guess
+                updated: when rows and bytes were last updated (or None)
+            These are updated every several seconds while the query runs.
+
         """
 
         result = self.post( f"{self.check_long_sql_query_url}{queryid}/" )
@@ -539,42 +1116,260 @@ class FASTDBClient:
         return result
 
 
-    def get_long_sql_query_result( self, queryid ):
+    def wait_long_sql_query( self, queryid, timeout=30, status=None ):
+        """Wait for a long SQL query to change status.
+
+        The server holds on to the request until the query's status
+        changes, so you find out as soon as it does, without having to
+        check over and over again.
+
+        Parameters
+        ----------
+          queryid : str
+            The string returned by submit_long_sql_query
+
+          timeout : float, default 30
+            Wait at most this many seconds.  (The server has its own
+            maximum, 60 seconds by default.)
+
+          status : str, default None
+            The status you last saw (e.g. from check_long_sql_query).
+            Returns as soon as the query's status is something else.
+            If None, returns as soon as the query's status is
+            different from what it is when the server gets the request.
+
+        Returns
+        -------
+          dict : the same as check_long_sql_query.  If the status is
+            the same as status, the wait timed out.  If the query is
+            already finished (or errored out), returns right away.  If
+            the server already has as many requests waiting as it
+            allows, it returns right away, with 'busy' True in the
+            dict; check back later (or use check_long_sql_query).
+
+        """
+
+        result = self.post( f"{self.wait_long_sql_query_url}{queryid}/",
+                            json={ 'timeout': timeout, **( { 'status': status } if status is not None else {} ) } )
+        if 'status' not in result.keys():
+            raise ValueError( "Unexpected response, no 'status' in return value" )
+        return result
+
+
+    def cancel_long_sql_query( self, queryid ):
+        """Cancel a long SQL query that's queued or running.
+
+        After this, check_long_sql_query will give the query a status
+        of 'error' (with 'cancelled' True).
+
+        Parameters
+        ----------
+          queryid : str
+            The string returned by submit_long_sql_query
+
+        Returns
+        -------
+          str : 'queued' or 'running', what the query was doing when it was cancelled
+
+        """
+
+        data = self.post( f"{self.cancel_long_sql_query_url}{queryid}/" )
+        if 'status' not in data.keys():
+            raise ValueError( "Unexpected response, no 'status' in return value" )
+        elif data['status'] == 'error':
+            raise RuntimeError( f"Got an error from the server: {data['error']}" )
+        self.logger.info( f"Cancelled query {queryid}, which was {data['was']}" )
+        return data['was']
+
+
+    def get_long_sql_query_result( self, queryid, outfile=None, compress=False ):
         """Get the results of a finished long sql query.
 
         Only call this after you've called check_long_sql_query on this
-        queryid and have received a status of 'sinished'
+        queryid and have received a status of 'finished'
+
+        The results are streamed from the server.  If the download is
+        interrupted, it's resumed from where it left off (up to the
+        number of retries configured for this FASTDBClient).  If the
+        server knows the checksum of the results, what was downloaded
+        is checked against it.
 
         Parameters
         ----------
           queryid : str
             The string returned by submit_long_sql_query
 
+          outfile : str or pathlib.Path, default None
+            If given, write the results to this file instead of
+            returning them.  This is what you want for big results, as
+            they're never all in memory at once.  If the file already
+            exists and is shorter than the results, it's assumed to be
+            the start of the results from an earlier, interrupted call
+            to this function, and only the rest is downloaded.  (If it
+            turns out not to be, the checksum won't match, and you'll
+            get an exception; the file is then deleted, so trying again
+            will start over.)
+
+          compress : bool, default False
+            Ask the server to gzip the results on the fly.  This helps
+            for csv results if your network connection is slow.  (It's
+            ignored when resuming a download.)
+
         Returns
         -------
-          str or binary blob
-            The results of the query.  The nature of these results
-            depend on the on the return_format parameter you passed to
-            submit_long_sql_query.
+          str, binary blob, or pathlib.Path
+            If outfile is None, the results of the query.  The nature of
+            these results depend on the on the return_format parameter
+            you passed to submit_long_sql_query.  If outfile is not
+            None, outfile (as a pathlib.Path).
 
             If you passed a sequence of queries to submit_long_sql_query,
             this will be the result of the last query in the list.
 
+          list
+            If the query was submitted with parallel, a list with the
+            results of each part, as above.  In this case, outfile is a
+            directory (created if necessary); the parts are written to
+            files part_000, part_001, etc. in it, along with the
+            server's manifest.json describing the parts, and the list
+            has the paths of the part files.
+
         """
 
-        result = self.post( f"{self.get_long_sql_query_results_url}{queryid}/", return_format='raw' )
-        ctype = result.headers[ 'content-type' ]
-        if ctype == 'text/csv; charset=utf-8':
-            return result.text
+        info = self.check_long_sql_query( queryid )
+        if info['status'] != 'finished':
+            raise RuntimeError( f"Query {queryid} status is {info['status']}, not finished" )
+        size = info['result_size'] if 'result_size' in info else None
+        sha256 = info['result_sha256'] if 'result_sha256' in info else None
+
+        if ( 'parallel' in info ) and ( info['parallel'] is not None ):
+            return self._get_parallel_long_sql_query_result( queryid, size, sha256, outfile, compress )
+
+        ctype, result = self._fetch_long_sql_query_result( queryid, outfile, size, sha256, compress )
+        return result if outfile is None else pathlib.Path( outfile )
+
+
+    def _get_parallel_long_sql_query_result( self, queryid, size, sha256, outfile, compress ):
+        # The results of a parallel query are a manifest and its parts.  Returns
+        #   a list of the parts' results (or files, if outfile is not None, in
+        #   which case outfile is a directory that also gets manifest.json).
+        ctype, manifest = self._fetch_long_sql_query_result( queryid, None, size, sha256, False )
+        if ctype != 'application/json':
+            raise TypeError( f"Expected the manifest of parallel query {queryid}, but got {ctype}" )
+        manifest = json.loads( manifest )
+
+        if outfile is not None:
+            outdir = pathlib.Path( outfile )
+            outdir.mkdir( parents=True, exist_ok=True )
+            with open( outdir / "manifest.json", "w" ) as ofp:
+                json.dump( manifest, ofp, indent=2 )
+
+        results = []
+        for part in manifest['parts']:
+            partfile = None if outfile is None else outdir / f"part_{part['part']:03d}"
+            self.logger.debug( f"Getting part {part['part']} of {len(manifest['parts'])} of query {queryid}" )
+            ctype, result = self._fetch_long_sql_query_result( queryid, partfile, part['size'], part['sha256'],
+                                                               compress, part=part['part'] )
+            results.append( result if outfile is None else partfile )
+        return results
+
+
+    def _fetch_long_sql_query_result( self, queryid, outfile, size, sha256, compress, part=None ):
+        # Download (or resume downloading) and verify the results of a query, or one
+        #   part of the results of a parallel query, to outfile.  Returns ( content
+        #   type, results ), where results is None if outfile is not None.
+        if outfile is None:
+            fileobj = io.BytesIO()
+            pos = 0
+        else:
+            outfile = pathlib.Path( outfile )
+            pos = outfile.stat().st_size if outfile.is_file() else 0
+            if ( size is None ) or ( pos > size ):
+                # Can't resume, start over
+                pos = 0
+            fileobj = open( outfile, "r+b" if pos > 0 else "w+b" )
+
+        badfile = False
+        try:
+            fileobj.seek( pos )
+            fileobj.truncate()
+            ctype = self._download_long_sql_query_result( queryid, fileobj, pos, size, compress, part=part )
+
+            if sha256 is not None:
+                fileobj.seek( 0 )
+                sha = hashlib.sha256()
+                while len( data := fileobj.read( 4 * 1024 * 1024 ) ) > 0:
+                    sha.update( data )
+                if sha.hexdigest() != sha256:
+                    badfile = True
+                    raise RuntimeError( f"Checksum of downloaded results of query {queryid} is {sha.hexdigest()}, "
+                                        f"but the server says it should be {sha256}" )
+        finally:
+            if outfile is not None:
+                fileobj.close()
+                # (A partial download is kept so that it can be resumed, but not a bad one.)
+                if badfile:
+                    outfile.unlink()
+
+        if outfile is not None:
+            return ctype, None
+
+        if ( ctype == 'text/csv; charset=utf-8' ) or ( ctype == 'application/json' ):
+            return ctype, fileobj.getvalue().decode( 'utf-8' )
         elif ctype == 'application/octet-stream':
-            return result.content
+            return ctype, fileobj.getvalue()
         else:
             raise TypeError( f"Got unknown type {ctype}, expected 'text/csv; charset=utf-8' "
                              f"or 'application/octet-stream'" )
 
 
+    def _download_long_sql_query_result( self, queryid, fileobj, pos, size, compress, part=None ):
+        # Write the results of the query, from byte pos onwards, to fileobj
+        #   (which is already positioned at pos).  Returns the content type
+        #   of the results, or None if there was nothing left to download.
+        if ( pos > 0 ) and ( size is not None ) and ( pos >= size ):
+            return None
+
+        self.verify_logged_in()
+        slash = '/' if self.url[-1] != '/' else ''
+        url = f'{self.url}{slash}{self.get_long_sql_query_results_url}{queryid}/'
+        if part is not None:
+            url += f'{part}/'
+        sleeptime = self.retrysleep
+        for tries in range( self.retries + 1 ):
+            headers = { 'Range': f'bytes={pos}-' } if pos > 0 else None
+            res = self.retry_send( url, json={ 'compress': compress and ( pos == 0 ) }, headers=headers,
+                                   stream=True )
+            try:
+                if ( pos > 0 ) and ( res.status_code != 206 ):
+                    self.logger.warning( "Server didn't honor the Range request, starting download over" )
+                    pos = 0
+                    fileobj.seek( 0 )
+                    fileobj.truncate()
+                ctype = res.headers[ 'content-type' ]
+                # iter_content undoes any Content-Encoding: gzip
+                for data in res.iter_content( chunk_size=1024 * 1024 ):
+                    fileobj.write( data )
+                    pos += len( data )
+                if ( size is not None ) and ( pos != size ):
+                    raise requests.exceptions.ChunkedEncodingError( f"Download ended after {pos} of {size} bytes" )
+                return ctype
+            except ( requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError ) as ex:
+                if tries == self.retries:
+                    self.logger.error( f"Download of the results of query {queryid} failed after "
+                                       f"{self.retries} retries, giving up." )
+                    raise
+                self.logger.warning( f"Download of the results of query {queryid} interrupted after {pos} bytes "
+                                     f"({ex}); sleeping {sleeptime} seconds and resuming" )
+                time.sleep( sleeptime )
+                sleeptime += self.retrysleepinc
+            finally:
+                res.close()
+
+
     def synchronous_long_sql_query( self, query, subdict=None, return_format='csv',
-                                    checkeach=300, maxwait=3600 ):
+                                    checkeach=300, maxwait=3600, outfile=None, usecache=False, parallel=None,
+                                    priority=None, timeout=None, work_mem=None ):
         """Get the result of an SQL query to FASDB.
 
         If the query will take less than 5 minutes, use submit_short_sql_query() instead.
@@ -585,12 +1380,16 @@ class FASTDBClient:
 
         Parameters
         ----------
-          query, subdict, return_format : same as what's passed to submit_long_sql_query()
+          query, subdict, return_format, usecache, parallel, priority, timeout, work_mem :
+            same as what's passed to submit_long_sql_query()
 
           checkeach: int, default 300
-            After submitting the query, wait this many seconds before
-            checking to see if it's done.  If it's not, wait again,
-            check again, etc.
+            Normally, this waits for the query on the server (see
+            wait_long_sql_query()), so finds out as soon as the query
+            is done.  If the server can't do that, it checks on the
+            query instead, first after about a second, and then waiting
+            about twice as long each time, but never more than
+            checkeach seconds.
 
           maxwait: int, default 3600
             Wait at most this many seconds for the query to finish
@@ -598,20 +1397,42 @@ class FASTDBClient:
             complete the query after this wait time, but you won't have
             a way of getting the result.
 
+          outfile: str or pathlib.Path, default None
+            Passed on to get_long_sql_query_result().
+
         Returns
         -------
           Same as what get_long_sql_query_result() returns
 
         """
 
-        queryid = self.submit_long_sql_query( query, subdict, return_format )
+        queryid = self.submit_long_sql_query( query, subdict, return_format, usecache=usecache, parallel=parallel,
+                                              priority=priority, timeout=timeout, work_mem=work_mem )
 
         t0 = time.perf_counter()
         done = False
         totwait = 0
+        status = None
+        usewait = True
+        delay = min( 1., checkeach )
         while ( not done ) and ( totwait < maxwait ):
-            time.sleep( checkeach )
-            data = self.check_long_sql_query( queryid )
+            data = None
+            if usewait:
+                try:
+                    data = self.wait_long_sql_query( queryid, timeout=max( 1., min( 30., maxwait - totwait ) ),
+                                                     status=status )
+                    if data.get( 'busy', False ) and ( data['status'] == status ):
+                        # The server didn't wait; check back after a delay, as if we weren't waiting
+                        data = None
+                except RuntimeError as ex:
+                    self.logger.warning( f"Couldn't wait for the query on the server ({ex}), "
+                                         f"checking on it every so often instead." )
+                    usewait = False
+            if data is None:
+                # Back off exponentially, with jitter so that lots of clients don't all check at once
+                time.sleep( max( 0., min( random.uniform( 0.5, 1. ) * delay, maxwait - totwait ) ) )
+                delay = min( 2. * delay, checkeach )
+                data = self.check_long_sql_query( queryid )
 
             if data['status'] == 'error':
                 strio = io.StringIO()
@@ -626,6 +1447,9 @@ class FASTDBClient:
                                   f"and finished at {data['finished']}" )
                 done = True
 
+            elif data['status'] == status:
+                pass
+
             elif data['status'] == 'started':
                 self.logger.info( f"Long query started at {data['started']} and is still in progress." )
 
@@ -635,10 +1459,242 @@ class FASTDBClient:
             else:
                 raise ValueError( f'Unexpected value of data["status"]: "{data["status"]}"' )
 
+            status = data['status']
             totwait = time.perf_counter() - t0
 
         if not done:
             raise RuntimeError( f"Query failed to complete within {totwait} seconds." )
 
         self.logger.info( f"Got long query result after {totwait} seconds." )
-        return self.get_long_sql_query_result( queryid )
+        return self.get_long_sql_query_result( queryid, outfile=outfile )
+
+
+    # ======================================================================
+    # Methods for communicating with the ltcv/ api
+
+    def get_many_ltcvs( self, objids, procver=None, return_format='pandas', chunksize=1000, nworkers=4,
+                        usecache=True, **kwargs ):
+        """Get the lightcurves of lots of objects.
+
+        Splits objids into chunks of at most chunksize objects, sends
+        one ltcv/getmanyltcvs request for each chunk (up to nworkers at
+        a time, over this client's logged-in session, each retried as
+        configured when the client was created), and puts the results
+        together.  Use this rather than sending getmanyltcvs yourself
+        when you want more than a few hundred lightcurves; one huge
+        request will probably time out.
+
+        Parameters
+        ----------
+          objids : list of int or list of str/uuid
+            The diaobjectids or rootids of the objects you want
+            lightcurves for.  (You can't mix them.)
+
+          procver : str, default None
+            The processing version to get lightcurves from.  If None,
+            uses the server's default.
+
+          return_format : str, default 'pandas'
+            One of 'pandas', 'arrow', or 'json'; see Returns.  You need
+            pandas installed for 'pandas', and pyarrow for 'arrow'.
+
+          chunksize : int, default 1000
+            Send at most this many objects in each request.
+
+          nworkers : int, default 4
+            Have at most this many requests going at once.
+
+          usecache : bool, default True
+            Ignored if this client doesn't have a cache (see cachedir
+            in the constructor).  Otherwise, lightcurves that are in
+            the cache are only downloaded again if they've changed.
+            Only works if objids are rootids, and you didn't ask for
+            return_object_info; otherwise, the cache isn't used.
+
+          **kwargs : passed on to ltcv/getmanyltcvs (e.g. bands, which,
+            mjd_now, return_object_info).  See the documentation on that
+            endpoint.
+
+        Returns
+        -------
+          ltcvs, or ( ltcvs, objinfo ) if return_object_info is true.
+
+          If return_format is 'json', ltcvs is the list you'd get from
+          getmanyltcvs, and objinfo is a dict of column: list.
+
+          If return_format is 'pandas', ltcvs is a pandas.DataFrame
+          indexed by ( rootid, mjd ), and objinfo is a DataFrame indexed
+          by diaobjectid.
+
+          If return_format is 'arrow', ltcvs and objinfo are
+          pyarrow.Tables; ltcvs has rootid and mjd as ordinary columns.
+
+          Lightcurves are in the order of the chunks of objids they came
+          back from.  If the same object comes back from more than one
+          chunk (which can happen if you pass diaobjectids, since
+          several can have the same rootid), you only get it once.
+
+        """
+
+        if return_format not in ( 'pandas', 'arrow', 'json' ):
+            raise ValueError( f"return_format must be pandas, arrow, or json, not {return_format}" )
+        if ( chunksize < 1 ) or ( nworkers < 1 ):
+            raise ValueError( "chunksize and nworkers must both be at least 1" )
+        objids = [ str(o) if isinstance( o, ( str, uuid.UUID ) ) else int(o) for o in objids ]
+        if len( objids ) == 0:
+            raise ValueError( "No objids given" )
+
+        if ( self.cache is not None ) and usecache:
+            try:
+                rootids = [ str( uuid.UUID( o ) ) for o in objids ]
+            except ( TypeError, ValueError, AttributeError ):
+                rootids = None
+            if kwargs.get( 'return_object_info' ):
+                self.logger.debug( "Not using the cache, because of return_object_info" )
+            elif rootids is None:
+                self.logger.debug( "Not using the cache, because objids aren't rootids" )
+            else:
+                ltcvs = self._get_many_ltcvs_cached( rootids, procver, chunksize, nworkers, kwargs )
+                return self._ltcvs_as( ltcvs, None, return_format )
+
+        url = 'ltcv/getmanyltcvs' if procver is None else f'ltcv/getmanyltcvs/{procver}'
+        chunks = [ objids[i:i+chunksize] for i in range( 0, len(objids), chunksize ) ]
+
+        t0 = time.perf_counter()
+        results = self._post_chunks( url, chunks, nworkers, lambda chunk: { 'objids': chunk, **kwargs } )
+        dt = time.perf_counter() - t0
+
+        ltcvs = []
+        seen = set()
+        for res in results:
+            for lc in ( res['ltcvs'] if isinstance( res, dict ) else res ):
+                if lc['rootid'] not in seen:
+                    seen.add( lc['rootid'] )
+                    ltcvs.append( lc )
+
+        objinfo = None
+        if any( isinstance( res, dict ) for res in results ):
+            objinfo = {}
+            seen = set()
+            for res in results:
+                chunkinfo = res['objinfo']
+                for i, diaobjectid in enumerate( chunkinfo.get( 'diaobjectid', [] ) ):
+                    if diaobjectid not in seen:
+                        seen.add( diaobjectid )
+                        for key, val in chunkinfo.items():
+                            objinfo.setdefault( key, [] ).append( val[i] )
+
+        npoints = sum( len( lc['mjd'] ) for lc in ltcvs )
+        self.logger.info( f"Got {len(ltcvs)} lightcurves ({npoints} points) for {len(objids)} objects "
+                          f"in {len(chunks)} requests in {dt:.2f} s "
+                          f"({len(objids)/dt:.0f} objects/s, {npoints/dt:.0f} points/s)" )
+
+        return self._ltcvs_as( ltcvs, objinfo, return_format )
+
+
+    def _post_chunks( self, url, chunks, nworkers, makejson ):
+        # Post makejson( chunk ) to url for each chunk, up to nworkers at a time; returns the responses, in order
+        nworkers = min( nworkers, len(chunks) )
+        if nworkers == 0:
+            return []
+
+        # Log in once here rather than in each thread.  The session's
+        #   connection pool has to be big enough for all the threads, or
+        #   connections get thrown away and remade.
+        self.verify_logged_in()
+        if nworkers > requests.adapters.DEFAULT_POOLSIZE:
+            self.req.mount( self.url, requests.adapters.HTTPAdapter( pool_maxsize=nworkers ) )
+
+        def post_chunk( chunk ):
+            return self.post( url, json=makejson( chunk ), verifyloggedin=False )
+
+        if nworkers == 1:
+            return [ post_chunk( c ) for c in chunks ]
+        with concurrent.futures.ThreadPoolExecutor( max_workers=nworkers ) as executor:
+            return list( executor.map( post_chunk, chunks ) )
+
+
+    def _get_many_ltcvs_cached( self, rootids, procver, chunksize, nworkers, kwargs ):
+        # The cached version of get_many_ltcvs.  Lightcurves that are
+        #   fresh in the cache (see FASTDBCache.is_fresh) aren't asked
+        #   for at all.  The rest are asked for with ltcv/getchangedltcvs,
+        #   sending the etags of the ones we have, so the server only
+        #   sends back the ones that have changed.
+        paramkey = FASTDBCache.key( 'ltcv/getmanyltcvs', procver, kwargs )
+        rootids = list( dict.fromkeys( rootids ) )
+        url = 'ltcv/getchangedltcvs' if procver is None else f'ltcv/getchangedltcvs/{procver}'
+        t0 = time.perf_counter()
+
+        watermark = self.import_watermark()
+        entries = self.cache.ltcv_entries( paramkey, rootids )
+        fresh = { r: e for r, e in entries.items() if self.cache.is_fresh( e, watermark ) }
+        ltcvs = self.cache.load_ltcvs( fresh )
+        hits = len( ltcvs )
+        revalidated = 0
+        misses = 0
+
+        # The second time around is for lightcurves the server said
+        #   hadn't changed, but were evicted (by another process) before
+        #   we could read them.
+        tofetch = [ r for r in rootids if r not in ltcvs ]
+        for known in ( entries, {} ):
+            chunks = [ tofetch[i:i+chunksize] for i in range( 0, len(tofetch), chunksize ) ]
+            results = self._post_chunks( url, chunks, nworkers,
+                                         lambda chunk: { 'objids': chunk,
+                                                         'etags': { r: known[r]['etag'] for r in chunk if r in known },
+                                                         **kwargs } )
+            unchanged = {}
+            for chunk, res in zip( chunks, results ):
+                if ( 'status' not in res ) or ( res['status'] != 'ok' ):
+                    raise RuntimeError( f"Unexpected response from {url}: {res}" )
+                for lc in res['ltcvs']:
+                    lc['rootid'] = str( lc['rootid'] )
+                    ltcvs[ lc['rootid'] ] = lc
+                misses += len( res['ltcvs'] )
+                self.cache.store_ltcvs( paramkey, res['ltcvs'], res['etags'], res['watermark'] )
+                chunkunchanged = [ r for r in chunk if ( r in res['etags'] ) and ( r not in ltcvs ) ]
+                self.cache.revalidated_ltcvs( paramkey, chunkunchanged, res['watermark'] )
+                gone = [ r for r in chunk if ( r in known ) and ( r not in res['etags'] ) ]
+                self.cache.forget_ltcvs( paramkey, gone )
+                unchanged.update( { r: known[r] for r in chunkunchanged } )
+            loaded = self.cache.load_ltcvs( unchanged )
+            ltcvs.update( loaded )
+            revalidated += len( loaded )
+            tofetch = [ r for r in unchanged if r not in loaded ]
+            if len( tofetch ) == 0:
+                break
+
+        self.cache.count( 'ltcv', hits=hits, revalidated=revalidated, misses=misses )
+        dt = time.perf_counter() - t0
+        self.logger.info( f"Got {len(ltcvs)} lightcurves for {len(rootids)} objects in {dt:.2f} s: "
+                          f"{hits} from the cache, {revalidated} unchanged since cached, {misses} downloaded" )
+        return [ ltcvs[r] for r in rootids if r in ltcvs ]
+
+
+    def _ltcvs_as( self, ltcvs, objinfo, return_format ):
+        # Turn a list of lightcurves (and objinfo) from getmanyltcvs into what get_many_ltcvs returns
+        if return_format != 'json':
+            # Turn the list of lightcurves into one set of columns
+            columns = {}
+            if len( ltcvs ) > 0:
+                columns['rootid'] = [ lc['rootid'] for lc in ltcvs for _ in lc['mjd'] ]
+                for key in ltcvs[0].keys():
+                    if key != 'rootid':
+                        columns[key] = [ v for lc in ltcvs for v in lc[key] ]
+
+            if return_format == 'pandas':
+                import pandas
+                ltcvs = pandas.DataFrame( columns )
+                if len( columns ) > 0:
+                    ltcvs.set_index( [ 'rootid', 'mjd' ], inplace=True )
+                if objinfo is not None:
+                    objinfo = pandas.DataFrame( objinfo )
+                    if len( objinfo ) > 0:
+                        objinfo.set_index( 'diaobjectid', inplace=True )
+            else:
+                import pyarrow
+                ltcvs = pyarrow.table( columns )
+                if objinfo is not None:
+                    objinfo = pyarrow.table( objinfo )
+
+        return ltcvs if objinfo is None else ( ltcvs, objinfo )
@@ -0,0 +1,42 @@
+-- Cached counts of things per processing version, so /count doesn't
+--   have to do a full DISTINCT ON count every time.
+-- tablename is one of 'rootid', 'diaobject', 'diasource', 'diaforcedsource'
+--   (i.e. the things that webserver/server.py::CountThings knows how to count).
+-- Rows are created by db.RowCount.reconcile (which computes an exact count),
+--   and then incremented by the importers and loaders as they commit rows.
+--   The increments can drift from the truth (e.g. rows that are shadowed by
+--   a higher-priority base processing version, or rows deleted by hand), so
+--   services/row_count_reconciler.py periodically recomputes them and logs
+--   any drift to row_count_reconciliation.
+
+CREATE TABLE row_counts(
+  procver_id UUID NOT NULL,
+  tablename text NOT NULL,
+  nrows bigint,
+  updated_at timestamp with time zone NOT NULL DEFAULT NOW(),
+  reconciled_at timestamp with time zone
+);
+ALTER TABLE row_counts ADD CONSTRAINT pk_row_counts PRIMARY KEY( procver_id, tablename );
+ALTER TABLE row_counts ADD CONSTRAINT fk_row_counts_procver
+  FOREIGN KEY (procver_id) REFERENCES processing_version(id)
+  ON DELETE CASCADE;
+COMMENT ON COLUMN row_counts.nrows IS 'NULL means the first exact count is still being computed';
+
+CREATE TABLE row_count_reconciliation(
+  procver_id UUID NOT NULL,
+  tablename text NOT NULL,
+  t timestamp with time zone NOT NULL DEFAULT NOW(),
+  previous_nrows bigint,
+  nrows bigint NOT NULL,
+  drift bigint,
+  duration double precision
+);
+COMMENT ON COLUMN row_count_reconciliation.previous_nrows IS 'Incrementally maintained count before reconciliation';
+COMMENT ON COLUMN row_count_reconciliation.nrows IS 'Exact count';
+COMMENT ON COLUMN row_count_reconciliation.drift IS 'previous_nrows - nrows (NULL if there was no previous count)';
+COMMENT ON COLUMN row_count_reconciliation.duration IS 'Seconds the exact count took';
+CREATE INDEX idx_row_count_reconciliation_procver_table ON row_count_reconciliation( procver_id, tablename );
+CREATE INDEX idx_row_count_reconciliation_t ON row_count_reconciliation( t );
+ALTER TABLE row_count_reconciliation ADD CONSTRAINT fk_row_count_reconciliation_procver
+  FOREIGN KEY (procver_id) REFERENCES processing_version(id)
+  ON DELETE CASCADE;
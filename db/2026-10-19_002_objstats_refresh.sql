@@ -0,0 +1,17 @@
+-- When the objstats_<procver> and objstatscomb_<procver> materialized
+--   views (see ltcv.create_object_stats_materialized_view) were last
+--   built or refreshed.  The views are a snapshot of the database as of
+--   refreshed_at; ltcv.object_search reports this so that clients know
+--   how stale the answer is.
+
+CREATE TABLE objstats_refresh(
+  procver_id UUID NOT NULL,
+  refreshed_at timestamp with time zone NOT NULL,
+  duration double precision
+);
+ALTER TABLE objstats_refresh ADD CONSTRAINT pk_objstats_refresh PRIMARY KEY( procver_id );
+ALTER TABLE objstats_refresh ADD CONSTRAINT fk_objstats_refresh_procver
+  FOREIGN KEY (procver_id) REFERENCES processing_version(id)
+  ON DELETE CASCADE;
+COMMENT ON COLUMN objstats_refresh.refreshed_at IS 'Start of the transaction that last built or refreshed the views';
+COMMENT ON COLUMN objstats_refresh.duration IS 'Seconds the last build or refresh took';
@@ -0,0 +1,12 @@
+-- Users who may use the admin-only webserver endpoints
+--   (webserver/baseview.py::BaseView._admin_required).
+-- Add a user with
+--   INSERT INTO authuser_admin(userid) SELECT id FROM authuser WHERE username='...';
+
+CREATE TABLE authuser_admin(
+  userid UUID NOT NULL
+);
+ALTER TABLE authuser_admin ADD CONSTRAINT pk_authuser_admin PRIMARY KEY( userid );
+ALTER TABLE authuser_admin ADD CONSTRAINT fk_authuser_admin_authuser
+  FOREIGN KEY (userid) REFERENCES authuser(id)
+  ON DELETE CASCADE;
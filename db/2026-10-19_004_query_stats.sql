@@ -0,0 +1,49 @@
+-- Per-query-fingerprint timing statistics collected by db.DBCon.
+--   Each process aggregates timings in memory (db.QueryStats) and
+--   periodically adds them to query_stats.  The fingerprint is a hash
+--   of the query with literals, parameters, whitespace, and (non-hint)
+--   comments normalized away; see db.query_fingerprint.
+-- Queries slower than db._slow_query_seconds are sampled (at most once
+--   per fingerprint per db._slow_query_sample_interval seconds per
+--   process) into slow_query_log, with an EXPLAIN (ANALYZE, BUFFERS)
+--   plan (added afterwards by a background thread) if the query is a
+--   SELECT.
+
+CREATE TABLE query_stats(
+  fingerprint text NOT NULL,
+  query text NOT NULL,
+  calls bigint NOT NULL DEFAULT 0,
+  slow_calls bigint NOT NULL DEFAULT 0,
+  total_time double precision NOT NULL DEFAULT 0,
+  total_fetch_time double precision NOT NULL DEFAULT 0,
+  max_time double precision,
+  nrows bigint NOT NULL DEFAULT 0,
+  first_seen timestamp with time zone NOT NULL DEFAULT NOW(),
+  last_seen timestamp with time zone NOT NULL DEFAULT NOW()
+);
+ALTER TABLE query_stats ADD CONSTRAINT pk_query_stats PRIMARY KEY( fingerprint );
+COMMENT ON COLUMN query_stats.query IS 'Normalized query text';
+COMMENT ON COLUMN query_stats.slow_calls IS 'Number of calls that took at least the slow query threshold';
+COMMENT ON COLUMN query_stats.total_time IS 'Seconds spent running and fetching, summed over all calls';
+COMMENT ON COLUMN query_stats.total_fetch_time IS 'Seconds spent fetching results, summed over all calls';
+COMMENT ON COLUMN query_stats.max_time IS 'Seconds the slowest call took';
+COMMENT ON COLUMN query_stats.nrows IS 'Rows fetched, summed over all calls';
+
+CREATE TABLE slow_query_log(
+  id UUID NOT NULL DEFAULT gen_random_uuid(),
+  t timestamp with time zone NOT NULL DEFAULT NOW(),
+  fingerprint text NOT NULL,
+  duration double precision NOT NULL,
+  query text NOT NULL,
+  plan jsonb,
+  pid integer,
+  program text
+);
+ALTER TABLE slow_query_log ADD CONSTRAINT pk_slow_query_log PRIMARY KEY( id );
+CREATE INDEX idx_slow_query_log_t ON slow_query_log( t );
+CREATE INDEX idx_slow_query_log_fingerprint ON slow_query_log( fingerprint );
+COMMENT ON COLUMN slow_query_log.duration IS 'Seconds the query took (running and fetching)';
+COMMENT ON COLUMN slow_query_log.query IS 'Normalized query text';
+COMMENT ON COLUMN slow_query_log.plan IS 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output, NULL if not a SELECT (or not EXPLAINed yet)';
+COMMENT ON COLUMN slow_query_log.pid IS 'Process id of the client process';
+COMMENT ON COLUMN slow_query_log.program IS 'Name of the client program';
@@ -0,0 +1,7 @@
+-- Size and checksum of the result file of a long query, filled in by
+--   services/long_query_runner.py when it finishes the query, so that
+--   clients can resume interrupted downloads and verify what they got.
+--   (NULL for queries finished before this was added.)
+
+ALTER TABLE query_queue ADD COLUMN result_size bigint;
+ALTER TABLE query_queue ADD COLUMN result_sha256 text;
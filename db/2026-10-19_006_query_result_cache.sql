@@ -0,0 +1,32 @@
+-- Cache of long query results, so that identical long queries aren't
+--   run over and over again.  See webserver/dbapp.py
+--   (SubmitLongSQLQuery) and services/long_query_runner.py.
+--
+-- cachekey is a hash of the (whitespace-normalized) queries, the
+--   subdicts, the result format, and the latest diasource_import_time,
+--   so new imports invalidate the cache.  The results are in the file
+--   /query_results/cache/{cachekey}, which is a hard link to the
+--   result file of query queryid; queries answered from the cache get
+--   their own hard link to it.
+
+CREATE TABLE query_result_cache(
+  cachekey text NOT NULL,
+  queryid UUID NOT NULL,
+  format text NOT NULL,
+  result_size bigint NOT NULL,
+  result_sha256 text NOT NULL,
+  created timestamp with time zone NOT NULL DEFAULT NOW(),
+  last_hit timestamp with time zone,
+  hits bigint NOT NULL DEFAULT 0
+);
+ALTER TABLE query_result_cache ADD CONSTRAINT pk_query_result_cache PRIMARY KEY( cachekey );
+
+-- cachekey is NULL for queries submitted with nocache.
+-- cached_from is the query whose results this query's results are (or,
+--   if that query is still running, will be).  cache_hit is true if
+--   this query was never run itself.
+ALTER TABLE query_queue ADD COLUMN cachekey text;
+ALTER TABLE query_queue ADD COLUMN cached_from UUID;
+ALTER TABLE query_queue ADD COLUMN cache_hit boolean NOT NULL DEFAULT false;
+CREATE INDEX ix_query_queue_cachekey ON query_queue(cachekey);
+CREATE INDEX ix_query_queue_cached_from ON query_queue(cached_from);
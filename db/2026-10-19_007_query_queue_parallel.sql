@@ -0,0 +1,8 @@
+-- Long queries can be run in parallel by services/long_query_runner.py,
+--   split across several connections that share one snapshot (see
+--   webserver/dbapp.py SubmitLongSQLQuery).  parallel holds the options
+--   ({ nworkers, splitby, column }); it's NULL for ordinary queries.
+--   The result file of a parallel query is a JSON manifest of the
+--   part files.
+
+ALTER TABLE query_queue ADD COLUMN parallel JSONB;
@@ -0,0 +1,36 @@
+-- Priorities, limits, and cancellation for long queries.  See
+--   webserver/dbapp.py (SubmitLongSQLQuery, CancelLongSQLQuery) and
+--   services/long_query_runner.py.
+--
+-- priority is 0 (low), 1 (normal), or 2 (high); the query runner runs
+--   higher priority queries first.  timeout is the statement_timeout
+--   (seconds) and work_mem_mb the work_mem the runner uses for the
+--   query.  backend_pids are the pids of the runner's database
+--   backends while the query is running, so it can be cancelled with
+--   pg_cancel_backend.  cancelled is the time the user cancelled it.
+
+ALTER TABLE query_queue ADD COLUMN priority smallint NOT NULL DEFAULT 1;
+ALTER TABLE query_queue ADD COLUMN timeout double precision;
+ALTER TABLE query_queue ADD COLUMN work_mem_mb integer;
+ALTER TABLE query_queue ADD COLUMN backend_pids integer[];
+ALTER TABLE query_queue ADD COLUMN cancelled timestamp with time zone;
+CREATE INDEX ix_query_queue_submitted ON query_queue(submitted);
+
+-- Per-user overrides of the defaults (in dbapp.py and
+--   long_query_runner.py).  NULL means use the default.
+--   max_running : number of the user's queries the runner runs at once
+--   max_queued : number of queued or running queries the user can have
+--   max_priority : highest priority the user can ask for
+--   max_timeout : longest timeout (seconds) the user can ask for
+--   max_work_mem_mb : most work_mem the user can ask for
+CREATE TABLE query_user_quota(
+  userid UUID NOT NULL,
+  max_running integer,
+  max_queued integer,
+  max_priority smallint,
+  max_timeout double precision,
+  max_work_mem_mb integer
+);
+ALTER TABLE query_user_quota ADD CONSTRAINT pk_query_user_quota PRIMARY KEY( userid );
+ALTER TABLE query_user_quota ADD CONSTRAINT fk_query_user_quota_userid
+  FOREIGN KEY (userid) REFERENCES authuser(id) ON DELETE CASCADE;
@@ -0,0 +1,9 @@
+-- Progress of running long queries, written every so often by
+--   services/long_query_runner.py while it fetches and saves the
+--   results, and reported by /db/checksqlquery.  estimated_rows is the
+--   planner's estimate of the number of rows, made when the query starts.
+
+ALTER TABLE query_queue ADD COLUMN estimated_rows bigint;
+ALTER TABLE query_queue ADD COLUMN progress_rows bigint;
+ALTER TABLE query_queue ADD COLUMN progress_bytes bigint;
+ALTER TABLE query_queue ADD COLUMN progress_updated timestamp with time zone;
@@ -0,0 +1,16 @@
+-- Short SQL queries (/db/runsqlquery) whose estimated plan cost was
+--   over the limit, and what was done about it: decision is 'rejected'
+--   or 'long' (submitted as long query queryid).  See
+--   webserver/dbapp.py (RunSQLQuery) and /admin/admissions.
+
+CREATE TABLE query_admission_log(
+  t timestamp with time zone NOT NULL DEFAULT NOW(),
+  userid UUID,
+  decision text NOT NULL,
+  cost double precision NOT NULL,
+  max_cost double precision NOT NULL,
+  queryid UUID,
+  queries text[]
+);
+CREATE INDEX ix_query_admission_log_t ON query_admission_log(t);
+CREATE INDEX ix_query_admission_log_userid ON query_admission_log(userid);
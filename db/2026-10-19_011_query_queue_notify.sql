@@ -0,0 +1,19 @@
+-- Send a notification on channel query_queue_state, with the queryid
+--   as the payload, whenever a long query starts, finishes, or errors
+--   out (including being cancelled).  The webserver listens for these
+--   to answer /db/waitsqlquery as soon as a query changes state.
+
+CREATE FUNCTION query_queue_notify() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify( 'query_queue_state', NEW.queryid::text );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER query_queue_state_notify
+  AFTER UPDATE OF started, finished, error ON query_queue
+  FOR EACH ROW
+  WHEN ( OLD.started IS DISTINCT FROM NEW.started
+         OR OLD.finished IS DISTINCT FROM NEW.finished
+         OR OLD.error IS DISTINCT FROM NEW.error )
+  EXECUTE FUNCTION query_queue_notify();
@@ -0,0 +1,7 @@
+-- Running total of everything db.RowCount.bump has added to a row count.
+--   db.RowCount.reconcile reads this in the same snapshot as its exact
+--   count, and adds the difference from the current value when it stores
+--   the count, so it doesn't have to lock the row while counting.
+
+ALTER TABLE row_counts ADD COLUMN bumped bigint NOT NULL DEFAULT 0;
+COMMENT ON COLUMN row_counts.bumped IS 'Sum of all increments from RowCount.bump; never reset';
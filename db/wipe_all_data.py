@@ -8,6 +8,7 @@ import db
 # By default, we don't want to drop users or migrations
 tablenames = db.all_table_names.copy()
 tablenames.remove( "authuser" )
+tablenames.remove( "authuser_admin" )
 tablenames.remove( "migrations_applied" )
 
 with db.DB() as conn:
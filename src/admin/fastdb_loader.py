@@ -31,10 +31,12 @@ class FastDBLoader:
     """
 
     def __init__( self, processing_version=None ):
-        self._all_tables = db.all_table_names.copy()
-        self._all_tables.remove( "authuser" )
-        self._all_tables.remove( "passwordlink" )
-        self._all_tables.remove( "migrations_applied" )
+        # Leave alone the user tables, and the bookkeeping tables that
+        #   the rest of FASTDB goes on writing to during a load
+        self._all_tables = [ t for t in db.all_table_names
+                             if t not in ( "authuser", "authuser_admin", "passwordlink", "migrations_applied",
+                                           "query_stats", "slow_query_log", "query_admission_log",
+                                           "row_counts", "row_count_reconciliation", "objstats_refresh" ) ]
 
         self.base_processing_version = {}
         self.processing_version = None
@@ -12,7 +12,7 @@ import traceback
 import nested_pandas
 
 from fastdb_loader import FastDBLoader, ColumnMapper
-from db import ( RootDiaObject, DiaObject, DiaSource, DiaForcedSource, #, HostGalaxy
+from db import ( RootDiaObject, DiaObject, DiaSource, DiaForcedSource, RowCount, #, HostGalaxy
                  PPDBDiaObject, PPDBDiaSource,PPDBDiaForcedSource ) # PPDBHostGalaxy,
 
 
@@ -163,11 +163,14 @@ class ParquetFileHandler:
                 else:
                     # Have to set root ids for the objects
                     df['rootid'] = [ str(uuid.uuid4()) for i in range(len(df)) ]
-                    _nroot = RootDiaObject.bulk_insert_or_upsert( { 'id': list( df.rootid ) },
-                                                                  assume_no_conflict=True )
+                    nroot = RootDiaObject.bulk_insert_or_upsert( { 'id': list( df.rootid ) },
+                                                                 assume_no_conflict=True )
                     nobj = DiaObject.bulk_insert_or_upsert( df.to_dict(), assume_no_conflict=True )
                     nsrc = DiaSource.bulk_insert_or_upsert( sourcedf.to_dict(), assume_no_conflict=True )
                     nfrc = DiaForcedSource.bulk_insert_or_upsert( forceddf.to_dict(), assume_no_conflict=True )
+                    for thing, n in ( ( 'rootid', nroot ), ( 'diaobject', nobj ),
+                                      ( 'diasource', nsrc ), ( 'diaforcedsource', nfrc ) ):
+                        RowCount.bump( thing, self.base_processing_version, n, commit=True )
             else:
                 loaded = "Would load"
                 nobj = len(df)
@@ -14,7 +14,7 @@ import astropy.table
 from admin.fastdb_loader import FastDBLoader, ColumnMapper
 from util import FDBLogger
 from db import ( DB, RootDiaObject, DiaObject, DiaObjectPosition,
-                 DiaSource, DiaForcedSource )
+                 DiaSource, DiaForcedSource, RowCount )
 
 
 # ======================================================================
@@ -148,6 +148,10 @@ class FITSFileHandler( SNANAColumnMapper ):
                                                                  assume_no_conflict=True, dbcon=conn )
                     if ( n != nobjs ):
                         raise RuntimeError( f"Woah!  Inserted {nobjs} but {n} positions; they should match!" )
+                    RowCount.bump( 'diaobject', self.base_processing_version['diaobject'], nobjs,
+                                   dbcon=conn, commit=True )
+                    RowCount.bump( 'rootid', self.base_processing_version['diaobject'], nobjs,
+                                   dbcon=conn, commit=True )
                     FDBLogger.info( f"PID {os.getpid()} loaded {nobjs} diaobjects from {headfile.name}" )
 
             else:
@@ -219,6 +223,7 @@ class FITSFileHandler( SNANAColumnMapper ):
                 forcedphot = astropy.table.Table( phot )
                 forcedphot.remove_column( 'photflag' )
                 nfrc = DiaForcedSource.bulk_insert_or_upsert( dict(forcedphot), assume_no_conflict=True )
+                RowCount.bump( 'diaforcedsource', self.base_processing_version['diaforcedsource'], nfrc, commit=True )
                 FDBLogger.info( f"PID {os.getpid()} loaded {nfrc} forced photometry points from {photfile.name}" )
                 del forcedphot
             else:
@@ -234,6 +239,7 @@ class FITSFileHandler( SNANAColumnMapper ):
 
             if self.really_do:
                 nsrc = DiaSource.bulk_insert_or_upsert( dict(phot), assume_no_conflict=True )
+                RowCount.bump( 'diasource', self.base_processing_version['diasource'], nsrc, commit=True )
                 FDBLogger.info( f"PID {os.getpid()} loaded {nsrc} sources from {photfile.name}" )
             else:
                 nsrc = len(phot)
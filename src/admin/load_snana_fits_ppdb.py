@@ -230,22 +230,26 @@ class FITSFileHandler( SNANAColumnMapper ):
                     FDBLogger.info( f"PID {os.getpid()} loaded {nhost} host galaxies from {headfile.name}" )
 
                     cls = PPDBDiaObject
-                    q = cls.bulk_insert_or_upsert( dict(head), assume_no_conflict=True,
-                                                   dbcon=conn, nocommit=True )
+                    q, temptable = cls.bulk_insert_or_upsert( dict(head), assume_no_conflict=True,
+                                                              dbcon=conn, nocommit=True )
                     cursor = conn.cursor()
-                    cursor.execute( "UPDATE temp_bulk_upsert SET nearbyextobj1=NULL, nearbyextobj1id=NULL, "
+                    cursor.execute( f"UPDATE {temptable} "
+                                    "SET nearbyextobj1=NULL, nearbyextobj1id=NULL, "
                                     "                            nearbyextobj1sep=NULL "
                                     "WHERE nearbyextobj1 <= 0" )
-                    cursor.execute( "UPDATE temp_bulk_upsert SET nearbyextobj2=NULL, nearbyextobj2id=NULL, "
+                    cursor.execute( f"UPDATE {temptable} "
+                                    "SET nearbyextobj2=NULL, nearbyextobj2id=NULL, "
                                     "                            nearbyextobj2sep=NULL "
                                     "WHERE nearbyextobj2 <= 0" )
                     if 'nearbyextobj3' in head.columns:
-                        cursor.execute( "UPDATE temp_bulk_upsert SET nearbyextobj3=NULL, nearbyextobj3id=NULL, "
+                        cursor.execute( f"UPDATE {temptable} "
+                                        "SET nearbyextobj3=NULL, nearbyextobj3id=NULL, "
                                         "                            nearbyextobj3sep=NULL "
                                         "WHERE nearbyextobj3 <= 0" )
                     # Null out ALL nearbyextids to get rid of the nulluuids we put there before
                     #   because of astropy tables and types and oh my
-                    cursor.execute( "UPDATE temp_bulk_upsert SET nearbyextobj1id=NULL, nearbyextobj2id=NULL, "
+                    cursor.execute( f"UPDATE {temptable} "
+                                    "SET nearbyextobj1id=NULL, nearbyextobj2id=NULL, "
                                     "  nearbyextobj3id=NULL" )
                     cursor.execute( q )
                     nobj = cursor.rowcount
@@ -1,18 +1,29 @@
 # IMPORTANT : make sure that everything in here stays synced with the
 #   database schema managed by migrations in ../db
 #
-# WARNING : code here will drop the table "temp_bulk_upsert" if you make it, so don't make that table.
+# WARNING : code here will truncate temp tables named "temp_bulk_upsert_<table>" if you make them,
+#   so don't make those tables.
 #
 # WARNING : code assumes all column names are lowercase.  Don't mix case in column names.
 
 # import sys
 import os
 import re
+import sys
+import json
+import struct
 import uuid
 import time
 import collections
 import types
 import logging
+import weakref
+import queue
+import hashlib
+import atexit
+import functools
+import itertools
+import threading
 
 from contextlib import contextmanager
 
@@ -54,17 +65,47 @@ _alwaysanalyze = False
 # The next one is aspirational, not yet implemnted.
 _dumpmongopipeline = False
 
+# Query statistics.  Unlike the things above, these are meant to be on in
+# production.  DBCon records how long every query takes, aggregated by
+# query fingerprint (see query_fingerprint and QueryStats), and adds the
+# aggregates to the query_stats table every _query_stats_flush_interval
+# seconds.  Queries that take at least _slow_query_seconds (running plus
+# fetching) are written to the slow_query_log table -- at most once per
+# fingerprint every _slow_query_sample_interval seconds.  If they were
+# read-only SELECTs run with DBCon.execute(), a background thread then
+# reruns them with EXPLAIN (ANALYZE, BUFFERS) on its own connection, and
+# adds the plan to the log entry.  (That thread has at most
+# _slow_query_explain_backlog queries waiting; past that, entries go
+# without a plan.  Each EXPLAIN ANALYZE gets a statement timeout of
+# _slow_query_explain_timeout seconds.)  Set _slow_query_seconds to
+# None to turn off the slow query log, and _collect_query_stats to False
+# to turn off all of it.
+_collect_query_stats = True
+_query_stats_flush_interval = 60.
+_slow_query_seconds = 2.
+_slow_query_sample_interval = 600.
+_slow_query_explain_backlog = 4
+_slow_query_explain_timeout = 60.
+
+# Queries run with DBCon.execute_prepared() are prepared on the server
+# (see PreparedStatements).  Set this to False to run them as ordinary
+# queries instead; you need to do that if you connect to the database
+# through something (like pgbouncer in transaction mode) that can move
+# you to a different server session between statements.
+_use_prepared_statements = True
+
 # The tables here should be in the order they safe to drop.
 # (Insofar as it's safe to drop all your tables....)
-all_table_names = [ 'query_queue',
+all_table_names = [ 'query_stats', 'slow_query_log',
+                    'query_admission_log', 'query_result_cache', 'query_user_quota', 'query_queue',
                     'spectruminfo', 'plannedspectra', 'wantedspectra',
                     'ppdb_alerts_sent', 'ppdb_diaforcedsource', 'ppdb_diasource', 'ppdb_diaobject', 'ppdb_host_galaxy',
                     'diaforcedsource_extra', 'diaforcedsource', 'diasource_brokerinfo', 'diasource_extra', 'diasource',
                     'diaobject_host_match', 'diaobject_position', 'diaobject', 'root_diaobject', 'host_galaxy',
-                    'diasource_import_time',
+                    'diasource_import_time', 'row_count_reconciliation', 'row_counts', 'objstats_refresh',
                     'processing_version_alias', 'base_procver_of_procver',
                     'processing_version', 'base_processing_version',
-                    'passwordlink', 'authuser',
+                    'passwordlink', 'authuser_admin', 'authuser',
                     'migrations_applied' ]
 
 # ======================================================================
@@ -141,6 +182,275 @@ class DBConTimings:
         self.tot_fetch_time = 0.
 
 
+# ======================================================================
+# Query statistics
+
+_fp_comment_re = re.compile( r'/\*(?!\+).*?\*/|--[^\n]*', re.DOTALL )
+_fp_string_re = re.compile( r"'(?:[^']|'')*'" )
+_fp_param_re = re.compile( r'%\(\w+\)s|%s|\$\d+' )
+_fp_number_re = re.compile( r'(?<![\w.])[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?(?![\w.])' )
+_fp_list_re = re.compile( r'\?(?:\s*,\s*\?)+' )
+_fp_space_re = re.compile( r'\s+' )
+_fp_writes_re = re.compile( r'\b(?:insert|update|delete|into|for update|for share)\b' )
+
+
+@functools.lru_cache( maxsize=4096 )
+def query_fingerprint( query ):
+    """Normalize a query so that calls that differ only in their parameters look the same.
+
+    Removes comments (but not pg_hint_plan hints), replaces string and
+    numeric literals and substitution parameters with ?, collapses
+    lists of those to a single ?, collapses whitespace, and lowercases
+    everything.
+
+    Parameters
+    ----------
+      query : str
+
+    Returns
+    -------
+      fingerprint, normalized
+
+      fingerprint is a 16-character hash of the normalized query.
+
+    """
+    norm = _fp_comment_re.sub( ' ', query )
+    norm = _fp_string_re.sub( '?', norm )
+    norm = _fp_param_re.sub( '?', norm )
+    norm = _fp_number_re.sub( '?', norm )
+    norm = _fp_list_re.sub( '?', norm )
+    norm = _fp_space_re.sub( ' ', norm ).strip().lower()
+    return hashlib.md5( norm.encode( 'utf-8' ) ).hexdigest()[:16], norm
+
+
+def query_is_read_only( normalized ):
+    """True if a query normalized by query_fingerprint looks like it's safe to run twice."""
+    if normalized.startswith( '/*+' ):
+        normalized = normalized[ normalized.find( '*/' ) + 2: ].lstrip()
+    return ( normalized.startswith( 'select' ) or normalized.startswith( 'with' ) ) and \
+        ( _fp_writes_re.search( normalized ) is None )
+
+
+class QueryStats:
+    """Per-fingerprint query timings for this process.
+
+    There is one of these per process (get it with
+    QueryStats.instance()); DBCon sends it the timing of every query.
+    Totals since the process started are in memory (see snapshot());
+    the increments since the last flush are added to the query_stats
+    table by flush(), which DBCon calls every
+    _query_stats_flush_interval seconds (and at exit).  The database
+    writes use their own connection, so they don't interfere with
+    whatever transaction the DBCon is in.
+
+    Plans of slow queries are gotten by a background thread (see
+    explain_later), so that the process that ran the query doesn't have
+    to wait for it to be run again.
+
+    A process forked from one that has collected statistics starts
+    with none of its own (see _after_fork), so the parent's unflushed
+    increments aren't written twice.
+
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+
+    @classmethod
+    def instance( cls ):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register( cls._instance.flush )
+            return cls._instance
+
+
+    @classmethod
+    def _after_fork( cls ):
+        # In a forked child, the unflushed increments belong to the parent,
+        #   which will flush them itself.  (The locks are remade in case
+        #   another thread of the parent held them when it forked.)
+        cls._instance_lock = threading.Lock()
+        if cls._instance is not None:
+            cls._instance._lock = threading.Lock()
+            cls._instance.totals = {}
+            cls._instance.pending = {}
+            cls._instance.lastflush = time.monotonic()
+            # The parent's explain thread didn't come along
+            cls._instance._explainqueue = None
+
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        # fingerprint -> { 'query', 'calls', 'slow_calls', 'total_time', 'total_fetch_time', 'max_time', 'nrows' }
+        self.totals = {}
+        self.pending = {}
+        self.lastsample = {}
+        self.lastflush = time.monotonic()
+        self._explainqueue = None
+
+
+    @staticmethod
+    def _add( stats, fingerprint, normalized, querytime, fetchtime, nrows, slow ):
+        if fingerprint not in stats:
+            stats[fingerprint] = { 'query': normalized, 'calls': 0, 'slow_calls': 0, 'total_time': 0.,
+                                   'total_fetch_time': 0., 'max_time': 0., 'nrows': 0 }
+        st = stats[fingerprint]
+        st['calls'] += 1
+        st['slow_calls'] += 1 if slow else 0
+        st['total_time'] += querytime + fetchtime
+        st['total_fetch_time'] += fetchtime
+        st['max_time'] = max( st['max_time'], querytime + fetchtime )
+        st['nrows'] += nrows if nrows is not None else 0
+
+
+    def record( self, fingerprint, normalized, querytime, fetchtime=0., nrows=None, slow=False ):
+        """Record one query.
+
+        Returns
+        -------
+          bool : True if the query was slow and should be sampled into
+          the slow query log.
+
+        """
+        now = time.monotonic()
+        sample = False
+        with self._lock:
+            self._add( self.totals, fingerprint, normalized, querytime, fetchtime, nrows, slow )
+            self._add( self.pending, fingerprint, normalized, querytime, fetchtime, nrows, slow )
+            if slow and ( now - self.lastsample.get( fingerprint, -1e32 ) >= _slow_query_sample_interval ):
+                self.lastsample[fingerprint] = now
+                sample = True
+            flushdue = ( now - self.lastflush ) >= _query_stats_flush_interval
+            if flushdue:
+                self.lastflush = now
+        if flushdue:
+            self.flush()
+        return sample
+
+
+    def snapshot( self ):
+        """A copy of the totals for this process, as a dict of fingerprint -> dict."""
+        with self._lock:
+            return { k: dict(v) for k, v in self.totals.items() }
+
+
+    def flush( self ):
+        """Add the statistics collected since the last flush to the query_stats table."""
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+        if len( pending ) == 0:
+            return
+        try:
+            with DB() as conn:
+                cursor = conn.cursor()
+                cursor.executemany( "INSERT INTO query_stats(fingerprint, query, calls, slow_calls, total_time, "
+                                    "                        total_fetch_time, max_time, nrows) "
+                                    "VALUES (%(fp)s, %(query)s, %(calls)s, %(slow_calls)s, %(total_time)s, "
+                                    "        %(total_fetch_time)s, %(max_time)s, %(nrows)s) "
+                                    "ON CONFLICT (fingerprint) DO UPDATE SET "
+                                    "  calls=query_stats.calls+EXCLUDED.calls, "
+                                    "  slow_calls=query_stats.slow_calls+EXCLUDED.slow_calls, "
+                                    "  total_time=query_stats.total_time+EXCLUDED.total_time, "
+                                    "  total_fetch_time=query_stats.total_fetch_time+EXCLUDED.total_fetch_time, "
+                                    "  max_time=GREATEST(query_stats.max_time, EXCLUDED.max_time), "
+                                    "  nrows=query_stats.nrows+EXCLUDED.nrows, "
+                                    "  last_seen=NOW()",
+                                    [ { 'fp': fp, **st } for fp, st in pending.items() ] )
+                conn.commit()
+        except Exception as ex:
+            FDBLogger.warning( f"Failed to write query statistics for {len(pending)} queries: {ex}" )
+
+
+    def log_slow( self, fingerprint, normalized, duration, plan=None ):
+        """Write a slow query to the log (and to the slow_query_log table).
+
+        Returns
+        -------
+          UUID : the id of the slow_query_log row, or None if it couldn't be written.
+
+        """
+        FDBLogger.warning( f"Slow query ({duration:.2f}s, fingerprint {fingerprint}): {normalized[:500]}" )
+        try:
+            with DB() as conn:
+                cursor = conn.cursor()
+                cursor.execute( "INSERT INTO slow_query_log(fingerprint, duration, query, plan, pid, program) "
+                                "VALUES (%(fp)s, %(dur)s, %(query)s, %(plan)s, %(pid)s, %(prog)s) "
+                                "RETURNING id",
+                                { 'fp': fingerprint, 'dur': duration, 'query': normalized,
+                                  'plan': None if plan is None else psycopg.types.json.Jsonb( plan ),
+                                  'pid': os.getpid(), 'prog': os.path.basename( sys.argv[0] ) } )
+                logid = cursor.fetchone()[0]
+                conn.commit()
+                return logid
+        except Exception as ex:
+            FDBLogger.warning( f"Failed to write to slow_query_log: {ex}" )
+            return None
+
+
+    def explain_later( self, logid, fingerprint, query, subdict ):
+        """Have the background thread add an EXPLAIN (ANALYZE, BUFFERS) plan to a slow_query_log entry.
+
+        The query is rerun on a separate connection, in a read-only
+        transaction that's rolled back.  So, it doesn't see anything
+        that wasn't committed (or any temp tables) in the transaction
+        that originally ran it; if that makes it fail, the entry just
+        doesn't get a plan.
+
+        Parameters
+        ----------
+          logid : UUID
+            The id of the slow_query_log row (from log_slow)
+
+          fingerprint : str
+
+          query : str
+            The query, with any psycopg placeholders still in it
+
+          subdict : dict or None
+            Substitutions for the query
+
+        """
+        with self._lock:
+            if self._explainqueue is None:
+                self._explainqueue = queue.Queue( maxsize=_slow_query_explain_backlog )
+                threading.Thread( target=self._explain_loop, args=( self._explainqueue, ),
+                                  name='slow_query_explainer', daemon=True ).start()
+            explainqueue = self._explainqueue
+        try:
+            explainqueue.put_nowait( ( logid, fingerprint, query, None if subdict is None else dict( subdict ) ) )
+        except queue.Full:
+            FDBLogger.debug( f"Too many slow queries waiting to be EXPLAINed, not EXPLAINing {fingerprint}" )
+
+
+    @staticmethod
+    def _explain_loop( explainqueue ):
+        while True:
+            logid, fingerprint, query, subdict = explainqueue.get()
+            try:
+                with DB() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute( "SET TRANSACTION READ ONLY" )
+                    cursor.execute( "SELECT set_config( 'statement_timeout', %(t)s, true )",
+                                    { 't': str( int( _slow_query_explain_timeout * 1000 ) ) } )
+                    cursor.execute( sql.SQL( "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " ) + sql.SQL( query ),
+                                    subdict )
+                    plan = cursor.fetchone()[0]
+                    conn.rollback()
+                    cursor.execute( "UPDATE slow_query_log SET plan=%(plan)s WHERE id=%(id)s",
+                                    { 'id': logid, 'plan': psycopg.types.json.Jsonb( plan ) } )
+                    conn.commit()
+            except Exception as ex:
+                FDBLogger.warning( f"Failed to EXPLAIN ANALYZE slow query {fingerprint}: {ex}" )
+
+
+os.register_at_fork( after_in_child=QueryStats._after_fork )
+
+
+# ======================================================================
+
 class DBCon:
     """Class that encapsulates a postgres database connection.
 
@@ -284,6 +594,7 @@ class DBCon:
 
         """
         self.con.rollback()
+        TempTableManager.for_connection( self.con ).rolled_back()
 
     def commit( self ):
         """Commit changes to the database.
@@ -298,10 +609,12 @@ class DBCon:
         t1 = time.perf_counter()
         self.timings.last_commit_time = t1 - t0
         self.timings.tot_commit_time += t1 - t0
+        TempTableManager.for_connection( self.con ).committed()
         self.remake_cursor( self.curcursorisdict )  # ...is this necessary?
 
 
-    def execute_nofetch( self, q, subdict={}, echo=None, explain=None, analyze=None, cursorname=None ):
+    def execute_nofetch( self, q, subdict={}, echo=None, explain=None, analyze=None, cursorname=None,
+                         prepare=None, _record_stats=True ):
         """Runs a query where you don't expect to fetch results.
 
         Parameters are the same as execute(), except:
@@ -311,6 +624,10 @@ class DBCon:
           for this query.  This will only work on SELECT queries.  Worry
           about postgres cursor namespace.
 
+        prepare : bool, default None
+          Passed on to psycopg's cursor.execute.  You probably want
+          execute_prepared() rather than this.
+
         Returns
         -------
           psycopg.ClientCursor or psycopg.ServerCursor
@@ -381,7 +698,7 @@ class DBCon:
         # be false, because you can't EXPLAIN ANALYZE the query and get the results
         # all in one call.
         if not alreadydid:
-            _cursor().execute( q, subdict )
+            _cursor().execute( q, subdict, prepare=prepare )
 
         if ( FDBLogger.instance().get().level <= logging.DEBUG ) and ( echo or explain ):
             FDBLogger.debug( "Query complete." )
@@ -389,11 +706,13 @@ class DBCon:
         t1 = time.perf_counter()
         self.timings.last_query_time = t1 - t0
         self.timings.tot_query_time += t1 - t0
+        if _record_stats:
+            self._record_query( q, subdict, t1 - t0 )
 
         return _curcursor
 
 
-    def execute( self, q, subdict={}, silent=False, echo=None, explain=None ):
+    def execute( self, q, subdict={}, silent=False, echo=None, explain=None, prepare=None ):
         """Runs a query, and returns either (rows, columns) or just rows.
 
         Parmaeters
@@ -424,6 +743,10 @@ class DBCon:
             attacks if you aren't completely and totally confident about
             where your SQL came from.  Do not get bobby tablesed!
 
+          prepare : bool, default None
+            Passed on to psycopg's cursor.execute.  You probably want
+            execute_prepared() rather than this.
+
         Returns
         -------
           If the current cursor is a dict cursor, returns a list of dictionaries.
@@ -433,29 +756,906 @@ class DBCon:
           dictionary.  The second is a list of column names.
 
         """
-        self.execute_nofetch( q, subdict, echo=echo, explain=explain, analyze=False )
+        self.execute_nofetch( q, subdict, echo=echo, explain=explain, analyze=False, prepare=prepare,
+                              _record_stats=False )
         if echo:
             FDBLogger.debug( "Query done, fetching" )
-        if self.curcursorisdict:
-            if self.cursor.description is None:
-                return None
-            else:
-                t0 = time.perf_counter()
-                rval = self.cursor.fetchall()
-                t1 = time.perf_counter()
-                self.timings.last_fetch_time = t1 - t0
-                self.timings.tot_fetch_time += t1 - t0
-                return rval
+        if self.cursor.description is None:
+            rval = None if self.curcursorisdict else ( None, None )
+            nrows = None
+            t0 = t1 = 0.
         else:
-            if self.cursor.description is None:
-                return None, None
             t0 = time.perf_counter()
             rows = self.cursor.fetchall()
-            cols = [ desc[0] for desc in self.cursor.description ]
+            if self.curcursorisdict:
+                rval = rows
+            else:
+                cols = [ desc[0] for desc in self.cursor.description ]
+                rval = ( rows, cols )
+            nrows = len( rows )
             t1 = time.perf_counter()
             self.timings.last_fetch_time = t1 - t0
             self.timings.tot_fetch_time += t1 - t0
-            return rows, cols
+        self._record_query( q, subdict, self.timings.last_query_time, t1 - t0, nrows, explainable=True )
+        return rval
+
+
+    def execute_prepared( self, name, subdict={}, query=None ):
+        """Run a query from the PreparedStatements registry, and return the results.
+
+        The first time a statement is run on this connection, it's
+        prepared on the server; after that, the prepared statement is
+        reused.
+
+        Parameters
+        ----------
+          name : str
+            The name of the statement in the PreparedStatements registry.
+
+          subdict : dict
+            Substitution dictionary, as in execute().
+
+          query : str or sql.Composable, default None
+            If not None, register this query as name first.  Use this
+            for queries that are built on the fly; name must then encode
+            everything that went into building the query, as the query
+            must be exactly the same every time it's registered with the
+            same name.  The query must not have any sql.Literals in it.
+
+        Returns
+        -------
+          The same as execute()
+
+        """
+        if query is not None:
+            if isinstance( query, sql.Composable ):
+                query = query.as_string( self.con )
+            PreparedStatements.register( name, query )
+        if not _use_prepared_statements:
+            return self.execute( PreparedStatements.query( name ), subdict, prepare=False )
+        rval = self.execute( PreparedStatements.query( name ), subdict, prepare=True )
+        PreparedStatements.executed( name, self.con )
+        return rval
+
+
+    def execute_batch( self, queries, prepared=False ):
+        """Send several independent queries in one round trip, and return all their results.
+
+        Uses psycopg pipeline mode: all of the queries are sent to the
+        server before waiting for any of the results, so a batch of n
+        small queries costs one network round trip instead of n.  The
+        queries can't depend on each other's results.  They all run in
+        the current transaction, in order; if one fails, the ones after
+        it don't run, and the exception is raised from here.
+
+        Parameters
+        ----------
+          queries : list
+            Each element is either a query (str or sql.Composed), or a
+            tuple of ( query, subdict ).  If prepared is True, then
+            instead of queries, these are names of statements in the
+            PreparedStatements registry.
+
+          prepared : bool, default False
+            See queries.
+
+        Returns
+        -------
+          list, with one element for each query.  Each element is what
+          execute() would have returned for that query.
+
+        """
+        queries = [ q if isinstance( q, tuple ) else ( q, {} ) for q in queries ]
+        if prepared:
+            names = [ q[0] for q in queries ]
+            queries = [ ( PreparedStatements.query( name ), subdict ) for name, subdict in queries ]
+        queries = [ ( q if isinstance( q, ( sql.SQL, sql.Composed ) ) else sql.SQL( q ), subdict )
+                    for q, subdict in queries ]
+        prepare = prepared and _use_prepared_statements
+        if self.echoqueries and ( FDBLogger.instance().get().level <= logging.DEBUG ):
+            for q, subdict in queries:
+                FDBLogger.debug( f"Sending batched query\n{q.as_string()}\nwith substitutions: {subdict}" )
+
+        rowfactory = psycopg.rows.dict_row if self.curcursorisdict else psycopg.rows.tuple_row
+        cursors = []
+        try:
+            t0 = time.perf_counter()
+            with self.con.pipeline():
+                for q, subdict in queries:
+                    cursor = self.con.cursor( row_factory=rowfactory )
+                    cursors.append( cursor )
+                    cursor.execute( q, subdict, prepare=prepare )
+            # Leaving the pipeline block waited for all the results
+            t1 = time.perf_counter()
+
+            rvals = []
+            for cursor in cursors:
+                if cursor.description is None:
+                    rvals.append( None if self.curcursorisdict else ( None, None ) )
+                elif self.curcursorisdict:
+                    rvals.append( cursor.fetchall() )
+                else:
+                    rvals.append( ( cursor.fetchall(), [ desc[0] for desc in cursor.description ] ) )
+            t2 = time.perf_counter()
+        finally:
+            for cursor in cursors:
+                cursor.close()
+
+        self.timings.last_query_time = t1 - t0
+        self.timings.tot_query_time += t1 - t0
+        self.timings.last_fetch_time = t2 - t1
+        self.timings.tot_fetch_time += t2 - t1
+        if prepare:
+            for name in names:
+                PreparedStatements.executed( name, self.con )
+        # There's no telling how the time was split between the queries, so share it out evenly
+        n = len( queries )
+        for ( q, subdict ), rval in zip( queries, rvals ):
+            nrows = None if rval is None or rval == ( None, None ) else len( rval if self.curcursorisdict else rval[0] )
+            self._record_query( q, subdict, ( t1 - t0 ) / n, ( t2 - t1 ) / n, nrows )
+        return rvals
+
+
+    def execute_columnar( self, q, subdict={}, return_format='numpy' ):
+        """Run a SELECT query, and return the results as typed columns.
+
+        Rather than fetching rows of python objects and then building
+        columns from them, this has postgres send the results with
+        COPY ... TO STDOUT (FORMAT BINARY), and decodes that straight
+        into numpy arrays.  The column types come from the types postgres
+        reports for the query (the same thing that's in
+        cursor.description), not from ColumnMeta, so it works for
+        any query, not just whole tables.  For big results, especially
+        ones with lots of numeric columns, this is much faster than
+        execute(), and uses much less memory.
+
+        Supported postgres types are boolean, smallint, integer, bigint,
+        real, double precision, numeric (which becomes float64), date,
+        timestamp, timestamp with time zone, uuid, text, character,
+        character varying, name, json, and jsonb.  If the query returns
+        a column of any other type, you get a TypeError; cast that
+        column to something supported in the query.
+
+        Parameters
+        ----------
+          q : str or sql.Composed
+            The query.  It must be something that can go inside
+            COPY ( ... ), i.e. a SELECT (or VALUES, or WITH ... SELECT)
+            without a trailing semicolon.
+
+          subdict : dict
+            Substitution dictionary, as in execute().  (The
+            substitutions are done client-side, as postgres can't take
+            parameters for COPY.)
+
+          return_format : str, default 'numpy'
+            'numpy' or 'arrow'; see Returns.
+
+        Returns
+        -------
+          If return_format is 'numpy', a dict of column name to
+          numpy array.  Numeric and boolean columns have the
+          corresponding numpy dtypes (float32 for real, int16 for
+          smallint, etc.); if the column has any NULLs in it, you get a
+          numpy.ma.masked_array with the NULLs masked.  Dates and
+          timestamps are datetime64[D] and datetime64[us]; timestamps
+          with time zone are in UTC.  uuid, text, and json columns are
+          object arrays holding uuid.UUID, str, or (for json) whatever
+          json.loads returned, with None for NULL.
+
+          If return_format is 'arrow', a pyarrow.Table.  uuid and json
+          columns are strings.
+
+          (If the query returned columns with the same name, you only
+          get the last one in the dict; give them different names in
+          the query.)
+
+        """
+        # (Exhaust the generator so that it records the query timing)
+        chunks = list( self._copy_columnar( q, subdict, None, return_format ) )
+        return chunks[0][1]
+
+
+    def iter_columnar( self, q, subdict={}, chunksize=100000, return_format='numpy' ):
+        """Run a SELECT query, and yield the results in chunks of typed columns.
+
+        Like execute_columnar, but for results too big to want in memory
+        all at once.  Finish iterating before using this DBCon for
+        anything else.
+
+        Parameters
+        ----------
+          q, subdict, return_format :
+            See execute_columnar
+
+          chunksize : int, default 100000
+            Yield this many rows at a time.  (The last chunk may have
+            fewer.)
+
+        Returns
+        -------
+          A generator; each thing it yields is what execute_columnar
+          would return for chunksize rows of the results.  If the query
+          returns no rows, it doesn't yield anything.
+
+        """
+        if chunksize < 1:
+            raise ValueError( f"chunksize must be positive, not {chunksize}" )
+        for nrows, columns in self._copy_columnar( q, subdict, chunksize, return_format ):
+            if nrows > 0:
+                yield columns
+
+
+    def _copy_columnar( self, q, subdict, chunksize, return_format ):
+        # Generator used by execute_columnar and iter_columnar.  Yields ( nrows, columns ).
+        # If chunksize is None, yields once with all the rows.
+        if return_format not in ( 'numpy', 'arrow' ):
+            raise ValueError( f"return_format must be numpy or arrow, not {return_format}" )
+        if not isinstance( q, ( sql.SQL, sql.Composed ) ):
+            q = sql.SQL( q )
+        if self.echoqueries and ( FDBLogger.instance().get().level <= logging.DEBUG ):
+            FDBLogger.debug( f"Sending columnar query\n{q.as_string()}\nwith substitutions: {subdict}" )
+
+        # Time spent by whoever is consuming the chunks isn't counted.
+        t0 = time.perf_counter()
+        fetchtime = 0.
+        totrows = 0
+        # psycopg can only substitute parameters into COPY client-side
+        with psycopg.ClientCursor( self.con ) as cursor:
+            # Find out the types of the columns without running the query
+            cursor.execute( sql.SQL( "SELECT * FROM ( " ) + q + sql.SQL( " ) _columnar LIMIT 0" ), subdict )
+            decoder = _BinaryCopyDecoder( [ desc.name for desc in cursor.description ],
+                                          [ desc.type_code for desc in cursor.description ],
+                                          self.con.info.encoding )
+
+            with cursor.copy( sql.SQL( "COPY ( " ) + q + sql.SQL( " ) TO STDOUT (FORMAT BINARY)" ),
+                              subdict ) as copy:
+                t1 = time.perf_counter()
+                querytime = t1 - t0
+                for data in copy:
+                    decoder.feed( data )
+                    while ( chunksize is not None ) and ( decoder.nrows >= chunksize ):
+                        nrows, columns = decoder.take( return_format, chunksize )
+                        totrows += nrows
+                        fetchtime += time.perf_counter() - t1
+                        yield nrows, columns
+                        t1 = time.perf_counter()
+                decoder.parse( final=True )
+
+            while True:
+                nrows, columns = decoder.take( return_format, chunksize )
+                totrows += nrows
+                fetchtime += time.perf_counter() - t1
+                if ( nrows > 0 ) or ( totrows == 0 ):
+                    yield nrows, columns
+                t1 = time.perf_counter()
+                if decoder.nrows == 0:
+                    break
+
+        self.timings.last_query_time = querytime
+        self.timings.tot_query_time += querytime
+        self.timings.last_fetch_time = fetchtime
+        self.timings.tot_fetch_time += fetchtime
+        self._record_query( q, subdict, querytime, fetchtime, totrows )
+
+
+    def _record_query( self, q, subdict, querytime, fetchtime=0., nrows=None, explainable=False ):
+        """Send the timing of a query to QueryStats, and maybe to the slow query log.
+
+        If explainable is True, and the query is slow, a read-only
+        SELECT, and due to be sampled, it's handed to
+        QueryStats.explain_later, which reruns it with EXPLAIN (ANALYZE,
+        BUFFERS) in a background thread on its own connection and adds
+        the plan to the log entry.  So, the caller doesn't wait for the
+        query to be run again, and the ongoing transaction isn't
+        disturbed.
+
+        """
+        if not _collect_query_stats:
+            return
+        try:
+            if not isinstance( q, ( sql.SQL, sql.Composed ) ):
+                q = sql.SQL( q )
+            querystr = q.as_string( self.con )
+            fingerprint, normalized = query_fingerprint( querystr )
+        except Exception as ex:
+            FDBLogger.debug( f"Couldn't fingerprint query: {ex}" )
+            return
+
+        duration = querytime + fetchtime
+        slow = ( _slow_query_seconds is not None ) and ( duration >= _slow_query_seconds )
+        if not QueryStats.instance().record( fingerprint, normalized, querytime, fetchtime, nrows, slow=slow ):
+            return
+
+        logid = QueryStats.instance().log_slow( fingerprint, normalized, duration )
+        if ( logid is not None ) and explainable and query_is_read_only( normalized ):
+            QueryStats.instance().explain_later( logid, fingerprint, querystr, subdict )
+
+
+    @contextmanager
+    def temp_table( self, name, columns ):
+        """Get an empty temp table, reusing one made earlier in this session if possible.
+
+        Always call this as "with dbcon.temp_table( ... ) as tablename:".
+        See TempTableManager.
+
+        Parameters
+        ----------
+          name : str
+            The name you'd like the table to have.  If a table by that
+            name is already in use in this session (e.g. by a function
+            further up the stack), or was made with different columns,
+            you get a different name (name_1, name_2, ...).
+
+          columns : str
+            What goes inside the parentheses of CREATE TEMP TABLE,
+            e.g. "diaobjectid bigint, rootid uuid" or "LIKE diasource".
+            This is put into the SQL verbatim, so never build it from
+            user input.
+
+        Returns
+        -------
+          str : the name of the table.  It's empty, and is yours until
+          the with block ends.  Don't drop or rename it.
+
+        """
+        mgr = TempTableManager.for_connection( self.con )
+        tablename = mgr.acquire( self, name, columns )
+        try:
+            yield tablename
+        finally:
+            mgr.release( tablename )
+
+
+# ======================================================================
+
+class TempTableManager:
+    """Keeps track of the reusable temp tables in a database session.
+
+    Creating and dropping a temp table on every call writes to pg_class,
+    pg_attribute, and friends, and invalidates cached plans; on a busy
+    server that adds up.  Tables handed out by DBCon.temp_table are
+    instead created the first time they're needed in a session, and
+    after that just truncated.  (They go away when the connection
+    closes, like any other temp table.)
+
+    There is one of these for each psycopg.Connection, shared by all the
+    DBCon objects that wrap it.  Tables are leased out by
+    DBCon.temp_table, so two users in the same session never get the
+    same table at the same time.
+
+    A temp table created in a transaction that is rolled back goes away.
+    DBCon.rollback() and DBCon.commit() tell the manager about that, but
+    if you roll back the psycopg connection directly it won't know.
+    That's OK; the table is created with CREATE TEMP TABLE IF NOT
+    EXISTS every time, so it will be remade.  (The statistics will count
+    that as a reuse.)
+
+    Use TempTableManager.stats() to see how many times each table was
+    created vs. reused in this process.
+
+    """
+
+    _managers = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+    _created = collections.Counter()
+    _reused = collections.Counter()
+
+
+    @classmethod
+    def for_connection( cls, con ):
+        """Get the TempTableManager for a psycopg.Connection, making it if necessary."""
+        with cls._lock:
+            mgr = cls._managers.get( con )
+            if mgr is None:
+                mgr = cls()
+                cls._managers[ con ] = mgr
+            return mgr
+
+
+    @classmethod
+    def stats( cls ):
+        """Number of times each temp table was created and reused in this process.
+
+        Returns
+        -------
+          dict of name: { 'created': int, 'reused': int }
+
+          name is the name that was asked for, not the name that was handed
+          out (which may have a _n suffix).
+
+        """
+        with cls._lock:
+            return { name: { 'created': cls._created[name], 'reused': cls._reused[name] }
+                     for name in sorted( set( cls._created.keys() ) | set( cls._reused.keys() ) ) }
+
+
+    @classmethod
+    def reset_stats( cls ):
+        with cls._lock:
+            cls._created.clear()
+            cls._reused.clear()
+
+
+    def __init__( self ):
+        # tablename -> columns definition for tables that exist in the session
+        self.tables = {}
+        # tables created in the current transaction (which vanish on rollback)
+        self.uncommitted = set()
+        self.leased = set()
+
+
+    def acquire( self, dbcon, name, columns ):
+        """Lease an empty temp table.  Use DBCon.temp_table rather than calling this directly."""
+        with self._lock:
+            n = 0
+            while True:
+                tablename = name if n == 0 else f"{name}_{n}"
+                if ( tablename not in self.leased ) and ( self.tables.get( tablename, columns ) == columns ):
+                    break
+                n += 1
+            self.leased.add( tablename )
+            reuse = tablename in self.tables
+
+        try:
+            q = sql.SQL( "CREATE TEMP TABLE IF NOT EXISTS {t} ({columns}); TRUNCATE TABLE {t}"
+                        ).format( t=sql.Identifier( tablename ), columns=sql.SQL( columns ) )
+            dbcon.execute_nofetch( q, explain=False, analyze=False )
+        except Exception:
+            self.release( tablename )
+            raise
+
+        with self._lock:
+            if reuse:
+                TempTableManager._reused[ name ] += 1
+            else:
+                TempTableManager._created[ name ] += 1
+                self.tables[ tablename ] = columns
+                self.uncommitted.add( tablename )
+        FDBLogger.debug( f"{'Reusing' if reuse else 'Created'} temp table {tablename}" )
+        return tablename
+
+
+    def release( self, tablename ):
+        with self._lock:
+            self.leased.discard( tablename )
+
+
+    def committed( self ):
+        with self._lock:
+            self.uncommitted.clear()
+
+
+    def rolled_back( self ):
+        with self._lock:
+            for tablename in self.uncommitted:
+                self.tables.pop( tablename, None )
+            self.uncommitted.clear()
+
+
+# ======================================================================
+
+class PreparedStatements:
+    """Registry of named queries that are prepared on the server.
+
+    Queries that run over and over again with different parameters (the
+    processing version lookups, the user lookup in BaseView.check_auth,
+    the object info and lightcurve queries) are registered here with a
+    name.  DBCon.execute_prepared( name, subdict ) prepares the query the
+    first time it's run on a connection, and after that reuses the
+    prepared statement, so the server doesn't have to parse the query
+    (and, once it has settled on a generic plan, plan it) again.
+
+    For this to work, the text of a registered query must never change;
+    everything that varies goes in the substitution dictionary, not in
+    sql.Literals.  Queries that are built on the fly (like the ones in
+    ltcv.py, which depend on which columns you ask for) are registered
+    under a name that encodes the options they were built with; see
+    DBCon.execute_prepared.
+
+    Preparing a statement costs one extra round trip the first time it's
+    used on a connection, so this only pays off on connections that run
+    the same query more than once.  (Set _use_prepared_statements at the
+    top of this module to False to turn preparing off.)
+
+    Use PreparedStatements.stats() to see how many times each statement
+    has been executed and prepared in this process.
+
+    """
+
+    _queries = {}
+    _prepared = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+    _executions = collections.Counter()
+    _prepares = collections.Counter()
+
+
+    @classmethod
+    def register( cls, name, query ):
+        """Register a query.
+
+        Registering the same query under the same name again is fine;
+        registering a different query under a name that's already used
+        is an error.
+
+        Parameters
+        ----------
+          name : str
+
+          query : str
+            The query, with %(var)s placeholders for everything that
+            changes from call to call.
+
+        """
+        with cls._lock:
+            if ( name in cls._queries ) and ( cls._queries[name] != query ):
+                raise ValueError( f"A different query is already registered as prepared statement {name}" )
+            cls._queries[ name ] = query
+
+
+    @classmethod
+    def query( cls, name ):
+        try:
+            return cls._queries[ name ]
+        except KeyError:
+            raise ValueError( f"Unknown prepared statement {name}" )
+
+
+    @classmethod
+    def executed( cls, name, con ):
+        """Record that name was executed on psycopg.Connection con (and whether that prepared it)."""
+        with cls._lock:
+            prepared = cls._prepared.setdefault( con, set() )
+            cls._executions[ name ] += 1
+            if name not in prepared:
+                prepared.add( name )
+                cls._prepares[ name ] += 1
+
+
+    @classmethod
+    def stats( cls ):
+        """Number of times each statement was executed, and prepared, in this process.
+
+        Returns
+        -------
+          dict of name: { 'executions': int, 'prepares': int }
+
+        """
+        with cls._lock:
+            return { name: { 'executions': cls._executions[name], 'prepares': cls._prepares[name] }
+                     for name in sorted( cls._executions.keys() ) }
+
+
+    @classmethod
+    def reset_stats( cls ):
+        with cls._lock:
+            cls._executions.clear()
+            cls._prepares.clear()
+
+
+PreparedStatements.register( 'authuser_by_username',
+                             "SELECT a.id,a.username,a.displayname,a.email,ad.userid IS NOT NULL AS isadmin "
+                             "FROM authuser a "
+                             "LEFT JOIN authuser_admin ad ON a.id=ad.userid "
+                             "WHERE a.username=%(username)s" )
+PreparedStatements.register( 'procver_by_id', "SELECT * FROM processing_version WHERE id=%(pv)s" )
+PreparedStatements.register( 'procver_by_description', "SELECT * FROM processing_version WHERE description=%(pv)s" )
+PreparedStatements.register( 'procver_by_alias',
+                             "SELECT p.* FROM processing_version p "
+                             "INNER JOIN processing_version_alias a ON p.id=a.procver_id "
+                             "WHERE a.description=%(pv)s" )
+PreparedStatements.register( 'base_procver_by_description',
+                             "SELECT id FROM base_processing_version "
+                             "WHERE description=%(pv)s AND _table=%(table)s" )
+
+
+# ======================================================================
+# Decoding the output of COPY ... TO STDOUT (FORMAT BINARY), for DBCon.execute_columnar
+#
+# The format is documented at https://www.postgresql.org/docs/current/sql-copy.html ; in short,
+# a 19-byte header (11-byte signature, int32 flags, int32 header extension length), then for each
+# row an int16 field count followed by (int32 length, bytes) for each field (length -1 for NULL),
+# then an int16 -1.  Everything is big-endian.  The binary representations of the types are
+# the types' send functions in the postgres source.
+
+_pgcopy_signature = b'PGCOPY\n\xff\r\n\x00'
+_int16 = struct.Struct( '>h' )
+_int32 = struct.Struct( '>i' )
+
+# Postgres's epoch is 2000-01-01
+_pg_epoch_us = 946684800 * 1000000
+_pg_epoch_days = 10957
+
+# Fixed-width types: { type oid: numpy dtype of the value as sent }
+_columnar_fixed_types = {
+    16: np.dtype( '?' ),          # boolean
+    20: np.dtype( '>i8' ),        # bigint
+    21: np.dtype( '>i2' ),        # smallint
+    23: np.dtype( '>i4' ),        # integer
+    700: np.dtype( '>f4' ),       # real
+    701: np.dtype( '>f8' ),       # double precision
+    1082: np.dtype( '>i4' ),      # date (days since 2000-01-01)
+    1114: np.dtype( '>i8' ),      # timestamp (μs since 2000-01-01)
+    1184: np.dtype( '>i8' ),      # timestamp with time zone (μs since 2000-01-01 UTC)
+    2950: np.dtype( 'V16' ),      # uuid
+}
+
+
+def _decode_numeric( val ):
+    ndigits, weight, sign, _dscale = struct.unpack_from( '>hhHh', val )
+    if sign == 0xc000:
+        return np.nan
+    if sign == 0xd000:
+        return np.inf
+    if sign == 0xf000:
+        return -np.inf
+    mantissa = 0
+    for digit in struct.unpack_from( f'>{ndigits}h', val, 8 ):
+        mantissa = mantissa * 10000 + digit
+    exponent = 4 * ( weight - ndigits + 1 )
+    # Python int / int is correctly rounded
+    fval = float( mantissa * 10**exponent ) if exponent >= 0 else mantissa / 10**(-exponent)
+    return -fval if sign == 0x4000 else fval
+
+
+# Variable-width types: { type oid: ( function( bytes, encoding ) -> python object, numpy dtype ) }
+_columnar_variable_types = {
+    19: ( lambda val, enc: val.decode( enc ), object ),             # name
+    25: ( lambda val, enc: val.decode( enc ), object ),             # text
+    1042: ( lambda val, enc: val.decode( enc ), object ),           # character
+    1043: ( lambda val, enc: val.decode( enc ), object ),           # character varying
+    114: ( lambda val, enc: json.loads( val.decode( enc ) ), object ),       # json
+    3802: ( lambda val, enc: json.loads( val[1:].decode( enc ) ), object ),  # jsonb (first byte is a version)
+    1700: ( lambda val, enc: _decode_numeric( val ), np.float64 ),  # numeric
+}
+
+
+class _BinaryCopyDecoder:
+    """Turns the data from COPY ... TO STDOUT (FORMAT BINARY) into columns.
+
+    Feed it the data with feed(), then call take() to get the columns.
+
+    If all of the columns are fixed-width, rows are decoded in blocks
+    by viewing the data as a numpy structured array; a row with a NULL
+    in it doesn't fit that array, so it (and only it) is decoded one
+    field at a time.  If any column is variable-width, every row is
+    decoded one field at a time.
+
+    """
+
+    # Don't bother decoding until we have at least this many bytes
+    _parse_bytes = 4 * 1024 * 1024
+    _max_block_rows = 65536
+
+    def __init__( self, names, oids, encoding='utf-8' ):
+        for name, oid in zip( names, oids ):
+            if ( oid not in _columnar_fixed_types ) and ( oid not in _columnar_variable_types ):
+                raise TypeError( f"Don't know how to fetch column {name} (postgres type oid {oid}) as a column; "
+                                 f"cast it to a number, text, or timestamp in the query." )
+        self.names = list( names )
+        self.oids = list( oids )
+        self.encoding = encoding
+        self.fixed = [ oid in _columnar_fixed_types for oid in self.oids ]
+        if all( self.fixed ):
+            fields = [ ( 'nf', '>i2' ) ]
+            for i, oid in enumerate( self.oids ):
+                fields.extend( [ ( f'l{i}', '>i4' ), ( f'v{i}', _columnar_fixed_types[oid] ) ] )
+            self.rowdtype = np.dtype( fields )
+        else:
+            self.rowdtype = None
+        self.blockrows = self._max_block_rows
+
+        self.buf = b''
+        self.pending = []
+        self.npending = 0
+        self.gotheader = False
+        self.done = False
+        self.nrows = 0
+        # For each column, a list of numpy arrays (fixed-width columns) or lists (variable-width columns)
+        self.pieces = [ [] for _ in self.oids ]
+        self.masks = [ [] for _ in self.oids ]
+        # Fields of rows decoded one field at a time that haven't been moved into pieces yet
+        self.raw = [ [] for _ in self.oids ]
+
+
+    def feed( self, data ):
+        self.pending.append( data )
+        self.npending += len( data )
+        if self.npending >= self._parse_bytes:
+            self.parse()
+
+
+    def parse( self, final=False ):
+        """Decode all the complete rows that have been fed so far.
+
+        If final is True, all the data has been fed, so it's an error if
+        the trailer hasn't been seen.
+
+        """
+        buf = self.buf + b''.join( self.pending )
+        self.pending = []
+        self.npending = 0
+        pos = 0
+
+        if not self.gotheader:
+            if len( buf ) >= 19:
+                if buf[0:11] != _pgcopy_signature:
+                    raise RuntimeError( "Data from COPY doesn't start with the binary COPY signature" )
+                extlen = _int32.unpack_from( buf, 15 )[0]
+                if len( buf ) >= 19 + extlen:
+                    pos = 19 + extlen
+                    self.gotheader = True
+
+        while self.gotheader and ( not self.done ):
+            if self.rowdtype is not None:
+                n = min( ( len( buf ) - pos ) // self.rowdtype.itemsize, self.blockrows )
+                if n > 0:
+                    arr = np.frombuffer( buf, dtype=self.rowdtype, count=n, offset=pos )
+                    good = arr['nf'] == len( self.oids )
+                    for i, oid in enumerate( self.oids ):
+                        good &= arr[f'l{i}'] == _columnar_fixed_types[oid].itemsize
+                    ngood = n if good.all() else int( np.argmin( good ) )
+                    # Adjust the block size so that checking rows we don't use doesn't dominate
+                    #   when there are lots of NULLs
+                    if ngood == n:
+                        self.blockrows = min( 2 * self.blockrows, self._max_block_rows )
+                    else:
+                        self.blockrows = max( 2 * ngood, 16 )
+                    if ngood > 0:
+                        self._flush_raw()
+                        for i in range( len( self.oids ) ):
+                            self.pieces[i].append( arr[f'v{i}'][:ngood].copy() )
+                            self.masks[i].append( np.zeros( ngood, dtype=bool ) )
+                        self.nrows += ngood
+                        pos += ngood * self.rowdtype.itemsize
+                        continue
+
+            newpos = self._parse_row( buf, pos )
+            if newpos is None:
+                break
+            pos = newpos
+
+        self.buf = buf[pos:]
+        if final and not self.done:
+            raise RuntimeError( "Binary COPY data ended without a trailer" )
+
+
+    def _parse_row( self, buf, pos ):
+        # Decode one row (or the trailer) one field at a time.
+        # Returns the position after it, or None if buf doesn't have all of it yet.
+        if len( buf ) - pos < 2:
+            return None
+        nfields = _int16.unpack_from( buf, pos )[0]
+        pos += 2
+        if nfields == -1:
+            self.done = True
+            return pos
+        if nfields != len( self.oids ):
+            raise RuntimeError( f"Got a row with {nfields} fields from COPY, expected {len(self.oids)}" )
+
+        vals = []
+        for i in range( nfields ):
+            if len( buf ) - pos < 4:
+                return None
+            length = _int32.unpack_from( buf, pos )[0]
+            pos += 4
+            if length == -1:
+                vals.append( None )
+            else:
+                if len( buf ) - pos < length:
+                    return None
+                vals.append( buf[pos:pos+length] )
+                pos += length
+
+        for i, val in enumerate( vals ):
+            self.raw[i].append( val )
+        self.nrows += 1
+        return pos
+
+
+    def _flush_raw( self ):
+        if len( self.raw[0] ) == 0:
+            return
+        for i, oid in enumerate( self.oids ):
+            raw = self.raw[i]
+            self.masks[i].append( np.array( [ val is None for val in raw ], dtype=bool ) )
+            if self.fixed[i]:
+                dtype = _columnar_fixed_types[oid]
+                zero = bytes( dtype.itemsize )
+                self.pieces[i].append( np.frombuffer( b''.join( zero if val is None else val for val in raw ),
+                                                      dtype=dtype ) )
+            else:
+                decode = _columnar_variable_types[oid][0]
+                self.pieces[i].append( [ None if val is None else decode( val, self.encoding ) for val in raw ] )
+            self.raw[i] = []
+
+
+    def take( self, return_format='numpy', nrows=None ):
+        """Return (and forget) the first nrows (default: all) decoded rows.
+
+        Returns
+        -------
+          ( int, columns )
+            The number of rows, and the columns; see
+            DBCon.execute_columnar for what the columns look like.
+
+        """
+        self._flush_raw()
+        nrows = self.nrows if nrows is None else min( nrows, self.nrows )
+
+        rawcols = []
+        masks = []
+        for i, oid in enumerate( self.oids ):
+            if self.fixed[i]:
+                col = ( np.concatenate( self.pieces[i] ) if len( self.pieces[i] ) > 0
+                        else np.empty( 0, dtype=_columnar_fixed_types[oid] ) )
+            else:
+                col = list( itertools.chain.from_iterable( self.pieces[i] ) )
+            mask = np.concatenate( self.masks[i] ) if len( self.masks[i] ) > 0 else np.empty( 0, dtype=bool )
+            rawcols.append( col[:nrows] )
+            masks.append( mask[:nrows] )
+            self.pieces[i] = [ col[nrows:] ] if len( col ) > nrows else []
+            self.masks[i] = [ mask[nrows:] ] if len( mask ) > nrows else []
+        self.nrows -= nrows
+
+        if return_format == 'arrow':
+            import pyarrow
+            columns = { name: self._arrow_column( oid, col, mask, pyarrow )
+                        for name, oid, col, mask in zip( self.names, self.oids, rawcols, masks ) }
+            return nrows, pyarrow.table( columns )
+
+        return nrows, { name: self._numpy_column( oid, col, mask )
+                        for name, oid, col, mask in zip( self.names, self.oids, rawcols, masks ) }
+
+
+    @staticmethod
+    def _convert_fixed( oid, col ):
+        # Returns a numpy array (without a mask) of col, which has values as they were sent
+        if oid in ( 1114, 1184 ):
+            us = col.astype( np.int64 )
+            rval = ( us + _pg_epoch_us ).view( 'datetime64[us]' )
+            rval[ ( us == np.iinfo( np.int64 ).max ) | ( us == np.iinfo( np.int64 ).min ) ] = np.datetime64( 'NaT' )
+            return rval
+        if oid == 1082:
+            days = col.astype( np.int64 )
+            rval = ( days + _pg_epoch_days ).astype( 'datetime64[D]' )
+            rval[ ( days == np.iinfo( np.int32 ).max ) | ( days == np.iinfo( np.int32 ).min ) ] = np.datetime64( 'NaT' )
+            return rval
+        if oid == 2950:
+            return np.fromiter( ( uuid.UUID( bytes=val.tobytes() ) for val in col ), dtype=object, count=len(col) )
+        return col.astype( col.dtype.newbyteorder( '=' ) )
+
+
+    def _numpy_column( self, oid, col, mask ):
+        if oid in _columnar_fixed_types:
+            col = self._convert_fixed( oid, col )
+        elif _columnar_variable_types[oid][1] is object:
+            return np.fromiter( col, dtype=object, count=len(col) )
+        else:
+            col = np.array( [ 0 if val is None else val for val in col ], dtype=_columnar_variable_types[oid][1] )
+        if ( col.dtype != object ) and mask.any():
+            return np.ma.masked_array( col, mask=mask )
+        if col.dtype == object:
+            col[ mask ] = None
+        return col
+
+
+    def _arrow_column( self, oid, col, mask, pyarrow ):
+        if oid == 2950:
+            return pyarrow.array( [ None if m else str( uuid.UUID( bytes=val.tobytes() ) )
+                                    for val, m in zip( col, mask ) ], type=pyarrow.string() )
+        if oid in ( 114, 3802 ):
+            return pyarrow.array( [ None if val is None else json.dumps( val ) for val in col ],
+                                  type=pyarrow.string() )
+        if oid in _columnar_variable_types:
+            if _columnar_variable_types[oid][1] is object:
+                return pyarrow.array( col, type=pyarrow.string() )
+            col = np.array( [ 0 if val is None else val for val in col ], dtype=_columnar_variable_types[oid][1] )
+        else:
+            col = self._convert_fixed( oid, col )
+        pytype = pyarrow.timestamp( 'us', tz='UTC' ) if oid == 1184 else None
+        mask = mask | np.isnat( col ) if col.dtype.kind == 'M' else mask
+        return pyarrow.array( col, type=pytype, mask=mask if mask.any() else None )
 
 
 # ======================================================================
@@ -1441,12 +2641,19 @@ class DBBase:
              This one is very scary and you should only use it if you
              really know what you're doing.  If this is True, not only
              will we not commit to the database, but we won't copy from
-             the table temp_bulk_upsert to the table of interest.  It
-             doesn't make sense to set this to True unless you also
-             pass a dbcon.  This is for things that want to do stuff to
-             the temp table before copying it over to the main table, in
-             which case it's the caller's responsibility to do that copy
-             and commit to the database.
+             the temp table to the table of interest.  It doesn't make
+             sense to set this to True unless you also pass a dbcon.
+             This is for things that want to do stuff to the temp table
+             before copying it over to the main table, in which case
+             it's the caller's responsibility to do that copy and commit
+             to the database.  The temp table is not one of the reusable
+             ones from DBCon.temp_table (that lease would end when this
+             function returns); it's temp_bulk_nocommit_<table> (where
+             <table> is cls.__tablename__), created ON COMMIT DROP, so
+             it goes away when the caller commits or rolls back.  Use
+             the table name that's returned, and don't call this again
+             for the same table on the same connection until you've
+             committed.
 
         Returns
         -------
@@ -1454,8 +2661,10 @@ class DBBase:
              If nocommit=False, returns the number of rows actually
              inserted (which may be less than len(data)).
 
+           tuple of (str, str)
              If nocommit=True, returns the string to execute to copy
-             from the temp table to the final table.
+             from the temp table to the final table, and the name of the
+             temp table.
 
         """
 
@@ -1486,31 +2695,43 @@ class DBBase:
         else:
             raise TypeError( f"Invalid type for data: {type(data)}" )
 
-        with DBCon( dbcon ) as con:
-            con.execute_nofetch( "DROP TABLE IF EXISTS temp_bulk_upsert", explain=False, analyze=False )
-            con.execute_nofetch( f"CREATE TEMP TABLE temp_bulk_upsert (LIKE {cls.__tablename__} INCLUDING DEFAULTS)",
-                                 explain=False, analyze=False )
-            with con.cursor.copy( f"COPY temp_bulk_upsert({','.join(columns)}) FROM STDIN" ) as copier:
-                for v in values:
-                    copier.write_row( v )
-
-            if not assume_no_conflict:
-                if not upsert:
-                    conflict = "ON CONFLICT DO NOTHING"
-                else:
-                    conflict = ( f"ON CONFLICT ({','.join(cls._pk)}) DO UPDATE SET "
-                                 + ",".join( f"{c}=EXCLUDED.{c}" for c in columns ) )
+        if not assume_no_conflict:
+            if not upsert:
+                conflict = "ON CONFLICT DO NOTHING"
             else:
-                conflict = ""
-
-            q = f"INSERT INTO {cls.__tablename__} SELECT * FROM temp_bulk_upsert {conflict}"
+                conflict = ( f"ON CONFLICT ({','.join(cls._pk)}) DO UPDATE SET "
+                             + ",".join( f"{c}=EXCLUDED.{c}" for c in columns ) )
+        else:
+            conflict = ""
 
+        with DBCon( dbcon ) as con:
             if nocommit:
-                return q
-            else:
-                con.execute_nofetch( q, explain=False, analyze=False )
+                # The caller keeps using the temp table after we return, so
+                #   it can't be a leased one.
+                temptable = f"temp_bulk_nocommit_{cls.__tablename__}"
+                con.execute_nofetch( f"CREATE TEMP TABLE {temptable} "
+                                     f"(LIKE {cls.__tablename__} INCLUDING DEFAULTS) ON COMMIT DROP",
+                                     explain=False, analyze=False )
+                with con.cursor.copy( f"COPY {temptable}({','.join(columns)}) FROM STDIN" ) as copier:
+                    for v in values:
+                        copier.write_row( v )
+                return f"INSERT INTO {cls.__tablename__} SELECT * FROM {temptable} {conflict}", temptable
+
+            # The temp table is left behind so that the next call on this
+            #   connection can reuse it, but it's emptied in the same
+            #   transaction as the INSERT, so it doesn't hang on to the rows
+            #   (memory, temp files) on a long-lived connection.  (If
+            #   something fails before then, the rollback takes the rows back
+            #   out, as they were copied in this transaction.)
+            with con.temp_table( f"temp_bulk_upsert_{cls.__tablename__}",
+                                 f"LIKE {cls.__tablename__} INCLUDING DEFAULTS" ) as temptable:
+                with con.cursor.copy( f"COPY {temptable}({','.join(columns)}) FROM STDIN" ) as copier:
+                    for v in values:
+                        copier.write_row( v )
+                con.execute_nofetch( f"INSERT INTO {cls.__tablename__} SELECT * FROM {temptable} {conflict}",
+                                     explain=False, analyze=False )
                 ninserted = con.cursor.rowcount
-                con.execute_nofetch( "DROP TABLE temp_bulk_upsert", explain=False, analyze=False )
+                con.execute_nofetch( f"TRUNCATE TABLE {temptable}", explain=False, analyze=False )
                 con.commit()
                 return ninserted
 
@@ -1577,9 +2798,8 @@ class BaseProcessingVersion( DBBase ):
         if table is None:
             raise ValueError( "table is required when base_processing_version is not a uuid" )
         with DBCon( dbcon ) as con:
-            rows, _cols = con.execute( "SELECT id FROM base_processing_version "
-                                       "WHERE description=%(pv)s AND _table=%(table)s",
-                                       { 'pv': base_processing_version, 'table': table } )
+            rows, _cols = con.execute_prepared( 'base_procver_by_description',
+                                                { 'pv': base_processing_version, 'table': table } )
             if len(rows) == 0:
                 raise ValueError( f"Unknown base processing version {base_processing_version} "
                                   f"for table {table}" )
@@ -1595,39 +2815,92 @@ class ProcessingVersion( DBBase ):
 
 
     @classmethod
-    def get_procver( cls, processing_version, dbcon=None ):
-        """Return a ProcessingVersion based on a UUID, description, or alias."""
+    def get_procvers( cls, processing_versions, dbcon=None ):
+        """Return ProcessingVersions based on UUIDs, descriptions, or aliases.
 
-        try:
-            pvid = util.asUUID( processing_version )
-        except Exception:
-            pvid = None
+        Looks them all up in one round trip to the database.
 
-        with DBCon( dbcon, dictcursor=True ) as con:
+        Parameters
+        ----------
+          processing_versions : list of str or UUID
+
+          dbcon : db.DBCon or psycopg.Connection or None
+            Database connection to use.  If None, will open a new one
+            and close it when done.
+
+        Returns
+        -------
+          list of ProcessingVersion, in the same order as processing_versions
+
+        """
+        # For each processing version, try (in order) the id, the description,
+        #   and the aliases.  These are all independent, so send them as one batch.
+        queries = []
+        ntries = []
+        for processing_version in processing_versions:
+            try:
+                pvid = util.asUUID( processing_version )
+            except Exception:
+                pvid = None
             if pvid is not None:
-                rows = con.execute( "SELECT * FROM processing_version WHERE id=%(pv)s", { 'pv': pvid } )
-                if len(rows) > 0:
+                queries.append( ( 'procver_by_id', { 'pv': pvid } ) )
+            # (str() because a UUID would be sent as a uuid, which can't be compared to text)
+            queries.append( ( 'procver_by_description', { 'pv': str( processing_version ) } ) )
+            queries.append( ( 'procver_by_alias', { 'pv': str( processing_version ) } ) )
+            ntries.append( 2 if pvid is None else 3 )
+
+        with DBCon( dbcon, dictcursor=True ) as con:
+            results = iter( con.execute_batch( queries, prepared=True ) )
+
+        procvers = []
+        for processing_version, tries in zip( processing_versions, ntries ):
+            found = None
+            for i in range( tries ):
+                rows = next( results )
+                if ( found is None ) and ( len(rows) > 0 ):
                     if len(rows) > 1:
                         raise RuntimeError( "This should never happen." )
-                    return ProcessingVersion( **(rows[0]) )
+                    found = ProcessingVersion( **(rows[0]) )
+            if found is None:
+                raise ValueError( f"Unknown processing version {processing_version}" )
+            procvers.append( found )
+
+        return procvers
+
+
+    @classmethod
+    def get_procver( cls, processing_version, dbcon=None ):
+        """Return a ProcessingVersion based on a UUID, description, or alias."""
+        return cls.get_procvers( [ processing_version ], dbcon=dbcon )[0]
+
 
-            rows = con.execute( "SELECT * FROM processing_version WHERE description=%(pv)s",
-                                { 'pv': processing_version } )
-            if len(rows) > 0:
-                if len(rows) > 1:
-                    raise RuntimeError( "This should never happen." )
-                return ProcessingVersion( **(rows[0]) )
+    @classmethod
+    def procver_ids( cls, processing_versions, dbcon=None ):
+        """Return the uuids of several processing versions, looking them up in one round trip if necessary.
+
+        Parameters are the same as procver_id(), except that
+        processing_versions is a list.  Returns a list of UUID.
+
+        """
+        ids = [ None ] * len( processing_versions )
+        lookup = []
+        for i, processing_version in enumerate( processing_versions ):
+            if isinstance( processing_version, ProcessingVersion ):
+                ids[i] = processing_version.id
+            elif isinstance( processing_version, uuid.UUID ):
+                ids[i] = processing_version
+            else:
+                try:
+                    ids[i] = uuid.UUID( processing_version )
+                except Exception:
+                    lookup.append( i )
 
-            rows = con.execute( "SELECT p.* FROM processing_version p "
-                                "INNER JOIN processing_version_alias a ON p.id=a.procver_id "
-                                "WHERE a.description=%(pv)s",
-                                { 'pv': processing_version } )
-            if len(rows) > 0:
-                if len(rows ) > 1:
-                    raise RuntimeError( "This should never happen." )
-                return ProcessingVersion( **(rows[0]) )
+        if len( lookup ) > 0:
+            pvs = cls.get_procvers( [ processing_versions[i] for i in lookup ], dbcon=dbcon )
+            for i, pv in zip( lookup, pvs ):
+                ids[i] = pv.id
 
-        raise ValueError( f"Unknown processing version {processing_version}" )
+        return ids
 
 
     @classmethod
@@ -1653,20 +2926,7 @@ class ProcessingVersion( DBBase ):
           UUID
 
         """
-
-        if isinstance( processing_version, ProcessingVersion ):
-            return processing_version.id
-        elif isinstance( processing_version, uuid.UUID ):
-            return processing_version
-
-        try:
-            ipv = uuid.UUID( processing_version )
-            return ipv
-        except Exception:
-            pass
-
-        pv = cls.get_procver( processing_version, dbcon=dbcon )
-        return pv.id
+        return cls.procver_ids( [ processing_version ], dbcon=dbcon )[0]
 
 
     def highest_prio_base_procver( self, table, dbcon=None ):
@@ -1918,3 +3178,236 @@ class QueryQueue( DBBase ):
     # Think... would it be OK to let this update?
     def update( self, dbcon=None, refresh=False, nocommit=False ):
         raise NotImplementedError( "update not implemented for QueryQueue" )
+
+
+# ======================================================================
+
+class RowCount( DBBase ):
+    """Cached counts of things per processing version.
+
+    The things are the same things that the /count web API counts:
+    'rootid', 'diaobject', 'diasource', and 'diaforcedsource'.  For a
+    processing version, a thing's count is the number of distinct
+    objects (or root objects, or (rootid, visit) pairs for sources)
+    that you'd get searching with that processing version.  (So, a
+    diasource that shows up in two base processing versions of one
+    processing version only counts once.)
+
+    Rows in row_counts are created with an exact count by reconcile().
+    After that, the importers and loaders call bump() in the same
+    transaction as they insert rows.  bump() just adds the number of
+    rows inserted, which will overcount rows that were already there
+    under a different base processing version of the same processing
+    version, and doesn't know about rows that have been deleted.  Run
+    reconcile() periodically (see services/row_count_reconciler.py) to
+    fix that; the drift it finds is recorded in the table
+    row_count_reconciliation.
+
+    """
+
+    __tablename__ = "row_counts"
+    _tablemeta = None
+    _pk = [ 'procver_id', 'tablename' ]
+
+    things = ( 'rootid', 'diaobject', 'diasource', 'diaforcedsource' )
+
+    # The base_procver_of_procver _table that determines the processing versions a thing belongs to
+    _procver_table = { 'rootid': 'diaobject',
+                       'diaobject': 'diaobject',
+                       'diasource': 'diasource',
+                       'diaforcedsource': 'diaforcedsource' }
+
+
+    @classmethod
+    def distinct_query( cls, thing, procver_id ):
+        """Return ( query, indexes ) for the things that count_query counts.
+
+        query is a sql.Composed that selects one row per distinct thing
+        for processing version procver_id; indexes are the pg_hint_plan
+        index hints count_query uses with it.
+
+        """
+        if thing in ( 'rootid', 'diaobject' ):
+            distinct = 'diaobjectid' if thing == 'diaobject' else 'rootid'
+            indexes = [ 'o idx_diaobject_procver' ]
+            baseq = sql.SQL( "SELECT DISTINCT ON({distinct}) {distinct} FROM diaobject o\n"
+                             "INNER JOIN base_procver_of_procver pv ON o.base_procver_id=pv.base_procver_id\n"
+                             "                                     AND pv.procver_id={pvid}\n"
+                             "ORDER BY {distinct}, pv.priority DESC\n"
+                            ).format( distinct=sql.Identifier("o", distinct), pvid=procver_id )
+        elif thing in ( 'diasource', 'diaforcedsource' ):
+            indexes = [ f's idx_{thing}_base_procver_id', f'o idx_{thing}_diaobjectid' ]
+            baseq = sql.SQL( "SELECT DISTINCT ON(o.rootid, s.visit) {idfield} FROM {table} s\n"
+                             "INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id\n"
+                             "                                     AND pv.procver_id={pvid}\n"
+                             "INNER JOIN diaobject o ON o.diaobjectid=s.diaobjectid\n"
+                             "ORDER BY o.rootid, s.visit, pv.priority DESC\n"
+                            ).format( table=sql.Identifier(thing),
+                                      idfield=sql.Identifier("s", f"{thing}id" ),
+                                      pvid=procver_id )
+        else:
+            raise ValueError( f"Unknown thing to count: {thing}" )
+        return baseq, indexes
+
+
+    @classmethod
+    def count_query( cls, thing, procver_id ):
+        """Return a sql.Composed that does an exact count of thing for processing version procver_id.
+
+        This can be slow (it's a COUNT over a DISTINCT ON); it's what
+        reconcile() runs.
+
+        """
+        baseq, indexes = cls.distinct_query( thing, procver_id )
+
+        # Forcing parallel workers here; see the comment in
+        #   webserver/server.py::CountThings.
+        q = sql.SQL( "/*+ " )
+        q += sql.SQL(" ").join( sql.SQL( f"IndexScan({i})" ) for i in indexes )
+        q += sql.SQL( " Parallel(t 4) */\n" )
+        q += sql.SQL( "SELECT COUNT(*) FROM (\n{baseq}\n) subq" ).format( baseq=baseq )
+        return q
+
+
+    @classmethod
+    def get_count( cls, processing_version, thing, dbcon=None ):
+        """Return the cached row_counts row for thing as a dict, or None if there isn't a usable one.
+
+        The dict has keys nrows, updated_at, and reconciled_at.
+
+        """
+        with DBCon( dbcon, dictcursor=True ) as con:
+            pvid = ProcessingVersion.procver_id( processing_version, dbcon=con )
+            rows = con.execute( "SELECT nrows, updated_at, reconciled_at FROM row_counts "
+                                "WHERE procver_id=%(pv)s AND tablename=%(thing)s",
+                                { 'pv': pvid, 'thing': thing } )
+            if ( len(rows) == 0 ) or ( rows[0]['nrows'] is None ):
+                return None
+            return rows[0]
+
+
+    @classmethod
+    def bump( cls, thing, base_procver_id, n, dbcon=None, commit=False ):
+        """Add n to the cached count of thing for every processing version that includes base_procver_id.
+
+        Call this in the same transaction that inserts the rows, right
+        before committing.  Only touches processing
+        versions that already have a row in row_counts (i.e. that have
+        been reconciled at least once); others will get an exact count
+        the first time somebody asks.
+
+        Parameters
+        ----------
+          thing : str
+            One of RowCount.things
+
+          base_procver_id : UUID
+            The base processing version of the rows inserted.  (For
+            'rootid', the base processing version of the diaobjects
+            that created the root objects.)
+
+          n : int
+            Number of rows inserted.
+
+          dbcon : DBCon or psycopg.Connection, default None
+            Database connection to use.  If None, opens a new one (in
+            which case you want commit=True).
+
+          commit : bool, default False
+            Commit when done.  Leave this False if you're calling this
+            in the middle of a transaction that inserts the rows.  (Bulk
+            loaders that have already committed the rows may set it to
+            True.)
+
+        """
+        if thing not in cls.things:
+            raise ValueError( f"Unknown thing to count: {thing}" )
+        if ( n is None ) or ( n <= 0 ):
+            return
+        with DBCon( dbcon ) as con:
+            con.execute_nofetch( "UPDATE row_counts r SET nrows=r.nrows+%(n)s, bumped=r.bumped+%(n)s, "
+                                 "  updated_at=NOW()\n"
+                                 "FROM base_procver_of_procver j\n"
+                                 "WHERE j.base_procver_id=%(bpv)s AND j._table=%(pvtab)s\n"
+                                 "  AND r.procver_id=j.procver_id AND r.tablename=%(thing)s",
+                                 { 'n': n, 'bpv': base_procver_id, 'pvtab': cls._procver_table[thing],
+                                   'thing': thing },
+                                 explain=False, analyze=False )
+            if commit:
+                con.commit()
+
+
+    @classmethod
+    def reconcile( cls, processing_version, thing, dbcon=None ):
+        """Do an exact count of thing for processing_version, and store it in row_counts.
+
+        Records the count, and the drift of the incrementally
+        maintained count (if there was one) from it, in
+        row_count_reconciliation.
+
+        The count runs in a REPEATABLE READ snapshot without locking
+        anything, so importers can keep calling bump() while it runs.
+        row_counts.bumped is the running total of everything bump()
+        has added, and bump() runs in the same transaction as the
+        inserts, so the value of bumped in the snapshot goes with the
+        rows the count saw.  Afterwards, the row is locked just long
+        enough to store the count plus whatever was bumped since the
+        snapshot.  COMMITS to the database.
+
+        Parameters
+        ----------
+          processing_version : UUID, str, or ProcessingVersion
+
+          thing : str
+            One of RowCount.things
+
+          dbcon : DBCon or psycopg.Connection, default None
+            Database connection to use.  Whatever transaction was
+            ongoing will be committed.
+
+        Returns
+        -------
+          ( nrows, drift ) ; drift is None if there wasn't a previous count.
+
+        """
+        if thing not in cls.things:
+            raise ValueError( f"Unknown thing to count: {thing}" )
+
+        with DBCon( dbcon ) as con:
+            pvid = ProcessingVersion.procver_id( processing_version, dbcon=con )
+            subdict = { 'pv': pvid, 'thing': thing }
+            con.execute_nofetch( "INSERT INTO row_counts(procver_id, tablename, nrows) "
+                                 "VALUES (%(pv)s, %(thing)s, NULL) ON CONFLICT DO NOTHING",
+                                 subdict, explain=False, analyze=False )
+            con.commit()
+
+            con.execute_nofetch( "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY",
+                                 explain=False, analyze=False )
+            rows, _ = con.execute( "SELECT nrows, bumped FROM row_counts "
+                                   "WHERE procver_id=%(pv)s AND tablename=%(thing)s", subdict, explain=False )
+            previous, snapbumped = rows[0]
+            t0 = time.perf_counter()
+            rows, _ = con.execute( cls.count_query( thing, pvid ) )
+            count = rows[0][0]
+            duration = time.perf_counter() - t0
+            con.commit()
+            drift = None if previous is None else previous - count
+
+            # Add on whatever was bumped since the snapshot
+            rows, _ = con.execute( "SELECT bumped FROM row_counts WHERE procver_id=%(pv)s AND tablename=%(thing)s "
+                                   "FOR UPDATE", subdict, explain=False )
+            nrows = count + rows[0][0] - snapbumped
+            con.execute_nofetch( "UPDATE row_counts SET nrows=%(n)s, updated_at=NOW(), reconciled_at=NOW() "
+                                 "WHERE procver_id=%(pv)s AND tablename=%(thing)s",
+                                 { **subdict, 'n': nrows }, explain=False, analyze=False )
+            con.execute_nofetch( "INSERT INTO row_count_reconciliation(procver_id, tablename, previous_nrows, "
+                                 "                                     nrows, drift, duration) "
+                                 "VALUES (%(pv)s, %(thing)s, %(prev)s, %(n)s, %(drift)s, %(dur)s)",
+                                 { **subdict, 'prev': previous, 'n': count, 'drift': drift, 'dur': duration },
+                                 explain=False, analyze=False )
+            con.commit()
+
+            if ( drift is not None ) and ( drift != 0 ):
+                FDBLogger.warning( f"Row count of {thing} for processing version {pvid} had drifted by {drift} "
+                                   f"(was {previous}, is {count})" )
+            return nrows, drift
@@ -7,6 +7,8 @@ import argparse
 import collections
 import logging
 import atexit
+import queue
+import threading
 
 import fastavro
 import confluent_kafka
@@ -29,13 +31,199 @@ def _close_kafka_consumer( obj ):
     obj.close()
 
 
+class _Prefetcher:
+    """Consume batches in a background thread so that fetching overlaps handling.
+
+    Used by KafkaConsumer.poll_loop when prefetch > 0.  Keeps up to
+    maxbatches batches in a queue.  When the queue is full, pauses all
+    assigned partitions (but keeps calling consume() so the consumer
+    stays in its group) and resumes them once there's room.
+
+    """
+
+    def __init__( self, kafkaconsumer, maxbatches, timeout=None ):
+        self.kc = kafkaconsumer
+        # If None, use the consumer's consume_timeout (which may be adaptive)
+        self.timeout = timeout
+        self.queue = queue.Queue( maxsize=maxbatches )
+        self._stop = threading.Event()
+        self._pending = None
+        self._paused = []
+        self.npauses = 0
+        self.exception = None
+        self._thread = threading.Thread( target=self._run, name="kafka-prefetch", daemon=True )
+
+    def start( self ):
+        self._thread.start()
+
+    def _run( self ):
+        consumer = self.kc.consumer
+        try:
+            while not self._stop.is_set():
+                if self._pending is not None:
+                    try:
+                        self.queue.put( self._pending, timeout=0.1 )
+                        self._pending = None
+                    except queue.Full:
+                        if len( self._paused ) == 0:
+                            self._paused = consumer.assignment()
+                            if len( self._paused ) > 0:
+                                self.kc.logger.debug( "Prefetch queue full, pausing partitions" )
+                                consumer.pause( self._paused )
+                                self.npauses += 1
+                                if self.kc.metrics is not None:
+                                    self.kc.metrics.inc( 'fastdb_kafka_prefetch_pauses_total',
+                                                         helpstr="Times partitions were paused for a full "
+                                                                 "prefetch queue" )
+                        # Keep the consumer alive in the group.  Partitions are paused, so this
+                        #   shouldn't return anything, but if it does, hang on to it.
+                        strays = consumer.consume( self.kc.consume_nmsgs, timeout=0.1 )
+                        if len( strays ) > 0:
+                            self._pending.extend( strays )
+                    continue
+
+                if len( self._paused ) > 0:
+                    self.kc.logger.debug( "Prefetch queue has room, resuming partitions" )
+                    consumer.resume( self._paused )
+                    self._paused = []
+
+                timeout = self.timeout if self.timeout is not None else self.kc.consume_timeout
+                msgs = consumer.consume( self.kc.consume_nmsgs, timeout=timeout )
+                if len( msgs ) > 0:
+                    self._pending = msgs
+                else:
+                    self._stop.wait( self.kc.nomsg_sleeptime )
+        except Exception as ex:
+            self.exception = ex
+            self.kc.logger.error( f"Exception in kafka prefetch thread: {ex}" )
+
+    def get( self, timeout ):
+        """Return the next batch, or [] if none shows up within timeout seconds."""
+        if self.exception is not None:
+            raise self.exception
+        try:
+            return self.queue.get( timeout=timeout )
+        except queue.Empty:
+            return []
+
+    def stop( self ):
+        """Stop the thread, and rewind partitions so unhandled prefetched messages will be consumed again."""
+        self._stop.set()
+        self._thread.join()
+        unhandled = []
+        while True:
+            try:
+                unhandled.extend( self.queue.get_nowait() )
+            except queue.Empty:
+                break
+        if self._pending is not None:
+            unhandled.extend( self._pending )
+            self._pending = None
+        consumer = self.kc.consumer
+        if len( self._paused ) > 0:
+            consumer.resume( self._paused )
+            self._paused = []
+        firstoffsets = {}
+        for msg in unhandled:
+            key = ( msg.topic(), msg.partition() )
+            firstoffsets[key] = min( firstoffsets.get( key, msg.offset() ), msg.offset() )
+        for ( topic, partition ), offset in firstoffsets.items():
+            try:
+                consumer.seek( confluent_kafka.TopicPartition( topic, partition, offset ) )
+            except Exception as ex:
+                # Probably the partition was revoked; it will be redelivered to
+                #   whoever got it, since we never stored an offset past it.
+                self.kc.logger.warning( f"Couldn't rewind {topic}[{partition}] to {offset}: {ex}" )
+        if len( unhandled ) > 0:
+            self.kc.logger.info( f"Discarded {len(unhandled)} prefetched but unhandled messages; "
+                                 f"rewound {len(firstoffsets)} partitions." )
+
+
+# ======================================================================
+
+class _BatchController:
+    """Tune KafkaConsumer's consume_nmsgs and consume_timeout from what poll_loop sees.
+
+    Used by KafkaConsumer when adaptive=True.  After every batch,
+    update() is told how many messages came back, how long the handler
+    took, and (if known) how many messages are waiting on the server.
+
+      * Full batch, or a backlog bigger than a batch: the stream is busy.
+        Grow the batch size (so per-batch overhead is amortized) and
+        shrink the timeout (full batches come back before it matters).
+      * Partial batch: the stream is thin.  Shrink the batch size
+        towards twice what we got, and shrink the timeout so messages
+        aren't held waiting for a batch that won't fill.
+      * No messages: wait longer on the next consume.
+      * Whatever else happens, don't let the batch size grow past what
+        the handler can get through in target_handle_time seconds.
+
+    Everything stays within [ min_nmsgs, max_nmsgs ] and
+    [ min_timeout, max_timeout ].
+
+    """
+
+    grow = 1.5
+    shrink = 0.8
+
+    def __init__( self, nmsgs, timeout, min_nmsgs, max_nmsgs, min_timeout, max_timeout, target_handle_time ):
+        if not ( 1 <= min_nmsgs <= max_nmsgs ):
+            raise ValueError( f"Need 1 ≤ min_nmsgs ≤ max_nmsgs, got {min_nmsgs}, {max_nmsgs}" )
+        if not ( 0 < min_timeout <= max_timeout ):
+            raise ValueError( f"Need 0 < min_timeout ≤ max_timeout, got {min_timeout}, {max_timeout}" )
+        self.min_nmsgs = int( min_nmsgs )
+        self.max_nmsgs = int( max_nmsgs )
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.target_handle_time = target_handle_time
+        self.nmsgs = min( max( int( nmsgs ), self.min_nmsgs ), self.max_nmsgs )
+        self.timeout = min( max( timeout, self.min_timeout ), self.max_timeout )
+        self.state = "initial"
+
+
+    def update( self, ngot, handle_time, backlog=None ):
+        """Adjust after a batch; returns ( nmsgs, timeout, changed )."""
+        nmsgs = self.nmsgs
+        timeout = self.timeout
+
+        if ngot == 0:
+            self.state = "idle"
+            timeout *= self.grow
+        elif ( ngot >= self.nmsgs ) or ( ( backlog is not None ) and ( backlog > self.nmsgs ) ):
+            self.state = "busy"
+            nmsgs *= self.grow
+            timeout *= self.shrink
+        else:
+            self.state = "thin"
+            nmsgs = max( 2 * ngot, nmsgs * self.shrink )
+            timeout *= self.shrink
+
+        if ( ngot > 0 ) and ( self.target_handle_time is not None ):
+            pertime = handle_time / ngot
+            if pertime > 0:
+                ceiling = self.target_handle_time / pertime
+                if nmsgs > ceiling:
+                    self.state = "handler-bound"
+                    nmsgs = ceiling
+
+        nmsgs = min( max( int( nmsgs ), self.min_nmsgs ), self.max_nmsgs )
+        timeout = min( max( timeout, self.min_timeout ), self.max_timeout )
+        changed = ( nmsgs != self.nmsgs ) or ( timeout != self.timeout )
+        self.nmsgs = nmsgs
+        self.timeout = timeout
+        return nmsgs, timeout, changed
+
+
+# ======================================================================
+
 class KafkaConsumer:
     """Consume messages from a kafka server using a confluent_kafka.Consumer."""
 
     def __init__( self, server, groupid, schemaless=False, schema=None, topics=None, reset=False,
                   extraconsumerconfig={},
                   consume_nmsgs=100, consume_timeout=1, nomsg_sleeptime=1,
-                  logger=_logger, countlogger=None ):
+                  logger=_logger, countlogger=None, metrics=None, lag_interval=30, prefetch=0,
+                  adaptive=False, consume_nmsgs_range=None, consume_timeout_range=None, target_handle_time=10 ):
         """Constructor.
 
         Parameters
@@ -86,6 +274,55 @@ class KafkaConsumer:
 
           countlogger: logging.Logger (optional and really in the weeds)
 
+          metrics: metrics.MetricsRegistry or None
+            If not None, poll_loop records message counts, consume and
+            handle times, and per-partition consumer lag here, and
+            includes a snapshot of it in pipe heartbeats.
+
+          lag_interval: float, default 30
+            Ignored if metrics is None.  poll_loop updates consumer lag
+            metrics this often (seconds).  (This requires a round trip
+            to the kafka server, so don't make it too short.)
+
+          prefetch: int, default 0
+            If more than 0, poll_loop runs a background thread that
+            consumes batches while the handler is working on the
+            previous one, keeping up to this many batches in a queue.
+            When the queue is full, the consumer's partitions are
+            paused until there's room.  In this mode, offsets are only
+            stored (and thus auto-committed) for messages after the
+            handler has returned, so messages that were prefetched but
+            never handled will be redelivered.  (This sets
+            enable.auto.offset.store to false in the consumer config.)
+
+          adaptive: bool, default False
+            If True, poll_loop tunes consume_nmsgs and consume_timeout
+            after every batch based on how full the batch was, how long
+            the handler took, and the consumer lag.  (The lag is
+            refreshed every lag_interval seconds.)  Changes are logged
+            at INFO, and if metrics is not None the current values are
+            in the gauges fastdb_kafka_consume_nmsgs and
+            fastdb_kafka_consume_timeout_seconds.  Ignored for calls to
+            poll_loop that pass an explicit timeout (the batch size is
+            still tuned).
+
+          consume_nmsgs_range: ( int, int ) or None
+            Ignored unless adaptive is True.  Minimum and maximum batch
+            size.  Defaults to ( consume_nmsgs // 10, consume_nmsgs * 10 ).
+
+          consume_timeout_range: ( float, float ) or None
+            Ignored unless adaptive is True.  Minimum and maximum
+            consume timeout in seconds.  Defaults to
+            ( min( 0.1, consume_timeout ), consume_timeout * 10 ).
+
+          target_handle_time: float or None, default 10
+            Ignored unless adaptive is True.  Don't grow batches past
+            the size the handler can get through in this many seconds.
+            (Keep this well under the kafka server's
+            max.poll.interval.ms, or you'll get kicked out of the
+            consumer group.)  None means no limit other than
+            consume_nmsgs_range.
+
         """
 
         self.logger = logger
@@ -108,9 +345,30 @@ class KafkaConsumer:
         self.consume_time = 0
         self.handle_time = 0
 
+        self.metrics = metrics
+        self.lag_interval = lag_interval
+        self.prefetch = prefetch
+        self.lag_total = None
+
+        self.batchcontrol = None
+        if adaptive:
+            consume_nmsgs_range = ( consume_nmsgs_range if consume_nmsgs_range is not None
+                                    else ( max( 1, consume_nmsgs // 10 ), consume_nmsgs * 10 ) )
+            consume_timeout_range = ( consume_timeout_range if consume_timeout_range is not None
+                                      else ( min( 0.1, consume_timeout ), consume_timeout * 10 ) )
+            self.batchcontrol = _BatchController( consume_nmsgs, consume_timeout,
+                                                  consume_nmsgs_range[0], consume_nmsgs_range[1],
+                                                  consume_timeout_range[0], consume_timeout_range[1],
+                                                  target_handle_time )
+            self.consume_nmsgs = self.batchcontrol.nmsgs
+            self.consume_timeout = self.batchcontrol.timeout
+            self._record_batchcontrol()
+
         consumerconfig = { 'bootstrap.servers': server,
                            'auto.offset.reset': 'earliest',
                            'group.id': groupid }
+        if self.prefetch > 0:
+            consumerconfig['enable.auto.offset.store'] = False
         consumerconfig.update( extraconsumerconfig )
         self.logger.debug( f"Initializing Kafka consumer with\n{json.dumps(consumerconfig, indent=4)}" )
         self.logger.debug( f"Topics given at KafkaConsumer init: {self.topics}" )
@@ -258,6 +516,94 @@ class KafkaConsumer:
         self.logger.debug( ofp.getvalue() )
         ofp.close()
 
+    def record_batch( self, msgs, consume_time, handle_time ):
+        """Record metrics for a batch of messages that has been consumed and handled."""
+        if self.metrics is None:
+            return
+        perpartition = collections.Counter( ( msg.topic(), msg.partition() ) for msg in msgs )
+        for ( topic, partition ), n in perpartition.items():
+            self.metrics.inc( 'fastdb_kafka_messages_consumed_total', n,
+                              helpstr="Messages consumed and handled", topic=topic, partition=partition )
+        self.metrics.observe( 'fastdb_kafka_consume_seconds', consume_time,
+                              helpstr="Time spent in confluent_kafka consume() per batch" )
+        self.metrics.observe( 'fastdb_kafka_handle_seconds', handle_time,
+                              helpstr="Time spent in the message handler per batch" )
+        self.metrics.observe( 'fastdb_kafka_batch_messages', len(msgs),
+                              helpstr="Number of messages per consumed batch",
+                              buckets=( 1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000 ) )
+
+
+    def update_lag_metrics( self, timeout=10 ):
+        """Set per-partition consumer lag gauges (high watermark minus committed offset).
+
+        Only looks at partitions currently assigned to this consumer.
+        If the group has never committed an offset for a partition, lag
+        is measured from the consumer's current position (or the low
+        watermark if there isn't one of those either).
+
+        Also sets self.lag_total to the total lag over all assigned
+        partitions (used by the adaptive batch controller).
+
+        """
+        if ( self.metrics is None ) and ( self.batchcontrol is None ):
+            return
+        assignment = self.consumer.assignment()
+        if len( assignment ) == 0:
+            self.lag_total = None
+            return
+        committed = self.consumer.committed( assignment, timeout=timeout )
+        positions = { ( p.topic, p.partition ): p.offset for p in self.consumer.position( assignment ) }
+        lag_total = 0
+        for tp in committed:
+            lowmark, highmark = self.consumer.get_watermark_offsets( tp, timeout=timeout )
+            offset = tp.offset
+            if offset < 0:
+                offset = positions.get( ( tp.topic, tp.partition ), -1 )
+            if offset < 0:
+                offset = lowmark
+            lag_total += max( highmark - offset, 0 )
+            if self.metrics is None:
+                continue
+            labels = { 'topic': tp.topic, 'partition': tp.partition }
+            self.metrics.set( 'fastdb_kafka_consumer_lag', max( highmark - offset, 0 ),
+                              helpstr="High watermark minus committed offset", **labels )
+            self.metrics.set( 'fastdb_kafka_committed_offset', offset, **labels )
+            self.metrics.set( 'fastdb_kafka_high_watermark', highmark, **labels )
+        self.lag_total = lag_total
+
+
+    def _record_batchcontrol( self ):
+        if ( self.metrics is None ) or ( self.batchcontrol is None ):
+            return
+        self.metrics.set( 'fastdb_kafka_consume_nmsgs', self.consume_nmsgs,
+                          helpstr="Current number of messages requested per consume (adaptive)" )
+        self.metrics.set( 'fastdb_kafka_consume_timeout_seconds', self.consume_timeout,
+                          helpstr="Current consume timeout (adaptive)" )
+
+
+    def adapt_batching( self, ngot, handle_time, nqueued=0 ):
+        """Let the adaptive batch controller (if any) adjust consume_nmsgs and consume_timeout after a batch.
+
+        nqueued is the number of messages already consumed but waiting
+        locally (i.e. in the prefetch queue); they're counted as backlog
+        along with the consumer lag on the server.
+
+        """
+        if self.batchcontrol is None:
+            return
+        backlog = None
+        if ( self.lag_total is not None ) or ( nqueued > 0 ):
+            backlog = ( self.lag_total if self.lag_total is not None else 0 ) + nqueued
+        nmsgs, timeout, changed = self.batchcontrol.update( ngot, handle_time, backlog=backlog )
+        self.consume_nmsgs = nmsgs
+        self.consume_timeout = timeout
+        if changed:
+            self.logger.info( f"Adaptive batching ({self.batchcontrol.state}): consume_nmsgs={nmsgs}, "
+                              f"consume_timeout={timeout:.3g}s (last batch: {ngot} messages, "
+                              f"handled in {handle_time:.3g}s; backlog {backlog})" )
+            self._record_batchcontrol()
+
+
     def poll_loop( self, handler=None, timeout=None, pipe=None, stopafter=datetime.timedelta(hours=1),
                    stopafternmessages=None, stopafternsleeps=None, maint_func=None, maint_timeout=60 ):
         """Calls handler with batches of messages.
@@ -311,61 +657,104 @@ class KafkaConsumer:
 
         """
 
-        timeout = timeout if timeout is not None else self.consume_timeout
+        fixedtimeout = timeout
         handler = handler if handler is not None else self.default_handle_message_batch
         t0 = datetime.datetime.now()
         next_maint_timeout = time.monotonic() + maint_timeout
+        next_lag_update = time.monotonic()
         nsleeps = 0
         nconsumed = 0
         keepgoing = True
         retval = True
-        while keepgoing:
-            self.logger.debug( f"Trying to consume {self.consume_nmsgs} messages "
-                               f"with timeout {timeout} sec...\n" )
-            tperf0 = time.perf_counter()
-            msgs = self.consumer.consume( self.consume_nmsgs, timeout=timeout )
-            if len(msgs) == 0:
-                if ( stopafternsleeps is not None ) and ( nsleeps >= stopafternsleeps ):
-                    self.logger.debug( f"Stopping after {nsleeps} consecutive sleeps." )
-                    keepgoing = False
+        prefetcher = None
+        if self.prefetch > 0:
+            prefetcher = _Prefetcher( self, self.prefetch, fixedtimeout )
+            prefetcher.start()
+        try:
+            while keepgoing:
+                # consume_timeout can change from batch to batch if self.batchcontrol is not None
+                timeout = fixedtimeout if fixedtimeout is not None else self.consume_timeout
+                self.logger.debug( f"Trying to consume {self.consume_nmsgs} messages "
+                                   f"with timeout {timeout} sec...\n" )
+                tperf0 = time.perf_counter()
+                if prefetcher is not None:
+                    msgs = prefetcher.get( timeout + self.nomsg_sleeptime )
+                    if self.metrics is not None:
+                        self.metrics.set( 'fastdb_kafka_prefetch_queue_batches', prefetcher.queue.qsize(),
+                                          helpstr="Batches waiting in the prefetch queue" )
                 else:
-                    self.logger.debug( f"...no messages, sleeping {self.nomsg_sleeptime} sec" )
-                    time.sleep( self.nomsg_sleeptime )
-                    nsleeps += 1
-            else:
-                tperf1 = time.perf_counter()
-                self.logger.debug( f"...got {len(msgs)} messages" )
-                nsleeps = 0
-                handler( msgs )
-                self.tot_handled += len( msgs )
-                nconsumed += len( msgs )
-                tperf2 = time.perf_counter()
-                self.consume_time += tperf1 - tperf0
-                self.handle_time += tperf2 - tperf1
-
-            runtime = datetime.datetime.now() - t0
-            if ( ( ( stopafternmessages is not None ) and ( nconsumed >= stopafternmessages ) )
-                 or
-                 ( ( stopafter is not None ) and ( runtime > stopafter ) )
-                ):
-                keepgoing = False
-
-            if ( maint_func is not None ) and ( time.monotonic() > next_maint_timeout ):
-                self.logger.warning( "Calling maint_func" )
-                maint_func()
-                next_maint_timeout += maint_timeout
-
-            if pipe is not None:
-                pipe.send( { "message": "ok", "nconsumed": nconsumed,
-                             "tot_handled": self.tot_handled, "runtime": runtime } )
-                if pipe.poll():
-                    msg = pipe.recv()
-                    if ( 'command' in msg ) and ( msg['command'] == 'die' ):
-                        self.logger.info( "Exiting poll loop due to die command." )
-                        retval = False
+                    msgs = self.consumer.consume( self.consume_nmsgs, timeout=timeout )
+                if len(msgs) == 0:
+                    self.adapt_batching( 0, 0. )
+                    if ( stopafternsleeps is not None ) and ( nsleeps >= stopafternsleeps ):
+                        self.logger.debug( f"Stopping after {nsleeps} consecutive sleeps." )
                         keepgoing = False
+                    elif prefetcher is not None:
+                        # prefetcher.get already waited
+                        nsleeps += 1
                     else:
-                        self.logger.error( f"Ignoring unknown message from pipe: {msg}" )
+                        self.logger.debug( f"...no messages, sleeping {self.nomsg_sleeptime} sec" )
+                        time.sleep( self.nomsg_sleeptime )
+                        nsleeps += 1
+                else:
+                    tperf1 = time.perf_counter()
+                    self.logger.debug( f"...got {len(msgs)} messages" )
+                    nsleeps = 0
+                    handler( msgs )
+                    if prefetcher is not None:
+                        try:
+                            self.consumer.store_offsets( messages=msgs )
+                        except confluent_kafka.KafkaException as ex:
+                            # Happens if a partition was revoked while we were handling its
+                            #   messages; whoever has it now will get them again.
+                            self.logger.warning( f"Failed to store offsets for handled messages: {ex}" )
+                    self.tot_handled += len( msgs )
+                    nconsumed += len( msgs )
+                    tperf2 = time.perf_counter()
+                    self.consume_time += tperf1 - tperf0
+                    self.handle_time += tperf2 - tperf1
+                    self.record_batch( msgs, tperf1 - tperf0, tperf2 - tperf1 )
+                    self.adapt_batching( len(msgs), tperf2 - tperf1,
+                                         nqueued=( 0 if prefetcher is None
+                                                   else prefetcher.queue.qsize() * self.consume_nmsgs ) )
+
+                if ( ( ( self.metrics is not None ) or ( self.batchcontrol is not None ) )
+                     and ( time.monotonic() > next_lag_update ) ):
+                    try:
+                        self.update_lag_metrics()
+                    except Exception as ex:
+                        self.logger.warning( f"Failed to update consumer lag metrics: {ex}" )
+                    next_lag_update = time.monotonic() + self.lag_interval
+
+                runtime = datetime.datetime.now() - t0
+                if ( ( ( stopafternmessages is not None ) and ( nconsumed >= stopafternmessages ) )
+                     or
+                     ( ( stopafter is not None ) and ( runtime > stopafter ) )
+                    ):
+                    keepgoing = False
+
+                if ( maint_func is not None ) and ( time.monotonic() > next_maint_timeout ):
+                    self.logger.warning( "Calling maint_func" )
+                    maint_func()
+                    next_maint_timeout += maint_timeout
+
+                if pipe is not None:
+                    heartbeat = { "message": "ok", "nconsumed": nconsumed,
+                                  "tot_handled": self.tot_handled, "runtime": runtime }
+                    if self.metrics is not None:
+                        heartbeat["metrics"] = self.metrics.snapshot()
+                    pipe.send( heartbeat )
+                    if pipe.poll():
+                        msg = pipe.recv()
+                        if ( 'command' in msg ) and ( msg['command'] == 'die' ):
+                            self.logger.info( "Exiting poll loop due to die command." )
+                            retval = False
+                            keepgoing = False
+                        else:
+                            self.logger.error( f"Ignoring unknown message from pipe: {msg}" )
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
 
         self.logger.info( f"Stopping poll loop after consuming {nconsumed} messages during {runtime}" )
         return retval
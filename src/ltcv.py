@@ -1,10 +1,12 @@
-__all__ = [ "object_ltcv", "object_search", "get_hot_ltcvs" ]
+__all__ = [ "object_ltcv", "object_search", "get_hot_ltcvs", "random_rootids", "import_watermark" ]
 
+import time
 import datetime
 import numbers
 import textwrap
 import random
 import json   # noqa: F401
+import contextlib
 
 from psycopg import sql
 import numpy as np
@@ -159,20 +161,12 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
         if len(objids) == 0:
             raise ValueError( "no objids requested" )
 
-    objpvid = None
     if base_procvers is not None:
         if not util.isSequence( base_procvers ):
             raise TypeError( "base_procvers must be a list of uuids" )
         base_procvers = [ util.asUUID(v) for v in base_procvers ]
         if processing_version is not None:
             FDBLogger.warning( "Both processing_version and base_procvers given, ignoring processing_version" )
-    else:
-        objpvid = db.ProcessingVersion.procver_id( processing_version
-                                                   if processing_version is not None
-                                                   else "default" )
-
-    pospvid = ( objpvid if position_processing_version is None
-                else db.ProcessingVersion.procver_id( position_processing_version ) )
 
     objcols = [ 'diaobjectid', 'rootid', 'obj_base_procver' ]
     poscols = [ 'pos_base_procver', 'ra', 'dec', 'raerr', 'decerr', 'ra_dec_cov' ]
@@ -202,7 +196,7 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
                                else sql.Identifier( 'p', 'description' ) + sql.SQL( " AS " ) + sql.Identifier( c ) )
     sqlcolumns = sql.SQL(',').join( c for c in sqlcolumns )
 
-    if gotsomepos and ( pospvid is None ):
+    if gotsomepos and ( base_procvers is not None ) and ( position_processing_version is None ):
         raise ValueError( "Must supply a position processing_version with base_procvers" )
 
     if ( not gotsomepos ) and ( position_processing_version is not None ):
@@ -210,6 +204,20 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
                            "ignoring the position processing version." )
 
     with db.DBCon( dbcon ) as dbcon:
+        # Look up the object and position processing versions together (one round trip)
+        objpvid = None
+        pospvid = None
+        lookup = []
+        if base_procvers is None:
+            lookup.append( processing_version if processing_version is not None else "default" )
+        if position_processing_version is not None:
+            lookup.append( position_processing_version )
+        if len( lookup ) > 0:
+            pvids = db.ProcessingVersion.procver_ids( lookup, dbcon=dbcon )
+            if base_procvers is None:
+                objpvid = pvids[0]
+            pospvid = pvids[-1] if position_processing_version is not None else objpvid
+
         if obj_is_root:
             q = sql.SQL( "/*+ IndexScan(o idx_diaobject_rootid)\n" )
         else:
@@ -229,11 +237,10 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
             q += sql.SQL( textwrap.dedent(
                 """\
                 INNER JOIN base_procver_of_procver pv ON b.id=pv.base_procver_id
-                                                     AND pv.procver_id={objpvid}
-                """ ) ).format( objpvid=objpvid )
+                                                     AND pv.procver_id=%(objpvid)s
+                """ ) )
         else:
-            q += sql.SQL( "                          AND b.id=ANY({base_procvers})\n"
-                         ).format( base_procvers=base_procvers )
+            q += sql.SQL( "                          AND b.id=ANY(%(base_procvers)s::uuid[])\n" )
 
         if gotsomepos:
             q += sql.SQL( textwrap.dedent(
@@ -244,10 +251,10 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
                   INNER JOIN diaobject_position p1 ON o1.diaobjectid=p1.diaobjectid
                   INNER JOIN base_processing_version b1 ON p1.base_procver_id=b1.id
                   INNER JOIN base_procver_of_procver pv1 ON b1.id=pv1.base_procver_id
-                                                        AND pv1.procver_id={pospvid}
+                                                        AND pv1.procver_id=%(pospvid)s
                   ORDER BY p1.diaobjectid, pv1.priority DESC
                 ) p ON o.diaobjectid=p.diaobjectid
-                """ ) ).format( pospvid=pospvid )
+                """ ) )
 
         if objids_table is not None:
             q += sql.SQL( textwrap.dedent(
@@ -259,8 +266,8 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
         else:
             q += sql.SQL( textwrap.dedent(
                 """\
-                WHERE {ojoin}=ANY({objids})
-                """ ) ).format( ojoin=sql.Identifier( 'o', joincolumn ), objids=objids )
+                WHERE {ojoin}=ANY(%(objids)s)
+                """ ) ).format( ojoin=sql.Identifier( 'o', joincolumn ) )
 
         q += sql.SQL( "ORDER BY o.diaobjectid\n" )
 
@@ -268,7 +275,14 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
         # TEMP DEBUGGING, TAKE THIS OUT
         # dbcon.echoqueries = True
         # ****
-        rows, cols = dbcon.execute( q )
+        subdict = { 'objpvid': objpvid, 'pospvid': pospvid, 'base_procvers': base_procvers, 'objids': objids }
+        if objids_table is None:
+            # The query only depends on these options, so it can be a prepared statement
+            stmtname = ( f"object_infos:{joincolumn}:{'bpvs' if base_procvers is not None else 'pv'}:"
+                         f"{','.join(columns)}" )
+            rows, cols = dbcon.execute_prepared( stmtname, subdict, query=q )
+        else:
+            rows, cols = dbcon.execute( q, subdict )
         # Next line deals with what I think is a dysfunctional psycopg return
         cols = columns if len(rows) == 0 else cols
         if return_format == 'pandas':
@@ -291,12 +305,179 @@ def get_object_infos( objids=None, objids_table=None, processing_version=None, p
         FDBLogger.debug( "get_object_infos done." )
 
 
+# Below this many objects, many_object_ltcvs gets the lightcurves with a
+#   single query instead of building temp tables.
+FEW_OBJECTS_THRESHOLD = 20
+
+
+def _ltcv_photometry_select( table, roots, into=None, bands=None, mjd_now=None,
+                             include_base_procver=False, include_positions=False ):
+    """Build the query that many_object_ltcvs uses to get detections or forced photometry.
+
+    Gets one row for each (rootid, visit).  If more than one base
+    processing version of the processing version has a measurement for
+    the same visit, the highest priority one wins.
+
+    The query has a %(procver)s placeholder that must be substituted
+    with the processing version id.  It has no literals, so that the
+    query is the same from call to call and can be a prepared statement.
+
+    Parameters
+    ----------
+      table : str
+        'diasource' or 'diaforcedsource'
+
+      roots : psycopg.sql.Composable
+        A table (or CTE) with a rootid column.  Gets photometry for all
+        diaobjects with those rootids.
+
+      into : str, default None
+        If not None, INSERT INTO this table, which must have the
+        columns given by _ltcv_photometry_columns.
+
+      bands : list of str, default None
+        If not None, the query has a %(bands)s placeholder that must be
+        substituted with the list of bands.
+
+      mjd_now : float, default None
+        If not None, only get photometry through this mjd; the query
+        has a %(mjd_now)s placeholder that must be substituted with it.
+
+      include_base_procver : bool, default False
+        Include a base_procver_s or base_procver_f column with the
+        description of the base processing version.
+
+      include_positions : bool, default False
+        Include det_ra, det_dec, det_raerr, det_decerr, det_ra_dec_cov.
+        Only for diasource.
+
+    Returns
+    -------
+      psycopg.sql.Composed
+
+    """
+    if table == 'diasource':
+        idcol, prefix, suffix, isdet = 'diasourceid', 'source', 's', 'TRUE'
+    elif table == 'diaforcedsource':
+        idcol, prefix, suffix, isdet = 'diaforcedsourceid', 'forced', 'f', 'FALSE'
+    else:
+        raise ValueError( f"Unknown photometry table {table}" )
+
+    pos_fields = sql.SQL( "ra AS det_ra, dec AS det_dec, raerr AS det_raerr, "
+                          "decerr AS det_decerr, ra_dec_cov AS det_ra_dec_cov, "
+                          if include_positions
+                          else "" )
+    procver_fields = sql.SQL( f"p.description AS base_procver_{suffix}, " if include_base_procver else "" )
+    q = sql.SQL( textwrap.dedent(
+        """\
+        {into}SELECT DISTINCT ON (t.rootid, s.visit)
+          t.rootid, s.{idcol}, s.diaobjectid AS {objcol}, s.visit, s.midpointmjdtai AS mjd,
+          s.band, s.psfflux AS flux, s.psffluxerr AS fluxerr, o.base_procver_id AS {bpvcol},
+          {pos_fields} {procver_fields} {isdet} as isdet
+        FROM {roots} t
+        INNER JOIN diaobject ot ON t.rootid=ot.rootid
+        INNER JOIN {table} s ON s.diaobjectid=ot.diaobjectid
+        INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
+                                             AND pv._table={tablename}
+                                             AND pv.procver_id=%(procver)s
+        INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+        """
+    ) ).format( idcol=sql.Identifier( idcol ), objcol=sql.Identifier( f'{prefix}_diaobjectid' ),
+                bpvcol=sql.Identifier( f'{prefix}_obj_bpv' ), pos_fields=pos_fields, procver_fields=procver_fields,
+                isdet=sql.SQL( isdet ),
+                into=( sql.SQL( "INSERT INTO {into}\n" ).format( into=sql.Identifier( into ) ) if into is not None
+                       else sql.SQL( "" ) ),
+                roots=roots, table=sql.Identifier( table ), tablename=table )
+    if include_base_procver:
+        q += sql.SQL( "INNER JOIN base_processing_version p ON pv.base_procver_id=p.id" )
+    _and = "WHERE"
+    if mjd_now is not None:
+        q += sql.SQL( f"                   {_and} s.midpointmjdtai<=%(mjd_now)s" )
+        _and = "  AND"
+    if bands is not None:
+        q += sql.SQL( f"                   {_and} s.band=ANY(%(bands)s)" )
+        _and = "  AND"
+    q += sql.SQL( "   ORDER BY t.rootid, s.visit, pv.priority DESC\n")
+    return q
+
+
+def _ltcv_photometry_columns( table, include_base_procver=False, include_positions=False ):
+    """The columns of the temp table that _ltcv_photometry_select( ..., into=... ) fills.
+
+    Parameters are the same as _ltcv_photometry_select.
+
+    Returns
+    -------
+      str : column definitions for DBCon.temp_table
+
+    """
+    prefix, idcol, suffix = ( ( 'source', 'diasourceid', 's' ) if table == 'diasource'
+                              else ( 'forced', 'diaforcedsourceid', 'f' ) )
+    cols = [ 'rootid uuid', f'{idcol} bigint', f'{prefix}_diaobjectid bigint', 'visit bigint',
+             'mjd double precision', 'band character(1)', 'flux real', 'fluxerr real', f'{prefix}_obj_bpv uuid' ]
+    if include_positions:
+        cols.extend( [ 'det_ra double precision', 'det_dec double precision', 'det_raerr real',
+                       'det_decerr real', 'det_ra_dec_cov real' ] )
+    if include_base_procver:
+        cols.append( f'base_procver_{suffix} text' )
+    cols.append( 'isdet boolean' )
+    return ', '.join( cols )
+
+
+def _ltcv_patch_select( forced, sources, include_base_procver=False, include_positions=False ):
+    """Build the query that joins forced photometry to detections for many_object_ltcvs.
+
+    Sets the 'isdet' and 'ispatch' flags.
+
+    Parameters
+    ----------
+      forced, sources : psycopg.sql.Composable
+        Tables (or CTEs) made with _ltcv_photometry_select for
+        diaforcedsource and diasource.
+
+      include_base_procver, include_positions : bool, default False
+        Must match what was passed to _ltcv_photometry_select.
+
+    Returns
+    -------
+      psycopg.sql.Composed
+
+    """
+    # The term FULL OUTER JOIN is extremely scary, of course
+    pos_fields = sql.SQL( "s.det_ra, s.det_dec, s.det_raerr, s.det_decerr, s.det_ra_dec_cov, "
+                          if include_positions
+                          else "" )
+    procver_fields = sql.SQL( "f.base_procver_f, s.base_procver_s, " if include_base_procver else "" )
+    return sql.SQL( textwrap.dedent(
+        """\
+        SELECT CASE WHEN f.rootid IS NULL THEN s.rootid ELSE f.rootid END AS rootid,
+               f.diaforcedsourceid,
+               s.diasourceid,
+               f.forced_diaobjectid,
+               s.source_diaobjectid,
+               f.forced_obj_bpv,
+               s.source_obj_bpv,
+               {procver_fields}
+               CASE WHEN f.rootid IS NULL THEN s.visit ELSE f.visit END AS visit,
+               CASE WHEN f.rootid IS NULL THEN s.mjd ELSE f.mjd END AS mjd,
+               CASE WHEN f.rootid IS NULL THEN s.band ELSE f.band END AS band,
+               CASE WHEN f.rootid IS NULL THEN s.flux ELSE f.flux END AS flux,
+               CASE WHEN f.rootid IS NULL THEN s.fluxerr ELSE f.fluxerr END AS fluxerr,
+               {pos_fields}
+               CASE WHEN s.rootid IS NULL THEN FALSE ELSE TRUE END AS isdet,
+               CASE WHEN f.rootid IS NULL THEN TRUE ELSE FALSE END as ispatch
+        FROM {forced} f
+        FULL OUTER JOIN {sources} s ON f.rootid=s.rootid AND s.visit=f.visit
+        ORDER BY rootid, mjd
+        """ ) ).format( pos_fields=pos_fields, procver_fields=procver_fields, forced=forced, sources=sources )
+
+
 def many_object_ltcvs( processing_version='default', objids=None, objids_table=None, return_format='json',
                        bands=None, which='patch', include_base_procver=False, include_obj_base_procver_id=False,
                        include_source_positions=False,
                        use_weighted_source_positions=False, always_use_weighted_source_positions=False,
                        return_object_info=False, include_object_positions=False, position_processing_version=None,
-                       mjd_now=None, dbcon=None ):
+                       mjd_now=None, few_objects_threshold=None, dbcon=None ):
     """Get lightcurves for objects.
 
     Parameters
@@ -398,6 +579,15 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
          through mjd n, even forced photometry; it doesn't try to
          simulate forced photometry coming in late.
 
+      few_objects_threshold : int, default None
+         If objids has at most this many objects, get the lightcurves
+         with one query, rather than building temp tables and reading
+         them back with a server-side cursor; that overhead dominates
+         for one or a few objects.  (Not used with objids_table, or if
+         objids are diaobjectids and return_object_info is True.)  If
+         None, uses FEW_OBJECTS_THRESHOLD.  Pass 0 to always use the
+         temp tables.  The results are the same either way.
+
       dbcon: psycopg.Connection, db.DBCon, or None
          Database connection to use.  If None, will make a new
          connection and close it when done.
@@ -545,8 +735,10 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
     must_get_source_positions = ( include_source_positions or use_weighted_source_positions or
                                   ( return_object_info and include_object_positions ) )
 
-    with db.DBCon( dbcon ) as dbcon:
-        tmpsmade = []
+    # Temp tables come from dbcon.temp_table, so they're reused within a
+    #   session rather than made and dropped every call.  tmptabs holds the
+    #   leases until we're done with them.
+    with db.DBCon( dbcon ) as dbcon, contextlib.ExitStack() as tmptabs:
         try:
             pvid = db.ProcessingVersion.procver_id( processing_version, dbcon=dbcon )
             pospvid = None
@@ -554,61 +746,94 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
                 pospvid = ( db.ProcessingVersion.procver_id( position_processing_version, dbcon=dbcon )
                             if position_processing_version is not None else pvid )
 
-            # Make a first pass and extract ALL diaobjectids from all base
-            #   processing versions that share the same roots as the
-            #   requested objects. Even *within* a base processing version
-            #   there are multiple diaOjbects in the lsst alert stream, and
-            #   what's more, the same diaSource will at different time
-            #   (original alert, previous soruces in later alerts) be
-            #   associated with different diaObjects.
-            # However, also, we can't really be sure the actual processing
-            #   versions of objects for the diasources in the processing
-            #   version the user asked for, so just yank them all, and then
-            #   trust the join to the source table to filter out the
-            #   irrelevant ones.
-            if objids is not None:
-                objids_table = 'tmp_objids'
-                tmpsmade.append( objids_table )
+            if few_objects_threshold is None:
+                few_objects_threshold = FEW_OBJECTS_THRESHOLD
+            fast = ( ( objids is not None ) and ( len(objids) <= few_objects_threshold )
+                     and ( objids_are_root or ( not return_object_info ) ) )
+
+            if fast:
+                # Few objects: do it all in one round trip.  No temp tables, and
+                #   the results are small enough to fetch all at once.
+                if objids_are_root:
+                    rootsq = sql.SQL( "SELECT unnest(%(objids)s::uuid[]) AS rootid" )
+                else:
+                    rootsq = sql.SQL( "SELECT DISTINCT rootid FROM diaobject WHERE diaobjectid=ANY(%(objids)s)" )
+                srcq = _ltcv_photometry_select( 'diasource', sql.Identifier( 'roots' ), bands=bands,
+                                                mjd_now=mjd_now, include_base_procver=include_base_procver,
+                                                include_positions=must_get_source_positions )
+                q = sql.SQL( "WITH roots AS ( {rootsq} ),\nsrc AS (\n{srcq})" ).format( rootsq=rootsq, srcq=srcq )
+                if which == 'detections':
+                    q += sql.SQL( "\nSELECT * FROM src ORDER BY rootid, mjd" )
+                else:
+                    frcq = _ltcv_photometry_select( 'diaforcedsource', sql.Identifier( 'roots' ), bands=bands,
+                                                    mjd_now=mjd_now, include_base_procver=include_base_procver )
+                    q += sql.SQL( ",\nfrc AS (\n{frcq})\n" ).format( frcq=frcq )
+                    q += _ltcv_patch_select( sql.Identifier( 'frc' ), sql.Identifier( 'src' ),
+                                             include_base_procver=include_base_procver,
+                                             include_positions=must_get_source_positions )
+                # The query only depends on these options, so it can be a prepared statement
+                flags = [ bands is not None, mjd_now is not None, include_base_procver, must_get_source_positions ]
+                stmtname = ( f"few_object_ltcvs:{which}:{'rootid' if objids_are_root else 'diaobjectid'}:"
+                             + "".join( str( int( bool( f ) ) ) for f in flags ) )
+                FDBLogger.debug( "...querying for lightcurves (few objects)" )
+                rows, cols = dbcon.execute_prepared( stmtname, { 'objids': objids, 'bands': bands, 'procver': pvid,
+                                                                 'mjd_now': mjd_now },
+                                                     query=q )
+
+            elif objids is not None:
+                # Make a first pass and extract ALL diaobjectids from all base
+                #   processing versions that share the same roots as the
+                #   requested objects. Even *within* a base processing version
+                #   there are multiple diaOjbects in the lsst alert stream, and
+                #   what's more, the same diaSource will at different time
+                #   (original alert, previous soruces in later alerts) be
+                #   associated with different diaObjects.
+                # However, also, we can't really be sure the actual processing
+                #   versions of objects for the diasources in the processing
+                #   version the user asked for, so just yank them all, and then
+                #   trust the join to the source table to filter out the
+                #   irrelevant ones.
+                objids_table = tmptabs.enter_context( dbcon.temp_table( 'tmp_objids',
+                                                                         'diaobjectid bigint, rootid uuid' ) )
                 if objids_are_root:
                     q = sql.SQL( textwrap.dedent(
                         """\
+                        INSERT INTO {objids_table}
                         SELECT diaobjectid, rootid
-                        INTO TEMP TABLE tmp_objids
                         FROM diaobject
                         WHERE rootid=ANY(%(roots)s)
                         """
-                    ) ).format()
-                    FDBLogger.debug( "...inserting objects from passed root ids into tmp_objids table" )
+                    ) ).format( objids_table=sql.Identifier( objids_table ) )
+                    FDBLogger.debug( f"...inserting objects from passed root ids into {objids_table} table" )
                     dbcon.execute_nofetch( q, {'roots': objids} )
                 else:
-                    q = sql.SQL( "CREATE TEMP TABLE temp_input_diaobject( diaobjectid bigint )" )
-                    dbcon.execute( q, explain=False )
-                    q = sql.SQL( "COPY temp_input_diaobject(diaobjectid) FROM STDIN"
-                                ).format( objids_table=sql.Identifier( objids_table ) )
+                    inputtable = tmptabs.enter_context( dbcon.temp_table( 'temp_input_diaobject',
+                                                                          'diaobjectid bigint' ) )
+                    q = sql.SQL( "COPY {inputtable}(diaobjectid) FROM STDIN"
+                                ).format( inputtable=sql.Identifier( inputtable ) )
                     with dbcon.cursor.copy( q ) as copier:
                         for objid in objids:
                             copier.write_row( [ objid ] )
 
                     q = sql.SQL( textwrap.dedent(
                         """\
+                        INSERT INTO {objids_table}
                         SELECT o.diaobjectid, o.rootid
-                        INTO TEMP TABLE tmp_objids
-                        FROM temp_input_diaobject t
+                        FROM {inputtable} t
                         INNER JOIN diaobject ot ON t.diaobjectid=ot.diaobjectid
                         INNER JOIN diaobject o ON ot.rootid=o.rootid
-                        """ ) )
-                    FDBLogger.debug( "...inserting objects from passed diaobjectid into tmp_objids table" )
+                        """ ) ).format( objids_table=sql.Identifier( objids_table ),
+                                        inputtable=sql.Identifier( inputtable ) )
+                    FDBLogger.debug( f"...inserting objects from passed diaobjectid into {objids_table} table" )
                     dbcon.execute( q )
             else:
-                actual_objids_table = f'{objids_table}_withboth'
-                tmpsmade.append( actual_objids_table )
-                dbcon.execute( sql.SQL( "DROP TABLE IF EXISTS {t}" ).format( t=sql.Identifier(actual_objids_table) ),
-                               explain=False )
+                actual_objids_table = tmptabs.enter_context( dbcon.temp_table( 'tmp_objids_withboth',
+                                                                                'diaobjectid bigint, rootid uuid' ) )
                 if objids_are_root:
                     q = sql.SQL( textwrap.dedent(
                         """\
+                        INSERT INTO {desttable}
                         SELECT o.diaobjectid, o.rootid
-                        INTO TEMP TABLE {desttable}
                         FROM {sourcetable} x
                         INNER JOIN diaobject o ON x.rootid=o.rootid
                         """ ) ).format( desttable=sql.Identifier( actual_objids_table ),
@@ -618,135 +843,69 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
                 else:
                     q = sql.SQL( textwrap.dedent(
                         """\
+                        INSERT INTO {desttable}
                         SELECT o.diaobjectid, o.rootid
-                        INTO TEMP TABLE {desttable}
                         FROM {sourcetable} x
-                        INNER JOIN diaobject ot ON t.diaobjectid=x.diaobjectid
-                        INNER JOIN diaobject o ON t.rootid=o.rootid
+                        INNER JOIN diaobject ot ON ot.diaobjectid=x.diaobjectid
+                        INNER JOIN diaobject o ON ot.rootid=o.rootid
                         """ ) ).format( desttable=sql.Identifier(actual_objids_table),
                                         sourcetable=sql.Identifier(objids_table) )
                     FDBLogger.debug( f"...inserting objects from passed diaobjectid table to {actual_objids_table}" )
                     dbcon.execute( q )
                 objids_table = actual_objids_table
 
-            # Extract detections
-            pos_fields = sql.SQL( "ra AS det_ra, dec AS det_dec, raerr AS det_raerr, "
-                                  "decerr AS det_decerr, ra_dec_cov AS det_ra_dec_cov, "
-                                  if must_get_source_positions
-                                  else "" )
-            procver_fields = sql.SQL( "p.description AS base_procver_s, " if include_base_procver else "" )
-            dbcon.execute( "DROP TABLE IF EXISTS tmp_sources", explain=False )
-            tmpsmade.append( 'tmp_sources' )
-            q = sql.SQL( textwrap.dedent(
-                """\
-                /*+ IndexScan(s idx_diasource_diaobjectid)
-                    IndexScan(ot idx_diaobject_rootid)
-                */
-                SELECT DISTINCT ON (t.rootid, s.visit)
-                  t.rootid, s.diasourceid, s.diaobjectid AS source_diaobjectid, s.visit, s.midpointmjdtai AS mjd,
-                  s.band, s.psfflux AS flux, s.psffluxerr AS fluxerr, o.base_procver_id AS source_obj_bpv,
-                  {pos_fields} {procver_fields} TRUE as isdet
-                INTO tmp_sources
-                FROM {objids_table} t
-                INNER JOIN diaobject ot ON t.rootid=ot.rootid
-                INNER JOIN diasource s ON s.diaobjectid=ot.diaobjectid
-                INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
-                                                     AND pv._table='diasource'
-                                                     AND pv.procver_id={procver}
-                INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                """
-            ) ).format( procver=pvid, objids_table=sql.Identifier(objids_table),
-                        pos_fields=pos_fields, procver_fields=procver_fields )
-            if include_base_procver:
-                q += sql.SQL( "INNER JOIN base_processing_version p ON pv.base_procver_id=p.id" )
-            _and = "WHERE"
-            if mjd_now is not None:
-                q += sql.SQL( f"                   {_and} s.midpointmjdtai<={{t0}}" ).format( t0=mjd_now )
-                _and = "  AND"
-            if bands is not None:
-                q += sql.SQL( f"                   {_and} s.band=ANY(%(bands)s)" )
-                _and = "  AND"
-            q += sql.SQL( "   ORDER BY t.rootid, s.visit, pv.priority DESC\n")
-            FDBLogger.debug( "...querying for detections" )
-            dbcon.execute_nofetch( q, { 'bands': bands } )
-
-            if which == 'detections':
-                q = sql.SQL( "SELECT * FROM tmp_sources ORDER BY rootid, mjd" )
-
-            else:
-                # Extract forced photometry if necessary
-                procver_fields = sql.SQL( "p.description as base_procver_f, " if include_base_procver else "" )
-                dbcon.execute( "DROP TABLE IF EXISTS tmp_forced", explain=False )
-                tmpsmade.append( 'tmp_forced' )
+            if not fast:
+                # Extract detections
+                srctable = tmptabs.enter_context( dbcon.temp_table(
+                    'tmp_sources', _ltcv_photometry_columns( 'diasource', include_base_procver=include_base_procver,
+                                                             include_positions=must_get_source_positions ) ) )
                 q = sql.SQL( textwrap.dedent(
                     """\
-                    /*+ IndexScan(s idx_diaforcedsource_diaobjectid)
+                    /*+ IndexScan(s idx_diasource_diaobjectid)
                         IndexScan(ot idx_diaobject_rootid)
                     */
-                    SELECT DISTINCT ON (t.rootid, s.visit)
-                      t.rootid, s.diaforcedsourceid, s.diaobjectid AS forced_diaobjectid,
-                      s.visit, s.midpointmjdtai AS mjd,
-                      s.band, s.psfflux AS flux, s.psffluxerr AS fluxerr, o.base_procver_id AS forced_obj_bpv,
-                      {procver_fields} FALSE as isdet
-                    INTO tmp_forced
-                    FROM {objids_table} t
-                    INNER JOIN diaobject ot ON t.rootid=ot.rootid
-                    INNER JOIN diaforcedsource s ON s.diaobjectid=ot.diaobjectid
-                    INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
-                                                         AND pv._table='diaforcedsource'
-                                                         AND pv.procver_id={procver}
-                    INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                    """
-                ) ).format( procver=pvid, procver_fields=procver_fields, objids_table=sql.Identifier(objids_table) )
-                if include_base_procver:
-                    q += sql.SQL( "INNER JOIN base_processing_version p ON pv.base_procver_id=p.id" )
-                _and = "WHERE"
-                if mjd_now is not None:
-                    q += sql.SQL( f"                   {_and} s.midpointmjdtai<={{t0}}" ).format( t0=mjd_now )
-                    _and = "  AND"
-                if bands is not None:
-                    q += sql.SQL( f"                   {_and} s.band=ANY(%(bands)s)" )
-                    _and = "  AND"
-                q += sql.SQL( "   ORDER BY t.rootid, s.visit, pv.priority DESC\n" )
-                FDBLogger.debug( "...querying for forced photometry" )
-                dbcon.execute_nofetch( q, { 'bands': bands } )
-
-                # Join detections to forced photometry to set the 'isdet' and 'ispatch' flags.
-                # The term FULL OUTER JOIN is extremely scary, of course
-                pos_fields = sql.SQL( "s.det_ra, s.det_dec, s.det_raerr, s.det_decerr, s.det_ra_dec_cov, "
-                                      if must_get_source_positions
-                                      else "" )
-                procver_fields = sql.SQL( "f.base_procver_f, s.base_procver_s, " if include_base_procver else "" )
-                q = sql.SQL( textwrap.dedent(
-                    """\
-                    SELECT CASE WHEN f.rootid IS NULL THEN s.rootid ELSE f.rootid END AS rootid,
-                           f.diaforcedsourceid,
-                           s.diasourceid,
-                           f.forced_diaobjectid,
-                           s.source_diaobjectid,
-                           f.forced_obj_bpv,
-                           s.source_obj_bpv,
-                           {procver_fields}
-                           CASE WHEN f.rootid IS NULL THEN s.visit ELSE f.visit END AS visit,
-                           CASE WHEN f.rootid IS NULL THEN s.mjd ELSE f.mjd END AS mjd,
-                           CASE WHEN f.rootid IS NULL THEN s.band ELSE f.band END AS band,
-                           CASE WHEN f.rootid IS NULL THEN s.flux ELSE f.flux END AS flux,
-                           CASE WHEN f.rootid IS NULL THEN s.fluxerr ELSE f.fluxerr END AS fluxerr,
-                           {pos_fields}
-                           CASE WHEN s.rootid IS NULL THEN FALSE ELSE TRUE END AS isdet,
-                           CASE WHEN f.rootid IS NULL THEN TRUE ELSE FALSE END as ispatch
-                    FROM tmp_forced f
-                    FULL OUTER JOIN tmp_sources s ON f.rootid=s.rootid AND s.visit=f.visit
-                    ORDER BY rootid, mjd
-                    """ ) ).format( pos_fields=pos_fields, procver_fields=procver_fields )
-
-            FDBLogger.debug( "...extracting results from postgres" )
-            FDBLogger.debug( "...executing query" )
-            barf = "".join( random.choices( "abcdefghijklmnopqrstuvwxyz", k=6 ) )
-            cursor = dbcon.execute_nofetch( q, echo=True, cursorname=f'many_object_ltcvs_{barf}' )
-            cursor.itersize = 1000
-            FDBLogger.debug( "...fetching results from postgres" )
-            cols = [ desc[0] for desc in cursor.description ]
+                    """ ) )
+                q += _ltcv_photometry_select( 'diasource', sql.Identifier( objids_table ), into=srctable,
+                                              bands=bands, mjd_now=mjd_now, include_base_procver=include_base_procver,
+                                              include_positions=must_get_source_positions )
+                FDBLogger.debug( "...querying for detections" )
+                dbcon.execute_nofetch( q, { 'bands': bands, 'procver': pvid, 'mjd_now': mjd_now } )
+
+                if which == 'detections':
+                    q = sql.SQL( "SELECT * FROM {srctable} ORDER BY rootid, mjd"
+                                ).format( srctable=sql.Identifier( srctable ) )
+
+                else:
+                    # Extract forced photometry if necessary
+                    frctable = tmptabs.enter_context( dbcon.temp_table(
+                        'tmp_forced', _ltcv_photometry_columns( 'diaforcedsource',
+                                                                include_base_procver=include_base_procver ) ) )
+                    q = sql.SQL( textwrap.dedent(
+                        """\
+                        /*+ IndexScan(s idx_diaforcedsource_diaobjectid)
+                            IndexScan(ot idx_diaobject_rootid)
+                        */
+                        """ ) )
+                    q += _ltcv_photometry_select( 'diaforcedsource', sql.Identifier( objids_table ),
+                                                  into=frctable, bands=bands, mjd_now=mjd_now,
+                                                  include_base_procver=include_base_procver )
+                    FDBLogger.debug( "...querying for forced photometry" )
+                    dbcon.execute_nofetch( q, { 'bands': bands, 'procver': pvid, 'mjd_now': mjd_now } )
+
+                    # Join detections to forced photometry to set the 'isdet' and 'ispatch' flags.
+                    q = _ltcv_patch_select( sql.Identifier( frctable ), sql.Identifier( srctable ),
+                                            include_base_procver=include_base_procver,
+                                            include_positions=must_get_source_positions )
+
+                FDBLogger.debug( "...extracting results from postgres" )
+                FDBLogger.debug( "...executing query" )
+                barf = "".join( random.choices( "abcdefghijklmnopqrstuvwxyz", k=6 ) )
+                cursor = dbcon.execute_nofetch( q, echo=True, cursorname=f'many_object_ltcvs_{barf}' )
+                cursor.itersize = 1000
+                FDBLogger.debug( "...fetching results from postgres" )
+                cols = [ desc[0] for desc in cursor.description ]
+                rows = cursor
+
             coldex = { c: i for i, c in enumerate(cols) }
 
             ltcvs = []
@@ -774,7 +933,7 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
                 currootid = row[ coldex['rootid'] ]
 
             n = 0
-            for row in cursor:
+            for row in rows:
                 if ( n % 50000 == 0 ) and ( n > 0 ):
                     FDBLogger.debug( f"...{n} rows, {len(ltcvs)} ltcvs so far" )
                 n += 1
@@ -789,7 +948,8 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
                 # I wish python had inline functions
                 _extract_rowcache()
 
-            cursor.close()
+            if not fast:
+                cursor.close()
             FDBLogger.debug( f"...done fetching {n} rows, {len(ltcvs)} lightcurves." )
 
             # We might also need to get object info.  Get all diaobjects
@@ -806,23 +966,19 @@ def many_object_ltcvs( processing_version='default', objids=None, objids_table=N
                     if include_base_procver:
                         columns.append( 'pos_base_procver' )
 
-                objinfo = get_object_infos( objids_table=objids_table, base_procvers=bpvs,
-                                            position_processing_version=pospvid, columns=columns,
-                                            return_format=return_format, dbcon=dbcon )
+                if fast:
+                    # (fast implies objids are rootids here)
+                    objinfo = get_object_infos( objids=objids, base_procvers=bpvs,
+                                                position_processing_version=pospvid, columns=columns,
+                                                return_format=return_format, dbcon=dbcon )
+                else:
+                    objinfo = get_object_infos( objids_table=objids_table, base_procvers=bpvs,
+                                                position_processing_version=pospvid, columns=columns,
+                                                return_format=return_format, dbcon=dbcon )
 
         except Exception:
             dbcon.rollback()
             raise
-        finally:
-            # Drop any temp tables we created.  Do NOT commit, however.  Reason:
-            #   If this is called with an existing dbcon, then the caller
-            #   may be impolicitly assuming these temp tables don't exist.
-            #   However, the caller might also (perversely?) be in the middle
-            #   of a transaction, and we don't want to end that transaction
-            #   by committing.
-            for tab in tmpsmade:
-                dbcon.execute( sql.SQL( "DROP TABLE IF EXISTS {tab}" ).format( tab=sql.Identifier(tab) ),
-                               explain=False )
 
 
     # Update object positions if necessary
@@ -1483,58 +1639,332 @@ def get_hot_ltcvs( processing_version, position_processing_version=None,
         mjd0 = astropy.time.Time( datetime.datetime.now( tz=datetime.UTC )
                                   - datetime.timedelta( days=lastdays ) ).mjd
 
+    with db.DBCon( dbcon ) as con, con.temp_table( 'tmp_hot_objids', 'rootid uuid' ) as objids_table:
+        procver = util.procver_id( processing_version, dbcon=con.con )
+
+        # First : get a table of all root object ids that have a
+        #   detection (i.e. a diasource) in the desired time period.
+
+        q = sql.SQL( textwrap.dedent(
+            """\
+            /*+ IndexScan(s idx_diasource_mjd) */
+            INSERT INTO {objids_table}
+            SELECT DISTINCT ON(o.rootid) o.rootid
+            FROM diasource s
+            INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+            INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
+                                                 AND pv.procver_id=%(procver)s
+            WHERE s.midpointmjdtai>=%(t0)s
+            """ ) ).format( objids_table=sql.Identifier( objids_table ) )
+        if mjd_now is not None:
+            q += sql.SQL( "  AND s.midpointmjdtai<=%(t1)s\n" )
+        q += sql.SQL( "ORDER BY o.rootid\n" )
+        con.execute_prepared( f"hot_objids:{objids_table}:{mjd_now is not None:d}",
+                              { 'procver': procver, 't0': mjd0, 't1': mjd_now }, query=q )
+
+        # Second: get the lightcurves and object info
+        return many_object_ltcvs( processing_version=procver, objids_table=objids_table,
+                                  return_format=return_format, mjd_now=mjd_now, dbcon=con,
+                                  which='patch' if source_patch else 'forced',
+                                  include_base_procver=include_base_procver,
+                                  include_source_positions=include_source_positions,
+                                  use_weighted_source_positions=use_weighted_source_positions,
+                                  always_use_weighted_source_positions=always_use_weighted_source_positions,
+                                  include_object_positions=include_object_positions,
+                                  return_object_info=True )
+
+
+def random_rootids( processing_version='default', n=1, oversample=100, maxtries=6, dbcon=None ):
+    """Return randomly chosen root object ids that have a diaobject in a processing version.
+
+    Doesn't scan the diaobject table.  Instead, uses TABLESAMPLE SYSTEM
+    to read a small random set of disk pages from diaobject (enough
+    that we expect about oversample×n rows), keeps the rows that are in
+    processing_version, and picks n distinct rootids from those.  If
+    that didn't find enough, tries again reading 10× as many pages,
+    up to maxtries times; the last try reads the whole table.  So, as
+    long as the processing version isn't a tiny fraction of the
+    diaobject table, the time this takes doesn't depend on how big the
+    table is.
+
+    Caveats: SYSTEM sampling chooses whole pages, and objects loaded
+    together tend to be on the same page, so when n > 1 the objects you
+    get back are not independent draws.  Root objects with diaobjects
+    in more than one base processing version of processing_version are
+    a bit more likely to be chosen.  For picking "an object to look at",
+    neither matters.
+
+    Parameters
+    ----------
+      processing_version : UUID or str, default 'default'
+        Processing version (or alias) of the diaobjects.
+
+      n : int, default 1
+        Number of rootids to return.
+
+      oversample : int, default 100
+        Sample enough pages on the first try to expect this many times
+        n rows.
+
+      maxtries : int, default 6
+        Give up sampling and read the whole table after this many tries.
+
+      dbcon : db.DBCon or psycopg.Connection, default None
+        Database connection to use.  If None, will make a new connection
+        and close it when done.
+
+    Returns
+    -------
+      list of UUID.  Will have fewer than n elements (possibly 0) only
+      if the processing version has fewer than n root objects.
+
+    """
+    n = int( n )
+    if n <= 0:
+        raise ValueError( f"n must be positive, not {n}" )
+
     with db.DBCon( dbcon ) as con:
-        try:
-            procver = util.procver_id( processing_version, dbcon=con.con )
+        pvid = db.ProcessingVersion.procver_id( processing_version, dbcon=con )
+
+        # reltuples is what postgres thinks the table size is as of the last ANALYZE
+        rows, _cols = con.execute( "SELECT reltuples FROM pg_class WHERE relname='diaobject'" )
+        ntot = rows[0][0] if ( len(rows) > 0 ) and ( rows[0][0] is not None ) else -1
+        pct = 100. if ntot <= 0 else min( 100., 100. * oversample * n / ntot )
+
+        found = []
+        for ntry in range( maxtries ):
+            if ntry == maxtries - 1:
+                pct = 100.
+            q = sql.SQL( "SELECT DISTINCT o.rootid FROM diaobject o TABLESAMPLE SYSTEM ({pct})\n"
+                         "INNER JOIN base_procver_of_procver pv ON o.base_procver_id=pv.base_procver_id\n"
+                         "                                     AND pv.procver_id={pv}" ).format(
+                             pct=sql.Literal( pct ), pv=pvid )
+            rows, _cols = con.execute( q, explain=False )
+            found = [ r[0] for r in rows ]
+            FDBLogger.debug( f"random_rootids: sampling {pct:.3g}% of diaobject found {len(found)} rootids" )
+            if ( len( found ) >= n ) or ( pct >= 100. ):
+                break
+            pct = min( 100., pct * 10. )
+
+    if len( found ) <= n:
+        random.shuffle( found )
+        return found
+    return random.sample( found, n )
+
+
+def import_watermark( dbcon=None ):
+    """Return the time of the latest source import.
+
+    This is the latest time in diasource_import_time, which
+    SourceImporter updates in the same transaction as the sources it
+    imports.  If it hasn't changed, lightcurves (and anything else
+    built from sources) haven't changed either, as long as sources are
+    only loaded by SourceImporter.  (The bulk loaders in admin don't
+    update it.)
 
-            # First : get a table of all root object ids that have a
-            #   detection (i.e. a diasource) in the desired time period.
+    Parameters
+    ----------
+      dbcon : psycopg.Connection, db.DBCon, or None
+        Database connection to use.  If None, will make a new
+        connection and close it when done.
 
-            q = sql.SQL( textwrap.dedent(
-                """\
-                /*+ IndexScan(s idx_diasource_mjd) */
-                SELECT DISTINCT ON(o.rootid) o.rootid
-                INTO TEMP TABLE tmp_objids
-                FROM diasource s
-                INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
-                                                     AND pv.procver_id=%(procver)s
-                WHERE s.midpointmjdtai>=%(t0)s
-                """ ) )
-            if mjd_now is not None:
-                q += sql.SQL( "  AND s.midpointmjdtai<=%(t1)s\n" )
-            q += sql.SQL( "ORDER BY o.rootid\n" )
-            con.execute_nofetch( q, { 'procver': procver, 't0': mjd0, 't1': mjd_now } )
-
-            # Second: get the lightcurves and object info
-            return many_object_ltcvs( processing_version=procver, objids_table='tmp_objids',
-                                      return_format=return_format, mjd_now=mjd_now, dbcon=con,
-                                      which='patch' if source_patch else 'forced',
-                                      include_base_procver=include_base_procver,
-                                      include_source_positions=include_source_positions,
-                                      use_weighted_source_positions=use_weighted_source_positions,
-                                      always_use_weighted_source_positions=always_use_weighted_source_positions,
-                                      include_object_positions=include_object_positions,
-                                      return_object_info=True )
-
-        finally:
-            # This is probably gratuitous.  However, *just in case*
-            # somebody passed a dbcon, and might try to create temp
-            # tables that have exactly the same names as the temp tables
-            # we just created, drop them for cleanliness.
-            con.execute( "DROP TABLE IF EXISTS tmp_objids", explain=False )
-
-            # However, don't commit!  Reason: if somebody passed a dbcon
-            # in the middle of a transaction, for whatever perverse
-            # reason, we don't want to end that transaction.  If
-            # somebody passed a dbcon, then the table is already deleted
-            # for that dbcon now even without committing.  If there was
-            # no passed dbcon, then the while db.DBCon() loop will close
-            # the connection when it exits, which will automatically
-            # delete the temp tables anyway.
-
-
-def create_object_stats_materialized_view( procver ):
+    Returns
+    -------
+      datetime.datetime or None (if nothing has been imported)
+
+    """
+    with db.DBCon( dbcon ) as con:
+        rows, _cols = con.execute( "SELECT MAX(t) FROM diasource_import_time" )
+        return rows[0][0]
+
+
+def object_stats_select( pvid ):
+    """Return the SELECT that builds the per-band objstats materialized view.
+
+    Resolves the diasources of the processing version (highest priority
+    base processing version wins for each rootid and visit) once, and
+    then gets everything else from that one pass: ROW_NUMBER windows
+    pick out the first, last, and max detection in each band, and
+    FILTER aggregates do the counts.
+
+    Note: there are hardcoded flux numbers below.
+      For zeropoint = 31.4,
+        m = 24 : f =   912
+        m = 23 : f =  2291
+        m = 22 : f =  5754
+        m = 21 : f = 14454
+
+    Parameters
+    ----------
+      pvid : UUID
+        The processing version id.
+
+    Returns
+    -------
+      psycopg.sql.Composed
+
+    """
+    return sql.SQL( textwrap.dedent(
+        """
+        WITH src AS (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+        ),
+        ranked AS (
+          SELECT rootid, band, midpointmjdtai, psfflux, psffluxerr,
+                 ROW_NUMBER() OVER (PARTITION BY rootid, band ORDER BY midpointmjdtai) AS ifirst,
+                 ROW_NUMBER() OVER (PARTITION BY rootid, band ORDER BY midpointmjdtai DESC) AS ilast,
+                 ROW_NUMBER() OVER (PARTITION BY rootid, band ORDER BY psfflux DESC) AS imax
+          FROM src
+        )
+        SELECT r.id AS rootid, d.band AS band, r.ra AS ra, r.dec AS dec,
+               MIN(d.midpointmjdtai) FILTER (WHERE d.ifirst=1) AS firstdet_mjd,
+               MIN(d.psfflux) FILTER (WHERE d.ifirst=1) AS firstdet_flux,
+               MIN(d.psffluxerr) FILTER (WHERE d.ifirst=1) AS firstdet_fluxerr,
+               MIN(d.midpointmjdtai) FILTER (WHERE d.ilast=1) AS lastdet_mjd,
+               MIN(d.psfflux) FILTER (WHERE d.ilast=1) AS lastdet_flux,
+               MIN(d.psffluxerr) FILTER (WHERE d.ilast=1) AS lastdet_fluxerr,
+               MIN(d.midpointmjdtai) FILTER (WHERE d.imax=1) AS maxdet_mjd,
+               MIN(d.psfflux) FILTER (WHERE d.imax=1) AS maxdet_flux,
+               MIN(d.psffluxerr) FILTER (WHERE d.imax=1) AS maxdet_fluxerr,
+               COUNT(*) AS ndets,
+               COUNT(*) FILTER (WHERE d.psfflux >= 912) AS ndets24,
+               COUNT(*) FILTER (WHERE d.psfflux >= 2291) AS ndets23,
+               COUNT(*) FILTER (WHERE d.psfflux >= 5754) AS ndets22,
+               COUNT(*) FILTER (WHERE d.psfflux >= 14454) AS ndets21,
+               COUNT(*) FILTER (WHERE d.psfflux / d.psffluxerr >= 10) AS nsn10,
+               COUNT(*) FILTER (WHERE d.psfflux / d.psffluxerr >= 7) AS nsn7,
+               COUNT(*) FILTER (WHERE d.psfflux / d.psffluxerr >= 5) AS nsn5
+        FROM ranked d
+        INNER JOIN root_diaobject r ON d.rootid=r.id
+        GROUP BY r.id, d.band, r.ra, r.dec
+        """
+    ) ).format( pvid=pvid )
+
+
+def object_stats_comb_select( viewname ):
+    """Return the SELECT that builds the all-bands objstatscomb materialized view.
+
+    Works like object_stats_select, only reading the per-band view
+    viewname (once) instead of diasource.
+
+    Parameters
+    ----------
+      viewname : str
+        Name of the per-band objstats materialized view.
+
+    Returns
+    -------
+      psycopg.sql.Composed
+
+    """
+    return sql.SQL( textwrap.dedent(
+        """
+        WITH ranked AS (
+          SELECT *,
+                 ROW_NUMBER() OVER (PARTITION BY rootid ORDER BY firstdet_mjd) AS ifirst,
+                 ROW_NUMBER() OVER (PARTITION BY rootid ORDER BY lastdet_mjd DESC) AS ilast,
+                 ROW_NUMBER() OVER (PARTITION BY rootid ORDER BY maxdet_flux DESC) AS imax
+          FROM {viewname}
+        )
+        SELECT rootid, ra, dec,
+               MIN(firstdet_mjd) FILTER (WHERE ifirst=1) AS firstdet_mjd,
+               MIN(firstdet_flux) FILTER (WHERE ifirst=1) AS firstdet_flux,
+               MIN(firstdet_fluxerr) FILTER (WHERE ifirst=1) AS firstdet_fluxerr,
+               MIN(lastdet_mjd) FILTER (WHERE ilast=1) AS lastdet_mjd,
+               MIN(lastdet_flux) FILTER (WHERE ilast=1) AS lastdet_flux,
+               MIN(lastdet_fluxerr) FILTER (WHERE ilast=1) AS lastdet_fluxerr,
+               MIN(maxdet_mjd) FILTER (WHERE imax=1) AS maxdet_mjd,
+               MIN(maxdet_flux) FILTER (WHERE imax=1) AS maxdet_flux,
+               MIN(maxdet_fluxerr) FILTER (WHERE imax=1) AS maxdet_fluxerr,
+               SUM(ndets) AS ndets, SUM(ndets24) AS ndets24, SUM(ndets23) AS ndets23,
+               SUM(ndets22) AS ndets22, SUM(ndets21) AS ndets21, SUM(nsn10) AS nsn10,
+               SUM(nsn7) AS nsn7, SUM(nsn5) AS nsn5
+        FROM ranked
+        GROUP BY rootid, ra, dec
+        """
+    ) ).format( viewname=sql.Identifier( viewname ) )
+
+
+def _objstats_unique_indexes( dbcon, procver ):
+    # REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index on each view.
+    #   (Views created before these indexes were added to
+    #   create_object_stats_materialized_view won't have them.)
+    q = sql.SQL( 'CREATE UNIQUE INDEX IF NOT EXISTS {idxname} ON {viewname}(rootid, band)'
+                ).format( idxname=sql.Identifier( f'idx_objstats_{procver}_unique' ),
+                          viewname=sql.Identifier( f'objstats_{procver}' ) )
+    dbcon.execute_nofetch( q, explain=False )
+    q = sql.SQL( 'CREATE UNIQUE INDEX IF NOT EXISTS {idxname} ON {viewname}(rootid)'
+                ).format( idxname=sql.Identifier( f'idx_objstatscomb_{procver}_unique' ),
+                          viewname=sql.Identifier( f'objstatscomb_{procver}' ) )
+    dbcon.execute_nofetch( q, explain=False )
+
+
+def _record_objstats_refresh( dbcon, procver, duration ):
+    # NOW() is the start of the transaction, so the views have everything committed before then
+    pvid = db.ProcessingVersion.procver_id( procver, dbcon=dbcon )
+    dbcon.execute_nofetch( "INSERT INTO objstats_refresh(procver_id, refreshed_at, duration) "
+                           "VALUES (%(pv)s, NOW(), %(dt)s) "
+                           "ON CONFLICT (procver_id) DO UPDATE SET refreshed_at=EXCLUDED.refreshed_at, "
+                           "                                      duration=EXCLUDED.duration",
+                           { 'pv': pvid, 'dt': duration }, explain=False )
+
+
+def objstats_refreshed_at( processing_version, dbcon=None ):
+    """Return when the objstats views for a processing version were last built or refreshed.
+
+    Parameters
+    ----------
+      processing_version : UUID or str
+        The processing version (or alias).
+
+      dbcon : db.DBCon or psycopg.Connection, default None
+        Database connection to use.  If None, will make a new connection
+        and close it when done.
+
+    Returns
+    -------
+      datetime.datetime or None
+        The views include everything committed to the database before
+        this time.  None if there's no record of the views having been
+        built.
+
+    """
+    with db.DBCon( dbcon ) as con:
+        pvid = db.ProcessingVersion.procver_id( processing_version, dbcon=con )
+        rows, _cols = con.execute( "SELECT refreshed_at FROM objstats_refresh WHERE procver_id=%(pv)s",
+                                   { 'pv': pvid } )
+        return rows[0][0] if len(rows) > 0 else None
+
+
+def create_object_stats_materialized_view( procver, concurrently=True ):
+    """Create, or refresh, the objstats materialized views for a processing version.
+
+    These are the views that object_search searches.
+    objstats_{procver} has one row for each rootid and band, and
+    objstatscomb_{procver} has one row for each rootid.  If the views
+    don't exist, they're created (and filled); if they do exist, they're
+    refreshed.  Either way, the time is recorded in the objstats_refresh
+    table (see objstats_refreshed_at).
+
+    Parameters
+    ----------
+      procver : str
+        The processing version (or alias).  This is used in the view
+        names.
+
+      concurrently : bool, default True
+        If True, refresh with REFRESH MATERIALIZED VIEW CONCURRENTLY.
+        This is slower than a plain refresh, but object_search can
+        still read the views while it runs.  (Ignored when the views
+        are first created.)
+
+    """
+    t0 = time.perf_counter()
     with db.DBCon( dictcursor=True ) as dbcon:
         # Check to see if it already exists
         q = sql.SQL( "SELECT * FROM pg_class WHERE relname={viewname}" ).format( viewname=f'objstats_{procver}' )
@@ -1573,189 +2003,29 @@ def create_object_stats_materialized_view( procver ):
                 raise RuntimeError( f"postgrew view objstatscomb_{procver} has the wrong set of columns" )
 
 
+            refresh = "REFRESH MATERIALIZED VIEW"
+            if concurrently:
+                _objstats_unique_indexes( dbcon, procver )
+                refresh += " CONCURRENTLY"
             FDBLogger.info( f"Refreshing materizalized view objstats_{procver}" )
-            q = sql.SQL( "REFRESH MATERIALIZED VIEW {viewname}"
-                        ).format( viewname=sql.Identifier( f'objstats_{procver}' ) )
-            dbcon.execute( q )
+            q = sql.SQL( refresh + " {viewname}" ).format( viewname=sql.Identifier( f'objstats_{procver}' ) )
+            dbcon.execute_nofetch( q, explain=False )
             FDBLogger.info( f"Refreshing materizalized view objstatscomb_{procver}" )
-            q = sql.SQL( "REFRESH MATERIALIZED VIEW {viewname}"
-                        ).format( viewname=sql.Identifier( f'objstatscomb_{procver}' ) )
-            dbcon.execute( q )
+            q = sql.SQL( refresh + " {viewname}" ).format( viewname=sql.Identifier( f'objstatscomb_{procver}' ) )
+            dbcon.execute_nofetch( q, explain=False )
+            _record_objstats_refresh( dbcon, procver, time.perf_counter() - t0 )
             dbcon.commit()
             FDBLogger.info( f"Done refreshing materialized views for {procver}" )
             return
 
         # If we get here, the materialized view does not exist
-        #
-        # Note: there are hardcoded flux numbers below.
-        #   For zeropoint = 31.4,
-        #     m = 24 : f =   912
-        #     m = 23 : f =  2291
-        #     m = 22 : f =  5754
-        #     m = 21 : f = 14454
 
         FDBLogger.info( f"Creating materialized view objstats_{procver}" )
         pvid = db.ProcessingVersion.procver_id( procver, dbcon=dbcon )
 
-        q = sql.SQL( textwrap.dedent(
-            """
-            CREATE MATERIALIZED VIEW {viewname} AS (
-               SELECT r.id AS rootid, d0.band AS band, r.ra AS ra, r.dec AS dec,
-                   d0.midpointmjdtai AS firstdet_mjd, d0.psfflux AS firstdet_flux, d0.psffluxerr AS firstdet_fluxerr,
-                   dn.midpointmjdtai AS lastdet_mjd, dn.psfflux AS lastdet_flux, dn.psffluxerr AS lastdet_fluxerr,
-                   dx.midpointmjdtai AS maxdet_mjd, dx.psfflux AS maxdet_flux, dx.psffluxerr AS maxdet_fluxerr,
-                   n.ndets AS ndets,
-                   CASE WHEN n24.ndets IS NULL THEN 0 ELSE n24.ndets END as ndets24,
-                   CASE WHEN n23.ndets IS NULL THEN 0 ELSE n23.ndets END AS ndets23,
-                   CASE WHEN n22.ndets IS NULL THEN 0 ELSE n22.ndets END AS ndets22,
-                   CASE WHEN n21.ndets IS NULL THEN 0 ELSE n21.ndets END AS ndets21,
-                   CASE WHEN sn10.ndets IS NULL THEN 0 ELSE sn10.ndets END AS nsn10,
-                   CASE WHEN sn7.ndets IS NULL THEN 0 ELSE sn7.ndets END AS nsn7,
-                   CASE WHEN sn5.ndets IS NULL THEN 0 ELSE sn5.ndets END AS nsn5
-               FROM root_diaobject r
-               INNER JOIN (
-                  SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  ORDER BY rootid, band, midpointmjdtai
-               ) d0 ON d0.rootid=r.id
-               INNER JOIN (
-                  SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  ORDER BY rootid, band, midpointmjdtai DESC
-               ) dn ON d0.rootid=dn.rootid and d0.band=dn.band
-               INNER JOIN (
-                  SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  ORDER BY rootid, band, psfflux DESC
-               ) dx ON d0.rootid=dx.rootid AND d0.band=dx.band
-               INNER JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  GROUP BY rootid, band
-               ) n ON d0.rootid=n.rootid AND d0.band=n.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux >= 912
-                  GROUP BY rootid, band
-               ) n24 ON d0.rootid=n24.rootid AND d0.band=n24.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux >= 2291
-                  GROUP BY rootid, band
-               ) n23 ON d0.rootid=n23.rootid AND d0.band=n23.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux >= 5754
-                  GROUP BY rootid, band
-               ) n22 ON d0.rootid=n22.rootid AND d0.band=n22.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux >= 14454
-                  GROUP BY rootid, band
-               ) n21 ON d0.rootid=n21.rootid AND d0.band=n21.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux / psffluxerr >= 10
-                  GROUP BY rootid, band
-               ) sn10 ON d0.rootid=sn10.rootid AND d0.band=sn10.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux / psffluxerr >= 7
-                  GROUP BY rootid, band
-               ) sn7 ON d0.rootid=sn7.rootid AND d0.band=sn7.band
-               LEFT JOIN (
-                  SELECT rootid, band, COUNT(diasourceid) AS ndets
-                  FROM (
-                     SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
-                     FROM diasource s
-                     INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
-                     INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
-                                                         AND j.procver_id={pvid}
-                     ORDER BY o.rootid, s.visit, j.priority DESC
-                  ) subq
-                  WHERE psfflux / psffluxerr >= 5
-                  GROUP BY rootid, band
-               ) sn5 ON d0.rootid=sn5.rootid AND d0.band=sn5.band
-            )
-            """
-        ) ).format( viewname=sql.Identifier( f'objstats_{procver}' ), pvid=pvid )
-
+        q = sql.SQL( "CREATE MATERIALIZED VIEW {viewname} AS ( {select} )"
+                    ).format( viewname=sql.Identifier( f'objstats_{procver}' ),
+                              select=object_stats_select( pvid ) )
         dbcon.execute_nofetch( q, explain=False )
 
         indexcols = [ 'rootid', 'firstdet_mjd', 'lastdet_mjd', 'maxdet_mjd',
@@ -1771,6 +2041,7 @@ def create_object_stats_materialized_view( procver ):
         q = sql.SQL( 'CREATE INDEX {idxname} ON {viewname}(band)',
                     ).format( idxname=sql.Identifier( f'idx_obstats_{procver}_band' ),
                               viewname=sql.Identifier( f'objstats_{procver}' ) )
+        dbcon.execute( q, explain=False )
 
         q = sql.SQL( 'CREATE INDEX {idxname} ON {viewname}(q3c_ang2ipix(ra, dec))'
                     ).format( idxname=sql.Identifier( f'idx_objstats_{procver}_q3c' ),
@@ -1778,41 +2049,9 @@ def create_object_stats_materialized_view( procver ):
         dbcon.execute( q, explain=False )
 
         # Now create the view that combines all the bands together
-        q = sql.SQL( textwrap.dedent(
-            """
-            CREATE MATERIALIZED VIEW {combviewname} AS (
-              SELECT s.rootid, s.ra, s.dec,
-                     fd.mjd AS firstdet_mjd, fd.flux AS firstdet_flux, fd.fluxerr AS firstdet_fluxerr,
-                     ld.mjd AS lastdet_mjd, ld.flux AS lastdet_flux, ld.fluxerr AS lastdet_fluxerr,
-                     xd.mjd AS maxdet_mjd, xd.flux AS maxdet_flux, xd.fluxerr AS maxdet_fluxerr,
-                     s.ndets AS ndets, s.ndets24 AS ndets24, s.ndets23 AS ndets23, s.ndets22 AS ndets22,
-                     s.ndets21 AS ndets21, s.nsn10 AS nsn10, s.nsn7 AS nsn7, s.nsn5 AS nsn5
-              FROM (
-                SELECT rootid, ra, dec, SUM(ndets) AS ndets, SUM(ndets24) AS ndets24, SUM(ndets23) AS ndets23,
-                       SUM(ndets22) AS ndets22, SUM(ndets21) AS ndets21, SUM(nsn10) AS nsn10,
-                       SUM(nsn7) AS nsn7, SUM(nsn5) AS nsn5
-                FROM {viewname}
-                GROUP BY rootid, ra, dec
-              ) s
-              INNER JOIN (
-                SELECT DISTINCT ON(rootid) rootid, firstdet_mjd AS mjd, firstdet_flux AS flux,
-                                           firstdet_fluxerr AS fluxerr
-                FROM {viewname}
-                ORDER BY rootid, firstdet_mjd
-              ) fd ON s.rootid=fd.rootid
-              INNER JOIN (
-                SELECT DISTINCT ON(rootid) rootid, lastdet_mjd AS mjd, lastdet_flux AS flux, lastdet_fluxerr AS fluxerr
-                FROM {viewname}
-                ORDER BY rootid, lastdet_mjd DESC
-              ) ld ON s.rootid=ld.rootid
-              INNER JOIN (
-                SELECT DISTINCT ON(rootid) rootid, maxdet_mjd AS mjd, maxdet_flux AS flux, maxdet_fluxerr AS fluxerr
-                FROM {viewname}
-                ORDER BY rootid, maxdet_flux DESC
-              ) xd ON s.rootid=xd.rootid
-            )
-            """ ) ).format( viewname=sql.Identifier(f'objstats_{procver}'),
-                            combviewname=sql.Identifier(f'objstatscomb_{procver}') )
+        q = sql.SQL( "CREATE MATERIALIZED VIEW {combviewname} AS ( {select} )"
+                    ).format( combviewname=sql.Identifier( f'objstatscomb_{procver}' ),
+                              select=object_stats_comb_select( f'objstats_{procver}' ) )
         dbcon.execute( q, explain=False )
 
         for col in indexcols:
@@ -1827,5 +2066,8 @@ def create_object_stats_materialized_view( procver ):
                               viewname=sql.Identifier( f'objstatscomb_{procver}' ) )
         dbcon.execute( q, explain=False )
 
+        _objstats_unique_indexes( dbcon, procver )
+        _record_objstats_refresh( dbcon, procver, time.perf_counter() - t0 )
+
         dbcon.commit()
         FDBLogger.info( f"Done creating materialized view objstats_{procver}" )
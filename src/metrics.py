@@ -0,0 +1,221 @@
+__all__ = [ "MetricsRegistry", "render_snapshots", "serve_metrics" ]
+
+import math
+import copy
+import threading
+import http.server
+
+
+# Default histogram buckets, in seconds, for timing things
+_default_buckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60. )
+
+
+class MetricsRegistry:
+    """A minimal thread-safe registry of counters, gauges, and histograms.
+
+    Renders to the Prometheus text exposition format.  (We don't use
+    prometheus_client because we need to ship snapshots between
+    processes through multiprocessing Pipes and merge them, and that's
+    easy with plain dicts.)
+
+    Metrics are created on first use.  Labels are passed as keyword
+    arguments, e.g.
+
+       reg = MetricsRegistry( constlabels={ 'broker': 'fink' } )
+       reg.inc( 'fastdb_kafka_messages_consumed_total', 100, topic='foo', partition=3 )
+       reg.observe( 'fastdb_broker_store_seconds', 0.25 )
+
+    constlabels are added to every series.
+
+    """
+
+    def __init__( self, constlabels={} ):
+        self.constlabels = { k: str(v) for k, v in constlabels.items() }
+        self._lock = threading.Lock()
+        # name → { 'type': str, 'help': str, 'buckets': tuple or None, 'series': { labeltuple: value } }
+        #   value is a float for counters and gauges, and [ bucketcounts (list), sum, count ] for histograms
+        self._metrics = {}
+
+
+    def _series( self, name, mtype, helpstr, labels, buckets=None ):
+        if name not in self._metrics:
+            self._metrics[name] = { 'type': mtype, 'help': helpstr, 'buckets': buckets, 'series': {} }
+        elif self._metrics[name]['type'] != mtype:
+            raise ValueError( f"Metric {name} is a {self._metrics[name]['type']}, not a {mtype}" )
+        alllabels = dict( self.constlabels )
+        alllabels.update( { k: str(v) for k, v in labels.items() } )
+        return self._metrics[name], tuple( sorted( alllabels.items() ) )
+
+
+    def inc( self, name, value=1, helpstr=None, **labels ):
+        """Increment counter name by value."""
+        with self._lock:
+            metric, key = self._series( name, 'counter', helpstr, labels )
+            metric['series'][key] = metric['series'].get( key, 0. ) + value
+
+
+    def set( self, name, value, helpstr=None, **labels ):
+        """Set gauge name to value."""
+        with self._lock:
+            metric, key = self._series( name, 'gauge', helpstr, labels )
+            metric['series'][key] = float( value )
+
+
+    def observe( self, name, value, helpstr=None, buckets=_default_buckets, **labels ):
+        """Add an observation of value to histogram name.
+
+        buckets is only used the first time the histogram is created.
+
+        """
+        with self._lock:
+            metric, key = self._series( name, 'histogram', helpstr, labels, buckets=tuple( buckets ) )
+            if key not in metric['series']:
+                metric['series'][key] = [ [ 0 ] * len( metric['buckets'] ), 0., 0 ]
+            hist = metric['series'][key]
+            for i, le in enumerate( metric['buckets'] ):
+                if value <= le:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+
+    def get( self, name, **labels ):
+        """Return the current value of a counter or gauge (or None if it hasn't been set)."""
+        with self._lock:
+            if name not in self._metrics:
+                return None
+            metric, key = self._series( name, self._metrics[name]['type'], None, labels )
+            return metric['series'].get( key, None )
+
+
+    def snapshot( self ):
+        """Return a deep copy of the registry contents.  Can be pickled and passed to render_snapshots."""
+        with self._lock:
+            return copy.deepcopy( self._metrics )
+
+
+    def render( self ):
+        """Return the registry in Prometheus text exposition format."""
+        return render_snapshots( [ self.snapshot() ] )
+
+
+# ======================================================================
+
+def _escape( v ):
+    return v.replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+
+def _fmtlabels( labels, extra=None ):
+    labels = list( labels )
+    if extra is not None:
+        labels.append( extra )
+    if len( labels ) == 0:
+        return ""
+    return "{" + ",".join( f'{k}="{_escape(v)}"' for k, v in labels ) + "}"
+
+
+def _fmtnum( v ):
+    if math.isinf( v ):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr( float( v ) ) if not float( v ).is_integer() else str( int( v ) )
+
+
+def render_snapshots( snapshots ):
+    """Merge snapshots from MetricsRegistry.snapshot() and render them in Prometheus text format.
+
+    Series with identical names and labels from different snapshots
+    are summed (counters and histograms) or the last one wins
+    (gauges).  Give each registry distinct constlabels (e.g. broker)
+    if you don't want that.
+
+    """
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            if name not in merged:
+                merged[name] = { 'type': metric['type'], 'help': metric['help'],
+                                 'buckets': metric['buckets'], 'series': {} }
+            mm = merged[name]
+            if mm['type'] != metric['type']:
+                continue
+            if ( mm['help'] is None ) and ( metric['help'] is not None ):
+                mm['help'] = metric['help']
+            for key, val in metric['series'].items():
+                if metric['type'] == 'gauge' or key not in mm['series']:
+                    mm['series'][key] = copy.deepcopy( val )
+                elif metric['type'] == 'counter':
+                    mm['series'][key] += val
+                elif tuple( mm['buckets'] ) == tuple( metric['buckets'] ):
+                    old = mm['series'][key]
+                    old[0] = [ a + b for a, b in zip( old[0], val[0] ) ]
+                    old[1] += val[1]
+                    old[2] += val[2]
+
+    lines = []
+    for name in sorted( merged.keys() ):
+        metric = merged[name]
+        if metric['help'] is not None:
+            lines.append( f"# HELP {name} {metric['help']}" )
+        lines.append( f"# TYPE {name} {metric['type']}" )
+        for key in sorted( metric['series'].keys() ):
+            val = metric['series'][key]
+            if metric['type'] == 'histogram':
+                for le, n in zip( metric['buckets'], val[0] ):
+                    lines.append( f"{name}_bucket{_fmtlabels( key, ( 'le', _fmtnum(le) ) )} {n}" )
+                lines.append( f"{name}_bucket{_fmtlabels( key, ( 'le', '+Inf' ) )} {val[2]}" )
+                lines.append( f"{name}_sum{_fmtlabels( key )} {_fmtnum( val[1] )}" )
+                lines.append( f"{name}_count{_fmtlabels( key )} {val[2]}" )
+            else:
+                lines.append( f"{name}{_fmtlabels( key )} {_fmtnum( val )}" )
+    return "\n".join( lines ) + "\n"
+
+
+# ======================================================================
+
+def serve_metrics( render_func, port, host='127.0.0.1' ):
+    """Serve render_func() at http://{host}:{port}/metrics from a daemon thread.
+
+    Parameters
+    ----------
+      render_func : callable
+        Returns a str in Prometheus text format (e.g. MetricsRegistry.render)
+
+      port : int
+        Port to listen on.  0 means pick a free port.
+
+      host : str, default '127.0.0.1'
+        Interface to listen on.  Use '0.0.0.0' if something outside the
+        container/pod needs to scrape it.
+
+    Returns
+    -------
+      http.server.ThreadingHTTPServer ; call shutdown() on it to stop
+      serving.  Its server_address attribute has the actual port.
+
+    """
+
+    class MetricsHandler( http.server.BaseHTTPRequestHandler ):
+        def do_GET( self ):
+            if self.path.split( '?' )[0] not in ( '/', '/metrics' ):
+                self.send_error( 404 )
+                return
+            try:
+                body = render_func().encode( 'utf-8' )
+            except Exception as ex:
+                self.send_error( 500, str(ex) )
+                return
+            self.send_response( 200 )
+            self.send_header( 'Content-Type', 'text/plain; version=0.0.4; charset=utf-8' )
+            self.send_header( 'Content-Length', str( len( body ) ) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def log_message( self, *args ):
+            # Scrapes happen every few seconds; don't spam stderr
+            pass
+
+    server = http.server.ThreadingHTTPServer( ( host, port ), MetricsHandler )
+    server.daemon_threads = True
+    thread = threading.Thread( target=server.serve_forever, name=f"metrics-{port}", daemon=True )
+    thread.start()
+    return server
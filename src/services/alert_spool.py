@@ -0,0 +1,324 @@
+import os
+import re
+import time
+import struct
+import pickle
+import zlib
+import pathlib
+import logging
+import threading
+
+
+class AlertSpool:
+    """An append-only on-disk spool of decoded broker message batches.
+
+    BrokerConsumer writes each batch of decoded (and wrangled) messages
+    to the spool instead of writing directly to mongo.  A drain thread
+    reads batches back out of the spool in order and hands them to a
+    store function (normally BrokerConsumer.mongodb_store).  That way,
+    if mongo is slow or restarting, kafka consumption keeps going at
+    line rate (up to the disk limit of the spool), and we don't get
+    rebalanced out of our consumer group.
+
+    The spool is a directory of segment files named
+    "{segment number, zero padded}.seg".  Each segment is a sequence of
+    records; each record is an 8-byte header (payload length and crc32
+    of the payload, both little-endian unsigned 32-bit ints) followed by
+    the pickled batch.  The writer only ever appends to the newest
+    segment, and starts a new segment when the current one gets bigger
+    than segment_bytes.  The drain thread deletes a segment once it has
+    stored everything in it.  Progress through the oldest segment is
+    recorded in the file "cursor" (replaced atomically after every
+    stored batch), so after a crash replay picks up at the first batch
+    that wasn't known to have been stored.  This means delivery to
+    mongo is at-least-once: a batch that was stored right before a crash
+    (but whose cursor update didn't make it) will be stored again.
+    (This is also true of kafka redelivery, so source_importer already
+    has to cope with duplicates.)
+
+    A record that was torn by a crash in the middle of a write (short or
+    with a bad checksum) can only be at the end of a segment; it, and
+    anything after it in that segment, is logged and skipped.
+
+    Disk usage is bounded by max_bytes of not-yet-stored batches (plus
+    at most one segment of already-stored batches that haven't been
+    deleted yet).  If the spool is full, append() blocks until the drain
+    thread has made room, which is the same backpressure on the poll
+    loop that we'd have had without a spool.
+
+    """
+
+    _header = struct.Struct( "<II" )
+    _segre = re.compile( r"^(\d{12})\.seg$" )
+
+    def __init__( self, spooldir, store_func, max_bytes=10*1024**3, segment_bytes=64*1024**2,
+                  fsync=True, retry_sleeptime=1, max_retry_sleeptime=60, logger=None ):
+        """Create an AlertSpool.  Call start() to start the drain thread.
+
+        Parameters
+        ----------
+          spooldir : Path or str
+            Directory for segment files.  Will be created if it doesn't
+            exist.  Must not be shared between two running spools.
+            If there are segments left over from a previous run, they
+            will be drained before anything appended by this run.
+
+          store_func : callable
+            Called by the drain thread as store_func( **batch ) for
+            every batch passed to append().  If it raises an exception,
+            the batch will be retried (with backoff) until it succeeds.
+
+          max_bytes : int, default 10GiB
+            append() blocks when the spool has more than this many bytes
+            of batches that haven't been stored yet.
+
+          segment_bytes : int, default 64MiB
+            Start a new segment file after the current one exceeds this
+            size.
+
+          fsync : bool, default True
+            fsync the segment after every append.  Set this to False to
+            trade crash-safety for speed.
+
+          retry_sleeptime : float, default 1
+            Seconds to wait before retrying a failed store_func call.
+            Doubles after every consecutive failure...
+
+          max_retry_sleeptime : float, default 60
+            ...up to this many seconds.
+
+          logger : logging.Logger or None
+            Where to send log messages.
+
+        """
+        self.spooldir = pathlib.Path( spooldir )
+        self.spooldir.mkdir( parents=True, exist_ok=True )
+        self.store_func = store_func
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.retry_sleeptime = retry_sleeptime
+        self.max_retry_sleeptime = max_retry_sleeptime
+        self.logger = logger if logger is not None else logging.getLogger( "AlertSpool" )
+
+        self._cursorfile = self.spooldir / "cursor"
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+
+        # Stats
+        self.n_appended = 0
+        self.n_stored = 0
+        self.n_store_failures = 0
+
+        # Figure out what's left over from a previous run.  Never append to
+        #   an old segment; its tail may be torn.
+        self._segments = sorted( int( m.group(1) ) for m in
+                                 ( self._segre.match( f.name ) for f in self.spooldir.iterdir() )
+                                 if m is not None )
+        self._bytes = sum( self._segpath( s ).stat().st_size for s in self._segments )
+        if len( self._segments ) > 0:
+            self.logger.info( f"Spool {self.spooldir} has {len(self._segments)} segments "
+                              f"({self._bytes} bytes) left over; will replay them." )
+
+        # Where the drain thread is.
+        self._read_seg = None
+        self._read_pos = 0
+        if self._cursorfile.is_file():
+            try:
+                seg, pos = self._cursorfile.read_text().split()
+                seg = int( seg )
+                if seg in self._segments:
+                    self._read_seg = seg
+                    self._read_pos = int( pos )
+            except Exception as ex:
+                self.logger.warning( f"Couldn't parse spool cursor file {self._cursorfile}, "
+                                     f"replaying from start of oldest segment: {ex}" )
+
+        self._write_seg = ( self._segments[-1] + 1 ) if len( self._segments ) > 0 else 0
+        self._segments.append( self._write_seg )
+        self._write_fp = open( self._segpath( self._write_seg ), "ab" )
+        self._write_pos = 0
+        if self._read_seg is None:
+            self._read_seg = self._segments[0]
+            self._read_pos = 0
+
+
+    def _segpath( self, seg ):
+        return self.spooldir / f"{seg:012d}.seg"
+
+
+    @property
+    def nbytes( self ):
+        """Bytes currently on disk in the spool (approximately)."""
+        with self._cond:
+            return self._bytes
+
+
+    @property
+    def nbytes_pending( self ):
+        """Bytes on disk in the spool that haven't been stored yet."""
+        with self._cond:
+            return self._bytes - self._read_pos
+
+
+    def _drained( self ):
+        return ( self._read_seg == self._write_seg ) and ( self._read_pos >= self._write_pos )
+
+
+    def append( self, **batch ):
+        """Durably add a batch to the spool.
+
+        The kwargs are what will eventually be passed to store_func.
+        They must be picklable.  Blocks if the spool is over max_bytes.
+
+        """
+        payload = pickle.dumps( batch, protocol=pickle.HIGHEST_PROTOCOL )
+        record = self._header.pack( len(payload), zlib.crc32( payload ) ) + payload
+
+        with self._cond:
+            warned = False
+            while ( ( self._bytes > self._read_pos )
+                    and ( self._bytes - self._read_pos + len(record) > self.max_bytes ) ):
+                if self._thread is None or not self._thread.is_alive():
+                    raise RuntimeError( f"Spool {self.spooldir} is full and the drain thread isn't running" )
+                if not warned:
+                    self.logger.warning( f"Spool {self.spooldir} is full ({self._bytes - self._read_pos} "
+                                         f"bytes pending); "
+                                         f"waiting for the drain thread to catch up." )
+                    warned = True
+                self._cond.wait( timeout=1 )
+
+            if self._write_pos >= self.segment_bytes:
+                self._write_fp.close()
+                self._write_seg += 1
+                self._segments.append( self._write_seg )
+                self._write_fp = open( self._segpath( self._write_seg ), "ab" )
+                self._write_pos = 0
+
+            self._write_fp.write( record )
+            self._write_fp.flush()
+            if self.fsync:
+                os.fsync( self._write_fp.fileno() )
+            self._write_pos += len( record )
+            self._bytes += len( record )
+            self.n_appended += 1
+            self._cond.notify_all()
+
+
+    def _write_cursor( self ):
+        tmp = self.spooldir / "cursor.tmp"
+        tmp.write_text( f"{self._read_seg} {self._read_pos}\n" )
+        os.replace( tmp, self._cursorfile )
+
+
+    def _next_batch( self ):
+        """Return ( batch, reclen ) for the next unstored record, or None if there isn't one yet.
+
+        Deletes fully-drained segments along the way.  Must be called with self._cond held.
+
+        """
+        while True:
+            active = ( self._read_seg == self._write_seg )
+            path = self._segpath( self._read_seg )
+            end = self._write_pos if active else path.stat().st_size
+            if self._read_pos < end:
+                with open( path, "rb" ) as ifp:
+                    ifp.seek( self._read_pos )
+                    hdr = ifp.read( self._header.size )
+                    if len( hdr ) == self._header.size:
+                        length, crc = self._header.unpack( hdr )
+                        payload = ifp.read( length )
+                        if ( len( payload ) == length ) and ( zlib.crc32( payload ) == crc ):
+                            return pickle.loads( payload ), self._header.size + length
+                # If we get here, we got a torn or corrupted record.  The writer
+                #   never tears records in the active segment, so this must be a
+                #   segment left over from a crash.
+                self.logger.error( f"Spool segment {path} has a torn or corrupt record at byte "
+                                   f"{self._read_pos}; skipping the remaining {end - self._read_pos} bytes." )
+                self._read_pos = end
+
+            if active:
+                return None
+
+            # Done with this segment
+            self._bytes -= path.stat().st_size
+            path.unlink()
+            self._segments.remove( self._read_seg )
+            self._read_seg = self._segments[0]
+            self._read_pos = 0
+            self._write_cursor()
+            self._cond.notify_all()
+
+
+    def _drain_loop( self ):
+        sleeptime = self.retry_sleeptime
+        while True:
+            with self._cond:
+                nxt = self._next_batch()
+                while nxt is None:
+                    if self._stop:
+                        return
+                    self._cond.wait( timeout=1 )
+                    nxt = self._next_batch()
+            batch, reclen = nxt
+
+            try:
+                self.store_func( **batch )
+            except Exception as ex:
+                self.n_store_failures += 1
+                self.logger.warning( f"Storing spooled batch failed ({ex}); retrying in {sleeptime}s. "
+                                     f"Spool has {self.nbytes_pending} bytes pending." )
+                time.sleep( sleeptime )
+                sleeptime = min( 2 * sleeptime, self.max_retry_sleeptime )
+                continue
+
+            sleeptime = self.retry_sleeptime
+            with self._cond:
+                self._read_pos += reclen
+                self._write_cursor()
+                self.n_stored += 1
+                self._cond.notify_all()
+
+
+    def start( self ):
+        """Start the drain thread."""
+        if ( self._thread is not None ) and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread( target=self._drain_loop, name=f"AlertSpool-{self.spooldir.name}",
+                                         daemon=True )
+        self._thread.start()
+
+
+    def stop( self, timeout=None ):
+        """Stop the drain thread once the spool is empty (or timeout seconds have passed).
+
+        Whatever isn't drained when this returns stays on disk and will
+        be replayed the next time an AlertSpool is created on the same
+        directory.
+
+        Returns
+        -------
+          True if the spool was fully drained, False otherwise.
+
+        """
+        t0 = time.monotonic()
+        with self._cond:
+            while not self._drained():
+                if ( self._thread is None ) or ( not self._thread.is_alive() ):
+                    break
+                if ( timeout is not None ) and ( time.monotonic() - t0 >= timeout ):
+                    break
+                self._cond.wait( timeout=1 )
+            drained = self._drained()
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join( timeout=None if drained else 5 )
+        return drained
+
+
+    def close( self ):
+        with self._cond:
+            self._write_fp.close()
@@ -23,6 +23,8 @@ import pymongo
 
 import db
 from kafka_consumer import KafkaConsumer
+from metrics import MetricsRegistry, render_snapshots, serve_metrics
+from services.alert_spool import AlertSpool
 
 # Default location of BrokerMessage schema
 _default_brokermessage_schemafile = "/fastdb/share/avsc/fastdb.v10_0_0.BrokerMessage.avsc"
@@ -34,6 +36,60 @@ _rundir = pathlib.Path(__file__).parent
 _logdir = pathlib.Path( os.getenv( 'LOGDIR', '/logs' ) )
 
 
+def rss_bytes( pid='self' ):
+    """Resident set size of a process (default: this one) in bytes, or None if it can't be determined."""
+    try:
+        with open( f"/proc/{pid}/statm" ) as ifp:
+            return int( ifp.read().split()[1] ) * os.sysconf( "SC_PAGE_SIZE" )
+    except Exception:
+        return None
+
+
+def decode_raw_messages( raw, schemaless, schema_in_key, schema ):
+    """Decode the avro payloads of messages returned by BrokerConsumer.raw_messages.
+
+    This is a module-level function (rather than a BrokerConsumer
+    method) so that it can be sent to a worker process.
+
+    Parameters
+    ----------
+      raw : list of ( topic, offset, timestamp, key, payload )
+
+      schemaless, schema_in_key : bool
+        See BrokerConsumer.__init__
+
+      schema : parsed avro schema or None
+        Required if schemaless is True.
+
+    Returns
+    -------
+      list of dict, the decoded alerts, in the same order as raw
+
+    """
+    alerts = []
+    for _topic, _offset, _timestamp, key, payload in raw:
+        if schemaless:
+            alert = fastavro.schemaless_reader( io.BytesIO( payload ), schema )
+        else:
+            if schema_in_key:
+                if isinstance( key, bytes ):
+                    key = key.decode( "utf-8" )
+                parsed_schema = fastavro.schema.parse_schema( simplejson.loads( key ) )
+                alert = fastavro.schemaless_reader( io.BytesIO( payload ), parsed_schema )
+            else:
+                # ...there may be a better way than instantiating a new reader for every
+                #   message.  Figure it out.
+                reader = fastavro.read.reader( io.BytesIO( payload ) )
+                alertlist = [ m for m in reader ]
+                if len(alertlist) != 1:
+                    raise RuntimeError( "This should never happen." )
+                alert = alertlist[0]
+        alerts.append( alert )
+    return alerts
+
+
+# ======================================================================
+
 class BrokerConsumer:
     """A class for consuming broker messages from brokers.
 
@@ -118,6 +174,15 @@ class BrokerConsumer:
     "countlogger_{loggername_prefix}{loggername}".  (The variables
     loggername_prefix and loggername are passed at object construction).
 
+    Spooling : if spool_dir is given at construction, decoded and
+    wrangled batches are written to a local on-disk spool
+    (services/alert_spool.py) rather than directly to mongo, and a
+    background thread drains the spool into mongo.  This keeps kafka
+    consumption going when mongo is slow or restarting.  Anything still
+    in the spool when the process exits is replayed into mongo the next
+    time a BrokerConsumer starts with the same spool_dir and
+    mongodb_collection_base.
+
     TODO : implement count log file rotation?
 
     """
@@ -133,7 +198,11 @@ class BrokerConsumer:
                   brokername_for_alerts=None, brokername_key=None,
                   mongodb_collection_base=None, cache_alerts=False, no_wrangle=False,
                   pipe=None, loggername="BROKER", loggername_prefix='',
-                  consume_timeout=1, nomsg_sleeptime=5, batch_size=1000 ):
+                  consume_timeout=1, nomsg_sleeptime=5, batch_size=1000, prefetch_batches=0,
+                  adaptive_batching=False, batch_size_range=None, consume_timeout_range=None,
+                  target_handle_time=10,
+                  spool_dir=None, spool_max_gb=10., spool_segment_mb=64., spool_fsync=True,
+                  spool_shutdown_timeout=10, metrics_name=None, metrics_port=None ):
         """Create a connection to a kafka server and consumer broker messages.
 
         Note that you often (but not always) want to instantiate a subclass.
@@ -247,6 +316,66 @@ class BrokerConsumer:
           batch_size : int, default 1000
             Try to consume this many messages at once.
 
+          prefetch_batches : int, default 0
+            If more than 0, consume batches from kafka in a background
+            thread while the previous batch is being handled, keeping
+            up to this many batches ready.  Offsets are only committed
+            for batches that have been handled.  See the prefetch
+            parameter of KafkaConsumer (src/kafka_consumer.py).
+
+          adaptive_batching : bool, default False
+            If True, batch_size and consume_timeout are only starting
+            points; the consumer tunes them as it goes based on how
+            full batches are, how long handling takes, and the consumer
+            lag.  See the adaptive parameter of KafkaConsumer.
+
+          batch_size_range : ( int, int ) or None
+            Bounds for batch_size if adaptive_batching is True.  Defaults
+            to ( batch_size // 10, batch_size * 10 ).
+
+          consume_timeout_range : ( float, float ) or None
+            Bounds for consume_timeout if adaptive_batching is True.
+
+          target_handle_time : float or None, default 10
+            If adaptive_batching is True, don't grow batches past what
+            can be handled in this many seconds.
+
+          spool_dir : Path, str, or None
+            If not None, spool batches to disk under
+            {spool_dir}/{mongodb_collection_base}, and store them to
+            mongo from a background thread.  See "Spooling" in the class
+            docstring.
+
+          spool_max_gb : float, default 10.
+            Ignored if spool_dir is None.  Once the spool holds this
+            many GB of batches not yet stored to mongo, consumption
+            blocks until the spool drains.
+
+          spool_segment_mb : float, default 64.
+            Ignored if spool_dir is None.  Size of spool segment files.
+
+          spool_fsync : bool, default True
+            Ignored if spool_dir is None.  fsync the spool after every
+            batch.  Setting this to False is faster, but batches may be
+            lost if the machine (not just the process) crashes.
+
+          spool_shutdown_timeout : float, default 10
+            Ignored if spool_dir is None.  When poll exits, wait at most
+            this many seconds for the spool to drain to mongo.  Anything
+            left will be replayed next time.
+
+          metrics_name : str or None
+            Value of the "broker" label on all metrics this consumer
+            records.  Defaults to {loggername_prefix}{loggername}.
+            (BrokerConsumerLauncher sets this to the name of the broker
+            in its config file.)
+
+          metrics_port : int or None
+            If not None, serve this consumer's metrics in Prometheus
+            text format at http://localhost:{metrics_port}/metrics.
+            (You usually don't need this with BrokerConsumerLauncher,
+            which can serve the metrics of all of its consumers.)
+
         """
 
         if not _logdir.is_dir():
@@ -320,6 +449,11 @@ class BrokerConsumer:
         self.extraconfig = extraconfig
         self.nomsg_sleeptime = nomsg_sleeptime
         self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+        self.adaptive_batching = adaptive_batching
+        self.batch_size_range = batch_size_range
+        self.consume_timeout_range = consume_timeout_range
+        self.target_handle_time = target_handle_time
         self.consume_timeout = consume_timeout
         self.brokername_for_alerts = brokername_for_alerts
         self.brokername_key = brokername_key
@@ -334,6 +468,25 @@ class BrokerConsumer:
             raise ValueError( "no_wrangle requires cache_alerts" )
         self.ensure_collections()
 
+        self.metrics = MetricsRegistry( constlabels={ 'broker': ( metrics_name if metrics_name is not None
+                                                                  else f"{loggername_prefix}{loggername}" ) } )
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = serve_metrics( self.metrics.render, metrics_port )
+            self.logger.info( f"Serving metrics on port {self.metrics_server.server_address[1]}" )
+
+        self.spool = None
+        self.spool_shutdown_timeout = spool_shutdown_timeout
+        if spool_dir is not None:
+            self.spool = AlertSpool( pathlib.Path( spool_dir ) / self.mongodb_collection_base,
+                                     self._store_spooled_batch,
+                                     max_bytes=int( spool_max_gb * 1024**3 ),
+                                     segment_bytes=int( spool_segment_mb * 1024**2 ),
+                                     fsync=spool_fsync,
+                                     logger=self.logger )
+            self.spool.start()
+            self.logger.info( f"Spooling broker messages to {self.spool.spooldir}" )
+
         self.logger.info( f"Writing broker messages to monogdb collections {self.mongodb_collection_base}*" )
 
 
@@ -427,7 +580,13 @@ class BrokerConsumer:
                                                           consume_timeout=self.consume_timeout,
                                                           nomsg_sleeptime=self.nomsg_sleeptime,
                                                           logger=self.logger,
-                                                          countlogger=self.countlogger )
+                                                          countlogger=self.countlogger,
+                                                          metrics=self.metrics,
+                                                          prefetch=self.prefetch_batches,
+                                                          adaptive=self.adaptive_batching,
+                                                          consume_nmsgs_range=self.batch_size_range,
+                                                          consume_timeout_range=self.consume_timeout_range,
+                                                          target_handle_time=self.target_handle_time )
 
         self.countlogger.info( "**************** Consumer connection opened *****************" )
 
@@ -648,39 +807,35 @@ class BrokerConsumer:
                  'thumbnailses': thumbnailses,
                  'brokerinfos': brokerinfos }
 
-    def handle_message_batch( self, msgs ):
-        messagebatch = []
-        self.countlogger.info( f"Handling {len(msgs)} messages; consumer has received "
-                               f"{self.consumer.tot_handled} messages." )
-        now = datetime.datetime.now( tz=datetime.UTC )
-        t0 = time.perf_counter()
+    @classmethod
+    def raw_messages( cls, msgs ):
+        """Pull what we need out of confluent_kafka.Message objects.
+
+        The result (unlike the Message objects) can be pickled, so can
+        be sent to decode_raw_messages in another process.
+
+        Returns
+        -------
+          list of ( topic, offset, timestamp, key, payload )
+            timestamp is a datetime or None
+
+        """
+        raw = []
         for msg in msgs:
             timestamptype, timestamp = msg.timestamp()
-
             if timestamptype == confluent_kafka.TIMESTAMP_NOT_AVAILABLE:
                 timestamp = None
             else:
                 timestamp = datetime.datetime.fromtimestamp( timestamp / 1000 )
+            raw.append( ( msg.topic(), msg.offset(), timestamp, msg.key(), msg.value() ) )
+        return raw
 
-            key = msg.key()
-            payload = msg.value()
-            if self.schemaless:
-                alert = fastavro.schemaless_reader( io.BytesIO( payload ), self.schema )
-            else:
-                if self.schema_in_key:
-                    if isinstance( key, bytes ):
-                        key = key.decode( "utf-8" )
-                    parsed_schema = fastavro.schema.parse_schema( simplejson.loads( key ) )
-                    alert = fastavro.schemaless_reader( io.BytesIO( payload ), parsed_schema )
-                else:
-                    # ...there may be a better way than instantiating a new reader for every
-                    #   message.  Figure it out.
-                    reader = fastavro.read.reader( io.BytesIO( payload ) )
-                    alertlist = [ m for m in reader ]
-                    if len(alertlist) != 1:
-                        raise RuntimeError( "This should never happen." )
-                    alert = alertlist[0]
 
+    def build_messagebatch( self, raw, alerts, now=None ):
+        """Combine the output of raw_messages and decode_raw_messages into the list alert_wrangler wants."""
+        now = datetime.datetime.now( tz=datetime.UTC ) if now is None else now
+        messagebatch = []
+        for ( topic, offset, timestamp, _key, _payload ), alert in zip( raw, alerts ):
             if self.brokername_for_alerts is not None:
                 bname = self.brokername_for_alerts
             elif self.brokername_key is not None:
@@ -689,21 +844,61 @@ class BrokerConsumer:
                 bname = self._brokername
 
             messagebatch.append( { 'brokername': bname,
-                                   'topic': msg.topic(),
-                                   'msgoffset': msg.offset(),
+                                   'topic': topic,
+                                   'msgoffset': offset,
                                    'timestamp': timestamp,
                                    'savetime': now,
                                    'msg': alert } )
+        return messagebatch
 
+
+    def handle_message_batch( self, msgs ):
+        self.countlogger.info( f"Handling {len(msgs)} messages; consumer has received "
+                               f"{self.consumer.tot_handled} messages." )
+        now = datetime.datetime.now( tz=datetime.UTC )
+        t0 = time.perf_counter()
+        raw = self.raw_messages( msgs )
+        alerts = decode_raw_messages( raw, self.schemaless, self.schema_in_key, self.schema )
+        messagebatch = self.build_messagebatch( raw, alerts, now=now )
+        t1 = time.perf_counter()
+        self.store_messagebatch( messagebatch, parsetime=t1-t0 )
+
+
+    def store_messagebatch( self, messagebatch, parsetime=None ):
+        """Wrangle a batch of decoded messages and send it to the spool or mongo."""
         t1 = time.perf_counter()
         if self.no_wrangle:
             wrangled = {}
         else:
             wrangled = self.alert_wrangler( messagebatch )
         t2 = time.perf_counter()
+        if parsetime is not None:
+            self.metrics.observe( 'fastdb_broker_parse_seconds', parsetime,
+                                  helpstr="Time to decode a batch of messages" )
+        self.metrics.observe( 'fastdb_broker_wrangle_seconds', t2 - t1,
+                              helpstr="Time to wrangle a batch of messages" )
+        if self.spool is not None:
+            self.spool.append( messagebatch=messagebatch, **wrangled )
+            t3 = time.perf_counter()
+            self.metrics.observe( 'fastdb_broker_spool_seconds', t3 - t2,
+                                  helpstr="Time to write a batch of messages to the spool" )
+            self.metrics.set( 'fastdb_broker_spool_pending_bytes', self.spool.nbytes_pending,
+                              helpstr="Bytes in the spool not yet stored to mongo" )
+            strio = io.StringIO()
+            strio.write( f"...spooled {len(messagebatch)} messages; spool has "
+                         f"{self.spool.nbytes_pending} bytes not yet in mongodb" )
+            if parsetime is not None:
+                strio.write( f"\n   ...parse time: {parsetime:.3f}" )
+            strio.write( f"\n   ...wrangle time: {t2-t1:.3f}" )
+            strio.write( f"\n   ...spool time: {t3-t2:.3f}" )
+            self.countlogger.info( strio.getvalue() )
+            return
         nadded = self.mongodb_store( messagebatch=messagebatch, **wrangled )
         t3 = time.perf_counter()
+        self._log_nadded( nadded, parsetime, t2-t1, t3-t2 )
 
+
+    def _log_nadded( self, nadded, parsetime, wranglertime, storetime ):
         strio = io.StringIO()
         strio.write( f"...added to mongodb:\n"
                      f"              {nadded['diaobject']} diaobject\n"
@@ -716,12 +911,23 @@ class BrokerConsumer:
                     )
         if self.cache_alerts:
             strio.write( f"\n              {nadded['alertcache']} cached alerts" )
-        strio.write( f"\n   ...parse time: {t1-t0:.3f}\n" )
-        strio.write( f"   ...wrangle time: {t2-t1:.3f}\n" )
-        strio.write( f"   ...store time: {t3-t2:.3f}" )
+        if parsetime is not None:
+            strio.write( f"\n   ...parse time: {parsetime:.3f}" )
+        if wranglertime is not None:
+            strio.write( f"\n   ...wrangle time: {wranglertime:.3f}" )
+        strio.write( f"\n   ...store time: {storetime:.3f}" )
         self.countlogger.info( strio.getvalue() )
 
 
+    def _store_spooled_batch( self, **batch ):
+        # Called from the spool's drain thread
+        t0 = time.perf_counter()
+        nadded = self.mongodb_store( **batch )
+        self._log_nadded( nadded, None, None, time.perf_counter() - t0 )
+        self.metrics.set( 'fastdb_broker_spool_pending_bytes', self.spool.nbytes_pending,
+                          helpstr="Bytes in the spool not yet stored to mongo" )
+
+
     def mongodb_store( self, objects=[], sources=[], sources_extra=[],
                        forcedsources=[], forcedsources_extra=[],
                        thumbnailses=[], brokerinfos=[], messagebatch=[] ):
@@ -736,6 +942,7 @@ class BrokerConsumer:
                            f"    ....{len(messagebatch)} messagebatch\n" )
         # ****
         inserted = {}
+        t0 = time.perf_counter()
         with db.MGCon() as mg:
             for arr, suffix in zip( [ objects, sources, sources_extra,
                                       forcedsources, forcedsources_extra,
@@ -760,6 +967,12 @@ class BrokerConsumer:
                 else:
                     inserted['alertcache'] = 0
 
+        self.metrics.observe( 'fastdb_broker_store_seconds', time.perf_counter() - t0,
+                              helpstr="Time to store a batch of messages to mongo" )
+        for suffix, n in inserted.items():
+            self.metrics.inc( 'fastdb_broker_mongodb_documents_total', n,
+                              helpstr="Documents inserted into mongo", collection=suffix )
+
         # ****
         import pprint
         strio = io.StringIO()
@@ -906,6 +1119,21 @@ class BrokerConsumer:
                                   "runtime": datetime.datetime.now() - tstart } )
             return
 
+        finally:
+            self.stop_spool()
+
+
+    def stop_spool( self ):
+        """Give the spool (if any) a chance to drain to mongo, then stop its drain thread."""
+        if self.spool is None:
+            return
+        self.logger.info( f"Waiting up to {self.spool_shutdown_timeout}s for the spool to drain..." )
+        if self.spool.stop( timeout=self.spool_shutdown_timeout ):
+            self.logger.info( "...spool drained." )
+        else:
+            self.logger.warning( f"...spool not drained; {self.spool.nbytes_pending} bytes left in "
+                                 f"{self.spool.spooldir} will be replayed next time." )
+
 
 
 # ======================================================================
@@ -1156,7 +1384,11 @@ class PittGoogleConsumer(BrokerConsumer):
         else:
             wrangled = self.alert_wrangler( messagebatch )
         t1 = time.perf_counter()
-        nadded = self.mongodb_store( messagebatch=messagebatch, **wrangled )
+        if self.spool is not None:
+            self.spool.append( messagebatch=messagebatch, **wrangled )
+            nadded = 'spooled'
+        else:
+            nadded = self.mongodb_store( messagebatch=messagebatch, **wrangled )
         t2 = time.perf_counter()
         self.tot_n_messages_consumed += len(messagebatch)
         self.countlogger.info( f"...added {len(messagebatch)} messages to mongodb collections "
@@ -1252,6 +1484,9 @@ class PittGoogleConsumer(BrokerConsumer):
                                   "runtime": datetime.datetime.now() - tstart } )
             return
 
+        finally:
+            self.stop_spool()
+
 
 class BrokerConsumerLauncher:
     """Launch a bunch of BrokerConsumer (or subclass) processes to listen to brokers.
@@ -1273,7 +1508,13 @@ class BrokerConsumerLauncher:
 
     """
 
-    def __init__( self, configfile, barf='', barf2=None, verbose=False, logtag=None, shutdown_graceperiod=20 ):
+    _loggername = "BrokerConsumerLauncher"
+    _clsmap = { 'BrokerConsumer': BrokerConsumer,
+                'FinkConsumer': FinkConsumer,
+                'PittGoogleConsumer': PittGoogleConsumer }
+
+    def __init__( self, configfile, barf='', barf2=None, verbose=False, logtag=None, shutdown_graceperiod=20,
+                  status_interval=60, metrics_port=None ):
         """Create a BrokerConsumerLauncher.
 
         Parmaeters
@@ -1309,6 +1550,16 @@ class BrokerConsumerLauncher:
             chance to go through, but also we want to exit before they kill
             us.
 
+          status_interval : float, default 60
+            Log aggregate messages/s and the memory use of each
+            consumer process this often (seconds).
+
+          metrics_port : int or None
+            If not None, serve the metrics of all consumers (collected
+            from their heartbeats), plus heartbeat age, failure count,
+            and memory use of each consumer, in Prometheus text format
+            at http://localhost:{metrics_port}/metrics.
+
         """
 
 
@@ -1318,6 +1569,10 @@ class BrokerConsumerLauncher:
         self.barf2 = barf if barf2 is None else barf2
         self.verbose = verbose
         self.logtag = logtag
+        self.status_interval = status_interval
+        self.metrics_port = metrics_port
+        self.metrics = MetricsRegistry()
+        self._brokers = {}
 
         # This is the grace period between when the main process tells launched broker to die and
         #   when it returns.
@@ -1335,16 +1590,8 @@ class BrokerConsumerLauncher:
         bc.poll( **brokerinfo['pollkwargs'] )
 
 
-    def __call__( self ):
-        """Run the BrokerConsumerLauncher.
-
-        IMPORTANT: Only ever run this in a subprocess, or from main() below.
-        It will screw up your process' signal handlers otherwise.
-        See docstring on BrokerConsumerLauncher class for more info.
-
-        """
-
-        logger = logging.getLogger( f"BrokerConsumerLauncher{f'-{self.logtag}' if self.logtag is not None else ''}" )
+    def _make_logger( self ):
+        logger = logging.getLogger( f"{self._loggername}{f'-{self.logtag}' if self.logtag is not None else ''}" )
         logger.propagate = False
         if not logger.hasHandlers():
             logout = logging.StreamHandler( sys.stderr )
@@ -1355,11 +1602,15 @@ class BrokerConsumerLauncher:
         else:
             logger.warning( "I am surprised, I already have handlers.  Logger is mysterious." )
         logger.setLevel( logging.DEBUG if self.verbose else logging.INFO )
+        return logger
+
+
+    def _parse_config( self, logger, clsmap=None ):
+        """Parse the config file, return a dict of brokername → info needed to launch the broker."""
 
         brokers = {}
-        clsmap = { 'BrokerConsumer': BrokerConsumer,
-                   'FinkConsumer': FinkConsumer,
-                   'PittGoogleConsumer': PittGoogleConsumer }
+        if clsmap is None:
+            clsmap = self._clsmap
 
         config = yaml.safe_load( open( self.config ) )
         # ****
@@ -1439,6 +1690,64 @@ class BrokerConsumerLauncher:
                               'nfails': 0
                              }
 
+        return brokers
+
+
+    def _render_metrics( self ):
+        snapshots = [ self.metrics.snapshot() ]
+        snapshots.extend( b['metrics'] for b in list( self._brokers.values() ) if 'metrics' in b )
+        return render_snapshots( snapshots )
+
+
+    def _update_launcher_metrics( self, brokers ):
+        now = time.monotonic()
+        for name, broker in brokers.items():
+            self.metrics.set( 'fastdb_launcher_heartbeat_age_seconds', now - broker['lastheartbeat'],
+                              helpstr="Seconds since the last heartbeat from the consumer", broker=name )
+            self.metrics.set( 'fastdb_launcher_consumer_failures', broker['nfails'],
+                              helpstr="Number of times the consumer has been restarted", broker=name )
+            if 'process' in broker:
+                rss = rss_bytes( broker['process'].pid )
+                if rss is not None:
+                    self.metrics.set( 'fastdb_launcher_consumer_rss_bytes', rss,
+                                      helpstr="Resident memory of the consumer process", broker=name )
+
+
+    def _log_status( self, logger, brokers, tlast, handledlast ):
+        # tot_handled from heartbeats is per-process-lifetime, so this is off after restarts
+        now = time.monotonic()
+        tot = sum( b.get( 'tot_handled', 0 ) for b in brokers.values() )
+        lines = [ f"Status: {len(brokers)} consumer processes, {max(tot-handledlast, 0)/(now-tlast):.1f} "
+                  f"msgs/s aggregate" ]
+        totrss = 0
+        for name, broker in brokers.items():
+            rss = rss_bytes( broker['process'].pid )
+            totrss += rss if rss is not None else 0
+            lines.append( f"    {name}: {broker.get('tot_handled', 0)} messages handled, RSS "
+                          f"{'?' if rss is None else f'{rss/1024**2:.1f}'} MiB" )
+        lines.append( f"    total RSS of consumer processes: {totrss/1024**2:.1f} MiB" )
+        logger.info( "\n".join( lines ) )
+        return now, tot
+
+
+    def __call__( self ):
+        """Run the BrokerConsumerLauncher.
+
+        IMPORTANT: Only ever run this in a subprocess, or from main() below.
+        It will screw up your process' signal handlers otherwise.
+        See docstring on BrokerConsumerLauncher class for more info.
+
+        """
+
+        logger = self._make_logger()
+        brokers = self._parse_config( logger )
+        self._brokers = brokers
+        for brokername, broker in brokers.items():
+            broker['kwargs'].setdefault( 'metrics_name', brokername )
+        if self.metrics_port is not None:
+            metrics_server = serve_metrics( self._render_metrics, self.metrics_port )
+            logger.info( f"Serving consumer metrics on port {metrics_server.server_address[1]}" )
+
         for broker in brokers.values():
             strio = io.StringIO()
             strio.write( f"Launching a {broker['class']}" )
@@ -1477,6 +1786,8 @@ class BrokerConsumerLauncher:
         heartbeatwait = 2
         toolongsilent = 300
         max_n_fails = 5
+        tstatus = time.monotonic()
+        handledstatus = 0
         while not self.mustdie:
             try:
                 pipelist = [ b['pipe'] for b in brokers.values() ]
@@ -1499,6 +1810,9 @@ class BrokerConsumerLauncher:
 
                             elif msg['message'] == 'ok':
                                 broker['lastheartbeat'] = time.monotonic()
+                                broker['tot_handled'] = msg['tot_handled']
+                                if 'metrics' in msg:
+                                    broker['metrics'] = msg['metrics']
                                 logger.debug( f"Got heartbeat from {brokername}; it claims to have handled "
                                               f"a total of {msg['tot_handled']} messages "
                                               f"over {str(msg['runtime'])}" )
@@ -1529,7 +1843,7 @@ class BrokerConsumerLauncher:
                                 brokerstorestart.add( brokername )
 
                             else:
-                                logger.error( f"Got message '{msg['message']}' from {name}, which probably means "
+                                logger.error( f"Got message '{msg['message']}' from {brokername}, which probably means "
                                               f"there's a coding error, because I don't understand it. Marking "
                                               f"the consumer for restart." )
                                 broker['nfails'] += 1
@@ -1595,6 +1909,11 @@ class BrokerConsumerLauncher:
                         broker['lastheartbeat'] = time.monotonic()
                         proc.start()
 
+                if self.metrics_port is not None:
+                    self._update_launcher_metrics( brokers )
+                if time.monotonic() - tstatus > self.status_interval:
+                    tstatus, handledstatus = self._log_status( logger, brokers, tstatus, handledstatus )
+
                 if len( brokers ) == 0:
                     logger.info( "All broker consumers have exited one way or another; shutting down." )
                     self.mustdie = True
@@ -1661,6 +1980,8 @@ def main():
                                 "Will have no effect if you never put {barf} in your config file." ) )
     parser.add_argument( '-v', '--verbose', default=False, action='store_true',
                          help="Show a few more log messages in the main process." )
+    parser.add_argument( '-m', '--metrics-port', type=int, default=None,
+                         help="Serve Prometheus metrics for all consumers on this port." )
     args = parser.parse_args()
 
     mongodb_host = os.getenv( "MONGODB_HOST" )
@@ -1671,7 +1992,7 @@ def main():
         raise ValueError( "Must set all the following env vars: MONGODB_HOST, MONGODB_DBNAME, "
                           "MONGODB_ALERT_WRITER_USER, MONGODB_ALERT_WRITER_PASSWD" )
 
-    bcl = BrokerConsumerLauncher( args.config, barf=args.barf, verbose=args.verbose )
+    bcl = BrokerConsumerLauncher( args.config, barf=args.barf, verbose=args.verbose, metrics_port=args.metrics_port )
     bcl()
 
 
@@ -0,0 +1,389 @@
+import os
+import time
+import signal
+import asyncio
+import argparse
+import datetime
+import functools
+import concurrent.futures
+
+import confluent_kafka
+
+from metrics import render_snapshots, serve_metrics
+from services.brokerconsumer import ( BrokerConsumer, FinkConsumer, BrokerConsumerLauncher,
+                                      decode_raw_messages, rss_bytes )
+
+
+class BrokerConsumerAsyncLauncher( BrokerConsumerLauncher ):
+    """Run a bunch of BrokerConsumers as asyncio tasks in a single process.
+
+    This is an alternative to BrokerConsumerLauncher, which forks one
+    process per broker.  It reads the same config file.  Each broker
+    stream is an asyncio task that:
+
+      * calls confluent_kafka's consume() in a thread (shared thread pool)
+      * decodes the avro payloads in a shared worker pool (processes
+        if decode_workers > 0, otherwise the shared thread pool)
+      * wrangles and stores (to mongo or to the stream's spool, see
+        BrokerConsumer) in the shared thread pool.
+
+    So, there's one interpreter, one copy of the code and of most
+    modules, and decode workers are shared between streams rather than
+    being one per broker.  Each stream keeps its own heartbeat; if a
+    stream is silent for too long, or raises an exception, its task is
+    thrown away and a new one is started, up to max_n_fails times.
+
+    Every status_interval seconds, logs the number of messages handled
+    by each stream, aggregate messages/s, and the RSS of the process
+    (total and per stream).  BrokerConsumerLauncher logs the same
+    numbers for its processes, so you can compare the two.
+
+    Only kafka consumers (BrokerConsumer and FinkConsumer) are
+    supported; PittGoogleConsumer manages its own threads.
+
+    Normal use is from main() below.  Like BrokerConsumerLauncher, this
+    installs signal handlers; on TERM or INT, it tells all streams to
+    stop, and waits up to shutdown_graceperiod for them to do so.
+
+    """
+
+    _loggername = "BrokerConsumerAsyncLauncher"
+    _clsmap = { 'BrokerConsumer': BrokerConsumer,
+                'FinkConsumer': FinkConsumer }
+
+    def __init__( self, configfile, decode_workers=0, heartbeatwait=2, toolongsilent=300, max_n_fails=5,
+                  **kwargs ):
+        """Create a BrokerConsumerAsyncLauncher.
+
+        Parameters
+        ----------
+          configfile, barf, barf2, verbose, logtag, shutdown_graceperiod, status_interval, metrics_port
+            See BrokerConsumerLauncher
+
+          decode_workers : int, default 0
+            Number of processes in the pool shared by all streams for
+            avro decoding.  If 0, decode in the shared thread pool
+            instead.  (fastavro holds the GIL, so threads don't give
+            you any parallelism for decoding, but you don't pay to
+            pickle the raw messages and the decoded alerts between
+            processes.)
+
+          heartbeatwait : float, default 2
+            Check stream heartbeats this often (seconds).
+
+          toolongsilent : float, default 300
+            Restart a stream whose last heartbeat was more than this
+            many seconds ago.
+
+          max_n_fails : int, default 5
+            Give up on a stream after it's been restarted this many times.
+
+        """
+        super().__init__( configfile, **kwargs )
+        self.decode_workers = decode_workers
+        self.heartbeatwait = heartbeatwait
+        self.toolongsilent = toolongsilent
+        self.max_n_fails = max_n_fails
+
+
+    def _discard_consumer( self, stream, close=True ):
+        """Throw away a stream's BrokerConsumer.
+
+        If close is False, don't try to close its kafka connection or
+        drain its spool, because a worker thread may be stuck using it.
+
+        """
+        bc = stream['bc']
+        if bc is None:
+            return
+        stream['bc'] = None
+        try:
+            if close:
+                bc.close_connection()
+                bc.stop_spool()
+        except Exception as ex:
+            self.logger.error( f"Exception cleaning up stream {stream['name']}: {ex}" )
+        # BrokerConsumer.__init__ adds handlers to these loggers; remove them so that
+        #   we don't get duplicate log messages from the next BrokerConsumer
+        for logger in ( bc.logger, bc.countlogger ):
+            for handler in list( logger.handlers ):
+                logger.removeHandler( handler )
+                handler.close()
+
+
+    async def _run_stream( self, stream ):
+        """The task for one broker stream.  This is the async version of BrokerConsumer.poll."""
+        loop = asyncio.get_running_loop()
+        pollkwargs = stream['pollkwargs']
+        reset = pollkwargs.get( 'reset', False ) and ( stream['nfails'] == 0 )
+        restart_time = pollkwargs.get( 'restart_time', datetime.timedelta( minutes=30 ) )
+        notopic_sleeptime = pollkwargs.get( 'notopic_sleeptime', 300 )
+        max_restarts = pollkwargs.get( 'max_restarts', None )
+        max_msgs = pollkwargs.get( 'max_msgs', None )
+
+        iorun = functools.partial( loop.run_in_executor, self._iopool )
+        if stream['bc'] is None:
+            stream['bc'] = await iorun( functools.partial( stream['class'], **stream['kwargs'] ) )
+        bc = stream['bc']
+
+        n_restarts = 0
+        nconsumed = 0
+        while not self._mustdie.is_set():
+            await iorun( bc.create_connection, reset )
+            reset = False
+            tconnect = time.monotonic()
+            next_lag_update = tconnect
+            stream['lastheartbeat'] = time.monotonic()
+
+            if len( bc.consumer.topics ) == 0:
+                bc.logger.info( f"No topics, will wait {notopic_sleeptime}s and reconnect." )
+                await self._sleep_unless_dying( notopic_sleeptime )
+            else:
+                bc.logger.info( f"Subscribed to topics: {bc.consumer.topics}; starting async poll loop." )
+                while not self._mustdie.is_set():
+                    tperf0 = time.perf_counter()
+                    msgs = await iorun( bc.consumer.consumer.consume, bc.consumer.consume_nmsgs,
+                                        bc.consumer.consume_timeout )
+                    stream['lastheartbeat'] = time.monotonic()
+                    if len( msgs ) == 0:
+                        bc.consumer.adapt_batching( 0, 0. )
+                        await self._sleep_unless_dying( bc.consumer.nomsg_sleeptime )
+                    else:
+                        bc.countlogger.info( f"Handling {len(msgs)} messages; consumer has received "
+                                             f"{bc.consumer.tot_handled} messages." )
+                        now = datetime.datetime.now( tz=datetime.UTC )
+                        t0 = time.perf_counter()
+                        raw = bc.raw_messages( msgs )
+                        alerts = await loop.run_in_executor( self._decodepool, decode_raw_messages, raw,
+                                                             bc.schemaless, bc.schema_in_key, bc.schema )
+                        messagebatch = bc.build_messagebatch( raw, alerts, now=now )
+                        t1 = time.perf_counter()
+                        await iorun( functools.partial( bc.store_messagebatch, messagebatch, parsetime=t1-t0 ) )
+                        if bc.consumer.prefetch > 0:
+                            # With prefetch_batches, KafkaConsumer turns off enable.auto.offset.store,
+                            #   so offsets have to be stored by hand once the batch is stored.  (We
+                            #   don't prefetch here; the other streams keep things busy instead.)
+                            try:
+                                await iorun( functools.partial( bc.consumer.consumer.store_offsets, messages=msgs ) )
+                            except confluent_kafka.KafkaException as ex:
+                                # Happens if a partition was revoked while we were handling its messages
+                                bc.logger.warning( f"Failed to store offsets for handled messages: {ex}" )
+                        bc.consumer.tot_handled += len( msgs )
+                        t2 = time.perf_counter()
+                        bc.consumer.record_batch( msgs, t0 - tperf0, t2 - t0 )
+                        bc.consumer.adapt_batching( len( msgs ), t2 - t0 )
+                        nconsumed += len( msgs )
+                        stream['tot_handled'] += len( msgs )
+                        stream['lastheartbeat'] = time.monotonic()
+
+                    if time.monotonic() > next_lag_update:
+                        try:
+                            await iorun( bc.consumer.update_lag_metrics )
+                        except Exception as ex:
+                            bc.logger.warning( f"Failed to update consumer lag metrics: {ex}" )
+                        next_lag_update = time.monotonic() + bc.consumer.lag_interval
+
+                    if ( max_msgs is not None ) and ( nconsumed >= max_msgs ):
+                        bc.logger.info( f"Exiting after consuming {nconsumed} messages." )
+                        return 'exited'
+                    if ( ( restart_time is not None )
+                         and ( time.monotonic() - tconnect > restart_time.total_seconds() ) ):
+                        break
+
+            if self._mustdie.is_set():
+                break
+            if ( max_restarts is not None ) and ( n_restarts >= max_restarts ):
+                bc.logger.info( f"Exiting after {n_restarts} restarts." )
+                return 'exited'
+            bc.logger.info( "Reconnecting to server." )
+            await iorun( bc.close_connection )
+            n_restarts += 1
+
+        return 'died'
+
+
+    async def _sleep_unless_dying( self, t ):
+        try:
+            await asyncio.wait_for( self._mustdie.wait(), timeout=t )
+        except TimeoutError:
+            pass
+
+
+    def _start_stream( self, stream ):
+        stream['lastheartbeat'] = time.monotonic()
+        stream['task'] = asyncio.create_task( self._run_stream( stream ), name=stream['name'] )
+
+
+    def _render_metrics( self ):
+        snapshots = [ self.metrics.snapshot() ]
+        snapshots.extend( s['bc'].metrics.snapshot() for s in list( self._brokers.values() ) if s['bc'] is not None )
+        return render_snapshots( snapshots )
+
+
+    def _log_stream_status( self, streams, tlast, handledlast ):
+        now = time.monotonic()
+        dt = now - tlast
+        tot = sum( s['tot_handled'] for s in streams.values() )
+        rss = rss_bytes()
+        rss = 0 if rss is None else rss
+        lines = [ f"Status: {len(streams)} streams, {(tot-handledlast)/dt:.1f} msgs/s aggregate, "
+                  f"process RSS {rss/1024**2:.1f} MiB "
+                  f"({rss/1024**2/max(len(streams), 1):.1f} MiB/stream, not counting decode workers)" ]
+        for name, stream in streams.items():
+            lines.append( f"    {name}: {stream['tot_handled']} messages handled, "
+                          f"last heartbeat {now-stream['lastheartbeat']:.0f}s ago, {stream['nfails']} fails" )
+        self.logger.info( "\n".join( lines ) )
+        return now, tot
+
+
+    async def _supervise( self, streams ):
+        loop = asyncio.get_running_loop()
+        for sig in ( signal.SIGTERM, signal.SIGINT ):
+            loop.add_signal_handler( sig, functools.partial( self._sigged, sig.name ) )
+
+        for stream in streams.values():
+            self.logger.info( f"Starting stream {stream['name']} ({stream['class'].__name__}) saving to "
+                              f"collections {stream['kwargs']['mongodb_collection_base']}*" )
+            self._start_stream( stream )
+
+        tstatus, handledstatus = time.monotonic(), 0
+        while ( not self._mustdie.is_set() ) and ( len( streams ) > 0 ):
+            await self._sleep_unless_dying( self.heartbeatwait )
+            if self.metrics_port is not None:
+                self._update_launcher_metrics( streams )
+
+            for name in list( streams.keys() ):
+                stream = streams[name]
+                restart = False
+                stuck = False
+                if stream['task'].done():
+                    try:
+                        result = stream['task'].result()
+                        self.logger.info( f"Stream {name} {result}; no longer tracking it." )
+                        await loop.run_in_executor( self._iopool, self._discard_consumer, stream )
+                        del streams[name]
+                        continue
+                    except Exception as ex:
+                        self.logger.exception( f"Stream {name} got an unhandled exception: {ex}" )
+                        restart = True
+                else:
+                    dt = time.monotonic() - stream['lastheartbeat']
+                    if dt > self.toolongsilent:
+                        self.logger.error( f"It's been {dt:.0f} seconds since last heartbeat from {name}; "
+                                           f"will restart." )
+                        stream['task'].cancel()
+                        restart = True
+                        stuck = True
+
+                if restart:
+                    stream['nfails'] += 1
+                    # Start fresh with a new BrokerConsumer
+                    await loop.run_in_executor( self._iopool,
+                                                functools.partial( self._discard_consumer, stream, close=not stuck ) )
+                    if stream['nfails'] >= self.max_n_fails:
+                        self.logger.error( f"Stream {name} has had {stream['nfails']} failures, giving up on it." )
+                        del streams[name]
+                    else:
+                        self.logger.warning( f"Restarting stream {name}" )
+                        self._start_stream( stream )
+
+            if time.monotonic() - tstatus > self.status_interval:
+                tstatus, handledstatus = self._log_stream_status( streams, tstatus, handledstatus )
+
+        if len( streams ) == 0:
+            self.logger.info( "All broker streams have exited one way or another; shutting down." )
+            return
+
+        self.logger.warning( f"Shutting down.  Giving {len(streams)} streams {self.shutdown_graceperiod}s to stop." )
+        tasks = [ s['task'] for s in streams.values() ]
+        _done, pending = await asyncio.wait( tasks, timeout=self.shutdown_graceperiod )
+        for task in pending:
+            self.logger.warning( f"Stream {task.get_name()} didn't stop, cancelling it." )
+            task.cancel()
+        for stream in streams.values():
+            await loop.run_in_executor( self._iopool, functools.partial( self._discard_consumer, stream,
+                                                                          close=stream['task'] not in pending ) )
+
+
+    def _sigged( self, sig="TERM" ):
+        self.logger.warning( f"Got a {sig} signal, trying to die." )
+        self._mustdie.set()
+
+
+    def __call__( self ):
+        """Run the BrokerConsumerAsyncLauncher.
+
+        IMPORTANT: this installs signal handlers; see BrokerConsumerLauncher.
+
+        """
+        self.logger = self._make_logger()
+        streams = self._parse_config( self.logger )
+        self._brokers = streams
+        for name, stream in streams.items():
+            stream['bc'] = None
+            stream['task'] = None
+            stream['tot_handled'] = 0
+            stream['kwargs'].setdefault( 'metrics_name', name )
+        if self.metrics_port is not None:
+            metrics_server = serve_metrics( self._render_metrics, self.metrics_port )
+            self.logger.info( f"Serving consumer metrics on port {metrics_server.server_address[1]}" )
+
+        # Each stream can have a consume and a store outstanding at once
+        self._iopool = concurrent.futures.ThreadPoolExecutor( max_workers=2 * len( streams ) + 4,
+                                                              thread_name_prefix="brokerio" )
+        if self.decode_workers > 0:
+            self._decodepool = concurrent.futures.ProcessPoolExecutor( max_workers=self.decode_workers )
+        else:
+            self._decodepool = self._iopool
+
+        async def run():
+            self._mustdie = asyncio.Event()
+            await self._supervise( streams )
+
+        try:
+            asyncio.run( run() )
+        finally:
+            if self._decodepool is not self._iopool:
+                self._decodepool.shutdown( wait=False, cancel_futures=True )
+            self._iopool.shutdown( wait=False, cancel_futures=True )
+
+        self.logger.info( "Exiting BrokerConsumerAsyncLauncher." )
+
+
+# ======================================================================
+def main():
+    parser = argparse.ArgumentParser( 'brokerconsumer_async',
+                                      description=( "Listen to broker streams and save broker messages, "
+                                                    "running all streams in one process" ),
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( 'config', help='YAML file with config of brokers to listen to' )
+    parser.add_argument( '-b', '--barf', default='abcdef',
+                         help=( "String of random characters for group and topic names.  (Used in tests.)"
+                                "Will have no effect if you never put {barf} in your config file." ) )
+    parser.add_argument( '-d', '--decode-workers', type=int, default=0,
+                         help="Number of processes for decoding avro; 0 means decode in threads." )
+    parser.add_argument( '--status-interval', type=float, default=60,
+                         help="Log throughput and memory use this often (seconds)." )
+    parser.add_argument( '-m', '--metrics-port', type=int, default=None,
+                         help="Serve Prometheus metrics for all streams on this port." )
+    parser.add_argument( '-v', '--verbose', default=False, action='store_true',
+                         help="Show a few more log messages." )
+    args = parser.parse_args()
+
+    mongodb_host = os.getenv( "MONGODB_HOST" )
+    mongodb_dbname = os.getenv( "MONGODB_DBNAME" )
+    mongodb_user = os.getenv( "MONGODB_ALERT_WRITER_USER" )
+    mongodb_password = os.getenv( "MONGODB_ALERT_WRITER_PASSWD" )
+    if any ( i is None for i in [ mongodb_host, mongodb_dbname, mongodb_user, mongodb_password ] ):
+        raise ValueError( "Must set all the following env vars: MONGODB_HOST, MONGODB_DBNAME, "
+                          "MONGODB_ALERT_WRITER_USER, MONGODB_ALERT_WRITER_PASSWD" )
+
+    bcl = BrokerConsumerAsyncLauncher( args.config, barf=args.barf, verbose=args.verbose,
+                                       decode_workers=args.decode_workers, status_interval=args.status_interval,
+                                       metrics_port=args.metrics_port )
+    bcl()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 import sys
 import io
 import logging
@@ -5,22 +6,93 @@ import datetime
 import pathlib
 import time
 import json
+import shutil
+import hashlib
 import argparse
 import multiprocessing
+import concurrent.futures
 from contextlib import contextmanager
 
 import pandas
 import psycopg
 import psycopg.rows
+import psycopg.sql
 
 import config
 
 _loglevel = logging.DEBUG
 
+# Results of long queries are cached (see webserver/dbapp.py
+#   SubmitLongSQLQuery) in {outdir}/cache.  Cache entries older than
+#   _cache_max_age days are evicted, as are the least recently used
+#   entries beyond _cache_max_bytes total.
+_cache_max_age = 1.
+_cache_max_bytes = 50 * 1024**3
+
+# How many of one user's queries are run at once, unless overridden by
+#   the user's max_running in query_user_quota
+_default_max_running = 2
+
+# Progress of running queries is written to query_queue at most this
+#   often (seconds), and rows are fetched this many at a time
+_progress_interval = 10.
+_fetch_rows = 10000
+
+# Number of q3c ipix values (6 faces of 4^30 pixels each), for splitting
+#   parallel queries by q3c ipix range
+_q3c_npix = 6 * 4**30
+
+
+class QueryCancelled( Exception ):
+    pass
+
+
+class QueryProgress:
+    """Keep track of a running query's progress, writing it to query_queue every so often.
+
+    Progress is written as increments, so several QueryProgress objects
+    (e.g. one for each part of a parallel query) can add to the same
+    query.
+
+    """
+
+    def __init__( self, runner, queryid, interval=None ):
+        self.runner = runner
+        self.queryid = queryid
+        self.interval = _progress_interval if interval is None else interval
+        self.rows = 0
+        self.nbytes = 0
+        self.lastflush = time.monotonic()
+
+
+    def add( self, rows=0, nbytes=0 ):
+        self.rows += rows
+        self.nbytes += nbytes
+        if time.monotonic() - self.lastflush >= self.interval:
+            self.flush()
+
+
+    def flush( self ):
+        if ( self.rows != 0 ) or ( self.nbytes != 0 ):
+            with self.runner.rwconn() as conn:
+                cursor = conn.cursor()
+                cursor.execute( "UPDATE query_queue SET progress_rows=COALESCE(progress_rows, 0)+%(rows)s, "
+                                "  progress_bytes=COALESCE(progress_bytes, 0)+%(nbytes)s, progress_updated=NOW() "
+                                "WHERE queryid=%(id)s",
+                                { 'id': self.queryid, 'rows': self.rows, 'nbytes': self.nbytes } )
+                conn.commit()
+            self.rows = 0
+            self.nbytes = 0
+        self.lastflush = time.monotonic()
+
 
 class QueryRunner:
     def __init__( self ):
         self.outdir = pathlib.Path( "/query_results" )
+        self.cachedir = self.outdir / "cache"
+        self.cachedir.mkdir( exist_ok=True )
+        self.cache_max_age = _cache_max_age
+        self.cache_max_bytes = _cache_max_bytes
         self.logger = logging.getLogger( "long_query_runner" )
         _logout = logging.StreamHandler( sys.stderr )
         self.logger.addHandler( _logout )
@@ -83,6 +155,9 @@ class QueryRunner:
                 outf = self.outdir / str(qid)
                 if outf.is_file():
                     outf.unlink()
+                partsdir = self.outdir / f"{qid}.parts"
+                if partsdir.is_dir():
+                    shutil.rmtree( partsdir )
                 if purgedb:
                     cursor.execute( "DELETE FROM query_queue WHERE queryid=%(id)s", { 'id': qid } )
 
@@ -93,7 +168,18 @@ class QueryRunner:
         with self.rwconn() as conn:
             cursor = conn.cursor( row_factory=psycopg.rows.dict_row )
             cursor.execute( "LOCK TABLE query_queue" )
-            cursor.execute( "SELECT * FROM query_queue WHERE started IS NULL ORDER BY submitted" )
+            # Queries with cached_from set get the results of another query, so aren't run.
+            # Highest priority first, then first come first served, but skipping users
+            #   who already have as many queries running as they're allowed.
+            cursor.execute( "SELECT q.* FROM query_queue q "
+                            "LEFT JOIN query_user_quota u ON q.userid=u.userid "
+                            "WHERE q.started IS NULL AND q.cached_from IS NULL AND NOT COALESCE(q.error, false) "
+                            "  AND ( SELECT COUNT(*) FROM query_queue r "
+                            "        WHERE r.userid=q.userid AND r.started IS NOT NULL AND r.finished IS NULL "
+                            "          AND r.cached_from IS NULL AND NOT COALESCE(r.error, false) "
+                            "      ) < COALESCE( u.max_running, %(maxrunning)s ) "
+                            "ORDER BY q.priority DESC, q.submitted LIMIT 1",
+                            { 'maxrunning': _default_max_running } )
             rows = cursor.fetchall()
             if len(rows) == 0:
                 return None
@@ -109,6 +195,18 @@ class QueryRunner:
             return dict( rows[0] )
 
 
+    @staticmethod
+    def result_checksum( path ):
+        """Return ( size in bytes, hex sha256 ) of a file."""
+        sha = hashlib.sha256()
+        size = 0
+        with open( path, "rb" ) as ifp:
+            while len( data := ifp.read( 4 * 1024 * 1024 ) ) > 0:
+                sha.update( data )
+                size += len( data )
+        return size, sha.hexdigest()
+
+
     def run_query( self, queryinfo ):
         queryid = queryinfo['queryid']
         try:
@@ -133,56 +231,383 @@ class QueryRunner:
                                 { 'id': queryid, 't': datetime.datetime.now(tz=datetime.UTC) } )
                 conn.commit()
 
-            # Want to use a readonly connection to the database because
-            #   this function will be running queries submitted by users
-            #   over the wide scary Internet.
-            with self.conn() as conn:
-                self.logger.info( f"Starting {len(queries)} queries for {queryid}" )
-                strio = io.StringIO()
-                for i, (query, subdict) in enumerate( zip( queries, subdicts ) ):
-                    strio.write( f"   {i:3d}: {query}   ;   subdict={subdict}\n" )
-                self.logger.debug( f"Queries:\n{strio.getvalue()}" )
-
-                cursor = conn.cursor()
-                for i, (query, subdict_text) in enumerate( zip( queries, subdicts ) ):
-                    try:
-                        self.logger.debug( f"Starting query {i} of {len(queries)}" )
-                        cursor.execute( query, subdict )
-                    except Exception as e:
-                        self.logger.exception( f"Exception running query {i} of {queryid}: {e}" )
-                        raise
-
-                self.logger.info( f"Done with queries for {queryid}, fetching." )
-                columns = [ d.name for d in cursor.description ]
-                rows = cursor.fetchall()
-
-            self.logger.info( f"Done fetching for {queryid}, saving" )
-            if ( queryinfo['format'] == 'csv' ) or ( queryinfo['format'] == 'pandas' ):
-                df = pandas.DataFrame( rows, columns=columns )
-                if queryinfo['format'] == 'pandas':
-                    df.to_pickle( self.outdir / str(queryid) )
-                else:
-                    df.to_csv( self.outdir / str(queryid) )
-
-            elif ( queryinfo['format'] == 'numpy' ):
-                raise NotImplementedError( "numpy return format isn't implemented yet" )
+            if queryinfo['parallel'] is not None:
+                self.run_parallel_query( queryinfo, queries, subdicts )
+            else:
+                # Want to use a readonly connection to the database because
+                #   this function will be running queries submitted by users
+                #   over the wide scary Internet.
+                progress = QueryProgress( self, queryid )
+                with self.conn() as conn:
+                    cursor = conn.cursor()
+                    self.start_backend( queryinfo, conn, cursor )
+                    # Fetch through a server-side cursor so that progress can be recorded as rows come in
+                    lastcursor = conn.cursor( f"long_query_{queryid.hex}" )
+                    self.execute_queries( cursor, queryid, queries, subdicts, lastcursor=lastcursor,
+                                          estimate=queries[-1] )
+                    self.logger.info( f"Done with queries for {queryid}, fetching." )
+                    columns, rows = self.fetch_rows( lastcursor, progress )
+
+                self.logger.info( f"Done fetching for {queryid}, saving" )
+                self.save_results( rows, columns, queryinfo['format'], self.outdir / str(queryid) )
+                progress.add( nbytes=( self.outdir / str(queryid) ).stat().st_size )
+                progress.flush()
 
             self.logger.info( f"Done saving {queryid}" )
+            # Record the size and checksum so that clients can resume and verify downloads
+            size, sha256 = self.result_checksum( self.outdir / str(queryid) )
+            now = datetime.datetime.now(tz=datetime.UTC)
             with self.rwconn() as conn:
                 cursor = conn.cursor()
-                cursor.execute( "UPDATE query_queue SET finished=%(t)s WHERE queryid=%(id)s",
-                                { 'id': queryid, 't': datetime.datetime.now(tz=datetime.UTC) } )
+                # Updating our row first locks it, so the webserver can't add
+                #   another query waiting on this one after we look for them below.
+                cursor.execute( "UPDATE query_queue SET finished=%(t)s, result_size=%(size)s, "
+                                "  result_sha256=%(sha)s, backend_pids=NULL "
+                                "WHERE queryid=%(id)s AND cancelled IS NULL",
+                                { 'id': queryid, 't': now, 'size': size, 'sha': sha256 } )
+                if cursor.rowcount == 0:
+                    raise QueryCancelled( f"Query {queryid} was cancelled" )
+                if queryinfo['cachekey'] is not None:
+                    self.cache_result( cursor, queryinfo, size, sha256 )
+                self.finish_waiting_queries( cursor, queryid, now, size, sha256 )
                 conn.commit()
 
+            if queryinfo['cachekey'] is not None:
+                self.prune_result_cache()
+
         except Exception as ex:
             with self.rwconn() as conn:
                 cursor = conn.cursor()
-                cursor.execute( "UPDATE query_queue SET error=TRUE, errortext=%(txt)s WHERE queryid=%(id)s",
+                # (A cancelled query already has error and errortext set.)
+                cursor.execute( "UPDATE query_queue SET error=TRUE, backend_pids=NULL, "
+                                "  errortext=CASE WHEN cancelled IS NULL THEN %(txt)s ELSE errortext END "
+                                "WHERE queryid=%(id)s",
                                 { 'id': queryid, 'txt': str(ex) } )
+                # Queries that were waiting for this one's results go back in the
+                #   queue to be run on their own (as when a query is cancelled),
+                #   with their own priority, timeout, and work_mem.
+                cursor.execute( "UPDATE query_queue SET cached_from=NULL, cache_hit=FALSE "
+                                "WHERE cached_from=%(id)s AND finished IS NULL AND NOT COALESCE(error, false)",
+                                { 'id': queryid } )
+                if cursor.rowcount > 0:
+                    self.logger.info( f"Requeued {cursor.rowcount} queries that were waiting for failed "
+                                      f"query {queryid}" )
                 conn.commit()
             return
 
 
+    def start_backend( self, queryinfo, conn, cursor ):
+        """Record the backend of conn as running a query, and set the query's limits on it.
+
+        The backend pid is recorded so that the webserver can cancel
+        the query.  Raises QueryCancelled if the query has already been
+        cancelled.  Call this right at the start of the connection's
+        transaction (but after any SET TRANSACTION), as the limits only
+        last for the transaction.
+
+        """
+        with self.rwconn() as rwconn:
+            rwcursor = rwconn.cursor()
+            rwcursor.execute( "UPDATE query_queue SET backend_pids=array_append( backend_pids, %(pid)s ) "
+                              "WHERE queryid=%(id)s RETURNING cancelled",
+                              { 'id': queryinfo['queryid'], 'pid': conn.info.backend_pid } )
+            cancelled = rwcursor.fetchone()[0]
+            rwconn.commit()
+        if cancelled is not None:
+            raise QueryCancelled( f"Query {queryinfo['queryid']} was cancelled" )
+
+        if queryinfo['timeout'] is not None:
+            cursor.execute( "SELECT set_config( 'statement_timeout', %(ms)s, true )",
+                            { 'ms': str( int( queryinfo['timeout'] * 1000 ) ) } )
+        if queryinfo['work_mem_mb'] is not None:
+            cursor.execute( "SELECT set_config( 'work_mem', %(mem)s, true )",
+                            { 'mem': f"{int(queryinfo['work_mem_mb'])}MB" } )
+
+
+    def execute_queries( self, cursor, queryid, queries, subdicts, lastcursor=None, estimate=None ):
+        """Run a query's queries on cursor, leaving the results of the last one to be fetched.
+
+        If lastcursor is given, the last query is run on it rather than
+        on cursor.  If estimate is given, it's a query whose estimated
+        number of rows is recorded (see estimate_rows) just before the
+        last query is run.
+
+        """
+        self.logger.info( f"Starting {len(queries)} queries for {queryid}" )
+        strio = io.StringIO()
+        for i, (query, subdict) in enumerate( zip( queries, subdicts ) ):
+            strio.write( f"   {i:3d}: {query}   ;   subdict={subdict}\n" )
+        self.logger.debug( f"Queries:\n{strio.getvalue()}" )
+
+        for i, (query, subdict) in enumerate( zip( queries, subdicts ) ):
+            try:
+                self.logger.debug( f"Starting query {i} of {len(queries)}" )
+                if i == len(queries) - 1:
+                    if estimate is not None:
+                        self.estimate_rows( cursor, queryid, estimate, subdict )
+                    if lastcursor is not None:
+                        lastcursor.execute( query, subdict )
+                        continue
+                cursor.execute( query, subdict )
+            except Exception as e:
+                self.logger.exception( f"Exception running query {i} of {queryid}: {e}" )
+                raise
+
+
+    def estimate_rows( self, cursor, queryid, query, subdict ):
+        """Record the planner's estimate of how many rows query will return as the query's estimated_rows."""
+        try:
+            # A savepoint, so that if the query can't be EXPLAINed we can carry on
+            with cursor.connection.transaction():
+                cursor.execute( f"EXPLAIN (FORMAT JSON) {query}", subdict )
+                plan = cursor.fetchone()[0]
+            estimate = int( plan[0]['Plan']['Plan Rows'] )
+        except Exception as ex:
+            self.logger.warning( f"Couldn't estimate the number of rows from {queryid}: {ex}" )
+            return
+
+        self.logger.debug( f"Estimated {estimate} rows from {queryid}" )
+        with self.rwconn() as conn:
+            rwcursor = conn.cursor()
+            rwcursor.execute( "UPDATE query_queue SET estimated_rows=%(n)s WHERE queryid=%(id)s",
+                              { 'id': queryid, 'n': estimate } )
+            conn.commit()
+
+
+    def fetch_rows( self, cursor, progress ):
+        """Fetch all the rows from cursor a batch at a time, adding them to progress; returns ( columns, rows )."""
+        columns = [ d.name for d in cursor.description ]
+        rows = []
+        while len( batch := cursor.fetchmany( _fetch_rows ) ) > 0:
+            rows.extend( batch )
+            progress.add( rows=len(batch) )
+        cursor.close()
+        return columns, rows
+
+
+    def save_results( self, rows, columns, fmt, path ):
+        """Write fetched rows to a result file in format fmt."""
+        if ( fmt == 'csv' ) or ( fmt == 'pandas' ):
+            df = pandas.DataFrame( rows, columns=columns )
+            if fmt == 'pandas':
+                df.to_pickle( path )
+            else:
+                df.to_csv( path )
+
+        elif ( fmt == 'numpy' ):
+            raise NotImplementedError( "numpy return format isn't implemented yet" )
+
+
+    @staticmethod
+    def partition_conditions( parallel ):
+        """The SQL conditions that split a parallel query into parts.
+
+        (These use mod() rather than %, as the queries are run with
+        psycopg substitution.)
+
+        """
+        n = parallel['nworkers']
+        column = parallel['column']
+        if parallel['splitby'] == 'rootid':
+            return [ f"( mod( mod( hashtext( ({column})::text ), {n} ) + {n}, {n} ) = {i} )" for i in range(n) ]
+        elif parallel['splitby'] == 'q3c':
+            edges = [ i * _q3c_npix // n for i in range( n+1 ) ]
+            return [ f"( ({column}) >= {edges[i]} AND ({column}) < {edges[i+1]} )" for i in range(n) ]
+        else:
+            raise ValueError( f"Unknown parallel splitby {parallel['splitby']}" )
+
+
+    def run_parallel_query( self, queryinfo, queries, subdicts ):
+        """Run a query split into parts on several connections that share one snapshot.
+
+        Each part is written to {outdir}/{queryid}.parts/, and the result
+        file {outdir}/{queryid} is a JSON manifest listing the parts.
+
+        """
+        queryid = queryinfo['queryid']
+        parallel = queryinfo['parallel']
+        conditions = self.partition_conditions( parallel )
+        partsdir = self.outdir / f"{queryid}.parts"
+        partsdir.mkdir( exist_ok=True )
+
+        # The exported snapshot is only good while this transaction is open,
+        #   so hold on to it until all the parts are done.
+        with self.conn() as conn:
+            conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+            conn.read_only = True
+            cursor = conn.cursor()
+            cursor.execute( "SELECT pg_export_snapshot()" )
+            snapshot = cursor.fetchone()[0]
+            self.logger.info( f"Running {queryid} in {len(conditions)} parts in snapshot {snapshot}" )
+
+            # Threads rather than processes, as this may already be running in a
+            #   multiprocessing pool worker (which can't have children).  The parts
+            #   spend most of their time waiting on the database, or (for csv) in
+            #   COPY, neither of which holds the GIL.
+            with concurrent.futures.ThreadPoolExecutor( max_workers=len(conditions) ) as pool:
+                futures = [ pool.submit( self.run_query_part, queryinfo, snapshot, queries, subdicts, condition,
+                                         queryinfo['format'], partsdir / f"{i:03d}", estimate=( i == 0 ) )
+                            for i, condition in enumerate( conditions ) ]
+                results = [ f.result() for f in futures ]
+
+        parts = []
+        for i, ( nrows, size, sha256 ) in enumerate( results ):
+            parts.append( { 'part': i,
+                            'file': f"{queryid}.parts/{i:03d}",
+                            'condition': conditions[i],
+                            'nrows': nrows,
+                            'size': size,
+                            'sha256': sha256 } )
+        manifest = { 'queryid': str(queryid),
+                     'format': queryinfo['format'],
+                     'snapshot': snapshot,
+                     'splitby': parallel['splitby'],
+                     'column': parallel['column'],
+                     'nrows': sum( p['nrows'] for p in parts ),
+                     'parts': parts }
+        with open( self.outdir / str(queryid), "w" ) as ofp:
+            json.dump( manifest, ofp, indent=2 )
+
+
+    def run_query_part( self, queryinfo, snapshot, queries, subdicts, condition, fmt, path, estimate=False ):
+        """Run one part of a parallel query in snapshot; returns ( nrows, size, sha256 ) of the part file.
+
+        If estimate is True, record the estimated number of rows of the
+        whole query (not just this part).
+
+        """
+        queryid = queryinfo['queryid']
+        # (The planner's guess of how many rows a partition condition selects is poor,
+        #   so estimate the whole query.)
+        estimate = queries[-1].replace( '{FASTDB_PARTITION}', 'TRUE' ) if estimate else None
+        queries = list( queries[:-1] ) + [ queries[-1].replace( '{FASTDB_PARTITION}', condition ) ]
+        progress = QueryProgress( self, queryid )
+        with self.conn() as conn:
+            conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+            conn.read_only = True
+            # A ClientCursor so that the last query (with its substitutions) can go in a COPY
+            cursor = psycopg.ClientCursor( conn )
+            cursor.execute( psycopg.sql.SQL( "SET TRANSACTION SNAPSHOT {}" ).format( psycopg.sql.Literal(snapshot) ) )
+            self.start_backend( queryinfo, conn, cursor )
+            if fmt == 'csv':
+                # Stream straight from postgres to the file.  (So, unlike the results
+                #   of a non-parallel csv query, the parts don't have a pandas index column.)
+                self.execute_queries( cursor, queryid, queries[:-1], subdicts[:-1] )
+                if estimate is not None:
+                    self.estimate_rows( cursor, queryid, estimate, subdicts[-1] )
+                last = queries[-1].strip().rstrip( ';' )
+                # Progress counts lines (less the header), which is rows unless there are newlines in strings
+                counted = -1
+                with open( path, "wb" ) as ofp:
+                    with cursor.copy( f"COPY ( {last} ) TO STDOUT WITH ( FORMAT csv, HEADER )",
+                                      subdicts[-1] ) as copy:
+                        for data in copy:
+                            ofp.write( data )
+                            lines = bytes( data ).count( b'\n' )
+                            counted += lines
+                            progress.add( rows=lines, nbytes=len(data) )
+                nrows = cursor.rowcount
+                progress.add( rows=nrows-counted-1 )
+            else:
+                lastcursor = conn.cursor( f"long_query_{queryid.hex}_{path.name}" )
+                self.execute_queries( cursor, queryid, queries, subdicts, lastcursor=lastcursor, estimate=estimate )
+                columns, rows = self.fetch_rows( lastcursor, progress )
+                nrows = len( rows )
+                self.save_results( rows, columns, fmt, path )
+                progress.add( nbytes=path.stat().st_size )
+
+        progress.flush()
+        size, sha256 = self.result_checksum( path )
+        self.logger.info( f"Done with part {path.name} of {queryid}: {nrows} rows, {size} bytes" )
+        return nrows, size, sha256
+
+
+    def cache_result( self, cursor, queryinfo, size, sha256 ):
+        """Put the results of a finished query into the result cache."""
+        key = queryinfo['cachekey']
+        # Link to a temporary name and rename so that a stale cache
+        #   file is replaced atomically
+        tmppath = self.cachedir / f"{key}.{queryinfo['queryid']}"
+        os.link( self.outdir / str(queryinfo['queryid']), tmppath )
+        os.replace( tmppath, self.cachedir / key )
+        cursor.execute( "INSERT INTO query_result_cache(cachekey, queryid, format, result_size, result_sha256) "
+                        "VALUES (%(key)s, %(id)s, %(format)s, %(size)s, %(sha)s) "
+                        "ON CONFLICT (cachekey) DO UPDATE SET queryid=EXCLUDED.queryid, format=EXCLUDED.format, "
+                        "  result_size=EXCLUDED.result_size, result_sha256=EXCLUDED.result_sha256, "
+                        "  created=NOW(), last_hit=NULL, hits=0",
+                        { 'key': key, 'id': queryinfo['queryid'], 'format': queryinfo['format'],
+                          'size': size, 'sha': sha256 } )
+        self.logger.info( f"Cached results of {queryinfo['queryid']} as {key}" )
+
+
+    def finish_waiting_queries( self, cursor, queryid, now, size, sha256 ):
+        """Give the results of a finished query to the identical queries that were waiting for it."""
+        cursor.execute( "SELECT queryid FROM query_queue WHERE cached_from=%(id)s AND finished IS NULL FOR UPDATE",
+                        { 'id': queryid } )
+        waiting = [ row[0] for row in cursor.fetchall() ]
+        for waitid in waiting:
+            outf = self.outdir / str(waitid)
+            if not outf.exists():
+                os.link( self.outdir / str(queryid), outf )
+        if len( waiting ) > 0:
+            self.logger.info( f"Results of {queryid} are also the results of {len(waiting)} waiting queries" )
+            cursor.execute( "UPDATE query_queue SET started=COALESCE(started, %(t)s), finished=%(t)s, "
+                            "  result_size=%(size)s, result_sha256=%(sha)s "
+                            "WHERE queryid=ANY(%(ids)s)",
+                            { 't': now, 'size': size, 'sha': sha256, 'ids': waiting } )
+
+
+    def prune_result_cache( self, max_age=None, max_bytes=None, orphans=False ):
+        """Evict entries from the long query result cache.
+
+        Parameters
+        ----------
+          max_age : float, default self.cache_max_age
+            Evict entries created more than this many days ago.
+
+          max_bytes : int, default self.cache_max_bytes
+            Evict the least recently used (or created) entries until
+            the total size of the cache is at most this.
+
+          orphans : bool, default False
+            Also delete files in the cache directory that aren't in the
+            query_result_cache table.
+
+        """
+        max_age = self.cache_max_age if max_age is None else max_age
+        max_bytes = self.cache_max_bytes if max_bytes is None else max_bytes
+        since = datetime.datetime.now( tz=datetime.UTC ) - datetime.timedelta( days=max_age )
+        with self.rwconn() as conn:
+            cursor = conn.cursor()
+            cursor.execute( "DELETE FROM query_result_cache WHERE created<%(since)s RETURNING cachekey",
+                            { 'since': since } )
+            evicted = [ row[0] for row in cursor.fetchall() ]
+            cursor.execute( "DELETE FROM query_result_cache WHERE cachekey IN ( "
+                            "  SELECT cachekey FROM ( "
+                            "    SELECT cachekey, SUM(result_size) OVER (ORDER BY COALESCE(last_hit, created) DESC, "
+                            "                                                     cachekey) AS cumsize "
+                            "    FROM query_result_cache ) subq "
+                            "  WHERE cumsize>%(maxbytes)s ) "
+                            "RETURNING cachekey",
+                            { 'maxbytes': max_bytes } )
+            evicted.extend( row[0] for row in cursor.fetchall() )
+            cursor.execute( "SELECT cachekey FROM query_result_cache" )
+            kept = set( row[0] for row in cursor.fetchall() )
+            conn.commit()
+
+        # The files are hard links, so this doesn't remove the results of any query in query_queue
+        for key in evicted:
+            ( self.cachedir / key ).unlink( missing_ok=True )
+        if len( evicted ) > 0:
+            self.logger.info( f"Evicted {len(evicted)} entries from the query result cache" )
+
+        if orphans:
+            for path in self.cachedir.iterdir():
+                if ( path.name not in kept ) and path.is_file():
+                    self.logger.info( f"Removing orphan cache file {path.name}" )
+                    path.unlink( missing_ok=True )
+
+
     def query_loop( self, sleeptime ):
         me = multiprocessing.current_process()
         self.logger = logging.getLogger( me.name )
@@ -218,10 +643,18 @@ class QueryRunner:
         parser.add_argument( '-p', '--prune', default=None, type=float,
                              help=( "Prune queries older than this many days.  It probably doesn't "
                                     "make sense to use this with --loop" ) )
+        parser.add_argument( '--cache-max-age', default=_cache_max_age, type=float,
+                             help="Evict cached query results older than this many days" )
+        parser.add_argument( '--cache-max-gb', default=_cache_max_bytes / 1024**3, type=float,
+                             help="Evict least recently used cached query results beyond this many GiB" )
         args = parser.parse_args()
 
+        self.cache_max_age = args.cache_max_age
+        self.cache_max_bytes = int( args.cache_max_gb * 1024**3 )
+
         if args.prune is not None:
             self.prune_old_query_results( args.prune )
+            self.prune_result_cache( orphans=True )
 
         if args.once:
             if args.loop:
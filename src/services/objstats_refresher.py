@@ -0,0 +1,142 @@
+import time
+import logging
+import argparse
+
+import db
+import ltcv
+from util import FDBLogger
+
+
+class ObjStatsRefresher:
+    """Keep the objstats materialized views used by ltcv.object_search up to date.
+
+    Refreshes the views (with REFRESH MATERIALIZED VIEW CONCURRENTLY, so
+    object searches aren't blocked while it runs) after each
+    SourceImporter commit, and on a schedule regardless.  It notices
+    SourceImporter commits by watching the diasource_import_time table,
+    which SourceImporter updates in the same transaction as the data it
+    imports.
+
+    """
+
+    def __init__( self, processing_versions, interval=86400, poll=60, min_interval=600, after_imports=True ):
+        """Create an ObjStatsRefresher.
+
+        Parameters
+        ----------
+          processing_versions : list of str
+            Processing versions (descriptions or aliases) whose views to
+            refresh.  These are used in the view names, so use the same
+            thing that the views were (or should be) created with.  Views
+            that don't exist yet are created.
+
+          interval : float, default 86400
+            Refresh at least this often (seconds), even if there have
+            been no imports.
+
+          poll : float, default 60
+            Check for new imports this often (seconds).
+
+          min_interval : float, default 600
+            Don't refresh more often than this (seconds), no matter how
+            often imports happen.  (A refresh rereads all of diasource,
+            so it's not something you want running back-to-back.)
+
+          after_imports : bool, default True
+            If False, ignore imports and only refresh every interval
+            seconds.
+
+        """
+        self.processing_versions = list( processing_versions )
+        if len( self.processing_versions ) == 0:
+            raise ValueError( "ObjStatsRefresher needs at least one processing version" )
+        self.interval = interval
+        self.poll = poll
+        self.min_interval = min_interval
+        self.after_imports = after_imports
+
+
+    def last_import( self ):
+        """The latest time in diasource_import_time (None if there have been no imports)."""
+        with db.DBCon() as dbcon:
+            rows, _ = dbcon.execute( "SELECT MAX(t) FROM diasource_import_time" )
+            return rows[0][0]
+
+
+    def refresh_once( self ):
+        """Refresh (or create) the views for all processing versions.
+
+        Returns
+        -------
+          list of str : the processing versions that were refreshed successfully
+
+        """
+        done = []
+        for procver in self.processing_versions:
+            t0 = time.perf_counter()
+            try:
+                ltcv.create_object_stats_materialized_view( procver, concurrently=True )
+            except Exception as ex:
+                FDBLogger.exception( f"Failed to refresh objstats views for {procver}: {ex}" )
+                continue
+            FDBLogger.info( f"Refreshed objstats views for {procver} in {time.perf_counter()-t0:.1f}s" )
+            done.append( procver )
+        return done
+
+
+    def __call__( self ):
+        lastrefresh = None
+        seenimport = None
+        while True:
+            now = time.monotonic()
+            due = ( lastrefresh is None ) or ( now - lastrefresh >= self.interval )
+            if ( not due ) and self.after_imports and ( now - lastrefresh >= self.min_interval ):
+                due = self.last_import() != seenimport
+                if due:
+                    FDBLogger.info( "New import since the last refresh" )
+
+            if due:
+                # Read this before refreshing, so that an import that commits while
+                #   we're refreshing triggers another refresh
+                seenimport = self.last_import()
+                lastrefresh = now
+                self.refresh_once()
+
+            time.sleep( self.poll )
+
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( 'objstats_refresher.py',
+                                      description="Keep the objstats materialized views up to date",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-versions", nargs='+', required=True,
+                         help="Processing versions whose views to refresh" )
+    parser.add_argument( "-i", "--interval", type=float, default=86400,
+                         help="Refresh at least this often (seconds)" )
+    parser.add_argument( "--poll", type=float, default=60,
+                         help="Check for new source imports this often (seconds)" )
+    parser.add_argument( "-m", "--min-interval", type=float, default=600,
+                         help="Don't refresh more often than this (seconds)" )
+    parser.add_argument( "--no-after-imports", action='store_true', default=False,
+                         help="Only refresh on the schedule, not after source imports" )
+    parser.add_argument( "--once", action='store_true', default=False,
+                         help="Refresh once and exit, instead of running forever" )
+    parser.add_argument( "-v", "--verbose", action='store_true', default=False,
+                         help="Show debug log messages" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.DEBUG if args.verbose else logging.INFO )
+
+    refresher = ObjStatsRefresher( args.processing_versions, interval=args.interval, poll=args.poll,
+                                   min_interval=args.min_interval, after_imports=not args.no_after_imports )
+    if args.once:
+        refresher.refresh_once()
+    else:
+        refresher()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
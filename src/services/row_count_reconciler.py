@@ -0,0 +1,119 @@
+import time
+import logging
+import argparse
+
+import db
+from util import FDBLogger
+
+
+class RowCountReconciler:
+    """Periodically recompute the exact counts in the row_counts table.
+
+    The importers and loaders keep row_counts up to date incrementally
+    (see db.RowCount), but the increments can drift from the truth.
+    This recomputes exact counts for every (processing version, thing)
+    and records any drift in row_count_reconciliation.
+
+    """
+
+    def __init__( self, processing_versions=None, things=None, interval=86400 ):
+        """Create a RowCountReconciler.
+
+        Parameters
+        ----------
+          processing_versions : list of str or UUID, or None
+            Processing versions (ids, descriptions, or aliases) to
+            reconcile.  If None, does every processing version in the
+            database.
+
+          things : list of str, or None
+            Things to count (from db.RowCount.things).  If None, count
+            all of them.
+
+          interval : float, default 86400
+            When run in a loop, start a new pass this many seconds after
+            the start of the previous one.
+
+        """
+        self.processing_versions = processing_versions
+        self.things = list( things ) if things is not None else list( db.RowCount.things )
+        for thing in self.things:
+            if thing not in db.RowCount.things:
+                raise ValueError( f"Unknown thing to count: {thing}" )
+        self.interval = interval
+
+
+    def reconcile_once( self ):
+        """Do one pass over all processing versions and things.
+
+        Returns
+        -------
+          list of ( procver_id, thing, nrows, drift )
+
+        """
+        with db.DBCon() as dbcon:
+            if self.processing_versions is None:
+                rows, _ = dbcon.execute( "SELECT id FROM processing_version ORDER BY description" )
+                pvids = [ r[0] for r in rows ]
+            else:
+                pvids = [ db.ProcessingVersion.procver_id( pv, dbcon=dbcon ) for pv in self.processing_versions ]
+
+            results = []
+            for pvid in pvids:
+                for thing in self.things:
+                    t0 = time.perf_counter()
+                    try:
+                        nrows, drift = db.RowCount.reconcile( pvid, thing, dbcon=dbcon )
+                    except Exception as ex:
+                        dbcon.rollback()
+                        FDBLogger.exception( f"Failed to reconcile count of {thing} for processing "
+                                             f"version {pvid}: {ex}" )
+                        continue
+                    FDBLogger.info( f"Processing version {pvid} has {nrows} {thing} "
+                                    f"(drift {drift}; took {time.perf_counter()-t0:.1f}s)" )
+                    results.append( ( pvid, thing, nrows, drift ) )
+
+        return results
+
+
+    def __call__( self ):
+        while True:
+            tstart = time.monotonic()
+            self.reconcile_once()
+            sleeptime = self.interval - ( time.monotonic() - tstart )
+            if sleeptime > 0:
+                FDBLogger.info( f"Sleeping {sleeptime:.0f}s until the next reconciliation" )
+                time.sleep( sleeptime )
+
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( 'row_count_reconciler.py',
+                                      description="Recompute exact counts in the row_counts table",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-versions", nargs='+', default=None,
+                         help="Processing versions to reconcile (default: all of them)" )
+    parser.add_argument( "-t", "--things", nargs='+', default=None, choices=db.RowCount.things,
+                         help="Things to count (default: all of them)" )
+    parser.add_argument( "-i", "--interval", type=float, default=86400,
+                         help="Seconds between the starts of reconciliation passes" )
+    parser.add_argument( "--once", action='store_true', default=False,
+                         help="Do one pass and exit, instead of running forever" )
+    parser.add_argument( "-v", "--verbose", action='store_true', default=False,
+                         help="Show debug log messages" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.DEBUG if args.verbose else logging.INFO )
+
+    reconciler = RowCountReconciler( processing_versions=args.processing_versions, things=args.things,
+                                     interval=args.interval )
+    if args.once:
+        reconciler.reconcile_once()
+    else:
+        reconciler()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
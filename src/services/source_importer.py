@@ -16,7 +16,6 @@ import sys
 import datetime
 import argparse
 import simplejson
-import textwrap
 import logging
 import traceback
 
@@ -52,6 +51,11 @@ class SourceImporter:
     diaforcedsource_extra_fields = [ 'diaforcedsourceid', 'detector', 'scienceflux', 'sciencefluxerr',
                                      'timeprocessedmjdtai', 'timewithdrawnmjdtai' ]
 
+    # Columns of the temp_diaobject_import and temp_new_diaobject tables
+    diaobject_import_columns = ( "diaobjectid bigint NOT NULL, rootid uuid, base_procver_id uuid, "
+                                 "base_pos_procver_id uuid, ra double precision, dec double precision, "
+                                 "raerr real, decerr real, ra_dec_cov real" )
+
 
     @classmethod
     def build_flags( cls, flagmap, row ):
@@ -147,8 +151,11 @@ class SourceImporter:
     def read_mongo_objects( self, dbcon, t0=None, t1=None, batchsize=10000 ):
         """Read all diaobject records from a mongo collection and stick them a temp table.
 
-        Populates temp tables temp_diaobject_import.  It will only live
-        as long as the dbcon session is open.
+        Populates temp table temp_diaobject_import.  (This comes from
+        dbcon.temp_table, so it's reused by later imports on the same
+        connection.  Nothing else uses that name, so we always get the
+        table we ask for.)  It will only live as long as the dbcon
+        session is open.
 
         Parameters
         ----------
@@ -165,22 +172,6 @@ class SourceImporter:
 
         """
 
-        if not self.debug_just_read_mongo:
-            q = sql.SQL( textwrap.dedent(
-                """
-                CREATE TEMP TABLE temp_diaobject_import (
-                  diaobjectid bigint NOT NULL,
-                  rootid uuid,
-                  base_procver_id uuid,
-                  base_pos_procver_id uuid,
-                  ra double precision,
-                  dec double precision,
-                  raerr real,
-                  decerr real,
-                  ra_dec_cov real )
-                """ ) )
-            dbcon.execute( q )
-
         pipeline = []
         self._add_mongo_time_limits_to_pipeline( pipeline, t0, t1 )
         # OK... scary.  Going to first sort on diaobject id, so that we
@@ -222,9 +213,10 @@ class SourceImporter:
                 FDBLogger.debug( f"      ...read {n} rows from mongo" )
 
             else:
-                with ( dbcon.cursor.copy( "COPY temp_diaobject_import(diaobjectid, rootid, base_procver_id,\n"
-                                          "                           base_pos_procver_id, ra, dec, raerr,\n"
-                                          "                           decerr, ra_dec_cov) FROM STDIN" )
+                with ( dbcon.temp_table( 'temp_diaobject_import', self.diaobject_import_columns ) as temptable,
+                       dbcon.cursor.copy( f"COPY {temptable}(diaobjectid, rootid, base_procver_id,\n"
+                                          f"                 base_pos_procver_id, ra, dec, raerr,\n"
+                                          f"                 decerr, ra_dec_cov) FROM STDIN" )
                        as pgcopy ):
                     for row in mongocursor:
                         # Sometimes alerts may have been solar system objects
@@ -248,11 +240,6 @@ class SourceImporter:
                             temptable, liketable, batchsize=10000,
                             base_procver_id=None, rejectfields={}, rejectid=None ):
 
-        if not self.debug_just_read_mongo:
-            q = sql.SQL( "CREATE TEMP TABLE IF NOT EXISTS {temptable} (LIKE {liketable})"
-                        ).format( temptable=sql.Identifier(temptable), liketable=sql.Identifier(liketable) )
-            dbcon.execute( q )
-
         # ****
         # strio = io.StringIO()
         # strio.write( "mongo pipeline is:\n" )
@@ -274,7 +261,8 @@ class SourceImporter:
             FDBLogger.debug( f"      ...read {gratuitous} rows from mongo" )
 
         else:
-            with dbcon.cursor.copy( f"COPY {temptable}({','.join(writefields)}) FROM STDIN" ) as pgcopy:
+            with ( dbcon.temp_table( temptable, f"LIKE {liketable}" ) as temptable,
+                   dbcon.cursor.copy( f"COPY {temptable}({','.join(writefields)}) FROM STDIN" ) as pgcopy ):
                 for row in mongocursor:
                     # We may need to reject some things.  E.g., we may have pulled alerts that have
                     #  no diaboejctid because they are solar system lists.
@@ -419,73 +407,77 @@ class SourceImporter:
             if self.debug_just_read_mongo:
                 return 0, 0, 0
 
-            # Filter the temp table to just new objects
-            dbcon.execute( "DROP TABLE IF EXISTS temp_new_diaobject" )
-            dbcon.execute( "CREATE TEMP TABLE temp_new_diaobject AS "
-                           "( SELECT tdi.* FROM temp_diaobject_import tdi "
-                           "  LEFT JOIN diaobject o ON "
-                           "    o.diaobjectid=tdi.diaobjectid AND o.base_procver_id=tdi.base_procver_id "
-                           "  WHERE o.diaobjectid IS NULL )" )
-
-            # Link new objects to existing root objects
-            # TODO : test this with multiple processing versions and multiple
-            #   objects that match!!!
-            FDBLogger.debug( "   ...linking to existing root diaobjects..." )
-            dbcon.execute( "UPDATE temp_new_diaobject tno SET rootid=r.id\n"
-                           "FROM root_diaobject r\n"
-                           "WHERE q3c_radial_query( r.ra, r.dec, tno.ra, tno.dec, %(rad)s)",
-                           { 'rad': self.object_match_radius/3600. } )
-
-            # Create new root objects
-            FDBLogger.debug( "   ...creating new root diaobjects..." )
-            dbcon.execute( "CREATE TEMP TABLE temp_new_root_obj (id UUID, ra double precision, dec double precision)" )
-            dbcon.execute( "INSERT INTO temp_new_root_obj(id, ra, dec) "
-                           "( SELECT gen_random_uuid(), ra, dec FROM temp_new_diaobject "
-                           "  WHERE rootid IS NULL )" )
-            # This next one is byzantine.  I'm trying to say, "hey, there are n
-            # rows in temp_new_diaobject that have NULL rootid, and I've just
-            # created temp_new_root_obj with n rows, now just fill those n NULL rootids
-            # from the n rows in temp_new_root_obj".  There must be a less byzantine
-            # way to do this.
-            FDBLogger.debug( "   ...filling new rootid into temp table..." )
-            dbcon.execute( "UPDATE temp_new_diaobject tno SET rootid=r.id "
-                           "FROM ( ( SELECT id, ROW_NUMBER() OVER () AS n FROM temp_new_root_obj ) tnro "
-                           "       INNER JOIN "
-                           "       ( SELECT diaobjectid, rootid, ROW_NUMBER() OVER () AS n FROM "
-                           "         ( SELECT diaobjectid, rootid FROM temp_new_diaobject WHERE rootid IS NULL ) subq "
-                           "       ) tnd "
-                           "       ON tnro.n=tnd.n ) r "
-                        "WHERE r.diaobjectid=tno.diaobjectid" )
-
-            # Add the new root diaobjects
-            FDBLogger.debug( "   ...inserting new root objects into root_diaobject tables..." )
-            dbcon.execute( "INSERT INTO root_diaobject(id, ra, dec) ( SELECT id, ra, dec FROM temp_new_root_obj )" )
-            nroot = dbcon.cursor.rowcount
-            FDBLogger.debug( f"      ...inserted {nroot} objects" )
-
-            # Add the new objects.
-            FDBLogger.debug( "   ...inserting new diaobjects into diaobject table..." )
-            dbcon.execute( "INSERT INTO diaobject(diaobjectid, rootid, base_procver_id)\n"
-                           "( SELECT diaobjectid, rootid, base_procver_id FROM temp_new_diaobject )" )
-            nobjs = dbcon.cursor.rowcount
-            FDBLogger.debug( f"      ...inserted {nobjs} objects" )
-
-            # For diaobject position, it's simpler, we can just do an import and ignore conflicts.
-
-            FDBLogger.debug( "   ...inserting unknown positions into diaobject table..." )
-            dbcon.execute( "INSERT INTO diaobject_position(diaobjectid, base_procver_id,\n"
-                           "                               ra, dec, raerr, decerr, ra_dec_cov)\n"
-                            "( SELECT diaobjectid, base_pos_procver_id, ra, dec, raerr, decerr, ra_dec_cov\n"
-                            "  FROM temp_new_diaobject\n"
-                            "  WHERE base_pos_procver_id IS NOT NULL )\n"
-                            "ON CONFLICT DO NOTHING" )
-            npos = dbcon.cursor.rowcount
-
-            if commit:
-                FDBLogger.debug("   ...commiting objects" )
-                dbcon.commit()
-
-            return nobjs, nroot, npos
+            with ( dbcon.temp_table( 'temp_new_diaobject', self.diaobject_import_columns ) as newobj,
+                   dbcon.temp_table( 'temp_new_root_obj',
+                                     'id UUID, ra double precision, dec double precision' ) as newroot ):
+                # Filter the temp table to just new objects
+                dbcon.execute( f"INSERT INTO {newobj} "
+                               "( SELECT tdi.* FROM temp_diaobject_import tdi "
+                               "  LEFT JOIN diaobject o ON "
+                               "    o.diaobjectid=tdi.diaobjectid AND o.base_procver_id=tdi.base_procver_id "
+                               "  WHERE o.diaobjectid IS NULL )" )
+
+                # Link new objects to existing root objects
+                # TODO : test this with multiple processing versions and multiple
+                #   objects that match!!!
+                FDBLogger.debug( "   ...linking to existing root diaobjects..." )
+                dbcon.execute( f"UPDATE {newobj} tno SET rootid=r.id\n"
+                               "FROM root_diaobject r\n"
+                               "WHERE q3c_radial_query( r.ra, r.dec, tno.ra, tno.dec, %(rad)s)",
+                               { 'rad': self.object_match_radius/3600. } )
+
+                # Create new root objects
+                FDBLogger.debug( "   ...creating new root diaobjects..." )
+                dbcon.execute( f"INSERT INTO {newroot}(id, ra, dec) "
+                               f"( SELECT gen_random_uuid(), ra, dec FROM {newobj} "
+                               "  WHERE rootid IS NULL )" )
+                # This next one is byzantine.  I'm trying to say, "hey, there are n
+                # rows in temp_new_diaobject that have NULL rootid, and I've just
+                # created temp_new_root_obj with n rows, now just fill those n NULL rootids
+                # from the n rows in temp_new_root_obj".  There must be a less byzantine
+                # way to do this.
+                FDBLogger.debug( "   ...filling new rootid into temp table..." )
+                dbcon.execute( f"UPDATE {newobj} tno SET rootid=r.id "
+                               f"FROM ( ( SELECT id, ROW_NUMBER() OVER () AS n FROM {newroot} ) tnro "
+                               "       INNER JOIN "
+                               "       ( SELECT diaobjectid, rootid, ROW_NUMBER() OVER () AS n FROM "
+                               f"         ( SELECT diaobjectid, rootid FROM {newobj} WHERE rootid IS NULL ) subq "
+                               "       ) tnd "
+                               "       ON tnro.n=tnd.n ) r "
+                            "WHERE r.diaobjectid=tno.diaobjectid" )
+
+                # Add the new root diaobjects
+                FDBLogger.debug( "   ...inserting new root objects into root_diaobject tables..." )
+                dbcon.execute( f"INSERT INTO root_diaobject(id, ra, dec) ( SELECT id, ra, dec FROM {newroot} )" )
+                nroot = dbcon.cursor.rowcount
+                FDBLogger.debug( f"      ...inserted {nroot} objects" )
+
+                # Add the new objects.
+                FDBLogger.debug( "   ...inserting new diaobjects into diaobject table..." )
+                dbcon.execute( "INSERT INTO diaobject(diaobjectid, rootid, base_procver_id)\n"
+                               f"( SELECT diaobjectid, rootid, base_procver_id FROM {newobj} )" )
+                nobjs = dbcon.cursor.rowcount
+                FDBLogger.debug( f"      ...inserted {nobjs} objects" )
+
+                # For diaobject position, it's simpler, we can just do an import and ignore conflicts.
+
+                FDBLogger.debug( "   ...inserting unknown positions into diaobject table..." )
+                dbcon.execute( "INSERT INTO diaobject_position(diaobjectid, base_procver_id,\n"
+                               "                               ra, dec, raerr, decerr, ra_dec_cov)\n"
+                                "( SELECT diaobjectid, base_pos_procver_id, ra, dec, raerr, decerr, ra_dec_cov\n"
+                                f"  FROM {newobj}\n"
+                                "  WHERE base_pos_procver_id IS NOT NULL )\n"
+                                "ON CONFLICT DO NOTHING" )
+                npos = dbcon.cursor.rowcount
+
+                db.RowCount.bump( 'diaobject', self.object_base_processing_version, nobjs, dbcon=dbcon )
+                db.RowCount.bump( 'rootid', self.object_base_processing_version, nroot, dbcon=dbcon )
+
+                if commit:
+                    FDBLogger.debug("   ...commiting objects" )
+                    dbcon.commit()
+
+                return nobjs, nroot, npos
 
 
     def import_sources( self, t0=None, t1=None, batchsize=10000, dbcon=None, commit=True ):
@@ -536,6 +528,8 @@ class SourceImporter:
             nextra = dbcon.cursor.rowcount
             FDBLogger.debug( f"      ...hit {nextra} rows, but I'm not 100% sure what that means" )
 
+            db.RowCount.bump( 'diasource', self.source_base_processing_version, nsrc, dbcon=dbcon )
+
             if commit:
                 FDBLogger.debug( "   ...comitting sources" )
                 dbcon.commit()
@@ -592,6 +586,8 @@ class SourceImporter:
             nextra = dbcon.cursor.rowcount
             FDBLogger.debug( f"      ...hit {nextra} rows but I'm not 100% sure what that means" )
 
+            db.RowCount.bump( 'diaforcedsource', self.forcedsource_base_processing_version, nfrc, dbcon=dbcon )
+
             if commit:
                 FDBLogger.debug( "   ...comitting forcedsources" )
                 dbcon.commit()
@@ -5,6 +5,7 @@ import io
 import datetime
 import pytz
 import logging
+import contextlib
 
 import numpy as np
 import pandas
@@ -127,7 +128,10 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         now = datetime.datetime.utcfromtimestamp( astropy.time.Time( mjdnow, format='mjd', scale='tai' ).unix_tai )
         now = pytz.utc.localize( now )
 
-    with db.DBCon() as con:
+    wantedcols = ( "rootid UUID, is_host boolean, ra double precision, dec double precision, "
+                   "requester text, priority int, wanttime timestamp with time zone" )
+
+    with db.DBCon() as con, contextlib.ExitStack() as tmptabs:
         procver = util.procver_id( procver, dbcon=con )
 
         # Create a temporary table with things that are wanted but that have not been claimed.
@@ -136,11 +140,8 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         #   requester requests the same spectrum more than once?  Maybe a unique
         #   constraint in wantedspectra?
 
-        con.execute_nofetch( "CREATE TEMP TABLE tmp_wanted( rootid UUID, is_host boolean, "
-                             "ra double precision, dec double precision, requester text, priority int, "
-                             "wanttime timestamp with time zone )",
-                             explain=False, analyze=False )
-        q = ( f"INSERT INTO tmp_wanted (\n"
+        tmp_wanted = tmptabs.enter_context( con.temp_table( 'tmp_wanted', wantedcols ) )
+        q = ( f"INSERT INTO {tmp_wanted} (\n"
               f"  SELECT DISTINCT ON(root_diaobject_id, requester, is_host)\n"
               f"    root_diaobject_id, is_host, ra, dec, requester, priority, wanttime\n"
               f"  FROM (\n"
@@ -170,7 +171,7 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
                      'is_host': is_host }
         con.execute_nofetch( q, subdict )
 
-        rows, _cols = con.execute( "SELECT COUNT(rootid) FROM tmp_wanted" )
+        rows, _cols = con.execute( f"SELECT COUNT(rootid) FROM {tmp_wanted}" )
         if rows[0][0] == 0:
             logger.debug( "Empty table tmp_wanted" )
             return pandas.DataFrame( [], columns=[ 'root_diaobject_id', 'requester', 'priority', 'wanttime',
@@ -180,7 +181,7 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         else:
             logger.debug( f"{rows[0][0]} rows in tmp_wanted" )
         if _show_way_too_much_debug_info:
-            rows, _cols = con.execute( "SELECT * FROM tmp_wanted" )
+            rows, _cols = con.execute( f"SELECT * FROM {tmp_wanted}" )
             sio = io.StringIO()
             sio.write( "Contents of tmp_wanted:\n" )
             sio.write( f"{'UUID':36s} {'requester':16s} priority\n" )
@@ -192,21 +193,17 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         # Filter that table by throwing out things that have a spectruminfo whose mjd is greater than
         #   obstime.
         if nospecsince is None:
-            con.execute_nofetch( "ALTER TABLE tmp_wanted RENAME TO tmp_wanted_no_spec", explain=False, analyze=False )
+            tmp_wanted_no_spec = tmp_wanted
         else:
-            con.execute_nofetch( "CREATE TEMP TABLE tmp_wanted_no_spec(\n"
-                                 "  rootid UUID, is_host boolean, ra double precision,\n"
-                                 "  dec double precision, requester text, priority int,\n"
-                                "   wanttime timestamp with time zone)\n",
-                                 explain=False, analyze=False )
+            tmp_wanted_no_spec = tmptabs.enter_context( con.temp_table( 'tmp_wanted_no_spec', wantedcols ) )
             q = ( "/*+ IndexScan(s idx_spectruminfo_root_diaobject_id) */"
-                  "INSERT INTO tmp_wanted_no_spec (\n"
+                  f"INSERT INTO {tmp_wanted_no_spec} (\n"
                   "  SELECT DISTINCT ON(rootid,requester,is_host)\n"
                   "    rootid, is_host, ra, dec, requester, priority, wanttime\n"
                   "  FROM (\n"
                   "    SELECT t.rootid, t.is_host, t.ra, t.dec, t.requester,\n"
                   "           t.priority, s.specinfo_id, t.wanttime\n"
-                  "    FROM tmp_wanted t\n"
+                  f"    FROM {tmp_wanted} t\n"
                   "    LEFT JOIN spectruminfo s\n"
                   "      ON s.root_diaobject_id=t.rootid AND s.is_host=t.is_host\n"
                   "        AND s.mjd>=%(obstime)s AND s.mjd<=%(now)s\n"
@@ -215,7 +212,7 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
                   "  ORDER BY rootid, requester, is_host )\n" )
             con.execute_nofetch( q, { 'obstime': nospecsince, 'now': mjdnow } )
 
-        row, _cols = con.execute( "SELECT COUNT(rootid) FROM tmp_wanted_no_spec" )
+        row, _cols = con.execute( f"SELECT COUNT(rootid) FROM {tmp_wanted_no_spec}" )
         if row[0][0] == 0:
             logger.debug( "Empty table tmp_wanted_no_spec" )
             return pandas.DataFrame( [], columns=[ 'root_diaobject_id', 'requester', 'priority', 'wanttime',
@@ -225,7 +222,7 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         else:
             logger.debug( f"{row[0][0]} rows in tmp_wanted_no_spec" )
         if _show_way_too_much_debug_info:
-            rows, _cols = con.execute( "SELECT * FROM tmp_wanted_no_spec" )
+            rows, _cols = con.execute( f"SELECT * FROM {tmp_wanted_no_spec}" )
             sio = io.StringIO()
             sio.write( "Contents of tmp_wanted2:\n" )
             sio.write( "------------------------------------ ---------------- --------\n" )
@@ -235,7 +232,7 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
             logger.debug( sio.getvalue() )
 
         # Pull down everything into a pandas dataframe
-        rows, cols = con.execute( "SELECT * FROM tmp_wanted_no_spec" )
+        rows, cols = con.execute( f"SELECT * FROM {tmp_wanted_no_spec}" )
         df = util.laboriously_construct_pandas( rows, columns=cols, doublecols=['ra', 'dec'],
                                                 int16cols=['priority'], ignore_missing_cols=True )
         df.set_index( 'rootid', inplace=True )
@@ -245,12 +242,12 @@ def what_spectra_are_wanted( procver='realtime', position_procver=None,
         #   if that would be faster, but this is simpler to code!
 
         srcltcvs, objinfo = ltcv.many_object_ltcvs( processing_version=procver, which='detections',
-                                                    objids_table='tmp_wanted_no_spec', return_format='pandas',
+                                                    objids_table=tmp_wanted_no_spec, return_format='pandas',
                                                     return_object_info=True, include_object_positions=True,
                                                     always_use_weighted_source_positions=True,
                                                     mjd_now=mjdnow, dbcon=con )
         frcltcvs = ltcv.many_object_ltcvs( processing_version=procver, which='forced',
-                                           objids_table='tmp_wanted_no_spec', return_format='pandas',
+                                           objids_table=tmp_wanted_no_spec, return_format='pandas',
                                            return_object_info=False, mjd_now=mjdnow, dbcon=con )
 
     srcltcvs.reset_index( inplace=True )
@@ -0,0 +1,256 @@
+import flask
+
+import db
+from webserver.baseview import BaseView
+
+
+# ======================================================================
+# /admin/querystats
+#
+# POST body is an optional JSON dict with:
+#    limit : int, default 100 ; return (at most) this many queries
+#    orderby : str, default 'total_time' ; one of total_time, calls, max_time, mean_time, slow_calls, nrows
+#
+# Returns { 'status': 'ok', 'querystats': [ dict, ... ] }, sorted descending
+#   by orderby.  The statistics are aggregated over every process that
+#   has talked to the database through db.DBCon (as of each process's
+#   last flush; this process is flushed before reading).
+
+class QueryStats( BaseView ):
+    _admin_required = True
+
+    orderbys = { 'total_time': 'total_time',
+                 'calls': 'calls',
+                 'max_time': 'max_time',
+                 'mean_time': 'total_time/calls',
+                 'slow_calls': 'slow_calls',
+                 'nrows': 'nrows' }
+
+    def do_the_things( self ):
+        data = flask.request.json if flask.request.is_json else {}
+        unknown = set( data.keys() ) - { 'limit', 'orderby' }
+        if len( unknown ) > 0:
+            return f"Unknown parameters: {unknown}", 422
+        limit = int( data['limit'] ) if 'limit' in data else 100
+        orderby = data['orderby'] if 'orderby' in data else 'total_time'
+        if orderby not in self.orderbys:
+            return f"orderby must be one of {list(self.orderbys.keys())}", 422
+
+        db.QueryStats.instance().flush()
+
+        with db.DBCon( dictcursor=True ) as dbcon:
+            rows = dbcon.execute( f"SELECT fingerprint, query, calls, slow_calls, total_time, "
+                                  f"  total_time/GREATEST(calls,1) AS mean_time, total_fetch_time, max_time, "
+                                  f"  nrows, first_seen, last_seen "
+                                  f"FROM query_stats "
+                                  f"ORDER BY {self.orderbys[orderby]} DESC LIMIT %(limit)s",
+                                  { 'limit': limit } )
+
+        for row in rows:
+            row['first_seen'] = row['first_seen'].isoformat()
+            row['last_seen'] = row['last_seen'].isoformat()
+
+        return { 'status': 'ok', 'querystats': rows }
+
+
+# ======================================================================
+# /admin/slowqueries
+#
+# POST body is an optional JSON dict with:
+#    limit : int, default 100 ; return (at most) this many log entries
+#    fingerprint : str ; only return entries for this query fingerprint
+#
+# Returns { 'status': 'ok', 'slowqueries': [ dict, ... ] }, most recent first.
+
+class SlowQueries( BaseView ):
+    _admin_required = True
+
+    def do_the_things( self ):
+        data = flask.request.json if flask.request.is_json else {}
+        unknown = set( data.keys() ) - { 'limit', 'fingerprint' }
+        if len( unknown ) > 0:
+            return f"Unknown parameters: {unknown}", 422
+        subdict = { 'limit': int( data['limit'] ) if 'limit' in data else 100 }
+        q = "SELECT t, fingerprint, duration, query, plan, pid, program FROM slow_query_log "
+        if 'fingerprint' in data:
+            q += "WHERE fingerprint=%(fp)s "
+            subdict['fp'] = data['fingerprint']
+        q += "ORDER BY t DESC LIMIT %(limit)s"
+
+        with db.DBCon( dictcursor=True ) as dbcon:
+            rows = dbcon.execute( q, subdict )
+
+        for row in rows:
+            row['t'] = row['t'].isoformat()
+
+        return { 'status': 'ok', 'slowqueries': rows }
+
+
+# ======================================================================
+# /admin/querycache
+#
+# No POST body.
+#
+# Returns { 'status': 'ok', 'entries': int, 'bytes': int, 'hits': int,
+#           'submissions': int, 'cache_hits': int, 'hit_rate': float or None }
+#
+#   entries, bytes, and hits are the number, total size, and total hits
+#   of entries currently in the long query result cache.  submissions
+#   is the number of long queries in query_queue that could have used
+#   the cache (i.e. were submitted with usecache), cache_hits is how
+#   many of those weren't run because an identical query was (or was
+#   being) run, and hit_rate is cache_hits / submissions.
+
+class QueryCache( BaseView ):
+    _admin_required = True
+
+    def do_the_things( self ):
+        with db.DBCon() as dbcon:
+            rows, _ = dbcon.execute( "SELECT COUNT(*), COALESCE(SUM(result_size),0), COALESCE(SUM(hits),0) "
+                                     "FROM query_result_cache" )
+            entries, nbytes, hits = rows[0]
+            rows, _ = dbcon.execute( "SELECT COUNT(*), COUNT(*) FILTER (WHERE cache_hit) "
+                                     "FROM query_queue WHERE cachekey IS NOT NULL" )
+            submissions, cache_hits = rows[0]
+
+        return { 'status': 'ok',
+                 'entries': entries,
+                 'bytes': int( nbytes ),
+                 'hits': int( hits ),
+                 'submissions': submissions,
+                 'cache_hits': cache_hits,
+                 'hit_rate': ( cache_hits / submissions ) if submissions > 0 else None }
+
+
+# ======================================================================
+# /admin/queuestats
+#
+# POST body is an optional JSON dict with:
+#    days : float, default 7 ; only look at long queries submitted in the last this many days
+#
+# Returns { 'status': 'ok', 'users': [ dict, ... ], 'priorities': [ dict, ... ] }
+#
+#   Each dict in users is one user's long queries, with keys username,
+#   submitted, queued, running, finished, errored, cancelled,
+#   cache_hits, mean_wait, and max_wait.  The waits are the time
+#   (seconds) between submission and when the query runner started the
+#   query, for queries the runner has started; they're None if there
+#   aren't any.  users is sorted by submitted, descending.  priorities
+#   has the same thing (with key priority rather than username) for
+#   each priority.
+
+class QueueStats( BaseView ):
+    _admin_required = True
+
+    priorities = { 0: 'low', 1: 'normal', 2: 'high' }
+
+    def do_the_things( self ):
+        data = flask.request.json if flask.request.is_json else {}
+        unknown = set( data.keys() ) - { 'days' }
+        if len( unknown ) > 0:
+            return f"Unknown parameters: {unknown}", 422
+        days = float( data['days'] ) if 'days' in data else 7.
+
+        # Queries answered from the cache (cached_from is not NULL) are never
+        #   started by the runner, so they aren't counted in the waits.
+        stats = ( "COUNT(*) AS submitted, "
+                  "COUNT(*) FILTER (WHERE q.started IS NULL AND NOT COALESCE(q.error, false)) AS queued, "
+                  "COUNT(*) FILTER (WHERE q.started IS NOT NULL AND q.finished IS NULL "
+                  "                   AND NOT COALESCE(q.error, false)) AS running, "
+                  "COUNT(*) FILTER (WHERE q.finished IS NOT NULL) AS finished, "
+                  "COUNT(*) FILTER (WHERE COALESCE(q.error, false)) AS errored, "
+                  "COUNT(*) FILTER (WHERE q.cancelled IS NOT NULL) AS cancelled, "
+                  "COUNT(*) FILTER (WHERE q.cache_hit) AS cache_hits, "
+                  "AVG(EXTRACT(EPOCH FROM q.started-q.submitted)) FILTER (WHERE q.cached_from IS NULL) "
+                  "  AS mean_wait, "
+                  "MAX(EXTRACT(EPOCH FROM q.started-q.submitted)) FILTER (WHERE q.cached_from IS NULL) "
+                  "  AS max_wait " )
+        subdict = { 'days': days }
+        with db.DBCon( dictcursor=True ) as dbcon:
+            users = dbcon.execute( f"SELECT a.username, {stats} "
+                                   f"FROM query_queue q INNER JOIN authuser a ON q.userid=a.id "
+                                   f"WHERE q.submitted > NOW() - %(days)s * INTERVAL '1 day' "
+                                   f"GROUP BY a.username ORDER BY submitted DESC",
+                                   subdict )
+            priorities = dbcon.execute( f"SELECT q.priority, {stats} "
+                                        f"FROM query_queue q "
+                                        f"WHERE q.submitted > NOW() - %(days)s * INTERVAL '1 day' "
+                                        f"GROUP BY q.priority ORDER BY q.priority DESC",
+                                        subdict )
+
+        for row in users + priorities:
+            for key in ( 'mean_wait', 'max_wait' ):
+                row[key] = None if row[key] is None else float( row[key] )
+        for row in priorities:
+            row['priority'] = self.priorities[ row['priority'] ]
+
+        return { 'status': 'ok', 'users': users, 'priorities': priorities }
+
+
+# ======================================================================
+# /admin/admissions
+#
+# POST body is an optional JSON dict with:
+#    limit : int, default 100 ; return (at most) this many log entries
+#    days : float, default 7 ; only look at the last this many days
+#
+# Returns { 'status': 'ok', 'counts': { decision: int, ... }, 'admissions': [ dict, ... ] }
+#
+#   These are the short queries that were too expensive to run (see
+#   RunSQLQuery in dbapp.py), and so were rejected or submitted as long
+#   queries.  counts is the number of each decision ('rejected' or
+#   'long') in the last days days; admissions has the log entries
+#   (with keys t, username, decision, cost, max_cost, queryid, and
+#   queries), most recent first.
+
+class Admissions( BaseView ):
+    _admin_required = True
+
+    def do_the_things( self ):
+        data = flask.request.json if flask.request.is_json else {}
+        unknown = set( data.keys() ) - { 'limit', 'days' }
+        if len( unknown ) > 0:
+            return f"Unknown parameters: {unknown}", 422
+        subdict = { 'limit': int( data['limit'] ) if 'limit' in data else 100,
+                    'days': float( data['days'] ) if 'days' in data else 7. }
+
+        with db.DBCon( dictcursor=True ) as dbcon:
+            counts = dbcon.execute( "SELECT decision, COUNT(*) AS n FROM query_admission_log "
+                                    "WHERE t > NOW() - %(days)s * INTERVAL '1 day' GROUP BY decision",
+                                    subdict )
+            rows = dbcon.execute( "SELECT l.t, a.username, l.decision, l.cost, l.max_cost, l.queryid, l.queries "
+                                  "FROM query_admission_log l LEFT JOIN authuser a ON l.userid=a.id "
+                                  "WHERE l.t > NOW() - %(days)s * INTERVAL '1 day' "
+                                  "ORDER BY l.t DESC LIMIT %(limit)s",
+                                  subdict )
+
+        for row in rows:
+            row['t'] = row['t'].isoformat()
+
+        return { 'status': 'ok', 'counts': { r['decision']: r['n'] for r in counts }, 'admissions': rows }
+
+
+# **********************************************************************
+# **********************************************************************
+# **********************************************************************
+
+bp = flask.Blueprint( 'adminapp', __name__, url_prefix='/admin' )
+
+urls = {
+    "/querystats": QueryStats,
+    "/slowqueries": SlowQueries,
+    "/querycache": QueryCache,
+    "/queuestats": QueueStats,
+    "/admissions": Admissions,
+}
+
+usedurls = {}
+for url, cls in urls.items():
+    if url not in usedurls.keys():
+        usedurls[ url ] = 0
+        name = url
+    else:
+        usedurls[ url ] += 1
+        name = f'{url}.{usedurls[url]}'
+
+    bp.add_url_rule (url, view_func=cls.as_view(name), methods=['POST'], strict_slashes=False )
@@ -8,7 +8,7 @@ import pandas
 import flask
 import flask.views
 
-from db import DB
+from db import DBCon
 from util import FDBLogger
 
 
@@ -56,7 +56,9 @@ class BaseView( flask.views.View ):
     200.  If it's a tuple, just let Flask deal with that tuple to figure
     out what the web server should send to the client.  Otherwise, the
     web server will sendn to the client application/octet-stream with
-    status 200.
+    status 200.  In all but the tuple case, do_the_things can add extra
+    HTTP headers to the response by putting them in
+    self.response_headers.
 
     Subclasses that do not override dispatch_request do not need to call
     check_auth.  However, if they do override it, they should call that
@@ -68,6 +70,7 @@ class BaseView( flask.views.View ):
 
     def __init__( self, *args, **kwargs ):
         super().__init__( *args, **kwargs )
+        self.response_headers = {}
 
     def check_auth( self ):
         self.username = flask.session['username'] if 'username' in flask.session else '(None)'
@@ -75,11 +78,8 @@ class BaseView( flask.views.View ):
         self.authenticated = ( 'authenticated' in flask.session ) and flask.session['authenticated']
         self.user = None
         if self.authenticated:
-            with DB() as conn:
-                cursor = conn.cursor()
-                cursor.execute( "SELECT id,username,displayname,email FROM authuser WHERE username=%(username)s",
-                                {'username': self.username } )
-                rows = cursor.fetchall()
+            with DBCon() as dbcon:
+                rows, _cols = dbcon.execute_prepared( 'authuser_by_username', { 'username': self.username } )
                 if len(rows) > 1:
                     self.authenticated = False
                     raise RuntimeError( f"Error, more than one {self.username} in database, "
@@ -88,7 +88,8 @@ class BaseView( flask.views.View ):
                     self.authenticated = False
                     raise ValueError( f"Error, failed to find user {self.username} in database" )
                 row = rows[0]
-                self.user = SimpleNamespace( id=row[0], username=row[1], displayname=row[2], email=row[3] )
+                self.user = SimpleNamespace( id=row[0], username=row[1], displayname=row[2], email=row[3],
+                                             isadmin=row[4] )
                 # Verify that session displayname and database displayname match?  Eh.  Whatevs.
         return self.authenticated
 
@@ -96,7 +97,8 @@ class BaseView( flask.views.View ):
         if not self.check_auth():
             return "Not logged in", 500
         if ( self._admin_required ) and ( not self.user.isadmin ):
-            return "Action requires admin", 500
+            # 422 rather than 403 so that the client doesn't retry
+            return "Action requires admin", 422
         try:
             retval = self.do_the_things( *args, **kwargs )
             # Can't just use the default JSON handling, because it
@@ -104,13 +106,13 @@ class BaseView( flask.views.View ):
             #   the javascript JSON parser chokes on.  Sigh.
             if isinstance( retval, dict ) or isinstance( retval, list ):
                 return ( simplejson.dumps( retval, ignore_nan=True, cls=UUIDJSONEncoder ),
-                         200, { 'Content-Type': 'application/json' } )
+                         200, { 'Content-Type': 'application/json', **self.response_headers } )
             elif isinstance( retval, str ):
-                return retval, 200, { 'Content-Type': 'text/plain; charset=utf-8' }
+                return retval, 200, { 'Content-Type': 'text/plain; charset=utf-8', **self.response_headers }
             elif isinstance( retval, tuple ):
                 return retval
             else:
-                return retval, 200, { 'Content-Type': 'application/octet-stream' }
+                return retval, 200, { 'Content-Type': 'application/octet-stream', **self.response_headers }
         except Exception as ex:
             # sio = io.StringIO()
             # traceback.print_exc( file=sio )
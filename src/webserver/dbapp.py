@@ -1,6 +1,15 @@
 import io
+import os
+import re
+import json
+import zlib
+import time
 import uuid
+import hashlib
+import pathlib
 import datetime
+import threading
+from contextlib import contextmanager
 
 import flask
 import psycopg
@@ -54,20 +63,228 @@ def _extract_queries( data ):
     return queries, subdicts, return_format
 
 
-def _dbcon():
-    # TODO : make these configurable?
-    dbuser = "postgres_ro"
-    pwfile = "/secrets/postgres_ro_password"
-    with open( pwfile ) as ifp:
-        password = ifp.readline().strip()
+# ======================================================================
+# Short SQL queries (RunSQLQuery) run on connections from a pool of
+#   read-only connections, one pool per webserver process.  A request
+#   that can't get a connection within _ro_pool_wait seconds fails.
+#   Idle connections older than _ro_pool_max_idle seconds are closed
+#   rather than reused.
+_ro_pool_size = 8
+_ro_pool_wait = 30.
+_ro_pool_max_idle = 600.
+
+# Limits on short SQL queries.  A request may ask for lower limits
+#   (with max_rows, max_bytes, and timeout in the POST data), but not
+#   higher ones.  A query that goes over a limit fails with an error
+#   telling the user to use the long query interface instead.  The
+#   byte limit is on the (approximate) size of the data values, not
+#   of the response.
+_short_query_max_rows = 100000
+_short_query_max_bytes = 100 * 1024 * 1024
+_short_query_timeout = 300.
+_short_query_fetch_rows = 5000
+
+# Admission control for short queries.  Before each of a short query's
+#   queries is run, its plan cost is estimated with EXPLAIN.  If the
+#   total goes over _short_query_max_cost (in postgres's plan cost
+#   units; set it to None to turn this off), the query is too expensive
+#   to run as a short query.  It's then either rejected, or submitted as
+#   a long query instead, depending on the request's if_expensive,
+#   which defaults to _short_query_if_expensive ('reject' or 'long').
+#   Rejections and conversions are logged in query_admission_log.
+#   A query that can't be EXPLAINed isn't admitted at all, unless it's
+#   a single utility statement that doesn't need planning (SET, SHOW,
+#   RESET, or CREATE TEMP TABLE or DROP TABLE for the temp tables that
+#   a list of queries can use); that includes a string with more than
+#   one statement in it.  (CREATE TEMP TABLE ... AS SELECT can be
+#   EXPLAINed, so its cost is counted.)
+_short_query_max_cost = 1e6
+_short_query_if_expensive = 'reject'
+
+
+class ReadOnlyConnectionPool:
+    """A pool of read-only database connections, for running the SQL that users send us.
+
+    Connections are made as postgres_ro, which only has SELECT
+    privileges, so users can't change anything in the database.  (The
+    connections aren't set read_only, because that would stop users from
+    making temp tables.)  When a connection is given back to the pool,
+    its transaction is rolled back and its session state reset with
+    DISCARD ALL (which drops any temp tables), so nothing one request
+    does can be seen by the next request to use the connection.
+
+    Use the pool with
+
+        with ReadOnlyConnectionPool.instance().connection() as conn:
+            ...
+
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance( cls ):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+
+    def __init__( self, maxconn=None, wait=None, max_idle=None ):
+        self.maxconn = maxconn if maxconn is not None else _ro_pool_size
+        self.wait = wait if wait is not None else _ro_pool_wait
+        self.max_idle = max_idle if max_idle is not None else _ro_pool_max_idle
+
+        # TODO : make these configurable?
+        self.dbuser = "postgres_ro"
+        with open( "/secrets/postgres_ro_password" ) as ifp:
+            self.password = ifp.readline().strip()
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore( self.maxconn )
+        # List of ( connection, time.monotonic() when it was put back ); last in, first out
+        self._idle = []
+
+
+    def _connect( self ):
+        conn = psycopg.connect( dbname=db.dbname, host=db.dbhost, port=db.dbport,
+                                user=self.dbuser, password=self.password )
+        # psycopg's automatically prepared statements wouldn't survive DISCARD ALL
+        conn.prepare_threshold = None
+        return conn
+
+
+    def _get( self ):
+        now = time.monotonic()
+        with self._lock:
+            while len( self._idle ) > 0:
+                conn, t = self._idle.pop()
+                if ( now - t <= self.max_idle ) and ( not conn.closed ) and ( not conn.broken ):
+                    return conn
+                conn.close()
+        return self._connect()
+
+
+    def _put( self, conn ):
+        try:
+            conn.rollback()
+            conn.autocommit = True
+            conn.execute( "DISCARD ALL" )
+            conn.autocommit = False
+        except Exception as ex:
+            FDBLogger.warning( f"Closing read-only connection that couldn't be reset: {ex}" )
+            conn.close()
+            return
+        with self._lock:
+            self._idle.append( ( conn, time.monotonic() ) )
+
+
+    @contextmanager
+    def connection( self ):
+        if not self._slots.acquire( timeout=self.wait ):
+            raise RuntimeError( f"All {self.maxconn} read-only database connections are in use; try again later" )
+        conn = None
+        try:
+            conn = self._get()
+            yield conn
+        finally:
+            try:
+                if conn is not None:
+                    self._put( conn )
+            finally:
+                self._slots.release()
+
+
+    def close( self ):
+        """Close all idle connections."""
+        with self._lock:
+            for conn, _t in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class QueryTooBig( RuntimeError ):
+    pass
+
+
+class QueryTooExpensive( RuntimeError ):
+    def __init__( self, cost, *args, **kwargs ):
+        self.cost = cost
+        super().__init__( *args, **kwargs )
+
+
+class QueryNotAdmitted( RuntimeError ):
+    pass
+
+
+_utility_statement = re.compile( r'^\s*(set|show|reset|drop\s+table'
+                                 r'|create\s+((local|global)\s+)?temp(orary)?\s+table)\b', re.IGNORECASE )
+
+
+def _plan_cost( cursor, query, subdict ):
+    # The planner's total cost for query.  Raises QueryNotAdmitted if it
+    #   can't be EXPLAINed, unless it's a single utility statement (cost 0).
+    try:
+        # A savepoint, so that a failed EXPLAIN doesn't abort the transaction.
+        # binary=True makes psycopg use the extended query protocol even when
+        #   there are no parameters, so that a string with several statements
+        #   in it fails here rather than running the ones after the first.
+        with cursor.connection.transaction():
+            cursor.execute( f"EXPLAIN (FORMAT JSON) {query}", subdict, binary=True )
+            plan = cursor.fetchone()[0]
+        return float( plan[0]['Plan']['Total Cost'] )
+    except psycopg.Error as ex:
+        if _utility_statement.search( query ) and ( ';' not in query.strip().rstrip( ';' ) ):
+            return 0.
+        FDBLogger.debug( f"Couldn't EXPLAIN query: {ex}" )
+        raise QueryNotAdmitted( f"Can't run this as a short query, because its cost couldn't be estimated "
+                                f"(only single statements that can be EXPLAINed, or single SET, SHOW, "
+                                f"RESET, CREATE TEMP TABLE, or DROP TABLE statements, are allowed): {ex}" )
+
+
+def _request_limit( data, key, servermax ):
+    if ( key not in data ) or ( data[key] is None ):
+        return servermax
+    val = type( servermax )( data[key] )
+    if val <= 0:
+        raise ValueError( f"{key} must be positive" )
+    return min( val, servermax )
 
-    conn = psycopg.connect( dbname=db.dbname, host=db.dbhost, port=db.dbport, user=dbuser, password=password )
 
-    return conn
+def _approx_nbytes( rows ):
+    # Rough size of the values in rows; good enough for enforcing a limit
+    return sum( len( v ) if isinstance( v, ( str, bytes ) ) else 8 for row in rows for v in row )
+
+
+def _too_big_message( what, limit ):
+    return ( f"Query returned more than {limit} {what}; add a LIMIT to your query, or use "
+             f"the long query interface (db/submitsqlquery)" )
 
 
 # ======================================================================
 # Interface for short SQL queries that return results directly.
+#
+# POST data is a JSON dict with:
+#    query : str or list of str
+#    subdict : dict or list of dict (optional)
+#    return_format : 0 (default), 1, or 'arrow'
+#                      0 : { 'status': 'ok', 'rows': [ { col: val, ... }, ... ] }
+#                      1 : { 'status': 'ok', 'data': { col: [ val, ... ], ... } }
+#                      'arrow' : the results as an Arrow IPC stream
+#                                (Content-Type application/vnd.apache.arrow.stream)
+#    max_rows, max_bytes, timeout : optional lower limits than the
+#                      server's (_short_query_max_rows, etc.)
+#    if_expensive : 'reject' or 'long' ; what to do if the query's
+#                      estimated cost is too high (see
+#                      _short_query_max_cost above).  'long' submits it
+#                      as a long query (as for submitsqlquery with
+#                      return_format 'csv'), and returns
+#                      { 'status': 'long', 'queryid': str, 'cost': float, 'max_cost': float }
+#
+# If a list of queries is given, they're all run in one transaction,
+#   and the results of the last one are returned.  Errors come back as
+#   { 'status': 'error', 'error': str }.
 
 class RunSQLQuery( BaseView ):
     def do_the_things( self ):
@@ -75,53 +292,318 @@ class RunSQLQuery( BaseView ):
             raise TypeError( "POST data was not JSON" )
         data = flask.request.json
 
+        timeout = _short_query_timeout
         try:
             queries, subdicts, return_format = _extract_queries( data )
+            if return_format not in ( 0, 1, 'arrow' ):
+                raise ValueError( f"Unknown return format {return_format}" )
+            max_rows = _request_limit( data, 'max_rows', _short_query_max_rows )
+            max_bytes = _request_limit( data, 'max_bytes', _short_query_max_bytes )
+            timeout = _request_limit( data, 'timeout', _short_query_timeout )
+            if_expensive = data['if_expensive'] if 'if_expensive' in data else _short_query_if_expensive
+            if if_expensive not in ( 'reject', 'long' ):
+                raise ValueError( f"if_expensive must be 'reject' or 'long', not {if_expensive}" )
 
-            try:
-                conn = _dbcon()
+            with ReadOnlyConnectionPool.instance().connection() as conn:
                 cursor = conn.cursor()
+                cursor.execute( "SELECT set_config( 'statement_timeout', %(t)s, true )",
+                                { 't': str( int( timeout * 1000 ) ) } )
 
                 FDBLogger.debug( "Starting query sequence" )
                 FDBLogger.debug( f"queries={queries}" )
                 FDBLogger.debug( f"subdicts={subdicts}" )
 
-                for query, subdict in zip( queries, subdicts ):
+                cost = 0.
+                for i, ( query, subdict ) in enumerate( zip( queries, subdicts ) ):
+                    # Estimate each query just before running it, as it may need
+                    #   (e.g.) temp tables created by the ones before.
+                    if _short_query_max_cost is not None:
+                        cost += _plan_cost( cursor, query, subdict )
+                        if cost > _short_query_max_cost:
+                            raise QueryTooExpensive( cost )
+                    if i == len(queries) - 1:
+                        break
                     FDBLogger.debug( f"Query is {query}, subdict is {subdict}, "
                                   f"user is {flask.session['useruuid']} ({flask.session['username']})" )
                     cursor.execute( query, subdict )
                     FDBLogger.debug( 'Query done' )
 
-                FDBLogger.debug( "Fetching" )
-                columns = [ c.name for c in cursor.description ]
-                rows = cursor.fetchall()
+                FDBLogger.debug( f"Final query is {queries[-1]}, subdict is {subdicts[-1]}, "
+                                 f"user is {flask.session['useruuid']} ({flask.session['username']})" )
+                if return_format == 'arrow':
+                    return self.arrow_results( conn, queries[-1], subdicts[-1], max_rows, max_bytes )
 
-            finally:
-                conn.rollback()
-                conn.close()
+                # Fetch through a server-side cursor so that we can stop as soon as we hit a limit
+                cursor = conn.cursor( f"runsqlquery_{uuid.uuid4().hex}" )
+                cursor.execute( queries[-1], subdicts[-1] )
+                columns = [ c.name for c in cursor.description ]
+                FDBLogger.debug( "Fetching" )
+                rows = []
+                nbytes = 0
+                while True:
+                    batch = cursor.fetchmany( min( _short_query_fetch_rows, max_rows + 1 - len(rows) ) )
+                    if len( batch ) == 0:
+                        break
+                    rows.extend( batch )
+                    if len( rows ) > max_rows:
+                        raise QueryTooBig( _too_big_message( "rows", max_rows ) )
+                    nbytes += _approx_nbytes( batch )
+                    if nbytes > max_bytes:
+                        raise QueryTooBig( _too_big_message( "bytes", max_bytes ) )
+                cursor.close()
 
             if return_format == 0:
                 retval = { 'status': 'ok',
                            'rows': [ { c: r[i] for i, c in enumerate(columns) } for r in rows ]
                           }
-            elif return_format == 1:
+            else:
                 retval = { 'status': 'ok',
                            'data': { c: [ r[i] for r in rows ] for i, c in enumerate(columns) }
                           }
-            else:
-                raise ValueError( f"Unknown return format {return_format}" )
 
             FDBLogger.debug( f"Returning {len(rows)} rows from query sequence." )
             return retval
 
+        except ( QueryTooBig, QueryNotAdmitted ) as ex:
+            FDBLogger.warning( str(ex) )
+            return { 'status': 'error', 'error': str(ex) }
+
+        except QueryTooExpensive as ex:
+            try:
+                return self.too_expensive( queries, subdicts, ex.cost, if_expensive )
+            except Exception as err:
+                FDBLogger.exception( err )
+                return { 'status': 'error', 'error': str(err) }
+
+        except psycopg.errors.QueryCanceled:
+            msg = ( f"Query took longer than {timeout} seconds; use the long query interface "
+                    f"(db/submitsqlquery) for queries that take a long time" )
+            FDBLogger.warning( msg )
+            return { 'status': 'error', 'error': msg }
+
         except Exception as ex:
             FDBLogger.exception( ex )
             return { 'status': 'error', 'error': str(ex) }
 
 
+    def too_expensive( self, queries, subdicts, cost, if_expensive ):
+        # Reject a query whose estimated cost is too high, or submit it as a long query
+        queryid = None
+        if if_expensive == 'long':
+            queryid = SubmitLongSQLQuery().submit( {}, queries, subdicts, 'csv' )
+            FDBLogger.info( f"Short query from {flask.session['username']} has estimated cost {cost:.4g}, "
+                            f"more than {_short_query_max_cost:.4g}; submitted it as long query {queryid}" )
+        else:
+            FDBLogger.info( f"Rejected short query from {flask.session['username']} with estimated cost "
+                            f"{cost:.4g}, more than {_short_query_max_cost:.4g}" )
+
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "INSERT INTO query_admission_log(userid, decision, cost, max_cost, queryid, "
+                                   "                                queries) "
+                                   "VALUES (%(userid)s, %(decision)s, %(cost)s, %(maxcost)s, %(queryid)s, "
+                                   "        %(queries)s)",
+                                   { 'userid': asUUID( flask.session['useruuid'] ),
+                                     'decision': 'rejected' if queryid is None else 'long',
+                                     'cost': cost, 'maxcost': _short_query_max_cost,
+                                     'queryid': queryid, 'queries': queries } )
+            dbcon.commit()
+
+        if queryid is not None:
+            return { 'status': 'long', 'queryid': str(queryid), 'cost': cost, 'max_cost': _short_query_max_cost }
+        return { 'status': 'error',
+                 'error': ( f"Query's estimated cost {cost:.4g} is more than the limit {_short_query_max_cost:.4g} "
+                            f"for short queries.  Make it more selective (e.g. make sure it can use an index), "
+                            f"or use the long query interface (db/submitsqlquery), or send if_expensive='long' "
+                            f"to have it submitted as a long query automatically." ) }
+
+
+    def arrow_results( self, conn, query, subdict, max_rows, max_bytes ):
+        import pyarrow
+
+        # The query gets wrapped in COPY ( ... ), where a trailing semicolon is a syntax error
+        query = query.strip().rstrip( ';' )
+
+        # Stream the results as binary into arrow columns, a chunk at a time, so we can stop at a limit
+        dbcon = db.DBCon( conn )
+        tables = []
+        nrows = 0
+        nbytes = 0
+        chunks = dbcon.iter_columnar( query, subdict, chunksize=_short_query_fetch_rows, return_format='arrow' )
+        try:
+            for table in chunks:
+                nrows += table.num_rows
+                if nrows > max_rows:
+                    raise QueryTooBig( _too_big_message( "rows", max_rows ) )
+                nbytes += table.nbytes
+                if nbytes > max_bytes:
+                    raise QueryTooBig( _too_big_message( "bytes", max_bytes ) )
+                tables.append( table )
+        finally:
+            # Finish with the COPY before the connection goes back to the pool
+            chunks.close()
+
+        if len( tables ) == 0:
+            # Still need the schema
+            table = dbcon.execute_columnar( f"SELECT * FROM ( {query} ) subq LIMIT 0", subdict,
+                                            return_format='arrow' )
+        else:
+            table = pyarrow.concat_tables( tables )
+
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream( sink, table.schema ) as writer:
+            writer.write_table( table )
+        FDBLogger.debug( f"Returning {table.num_rows} rows from query sequence as arrow." )
+        return sink.getvalue().to_pybytes(), 200, { 'Content-Type': 'application/vnd.apache.arrow.stream' }
+
 
 # ======================================================================
 # Submit a long SQL query for background running
+#
+# POST data is a JSON dict with:
+#    query, subdict : as for runsqlquery
+#    return_format : 'csv' (default), 'pandas', or 'numpy'
+#    usecache : bool, default False ; if True, reuse the results of an
+#                identical query if there are any (see below)
+#    parallel : dict, default None ; run the query in parallel (see below)
+#    priority : str, default 'normal' ; 'low', 'normal', or 'high'.  The
+#                query runner runs higher priority queries first.
+#    timeout : float, default _default_query_timeout ; the statement
+#                timeout (seconds) the query runner uses for the query
+#    work_mem : int, default None ; the work_mem (MB) the query runner
+#                uses for the query (None for the database default)
+#
+# A user can't ask for a higher priority, longer timeout, or more
+#   work_mem than their quota allows, nor have more than their quota of
+#   queries queued or running at once.  Quotas are the _default_*
+#   values below unless overridden in the query_user_quota table.  (The
+#   number of a user's queries that are run at once is limited by the
+#   query runner.)
+#
+# If _long_query_cache and usecache are both True, a query identical to
+#   one whose results are in the query_result_cache table (the same
+#   queries, give or take whitespace, the same subdicts, and the same
+#   format, with no new sources imported since) is finished as soon as
+#   it's submitted, with a hard link to the cached result file.  The
+#   only thing that marks cached results as out of date is an import of
+#   sources (diasource_import_time), so the submitter has to ask for
+#   this: it's only right for queries that read nothing but the tables
+#   the importers fill, and that don't use volatile functions like
+#   now() or random().  A query
+#   identical to one that's queued or running with at least the same
+#   priority and timeout waits for that one, and gets its results,
+#   rather than being run itself; if that one fails or is cancelled, the
+#   waiting query goes back into the queue to be run on its own.  (The
+#   query runner puts results in the cache, and evicts them.)
+#
+# parallel is for queries that go through a big table (e.g. exporting
+#   all of the sources).  It's a dict with:
+#      nworkers : int ; number of parts to split the query into (2 to _max_parallel_workers)
+#      splitby : str ; 'rootid' or 'q3c'
+#      column : str ; for splitby 'rootid', the rootid column to hash
+#                     (default 'rootid'); for 'q3c', the q3c ipix
+#                     expression to split (default 'q3c_ang2ipix(ra,dec)')
+#   The last query must have {FASTDB_PARTITION} where a condition goes
+#   (e.g. "SELECT * FROM diasource WHERE {FASTDB_PARTITION}").  The
+#   query runner runs nworkers copies of the queries at once, all in one
+#   database snapshot, with {FASTDB_PARTITION} replaced by a condition
+#   that selects a different part of the rows for each one.  For
+#   'rootid', the parts are by hash of the column; for 'q3c', they're
+#   equal ranges of q3c ipix (so, equal areas of sky, not necessarily
+#   equal numbers of rows).  Each part is written to its own file, and
+#   the results of the query are a JSON manifest listing the parts; get
+#   them with getsqlqueryresults/<queryid>/<part>.  Parallel queries
+#   aren't cached.
+
+_long_query_cache = True
+_max_parallel_workers = 8
+
+_query_priorities = { 'low': 0, 'normal': 1, 'high': 2 }
+_default_query_timeout = 3600.
+_default_max_queued = 20
+_default_max_priority = _query_priorities['normal']
+_default_max_timeout = 6 * 3600.
+_default_max_work_mem_mb = 1024
+_query_results_dir = pathlib.Path( "/query_results" )
+
+# Strings, quoted identifiers, and comments, where whitespace matters
+_sql_quoted_re = re.compile( r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$([A-Za-z_]\w*|)\$.*?\$\1\$|--[^\n]*\n?|/\*.*?\*/",
+                             re.DOTALL )
+_whitespace_re = re.compile( r'\s+' )
+
+
+def _normalize_sql( query ):
+    # Collapse runs of whitespace outside of strings, quoted identifiers, and comments
+    parts = []
+    pos = 0
+    for match in _sql_quoted_re.finditer( query ):
+        parts.append( _whitespace_re.sub( ' ', query[pos:match.start()] ) )
+        parts.append( match.group(0) )
+        pos = match.end()
+    parts.append( _whitespace_re.sub( ' ', query[pos:] ) )
+    return "".join( parts ).strip().rstrip( ';' ).rstrip()
+
+
+def _long_query_cache_key( queries, subdicts, return_format, watermark ):
+    keydata = { 'queries': [ _normalize_sql( q ) for q in queries ],
+                'subdicts': subdicts,
+                'format': return_format,
+                'watermark': None if watermark is None else watermark.isoformat() }
+    return hashlib.sha256( json.dumps( keydata, sort_keys=True, default=str ).encode( 'utf-8' ) ).hexdigest()
+
+
+def _parallel_options( parallel, queries ):
+    if parallel is None:
+        return None
+    if not isinstance( parallel, dict ):
+        raise TypeError( f"parallel must be a dict, not a {type(parallel)}" )
+    unknown = set( parallel.keys() ) - { 'nworkers', 'splitby', 'column' }
+    if len( unknown ) > 0:
+        raise ValueError( f"Unknown parallel options: {unknown}" )
+    nworkers = int( parallel['nworkers'] ) if 'nworkers' in parallel else _max_parallel_workers
+    if ( nworkers < 2 ) or ( nworkers > _max_parallel_workers ):
+        raise ValueError( f"parallel nworkers must be between 2 and {_max_parallel_workers}" )
+    splitby = parallel['splitby'] if 'splitby' in parallel else 'rootid'
+    if splitby == 'rootid':
+        column = parallel['column'] if 'column' in parallel else 'rootid'
+    elif splitby == 'q3c':
+        column = parallel['column'] if 'column' in parallel else 'q3c_ang2ipix(ra,dec)'
+    else:
+        raise ValueError( f"parallel splitby must be 'rootid' or 'q3c', not {splitby}" )
+    if '{FASTDB_PARTITION}' not in queries[-1]:
+        raise ValueError( "For a parallel query, the last query must include {FASTDB_PARTITION}" )
+    return { 'nworkers': nworkers, 'splitby': splitby, 'column': column }
+
+
+def _user_quota( dbcon, userid ):
+    rows, _ = dbcon.execute( "SELECT max_queued, max_priority, max_timeout, max_work_mem_mb "
+                             "FROM query_user_quota WHERE userid=%(id)s", { 'id': userid } )
+    quota = { 'max_queued': _default_max_queued,
+              'max_priority': _default_max_priority,
+              'max_timeout': _default_max_timeout,
+              'max_work_mem_mb': _default_max_work_mem_mb }
+    if len( rows ) > 0:
+        for key, val in zip( quota.keys(), rows[0] ):
+            if val is not None:
+                quota[key] = val
+    return quota
+
+
+def _query_limits( data, quota ):
+    priority = data['priority'] if 'priority' in data else 'normal'
+    if priority not in _query_priorities:
+        raise ValueError( f"priority must be one of {list(_query_priorities.keys())}" )
+    priority = _query_priorities[ priority ]
+    if priority > quota['max_priority']:
+        raise ValueError( f"You aren't allowed to submit queries with priority {data['priority']}" )
+    timeout = float( data['timeout'] ) if 'timeout' in data else min( _default_query_timeout,
+                                                                       quota['max_timeout'] )
+    if ( timeout <= 0 ) or ( timeout > quota['max_timeout'] ):
+        raise ValueError( f"timeout must be positive and at most {quota['max_timeout']} seconds" )
+    work_mem = int( data['work_mem'] ) if ( 'work_mem' in data ) and ( data['work_mem'] is not None ) else None
+    if ( work_mem is not None ) and ( ( work_mem <= 0 ) or ( work_mem > quota['max_work_mem_mb'] ) ):
+        raise ValueError( f"work_mem must be positive and at most {quota['max_work_mem_mb']} MB" )
+    return priority, timeout, work_mem
+
 
 class SubmitLongSQLQuery( BaseView ):
     def do_the_things( self ):
@@ -131,28 +613,7 @@ class SubmitLongSQLQuery( BaseView ):
 
         try:
             queries, subdicts, return_format = _extract_queries( data )
-
-            if return_format == 0:
-                return_format = 'csv'
-            if return_format not in [ 'csv', 'pandas', 'numpy' ]:
-                raise ValueError( f"Unknown format {return_format}" )
-
-            queryid = uuid.uuid4()
-            strio = io.StringIO()
-            strio.write( f"Queueing query {queryid} with {len(queries)} queries "
-                         f"for user {flask.session['useruuid']} ({flask.session['username']})\n" )
-            for q, s in zip( queries, subdicts ):
-                strio.write( f"  ====> query={q}   ;   subdict={s}\n" )
-            FDBLogger.debug( strio.getvalue() )
-
-            qq = db.QueryQueue( queryid = queryid,
-                                userid = asUUID( flask.session['useruuid'] ),
-                                submitted = datetime.datetime.now( tz=datetime.UTC ),
-                                queries = queries,
-                                subdicts = subdicts,
-                                format = return_format )
-            qq.insert()
-
+            queryid = self.submit( data, queries, subdicts, return_format )
             return { 'status': 'ok', 'queryid': str(queryid) }
 
         except Exception as ex:
@@ -160,39 +621,311 @@ class SubmitLongSQLQuery( BaseView ):
             return { 'status': 'error', 'error': str(ex) }
 
 
+    def submit( self, data, queries, subdicts, return_format ):
+        # Put the queries in query_queue (or use cached results); data has the other options.  Returns the queryid.
+        if return_format == 0:
+            return_format = 'csv'
+        if return_format not in [ 'csv', 'pandas', 'numpy' ]:
+            raise ValueError( f"Unknown format {return_format}" )
+        parallel = _parallel_options( data['parallel'], queries ) if 'parallel' in data else None
+        usecache = ( _long_query_cache and ( parallel is None )
+                     and ( 'usecache' in data ) and bool( data['usecache'] ) )
+
+        queryid = uuid.uuid4()
+        strio = io.StringIO()
+        strio.write( f"Queueing query {queryid} with {len(queries)} queries "
+                     f"for user {flask.session['useruuid']} ({flask.session['username']})\n" )
+        for q, s in zip( queries, subdicts ):
+            strio.write( f"  ====> query={q}   ;   subdict={s}\n" )
+        FDBLogger.debug( strio.getvalue() )
+
+        now = datetime.datetime.now( tz=datetime.UTC )
+        qq = db.QueryQueue( queryid = queryid,
+                            userid = asUUID( flask.session['useruuid'] ),
+                            submitted = now,
+                            queries = queries,
+                            subdicts = subdicts,
+                            format = return_format,
+                            parallel = parallel )
+
+        with db.DBCon() as dbcon:
+            quota = _user_quota( dbcon, qq.userid )
+            qq.priority, qq.timeout, qq.work_mem_mb = _query_limits( data, quota )
+            rows, _ = dbcon.execute( "SELECT COUNT(*) FROM query_queue "
+                                     "WHERE userid=%(id)s AND finished IS NULL AND NOT COALESCE(error, false)",
+                                     { 'id': qq.userid } )
+            if rows[0][0] >= quota['max_queued']:
+                raise RuntimeError( f"You already have {rows[0][0]} long queries queued or running, "
+                                    f"which is your limit" )
+
+            if usecache:
+                rows, _ = dbcon.execute( "SELECT MAX(t) FROM diasource_import_time" )
+                qq.cachekey = _long_query_cache_key( queries, subdicts, return_format, rows[0][0] )
+                self.use_cached_results( dbcon, qq, now )
+            qq.insert( dbcon=dbcon, nocommit=True, refresh=False )
+            dbcon.commit()
+
+        return queryid
+
+
+    def use_cached_results( self, dbcon, qq, now ):
+        # If there are cached results for qq.cachekey, or an identical query in progress,
+        #   set up qq to use them.
+        rows, _ = dbcon.execute( "UPDATE query_result_cache SET hits=hits+1, last_hit=NOW() "
+                                 "WHERE cachekey=%(key)s "
+                                 "RETURNING queryid, result_size, result_sha256",
+                                 { 'key': qq.cachekey } )
+        if len( rows ) > 0:
+            try:
+                os.link( _query_results_dir / "cache" / qq.cachekey, _query_results_dir / str(qq.queryid) )
+            except FileNotFoundError:
+                # The query runner must have evicted it since we looked
+                FDBLogger.warning( f"Cache file for {qq.cachekey} is missing" )
+                dbcon.rollback()
+            else:
+                FDBLogger.info( f"Query {qq.queryid} is answered by the cached results of query {rows[0][0]}" )
+                qq.cached_from = rows[0][0]
+                qq.cache_hit = True
+                qq.started = now
+                qq.finished = now
+                qq.result_size = rows[0][1]
+                qq.result_sha256 = rows[0][2]
+                return
+
+        # Locking the query in progress means that the query runner can't mark it finished
+        #   (and go looking for queries waiting for it) until we've committed.
+        # Only wait for a query that's being run with at least our priority and
+        #   timeout, so that waiting doesn't make us any slower to start or any
+        #   more likely to time out than running the query ourselves.
+        rows, _ = dbcon.execute( "SELECT queryid FROM query_queue "
+                                 "WHERE cachekey=%(key)s AND cached_from IS NULL "
+                                 "  AND finished IS NULL AND NOT error "
+                                 "  AND priority>=%(pri)s AND timeout>=%(timeout)s "
+                                 "ORDER BY submitted LIMIT 1 FOR UPDATE",
+                                 { 'key': qq.cachekey, 'pri': qq.priority, 'timeout': qq.timeout } )
+        if len( rows ) > 0:
+            FDBLogger.info( f"Query {qq.queryid} will wait for the results of identical query {rows[0][0]}" )
+            qq.cached_from = rows[0][0]
+            qq.cache_hit = True
+
+
 # ======================================================================
 # Check status of long running SQL query
+#
+# Once the query has started, the response includes 'progress', a dict
+#   with:
+#     rows : rows fetched so far (for a parallel query, the total of all the parts)
+#     bytes : bytes of results written so far
+#     estimated_rows : the database's guess at how many rows the query
+#                      will return (None if it couldn't guess); it can be
+#                      way off
+#     fraction : rows / estimated_rows, at most 1 (None if there's no estimate)
+#     updated : when rows and bytes were last updated (None if they haven't been)
+#   The query runner updates these every so often, not continuously.
+
+def _query_progress( qq ):
+    rows = qq.progress_rows if qq.progress_rows is not None else 0
+    fraction = None
+    if ( qq.estimated_rows is not None ) and ( qq.estimated_rows > 0 ):
+        fraction = min( rows / qq.estimated_rows, 1. )
+    return { 'rows': rows,
+             'bytes': qq.progress_bytes if qq.progress_bytes is not None else 0,
+             'estimated_rows': qq.estimated_rows,
+             'fraction': fraction,
+             'updated': None if qq.progress_updated is None else qq.progress_updated.isoformat() }
+
+
+def _long_query_status( queryid ):
+    qq = db.QueryQueue.get( queryid )
+    if qq is None:
+        raise ValueError( f"Unknown query {queryid}" )
+
+    response = { 'queryid': queryid,
+                 'queries': qq.queries,
+                 'subdicts': qq.subdicts,
+                 'submitted': qq.submitted.isoformat(),
+                 'cached': qq.cache_hit,
+                 'parallel': qq.parallel,
+                 'priority': { v: k for k, v in _query_priorities.items() }[ qq.priority ],
+                 'cancelled': qq.cancelled is not None }
+    if qq.error:
+        response.update( { 'status': 'error',
+                           'error': qq.errortext } )
+        if qq.finished is not None:
+            response['finished'] = qq.finished.isoformat()
+        if qq.started is not None:
+            response['started'] = qq.started.isoformat()
+
+    elif qq.finished is not None:
+        response.update( { 'status': 'finished',
+                           'started': qq.started.isoformat(),
+                           'finished': qq.finished.isoformat(),
+                           'result_size': qq.result_size,
+                           'result_sha256': qq.result_sha256 } )
+
+    elif qq.started is not None:
+        response.update( { 'status': 'started',
+                           'started': qq.started.isoformat() } )
+
+    else:
+        response.update( { 'status': 'queued' } )
+
+    if qq.started is not None:
+        response['progress'] = _query_progress( qq )
+
+    return response
+
 
 class CheckLongSQLQuery( BaseView ):
     def do_the_things( self, queryid ):
         try:
-            qq = db.QueryQueue.get( queryid )
-            if qq is None:
-                raise ValueError( f"Unknown query {queryid}" )
+            return _long_query_status( queryid )
 
-            response = { 'queryid': queryid,
-                         'queries': qq.queries,
-                         'subdicts': qq.subdicts,
-                         'submitted': qq.submitted.isoformat() }
-            if qq.error:
-                response.update( { 'status': 'error',
-                                   'error': qq.errortext } )
-                if qq.finished is not None:
-                    response['finished'] == qq.finished.isoformat()
-                if qq.started is not None:
-                    response['started'] = qq.started.isoformat()
-
-            elif qq.finished is not None:
-                response.update( { 'status': 'finished',
-                                   'started': qq.started.isoformat(),
-                                   'finished': qq.finished.isoformat() } )
-
-            elif qq.started is not None:
-                response.update( { 'status': 'started',
-                                   'started': qq.started.isoformat() } )
+        except Exception as ex:
+            FDBLogger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
+
+
+# ======================================================================
+# Wait for a long SQL query to change state
+#
+# POST body is an optional JSON dict with:
+#    timeout : float, default _wait_default_timeout ; wait at most this
+#                many seconds (and never more than _wait_max_timeout)
+#    status : str ; the status the client last saw.  If not given, the
+#                query's status when the request comes in.
+#
+# Returns as soon as the query's status is different from status, or
+#   is 'finished' or 'error', or after timeout seconds, whichever comes
+#   first.  Returns the same thing as checksqlquery (plus 'busy': True
+#   if the server didn't wait because too many requests are waiting
+#   already; see below).
+#
+# A trigger on query_queue (see db/2026-10-19_011_query_queue_notify.sql)
+#   sends a notification on channel query_queue_state (with the queryid
+#   as the payload) whenever a query starts, finishes, or errors out.
+#   Each webserver process has one QueryStateListener, with one database
+#   connection LISTENing for these, which wakes up the waiting requests.
+#   In case a notification is missed (e.g. while the listener is
+#   reconnecting), waiting requests also recheck the database every
+#   _wait_poll seconds.
+#
+# A waiting request ties up a webserver thread (or worker, if it isn't
+#   threaded) the whole time.  So that waits can't take over the server
+#   (the dev webserver image runs gunicorn with one worker and 10
+#   threads), at most _wait_max_waiters requests per process wait at
+#   once.  Past that, the request returns right away, with 'busy': True
+#   added to the response, and the client should fall back to checking
+#   the status every so often.  (With gunicorn's gevent worker class,
+#   waiting requests are cheap, and _wait_max_waiters can be much
+#   larger.)
+
+_wait_default_timeout = 30.
+_wait_max_timeout = 60.
+_wait_poll = 10.
+_wait_max_waiters = 4
+
+
+class QueryStateListener:
+    """Listen for query_queue_state notifications, and wake up whoever's waiting for that query.
+
+    Use with
+
+        with QueryStateListener.instance().waiter( queryid ) as event:
+            ...
+
+    event (a threading.Event) is set when a notification for queryid
+    comes in.  If there are already _wait_max_waiters waiters in this
+    process, event is None.
+
+    """
 
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance( cls ):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        # queryid (str) -> set of threading.Event
+        self._waiters = {}
+        self._nwaiters = 0
+        self._thread = threading.Thread( target=self._listen, name='query_state_listener', daemon=True )
+        self._thread.start()
+
+
+    def _listen( self ):
+        while True:
+            try:
+                with psycopg.connect( dbname=db.dbname, host=db.dbhost, port=db.dbport,
+                                      user=db.dbuser, password=db.dbpasswd, autocommit=True ) as conn:
+                    conn.execute( "LISTEN query_queue_state" )
+                    FDBLogger.debug( "Listening for query_queue_state notifications" )
+                    for notify in conn.notifies():
+                        self._wake( notify.payload )
+            except Exception as ex:
+                FDBLogger.warning( f"Lost query_queue_state listener connection ({ex}), reconnecting" )
+                time.sleep( 5 )
+
+
+    def _wake( self, queryid ):
+        with self._lock:
+            for event in self._waiters.get( queryid, () ):
+                event.set()
+
+
+    @contextmanager
+    def waiter( self, queryid ):
+        event = threading.Event()
+        with self._lock:
+            if self._nwaiters >= _wait_max_waiters:
+                event = None
             else:
-                response.update( { 'status': 'queued' } )
+                self._nwaiters += 1
+                self._waiters.setdefault( queryid, set() ).add( event )
+        if event is None:
+            yield None
+            return
+        try:
+            yield event
+        finally:
+            with self._lock:
+                self._nwaiters -= 1
+                self._waiters[queryid].discard( event )
+                if len( self._waiters[queryid] ) == 0:
+                    del self._waiters[queryid]
+
+
+class WaitLongSQLQuery( BaseView ):
+    def do_the_things( self, queryid ):
+        try:
+            data = flask.request.json if flask.request.is_json else {}
+            timeout = float( data['timeout'] ) if 'timeout' in data else _wait_default_timeout
+            timeout = max( 0., min( timeout, _wait_max_timeout ) )
+            laststatus = data['status'] if 'status' in data else None
+            deadline = time.monotonic() + timeout
+
+            # Start listening before looking at the status, so a change right after we look isn't missed
+            with QueryStateListener.instance().waiter( str( asUUID( queryid ) ) ) as event:
+                response = _long_query_status( queryid )
+                if event is None:
+                    FDBLogger.debug( f"Too many requests waiting, not waiting for query {queryid}" )
+                    return { **response, 'busy': True }
+                if laststatus is None:
+                    laststatus = response['status']
+                while ( response['status'] == laststatus ) and ( laststatus not in ( 'finished', 'error' ) ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    event.wait( min( remaining, _wait_poll ) )
+                    event.clear()
+                    response = _long_query_status( queryid )
 
             return response
 
@@ -201,12 +934,111 @@ class CheckLongSQLQuery( BaseView ):
             return { 'status': 'error', 'error': str(ex) }
 
 
+# ======================================================================
+# Cancel a long SQL query
+#
+# No POST body.  Only the user who submitted the query (or an admin)
+#   can cancel it.  The query is marked as errored right away, so a
+#   queued query will never be run.  If it's running, the query runner's
+#   database backends are sent pg_cancel_backend.  (The runner won't
+#   mark a cancelled query finished even if it's already past its
+#   database queries.)  Queries that were waiting for the results of
+#   this one (see SubmitLongSQLQuery) go back into the queue to be run
+#   on their own.
+#
+# Returns { 'status': 'ok', 'queryid': str, 'was': 'queued' or 'running' }
+
+class CancelLongSQLQuery( BaseView ):
+    def do_the_things( self, queryid ):
+        try:
+            with db.DBCon() as dbcon:
+                rows, _ = dbcon.execute( "SELECT userid, started, finished, error FROM query_queue "
+                                         "WHERE queryid=%(id)s FOR UPDATE", { 'id': queryid } )
+                if len( rows ) == 0:
+                    raise ValueError( f"Unknown query {queryid}" )
+                userid, started, finished, error = rows[0]
+                if ( userid != self.user.id ) and ( not self.user.isadmin ):
+                    raise RuntimeError( f"Query {queryid} isn't yours to cancel" )
+                if finished is not None:
+                    raise RuntimeError( f"Query {queryid} has already finished" )
+                if error:
+                    raise RuntimeError( f"Query {queryid} has already errored out" )
+
+                rows, _ = dbcon.execute( "UPDATE query_queue SET cancelled=NOW(), error=TRUE, errortext=%(txt)s "
+                                         "WHERE queryid=%(id)s RETURNING backend_pids",
+                                         { 'id': queryid, 'txt': f"Cancelled by {self.user.username}" } )
+                pids = rows[0][0]
+                dbcon.execute_nofetch( "UPDATE query_queue SET cached_from=NULL, cache_hit=FALSE "
+                                       "WHERE cached_from=%(id)s AND finished IS NULL AND NOT COALESCE(error, false)",
+                                       { 'id': queryid } )
+                dbcon.commit()
+
+                # Do this after committing so that if the runner is just starting
+                #   a backend, it either sees that the query was cancelled or
+                #   has already recorded the pid that we cancel here.
+                if ( pids is not None ) and ( len( pids ) > 0 ):
+                    rows, _ = dbcon.execute( "SELECT pid, pg_cancel_backend(pid) FROM pg_stat_activity "
+                                             "WHERE pid=ANY(%(pids)s) AND usename='postgres_ro'",
+                                             { 'pids': pids } )
+                    dbcon.commit()
+                    FDBLogger.info( f"Cancelled backends {[ r[0] for r in rows if r[1] ]} of query {queryid}" )
+
+            return { 'status': 'ok', 'queryid': queryid, 'was': 'queued' if started is None else 'running' }
+
+        except Exception as ex:
+            FDBLogger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
+
+
 # ======================================================================
 # Get results of long SQL query
+#
+# POST body is an optional JSON dict with:
+#    compress : bool, default False ; gzip the response on the fly
+#                (sent with Content-Encoding: gzip, so most HTTP clients
+#                will uncompress it transparently).  Ignored for Range
+#                requests.
+#
+# The result file is streamed rather than read into memory.  Send a
+#   Range header (a single range of bytes) to get just part of it, e.g. to
+#   resume an interrupted download.  If the query runner recorded the
+#   file's checksum, it's in the X-FASTDB-SHA256 header (and the ETag),
+#   and the result of checksqlquery.
+#
+# For a parallel query, getsqlqueryresults/<queryid> returns the JSON
+#   manifest, and getsqlqueryresults/<queryid>/<part> returns part
+#   number <part> (whose size and checksum are in the manifest).
+
+_result_chunk_size = 1024 * 1024
+
+
+def _file_chunks( path, start, stop ):
+    with open( path, "rb" ) as ifp:
+        ifp.seek( start )
+        remaining = stop - start
+        while remaining > 0:
+            data = ifp.read( min( _result_chunk_size, remaining ) )
+            if len( data ) == 0:
+                break
+            remaining -= len( data )
+            yield data
+
+
+def _gzip_chunks( chunks ):
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+    for data in chunks:
+        compressed = compressor.compress( data )
+        if len( compressed ) > 0:
+            yield compressed
+    yield compressor.flush()
+
 
 class GetLongSQLQueryResults( BaseView ):
-    def do_the_things( self, queryid ):
+    def do_the_things( self, queryid, part=None ):
         try:
+            data = flask.request.json if flask.request.is_json else {}
+            compress = bool( data.get( 'compress', False ) )
+
             qq = db.QueryQueue.get( queryid )
             if qq is None:
                 raise ValueError( f"Unknown query {queryid}" )
@@ -219,14 +1051,54 @@ class GetLongSQLQueryResults( BaseView ):
                     raise RuntimeError( f"Query {queryid} hasn't finished yet" )
 
             if ( qq.format == "numpy" ) or ( qq.format == "pandas" ):
-                with open( f"/query_results/{str(qq.queryid)}", "rb" ) as ifp:
-                    return ifp.read()
+                ctype = 'application/octet-stream'
             elif qq.format == "csv":
-                with open( f"/query_results/{str(qq.queryid)}", "r" ) as ifp:
-                    return ifp.read(), 200, { 'Content-Type': 'text/csv; charset=utf-8' }
+                ctype = 'text/csv; charset=utf-8'
             else:
                 raise ValueError( f"Query {queryid} is finished, but results are in an unknown format {qq.format}" )
 
+            path = _query_results_dir / str(qq.queryid)
+            sha256 = qq.result_sha256
+            if qq.parallel is not None:
+                if part is None:
+                    ctype = 'application/json'
+                else:
+                    with open( path ) as ifp:
+                        manifest = json.load( ifp )
+                    part = int( part )
+                    if ( part < 0 ) or ( part >= len( manifest['parts'] ) ):
+                        raise ValueError( f"Query {queryid} has {len(manifest['parts'])} parts, not part {part}" )
+                    path = _query_results_dir / manifest['parts'][part]['file']
+                    sha256 = manifest['parts'][part]['sha256']
+            elif part is not None:
+                raise ValueError( f"Query {queryid} isn't a parallel query, it has no parts" )
+
+            size = os.stat( path ).st_size
+            headers = { 'Content-Type': ctype, 'Accept-Ranges': 'bytes' }
+            if sha256 is not None:
+                headers['X-FASTDB-SHA256'] = sha256
+                headers['ETag'] = f'"{sha256}"'
+
+            status = 200
+            start, stop = 0, size
+            if flask.request.range is not None:
+                byterange = flask.request.range.range_for_length( size )
+                if byterange is None:
+                    return "Requested range not satisfiable", 416, { 'Content-Range': f'bytes */{size}' }
+                start, stop = byterange
+                status = 206
+                headers['Content-Range'] = flask.request.range.to_content_range_header( size )
+
+            chunks = _file_chunks( path, start, stop )
+            if compress and ( status == 200 ):
+                chunks = _gzip_chunks( chunks )
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                headers['Content-Length'] = str( stop - start )
+
+            FDBLogger.debug( f"Sending bytes {start}-{stop} of {size} of the results of query {queryid}" )
+            return chunks, status, headers
+
         except Exception as ex:
             FDBLogger.exception( ex )
             raise
@@ -242,7 +1114,10 @@ urls = {
     "runsqlquery": RunSQLQuery,
     "submitsqlquery": SubmitLongSQLQuery,
     "checksqlquery/<queryid>": CheckLongSQLQuery,
+    "waitsqlquery/<queryid>": WaitLongSQLQuery,
+    "cancelsqlquery/<queryid>": CancelLongSQLQuery,
     "getsqlqueryresults/<queryid>": GetLongSQLQueryResults,
+    "getsqlqueryresults/<queryid>/<part>": GetLongSQLQueryResults,
 }
 
 usedurls = {}
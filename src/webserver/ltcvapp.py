@@ -1,3 +1,5 @@
+import json
+import hashlib
 import textwrap
 
 from psycopg import sql
@@ -95,6 +97,57 @@ class GetManyLtcvs( BaseView ):
 
 
 
+# ======================================================================
+# /getchangedltcvs
+# /getchangedltcvs/<procver>
+#
+# POST body must be json, must include objids.  May include etags, a
+#   dict of { rootid: etag } for lightcurves the client already has, and
+#   anything getmanyltcvs takes except return_object_info.
+#
+# Returns { 'status': 'ok', 'watermark': str or None, 'etags': { rootid: etag }, 'ltcvs': [ ... ] }
+#   etags has the current etag of every lightcurve found; ltcvs (the
+#   same as from getmanyltcvs) only has the lightcurves whose etag isn't
+#   the one the client sent.  An etag is a hash of the lightcurve, so it
+#   changes if and only if the lightcurve does.  watermark is the same
+#   as from /importwatermark, read before the lightcurves were, so
+#   lightcurves are at least as new as it.
+
+class GetChangedLtcvs( GetManyLtcvs ):
+    @staticmethod
+    def etag( lc ):
+        return hashlib.sha256( json.dumps( lc, sort_keys=True, default=str ).encode( 'utf-8' ) ).hexdigest()[:32]
+
+
+    def do_the_things( self, procver='default' ):
+        if ( not flask.request.is_json ) or ( 'objids' not in flask.request.json ):
+            raise FASTDBWebException( "Must pass POST data as a json dict with at least objids as a key" )
+        objids = flask.request.json['objids']
+        del flask.request.json['objids']
+        known = {}
+        if 'etags' in flask.request.json:
+            known = flask.request.json['etags']
+            del flask.request.json['etags']
+            if not isinstance( known, dict ):
+                raise FASTDBWebException( "etags must be a dict of rootid: etag" )
+        if flask.request.json.get( 'return_object_info' ):
+            raise FASTDBWebException( "getchangedltcvs doesn't do return_object_info" )
+
+        watermark = ltcv.import_watermark()
+        etags = {}
+        changed = []
+        for lc in self.get_ltcvs( procver, objids ):
+            rootid = str( lc['rootid'] )
+            etags[rootid] = self.etag( lc )
+            if known.get( rootid ) != etags[rootid]:
+                changed.append( lc )
+
+        return { 'status': 'ok',
+                 'watermark': None if watermark is None else watermark.isoformat(),
+                 'etags': etags,
+                 'ltcvs': changed }
+
+
 # ======================================================================
 # /ltcv/getltcv
 
@@ -127,28 +180,27 @@ class GetLtcv( GetManyLtcvs ):
 
 class GetRandomLtcv( GetLtcv ):
     def do_the_things( self, procver="default" ):
-        with db.DBCon() as dbcon:
-            pv = db.ProcessingVersion.procver_id( procver, dbcon=dbcon  )
+        rootids = ltcv.random_rootids( procver, n=1 )
+        if len( rootids ) == 0:
+            raise FASTDBWebException( f"No objects found in processing version {procver}" )
+        return super().do_the_things( procver, str( rootids[0] ) )
 
-            q = sql.SQL(
-                """
-                SELECT diaobjectid
-                FROM (
-                  SELECT DISTINCT ON (o.diaobjectid) o.diaobjectid
-                  FROM diaobject o
-                  INNER JOIN base_procver_of_procver pv ON o.base_procver_id=pv.base_procver_id
-                                                       AND pv.procver_id={procver}
-                  ORDER BY o.diaobjectid, pv.priority DESC
-                ) subq
-                ORDER BY random() LIMIT 1
-                """
-            ).format( procver=pv )
-            rows, _cols = dbcon.execute( q )
 
-            mess = self.get_ltcvs( pv, [ rows[0][0] ], dbcon=dbcon )
+# ======================================================================
+# /ltcv/getrandomobjects
+# /ltcv/getrandomobjects/<procver>
+# /ltcv/getrandomobjects/<procver>/<n>
 
-        key0 = list( mess.keys() )[0]
-        return mess[ key0 ]
+class GetRandomObjects( BaseView ):
+    def do_the_things( self, procver="default", n=1 ):
+        try:
+            n = int( n )
+        except ValueError:
+            raise FASTDBWebException( f"n must be an integer, not {n}" )
+        if ( n < 1 ) or ( n > 10000 ):
+            raise FASTDBWebException( f"n must be between 1 and 10000, not {n}" )
+        rootids = ltcv.random_rootids( procver, n=n )
+        return { 'status': 'ok', 'rootids': [ str(r) for r in rootids ] }
 
 
 # ======================================================================
@@ -342,10 +394,15 @@ bp = flask.Blueprint( 'ltcvapp', __name__, url_prefix='/ltcv' )
 urls = {
     "/getmanyltcvs": GetManyLtcvs,
     "/getmanyltcvs/<procver>": GetManyLtcvs,
+    "/getchangedltcvs": GetChangedLtcvs,
+    "/getchangedltcvs/<procver>": GetChangedLtcvs,
     "/getltcv/<procver>": GetLtcv,             # <procver> is really <objid> in this case
     "/getltcv/<procver>/<objid>": GetLtcv,
     "/getrandomltcv": GetRandomLtcv,
     "/getrandomltcv/<procver>": GetRandomLtcv,
+    "/getrandomobjects": GetRandomObjects,
+    "/getrandomobjects/<procver>": GetRandomObjects,
+    "/getrandomobjects/<procver>/<n>": GetRandomObjects,
     "/gethottransients": GetHotTransients,
     "/gethottransients/<procver>": GetHotTransients,
     "/getbrokerinfo": GetBrokerInfo,
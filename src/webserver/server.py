@@ -1,5 +1,4 @@
 import logging
-import textwrap
 
 from psycopg import sql
 import flask
@@ -10,6 +9,7 @@ import ltcv
 from util import FDBLogger
 import webserver.rkauth_flask as rkauth_flask
 import webserver.dbapp as dbapp
+import webserver.adminapp as adminapp
 import webserver.ltcvapp as ltcvapp
 import webserver.spectrumapp as spectrumapp
 from webserver.baseview import BaseView, FASTDBWebException
@@ -36,8 +36,8 @@ class GetProcVers( BaseView ):
         # global app
 
         with db.DBCon() as con:
-            pvrows, _ = con.execute( "SELECT description FROM processing_version" )
-            alrows, _ = con.execute( "SELECT description FROM processing_version_alias" )
+            ( ( pvrows, _ ), ( alrows, _ ) ) = con.execute_batch( [ "SELECT description FROM processing_version",
+                                                                  "SELECT description FROM processing_version_alias" ] )
 
         rows = [ r[0] for r in ( pvrows + alrows ) ]
         rows.sort()
@@ -49,6 +49,20 @@ class GetProcVers( BaseView ):
                 }
 
 
+# ======================================================================
+# /importwatermark
+#
+# Returns { 'status': 'ok', 'watermark': str or None }, the time (ISO
+#   format) of the latest source import; see ltcv.import_watermark.
+#   Clients use this to tell whether things they got earlier might have
+#   changed.
+
+class ImportWatermark( BaseView ):
+    def do_the_things( self ):
+        watermark = ltcv.import_watermark()
+        return { 'status': 'ok', 'watermark': None if watermark is None else watermark.isoformat() }
+
+
 # ======================================================================
 
 class ProcVer( BaseView ):
@@ -57,30 +71,29 @@ class ProcVer( BaseView ):
         # app.logger.debug( f"In ProcVer with procver={procver}" )
 
         with db.DBCon() as con:
-            pvid = db.ProcessingVersion.procver_id( procver, dbcon=con )
-            if pvid is None:
+            try:
+                pv = db.ProcessingVersion.get_procver( procver, dbcon=con )
+            except ValueError:
                 return f"Unknown processing version {procver}", 422
 
-            retval = { 'status': 'ok', 'id': None, 'description': None, 'aliases': [], 'base_procvers': [] }
-            row, _ = con.execute( "SELECT id,description FROM processing_version WHERE id=%(pv)s", { 'pv': pvid } )
-            retval['id'] = row[0][0]
-            retval['description'] = row[0][1]
-
-            rows, _ = con.execute( "SELECT description FROM processing_version_alias WHERE procver_id=%(pv)s",
-                                   { 'pv': pvid } )
-            retval['aliases'] = [ r[0] for r in rows ]
-
-            rows, _ = con.execute( "SELECT _table, ARRAY_AGG(description), ARRAY_AGG(priority)\n"
-                                   "FROM (\n"
-                                   "  SELECT b.description,b._table,j.priority\n"
-                                   "  FROM base_processing_version b\n"
-                                   "  INNER JOIN base_procver_of_procver j ON b.id=j.base_procver_id\n"
-                                   "  WHERE j.procver_id=%(pv)s\n"
-                                   "  ORDER BY b._table,j.priority DESC\n"
-                                   ") subq\n"
-                                   "GROUP BY _table",
-                                   { 'pv': pvid } )
-            retval['base_procvers'] = { r[0]: [ [ d, p ] for d, p in zip(r[1], r[2]) ] for r in rows }
+            retval = { 'status': 'ok', 'id': pv.id, 'description': pv.description,
+                       'aliases': [], 'base_procvers': [] }
+
+            # The aliases and base processing versions are independent, so get them in one round trip
+            ( ( aliasrows, _ ), ( bpvrows, _ ) ) = con.execute_batch(
+                [ ( "SELECT description FROM processing_version_alias WHERE procver_id=%(pv)s", { 'pv': pv.id } ),
+                  ( "SELECT _table, ARRAY_AGG(description), ARRAY_AGG(priority)\n"
+                    "FROM (\n"
+                    "  SELECT b.description,b._table,j.priority\n"
+                    "  FROM base_processing_version b\n"
+                    "  INNER JOIN base_procver_of_procver j ON b.id=j.base_procver_id\n"
+                    "  WHERE j.procver_id=%(pv)s\n"
+                    "  ORDER BY b._table,j.priority DESC\n"
+                    ") subq\n"
+                    "GROUP BY _table",
+                    { 'pv': pv.id } ) ] )
+            retval['aliases'] = [ r[0] for r in aliasrows ]
+            retval['base_procvers'] = { r[0]: [ [ d, p ] for d, p in zip(r[1], r[2]) ] for r in bpvrows }
 
             return retval
 
@@ -91,12 +104,18 @@ class BaseProcVer( BaseView ):
     def do_the_things( self, procver, table=None ):
         with db.DBCon() as con:
             try:
-                pvid = db.BaseProcessingVersion.base_procver_id( procver, table )
+                pvid = db.BaseProcessingVersion.base_procver_id( procver, table, dbcon=con )
             except Exception as ex:
                 raise FASTDBWebException( str(ex) )
 
-            row, _ = con.execute( "SELECT id,description,_table FROM base_processing_version WHERE id=%(pv)s",
-                                  { 'pv': pvid } )
+            # These are independent, so get them in one round trip
+            ( ( row, _ ), ( rows, _ ) ) = con.execute_batch(
+                [ ( "SELECT id,description,_table FROM base_processing_version WHERE id=%(pv)s", { 'pv': pvid } ),
+                  ( "SELECT description FROM processing_version p "
+                    "INNER JOIN base_procver_of_procver j ON p.id=j.procver_id "
+                    "WHERE j.base_procver_id=%(pv)s "
+                    "ORDER BY p.description",
+                    { 'pv': pvid } ) ] )
             if len(row) == 0:
                 return f"Unknown base processing version {procver}", 422
 
@@ -105,11 +124,6 @@ class BaseProcVer( BaseView ):
                        'description': row[0][1],
                        'table': row[0][2]
                       }
-            rows, _ = con.execute( "SELECT description FROM processing_version p "
-                                   "INNER JOIN base_procver_of_procver j ON p.id=j.procver_id "
-                                   "WHERE j.base_procver_id=%(pv)s "
-                                   "ORDER BY p.description",
-                                   { 'pv': pvid } )
             retval['procvers'] = [ r[0] for r in rows ]
 
             return retval
@@ -136,70 +150,62 @@ class CountThings( BaseView ):
             return f"Unknown thing to count: {which}", 422
 
         estimate = False
+        exact = False
         if flask.request.is_json:
             data = flask.request.json
             estimate = ( 'estimate' in data ) and ( data['estimate'] )
+            exact = ( 'exact' in data ) and ( data['exact'] )
 
         with db.DBCon() as dbcon:
             pvid = db.ProcessingVersion.procver_id( procver )
 
-            if thingtocount in ( 'rootid', 'diaobject' ):
-                distinct = 'diaobjectid' if thingtocount=='diaobject' else 'rootid'
-                indexes = [ 'o idx_diaobject_procver' ]
-                baseq = sql.SQL( textwrap.dedent(
-                    """\
-                    SELECT DISTINCT ON({distinct}) {distinct} FROM diaobject o
-                    INNER JOIN base_procver_of_procver pv ON o.base_procver_id=pv.base_procver_id
-                                                         AND pv.procver_id={pvid}
-                    ORDER BY {distinct}, pv.priority DESC
-                    """
-                ) ).format( distinct=sql.Identifier("o", distinct), pvid=pvid )
-            else:
-                indexes = [ f's idx_{thingtocount}_base_procver_id', f'o idx_{thingtocount}_diaobjectid' ]
-                baseq = sql.SQL( textwrap.dedent(
-                    """\
-                    SELECT DISTINCT ON(o.rootid, s.visit) {idfield} FROM {table} s
-                    INNER JOIN base_procver_of_procver pv ON s.base_procver_id=pv.base_procver_id
-                                                         AND pv.procver_id={pvid}
-                    INNER JOIN diaobject o ON o.diaobjectid=s.diaobjectid
-                    ORDER BY o.rootid, s.visit, pv.priority DESC
-                    """
-                ) ).format( table=sql.Identifier(thingtocount),
-                            idfield=sql.Identifier("s", f"{thingtocount}id" ),
-                            pvid=pvid )
-
-            if estimate:
+            # Normally, just read the count out of the row_counts table.  That's
+            #   kept up to date by the importers and loaders, and fixed up by
+            #   services/row_count_reconciler.py.
+            if not exact:
+                cached = db.RowCount.get_count( pvid, thingtocount, dbcon=dbcon )
+                if cached is not None:
+                    return { 'status': 'ok',
+                             'table': thingtocount,
+                             'isestimate': False,
+                             'count': cached['nrows'],
+                             'updated_at': cached['updated_at'].isoformat(),
+                             'reconciled_at': ( None if cached['reconciled_at'] is None
+                                                else cached['reconciled_at'].isoformat() ) }
+
+            if estimate and not exact:
                 # THIS DOES A REALLY TERRIBLE JOB.
                 # cf: https://wiki.postgresql.org/wiki/Count_estimate
                 # TODO : figure out how accurate this count estimate really is.  I have
                 #    a suspicion that it's not very good when there are multiple
                 #    different processing versions.
                 FDBLogger.debug( f"Getting estimate of count of {which} for {pvid}" )
+                baseq, _indexes = db.RowCount.distinct_query( thingtocount, pvid )
                 q = sql.SQL( "EXPLAIN (FORMAT JSON) {baseq}" ).format( baseq=baseq )
                 rows, _  = dbcon.execute( q, explain=False )
                 FDBLogger.debug( f"rows is {rows}" )
                 count = rows[0][0][0]['Plan']['Plan Rows']
-
-            else:
-                # Gah.  I'm thrashing about a lot with these query
-                #   optimization thingies that I'm doing.  After bumping
-                #   the memory postgres had for buffers, the queries got
-                #   *slower*, for reasons I don't understand.  One thing
-                #   it did was assign fewer workers; the postgres query
-                #   optimizer is so strange.  So, I'm forcing parallel
-                #   workers, to make it faster.  For this count query,
-                #   this is probably not going to be a problem, but it
-                #   is of course scary.
-                q = sql.SQL( "/*+ " )
-                q += sql.SQL(" ").join( sql.SQL( f"IndexScan({i})" ) for i in indexes )
-                q += sql.SQL( " Parallel(t 4) */\n" )
-                q += sql.SQL( "SELECT COUNT(*) FROM (\n{baseq}\n) subq" ).format( baseq=baseq )
-                rows, _ = dbcon.execute( q )
-                count = rows[0][0]
+                return { 'status': 'ok',
+                         'table': thingtocount,
+                         'isestimate': True,
+                         'count': count }
+
+            # Gah.  I'm thrashing about a lot with these query
+            #   optimization thingies that I'm doing.  After bumping
+            #   the memory postgres had for buffers, the queries got
+            #   *slower*, for reasons I don't understand.  One thing
+            #   it did was assign fewer workers; the postgres query
+            #   optimizer is so strange.  So, I'm forcing parallel
+            #   workers, to make it faster (see db.RowCount.count_query).
+            #   For this count query, this is probably not going to be a
+            #   problem, but it is of course scary.
+            # Doing the exact count also stores it in row_counts, so next
+            #   time we don't have to.
+            count, _drift = db.RowCount.reconcile( pvid, thingtocount, dbcon=dbcon )
 
             return { 'status': 'ok',
                      'table': thingtocount,
-                     'isestimate': estimate,
+                     'isestimate': False,
                      'count': count }
 
 
@@ -243,10 +249,17 @@ class ObjectSearch( BaseView ):
 
         FDBLogger.debug( f"ObjectSearch on processing version {processing_version} with search data {searchdata}" )
         try:
-            return ltcv.object_search( processing_version, **searchdata )
+            with db.DBCon() as dbcon:
+                results = ltcv.object_search( processing_version, dbcon=dbcon, **searchdata )
+                refreshed_at = ltcv.objstats_refreshed_at( processing_version, dbcon=dbcon )
         except Exception as ex:
             raise FASTDBWebException( str(ex) )
 
+        # Let the client know how stale the objstats views are
+        self.response_headers['X-FASTDB-Objstats-Refreshed-At'] = ( '' if refreshed_at is None
+                                                                    else refreshed_at.isoformat() )
+        return results
+
 
 # **********************************************************************
 # **********************************************************************
@@ -293,11 +306,13 @@ app.register_blueprint( rkauth_flask.bp )
 app.register_blueprint( dbapp.bp )
 app.register_blueprint( ltcvapp.bp )
 app.register_blueprint( spectrumapp.bp )
+app.register_blueprint( adminapp.bp )
 
 
 urls = {
     "/": MainPage,
     "/getprocvers": GetProcVers,
+    "/importwatermark": ImportWatermark,
     "/procver/<procver>": ProcVer,
     "/baseprocver/<procver>": BaseProcVer,
     "/baseprocver/<procver>/<table>": BaseProcVer,
@@ -0,0 +1,80 @@
+"""Benchmark fetching a big float-heavy query: DBCon.execute vs. DBCon.execute_columnar.
+
+Run this from a shell container in the test environment (where
+/fastdb is on PYTHONPATH and the database is up), e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_columnar.py -n 1000000
+
+It runs a query that generates n rows, each with a bigint and several
+double precision columns (so no tables are needed), and fetches it
+with execute() (then building numpy columns from the rows, which is
+what you have to do to get something comparable) and with
+execute_columnar().  It prints the time and the throughput in MB/s,
+where MB is the size of the numpy columns you end up with.
+
+"""
+
+import sys
+import time
+import logging
+import argparse
+import statistics
+
+import numpy as np
+
+import db
+from util import FDBLogger
+
+
+def make_query( nfloats ):
+    floats = ", ".join( f"x * {i+1}.5::double precision AS f{i}" for i in range( nfloats ) )
+    return f"SELECT x::bigint AS x, {floats} FROM generate_series(1, %(n)s) x"
+
+
+def with_execute( con, q, n ):
+    rows, cols = con.execute( q, { 'n': n }, explain=False )
+    return { c: np.array( [ r[i] for r in rows ] ) for i, c in enumerate( cols ) }
+
+
+def with_execute_columnar( con, q, n ):
+    return con.execute_columnar( q, { 'n': n } )
+
+
+def timeit( func, nrep ):
+    times = []
+    for i in range( nrep ):
+        t0 = time.perf_counter()
+        rval = func()
+        times.append( time.perf_counter() - t0 )
+    return rval, statistics.median( times ), min( times )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_columnar.py', description="Benchmark columnar fetches",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-n", "--nrows", type=int, default=1_000_000, help="Number of rows to fetch" )
+    parser.add_argument( "-f", "--nfloats", type=int, default=6, help="Number of double precision columns" )
+    parser.add_argument( "-r", "--repeats", type=int, default=3, help="Times to repeat each fetch" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.INFO )
+    q = make_query( args.nfloats )
+
+    results = {}
+    with db.DBCon() as con:
+        for name, func in ( ( 'execute', with_execute ), ( 'execute_columnar', with_execute_columnar ) ):
+            cols, med, tmin = timeit( lambda: func( con, q, args.nrows ), args.repeats )
+            mb = sum( c.nbytes for c in cols.values() ) / 1e6
+            results[name] = ( med, tmin, mb / med )
+
+    sys.stdout.write( f"\nFetching {args.nrows} rows of 1 bigint and {args.nfloats} double precision columns "
+                      f"({mb:.1f} MB as numpy arrays)\n"
+                      f"{'method':20s} {'median (s)':>12s} {'min (s)':>12s} {'MB/s':>12s}\n" )
+    for method, ( med, tmin, rate ) in results.items():
+        sys.stdout.write( f"{method:20s} {med:12.3f} {tmin:12.3f} {rate:12.1f}\n" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
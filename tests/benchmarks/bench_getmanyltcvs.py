@@ -0,0 +1,98 @@
+"""Benchmark getting lots of lightcurves: one getmanyltcvs request vs. FASTDBClient.get_many_ltcvs.
+
+Run this from a shell container in the test environment (where
+/fastdb is on PYTHONPATH, and the database and webserver are up),
+against a database that has some lightcurves loaded, e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_getmanyltcvs.py -p realtime -n 20000 -u test -w test_password
+
+It picks n random objects from the processing version (with
+ltcv.random_rootids), then gets their lightcurves with one big
+ltcv/getmanyltcvs request (the way you had to before get_many_ltcvs),
+and with get_many_ltcvs for each combination of chunk size and number
+of workers.  It prints the time and the throughput in objects and
+lightcurve points per second.  It only reads from the database.
+
+"""
+
+import sys
+import time
+import logging
+import argparse
+
+import ltcv
+from util import FDBLogger
+from fastdb_client import FASTDBClient
+
+
+def single_request( client, pv, objids, which ):
+    ltcvs = client.post( f'ltcv/getmanyltcvs/{pv}', json={ 'objids': objids, 'which': which } )
+    return sum( len( lc['mjd'] ) for lc in ltcvs )
+
+
+def chunked( client, pv, objids, which, chunksize, nworkers ):
+    ltcvs = client.get_many_ltcvs( objids, procver=pv, return_format='json', which=which,
+                                   chunksize=chunksize, nworkers=nworkers )
+    return sum( len( lc['mjd'] ) for lc in ltcvs )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_getmanyltcvs.py', description="Benchmark chunked lightcurve fetches",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-version", default='default', help="Processing version to search" )
+    parser.add_argument( "-n", "--nobjects", type=int, default=20000, help="Number of objects to get" )
+    parser.add_argument( "--url", default='http://webap:8080', help="URL of the webserver" )
+    parser.add_argument( "-u", "--username", required=True, help="Username on the webserver" )
+    parser.add_argument( "-w", "--password", required=True, help="Password on the webserver" )
+    parser.add_argument( "-c", "--chunksizes", type=int, nargs='+', default=[ 250, 1000 ],
+                         help="Chunk sizes for get_many_ltcvs" )
+    parser.add_argument( "-j", "--nworkers", type=int, nargs='+', default=[ 1, 4, 8 ],
+                         help="Numbers of workers for get_many_ltcvs" )
+    parser.add_argument( "--which", default='patch', choices=[ 'patch', 'detections', 'forced' ],
+                         help="Which photometry to get" )
+    parser.add_argument( "--no-single", action='store_true', default=False,
+                         help="Don't try getting everything with one request" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.WARNING )
+
+    objids = [ str(r) for r in ltcv.random_rootids( args.processing_version, n=args.nobjects ) ]
+    if len( objids ) == 0:
+        raise RuntimeError( f"No objects found in processing version {args.processing_version}" )
+    client = FASTDBClient( args.url, username=args.username, password=args.password, info=False )
+
+    methods = []
+    if not args.no_single:
+        methods.append( ( 'single request', lambda: single_request( client, args.processing_version,
+                                                                    objids, args.which ) ) )
+    for chunksize in args.chunksizes:
+        for nworkers in args.nworkers:
+            methods.append( ( f'chunksize={chunksize} nworkers={nworkers}',
+                              lambda c=chunksize, w=nworkers: chunked( client, args.processing_version,
+                                                                       objids, args.which, c, w ) ) )
+
+    results = {}
+    for name, func in methods:
+        t0 = time.perf_counter()
+        try:
+            npoints = func()
+        except Exception as ex:
+            results[name] = None
+            FDBLogger.warning( f"{name} failed after {time.perf_counter()-t0:.1f} s: {ex}" )
+            continue
+        dt = time.perf_counter() - t0
+        results[name] = ( dt, len(objids) / dt, npoints / dt )
+
+    sys.stdout.write( f"\nGetting lightcurves of {len(objids)} objects\n"
+                      f"{'method':32s} {'time (s)':>12s} {'objects/s':>12s} {'points/s':>12s}\n" )
+    for method, res in results.items():
+        if res is None:
+            sys.stdout.write( f"{method:32s} {'failed':>12s}\n" )
+        else:
+            sys.stdout.write( f"{method:32s} {res[0]:12.2f} {res[1]:12.0f} {res[2]:12.0f}\n" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark getting the lightcurve of one (or a few) objects with ltcv.many_object_ltcvs.
+
+Compares the single-query code that many_object_ltcvs uses for small
+requests with the temp table code it uses for big ones (forced with
+few_objects_threshold=0).  Run this from a shell container in the test
+environment (where /fastdb is on PYTHONPATH and the database is up),
+against a database that has some lightcurves loaded, e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_object_ltcv.py -p realtime -r 500
+
+It picks random objects from the processing version (with
+ltcv.random_rootids), gets the lightcurve of each with both methods, and
+prints p50 and p99 latencies.  It only reads from the database.
+
+"""
+
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+
+import db
+import ltcv
+from util import FDBLogger
+
+
+def latencies( con, pv, objsets, which, threshold ):
+    times = []
+    for objids in objsets:
+        t0 = time.perf_counter()
+        ltcv.many_object_ltcvs( processing_version=pv, objids=objids, which=which,
+                                few_objects_threshold=threshold, dbcon=con )
+        times.append( time.perf_counter() - t0 )
+    return np.array( times )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_object_ltcv.py', description="Benchmark few-object lightcurve fetches",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-version", default='default', help="Processing version to search" )
+    parser.add_argument( "-r", "--repeats", type=int, default=200, help="Number of requests for each method" )
+    parser.add_argument( "-n", "--nobjects", type=int, nargs='+', default=[ 1, 5, 20 ],
+                         help="Number of objects per request" )
+    parser.add_argument( "-w", "--which", default='patch', choices=[ 'patch', 'detections', 'forced' ],
+                         help="Which photometry to get" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.WARNING )
+
+    results = {}
+    with db.DBCon() as con:
+        for n in args.nobjects:
+            objsets = [ ltcv.random_rootids( args.processing_version, n=n, dbcon=con )
+                        for i in range( args.repeats ) ]
+            if any( len(o) == 0 for o in objsets ):
+                raise RuntimeError( f"No objects found in processing version {args.processing_version}" )
+            # Warm up the cache so the first method doesn't pay for reading pages off disk
+            latencies( con, args.processing_version, objsets[:10], args.which, 0 )
+            results[ ( n, 'temp tables' ) ] = latencies( con, args.processing_version, objsets, args.which, 0 )
+            results[ ( n, 'single query' ) ] = latencies( con, args.processing_version, objsets, args.which,
+                                                          max( n, ltcv.FEW_OBJECTS_THRESHOLD ) )
+            con.rollback()
+
+    sys.stdout.write( f"\nmany_object_ltcvs which={args.which}, {args.repeats} requests each\n"
+                      f"{'nobj':>5s} {'method':14s} {'p50 (ms)':>10s} {'p99 (ms)':>10s}\n" )
+    for ( n, method ), times in results.items():
+        sys.stdout.write( f"{n:5d} {method:14s} {1000*np.percentile(times, 50):10.2f} "
+                          f"{1000*np.percentile(times, 99):10.2f}\n" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
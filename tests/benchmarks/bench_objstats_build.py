@@ -0,0 +1,293 @@
+"""Benchmark building the objstats materialized views: one pass vs. the old per-column subqueries.
+
+Run this from a shell container in the test environment (where
+/fastdb is on PYTHONPATH and the database is up) against a database
+that has diasources loaded, e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_objstats_build.py -p realtime --check
+
+It runs EXPLAIN (ANALYZE, BUFFERS) on the SELECT behind the per-band
+objstats view as it was built before (a separate DISTINCT ON subquery
+for every column, each rescanning diasource) and as
+ltcv.object_stats_select builds it now (one resolved pass), and then
+does the same for the all-bands objstatscomb view.  It prints the
+execution time and shared buffers touched for each.  Nothing is
+written to the database (the per-band results that the combined view
+reads from go into a temp table).
+
+"""
+
+import sys
+import logging
+import argparse
+
+from psycopg import sql
+
+import db
+import ltcv
+from util import FDBLogger
+
+
+# What ltcv.create_object_stats_materialized_view used to use to
+#   build objstats_<procver>
+OLD_OBJSTATS_SELECT = """
+    SELECT r.id AS rootid, d0.band AS band, r.ra AS ra, r.dec AS dec,
+        d0.midpointmjdtai AS firstdet_mjd, d0.psfflux AS firstdet_flux, d0.psffluxerr AS firstdet_fluxerr,
+        dn.midpointmjdtai AS lastdet_mjd, dn.psfflux AS lastdet_flux, dn.psffluxerr AS lastdet_fluxerr,
+        dx.midpointmjdtai AS maxdet_mjd, dx.psfflux AS maxdet_flux, dx.psffluxerr AS maxdet_fluxerr,
+        n.ndets AS ndets,
+        CASE WHEN n24.ndets IS NULL THEN 0 ELSE n24.ndets END as ndets24,
+        CASE WHEN n23.ndets IS NULL THEN 0 ELSE n23.ndets END AS ndets23,
+        CASE WHEN n22.ndets IS NULL THEN 0 ELSE n22.ndets END AS ndets22,
+        CASE WHEN n21.ndets IS NULL THEN 0 ELSE n21.ndets END AS ndets21,
+        CASE WHEN sn10.ndets IS NULL THEN 0 ELSE sn10.ndets END AS nsn10,
+        CASE WHEN sn7.ndets IS NULL THEN 0 ELSE sn7.ndets END AS nsn7,
+        CASE WHEN sn5.ndets IS NULL THEN 0 ELSE sn5.ndets END AS nsn5
+    FROM root_diaobject r
+    INNER JOIN (
+       SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       ORDER BY rootid, band, midpointmjdtai
+    ) d0 ON d0.rootid=r.id
+    INNER JOIN (
+       SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       ORDER BY rootid, band, midpointmjdtai DESC
+    ) dn ON d0.rootid=dn.rootid and d0.band=dn.band
+    INNER JOIN (
+       SELECT DISTINCT ON(rootid, band) rootid, band, midpointmjdtai, psfflux, psffluxerr
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.midpointmjdtai, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       ORDER BY rootid, band, psfflux DESC
+    ) dx ON d0.rootid=dx.rootid AND d0.band=dx.band
+    INNER JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       GROUP BY rootid, band
+    ) n ON d0.rootid=n.rootid AND d0.band=n.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux >= 912
+       GROUP BY rootid, band
+    ) n24 ON d0.rootid=n24.rootid AND d0.band=n24.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux >= 2291
+       GROUP BY rootid, band
+    ) n23 ON d0.rootid=n23.rootid AND d0.band=n23.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux >= 5754
+       GROUP BY rootid, band
+    ) n22 ON d0.rootid=n22.rootid AND d0.band=n22.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux >= 14454
+       GROUP BY rootid, band
+    ) n21 ON d0.rootid=n21.rootid AND d0.band=n21.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux / psffluxerr >= 10
+       GROUP BY rootid, band
+    ) sn10 ON d0.rootid=sn10.rootid AND d0.band=sn10.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux / psffluxerr >= 7
+       GROUP BY rootid, band
+    ) sn7 ON d0.rootid=sn7.rootid AND d0.band=sn7.band
+    LEFT JOIN (
+       SELECT rootid, band, COUNT(diasourceid) AS ndets
+       FROM (
+          SELECT DISTINCT ON(o.rootid, s.visit) o.rootid, s.band, s.diasourceid, s.psfflux, s.psffluxerr
+          FROM diasource s
+          INNER JOIN diaobject o ON s.diaobjectid=o.diaobjectid
+          INNER JOIN base_procver_of_procver j ON s.base_procver_id=j.base_procver_id
+                                              AND j.procver_id={pvid}
+          ORDER BY o.rootid, s.visit, j.priority DESC
+       ) subq
+       WHERE psfflux / psffluxerr >= 5
+       GROUP BY rootid, band
+    ) sn5 ON d0.rootid=sn5.rootid AND d0.band=sn5.band
+"""
+
+# ...and objstatscomb_<procver>
+OLD_OBJSTATSCOMB_SELECT = """
+    SELECT s.rootid, s.ra, s.dec,
+           fd.mjd AS firstdet_mjd, fd.flux AS firstdet_flux, fd.fluxerr AS firstdet_fluxerr,
+           ld.mjd AS lastdet_mjd, ld.flux AS lastdet_flux, ld.fluxerr AS lastdet_fluxerr,
+           xd.mjd AS maxdet_mjd, xd.flux AS maxdet_flux, xd.fluxerr AS maxdet_fluxerr,
+           s.ndets AS ndets, s.ndets24 AS ndets24, s.ndets23 AS ndets23, s.ndets22 AS ndets22,
+           s.ndets21 AS ndets21, s.nsn10 AS nsn10, s.nsn7 AS nsn7, s.nsn5 AS nsn5
+    FROM (
+      SELECT rootid, ra, dec, SUM(ndets) AS ndets, SUM(ndets24) AS ndets24, SUM(ndets23) AS ndets23,
+             SUM(ndets22) AS ndets22, SUM(ndets21) AS ndets21, SUM(nsn10) AS nsn10,
+             SUM(nsn7) AS nsn7, SUM(nsn5) AS nsn5
+      FROM {viewname}
+      GROUP BY rootid, ra, dec
+    ) s
+    INNER JOIN (
+      SELECT DISTINCT ON(rootid) rootid, firstdet_mjd AS mjd, firstdet_flux AS flux,
+                                 firstdet_fluxerr AS fluxerr
+      FROM {viewname}
+      ORDER BY rootid, firstdet_mjd
+    ) fd ON s.rootid=fd.rootid
+    INNER JOIN (
+      SELECT DISTINCT ON(rootid) rootid, lastdet_mjd AS mjd, lastdet_flux AS flux, lastdet_fluxerr AS fluxerr
+      FROM {viewname}
+      ORDER BY rootid, lastdet_mjd DESC
+    ) ld ON s.rootid=ld.rootid
+    INNER JOIN (
+      SELECT DISTINCT ON(rootid) rootid, maxdet_mjd AS mjd, maxdet_flux AS flux, maxdet_fluxerr AS fluxerr
+      FROM {viewname}
+      ORDER BY rootid, maxdet_flux DESC
+    ) xd ON s.rootid=xd.rootid
+"""
+
+
+def explain_analyze( con, q ):
+    """Returns ( execution time in seconds, shared buffers hit+read ) for query q."""
+    rows, _ = con.execute( sql.SQL( "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " ) + q, explain=False )
+    plan = rows[0][0][0]
+    top = plan['Plan']
+    return ( plan['Execution Time'] / 1000.,
+             top.get( 'Shared Hit Blocks', 0 ) + top.get( 'Shared Read Blocks', 0 ) )
+
+
+def ndiffer( con, qa, qb ):
+    """Number of rows in the result of qa that aren't in qb and vice versa."""
+    n = 0
+    for q0, q1 in ( ( qa, qb ), ( qb, qa ) ):
+        rows, _ = con.execute( sql.SQL( "SELECT COUNT(*) FROM ( ( {q0} ) EXCEPT ( {q1} ) ) subq"
+                                       ).format( q0=q0, q1=q1 ), explain=False )
+        n += rows[0][0]
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_objstats_build.py', description="Benchmark objstats view creation",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-version", default="default", help="Processing version to build for" )
+    parser.add_argument( "--check", action='store_true', default=False,
+                         help="Also check that the old and new queries return the same rows" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.INFO )
+
+    with db.DBCon() as con:
+        try:
+            pvid = db.ProcessingVersion.procver_id( args.processing_version, dbcon=con )
+            oldband = sql.SQL( OLD_OBJSTATS_SELECT ).format( pvid=pvid )
+            newband = ltcv.object_stats_select( pvid )
+
+            results = {}
+            FDBLogger.info( "Timing old objstats query..." )
+            results['objstats (old)'] = explain_analyze( con, oldband )
+            FDBLogger.info( "Timing new objstats query..." )
+            results['objstats (single pass)'] = explain_analyze( con, newband )
+
+            con.execute_nofetch( sql.SQL( "CREATE TEMP TABLE bench_objstats AS ( {q} )" ).format( q=newband ),
+                                 explain=False, analyze=False )
+            con.execute_nofetch( "ANALYZE bench_objstats", explain=False, analyze=False )
+            oldcomb = sql.SQL( OLD_OBJSTATSCOMB_SELECT ).format( viewname=sql.Identifier( 'bench_objstats' ) )
+            newcomb = ltcv.object_stats_comb_select( 'bench_objstats' )
+            FDBLogger.info( "Timing old objstatscomb query..." )
+            results['objstatscomb (old)'] = explain_analyze( con, oldcomb )
+            FDBLogger.info( "Timing new objstatscomb query..." )
+            results['objstatscomb (single pass)'] = explain_analyze( con, newcomb )
+
+            rows, _ = con.execute( "SELECT COUNT(*) FROM bench_objstats", explain=False )
+            sys.stdout.write( f"\nobjstats build for processing version {args.processing_version} "
+                              f"({rows[0][0]} rootid/band rows)\n"
+                              f"{'query':32s} {'exec time (s)':>14s} {'buffers':>12s}\n" )
+            for what, ( t, nbuf ) in results.items():
+                sys.stdout.write( f"{what:32s} {t:14.3f} {nbuf:12d}\n" )
+
+            if args.check:
+                FDBLogger.info( "Comparing results..." )
+                sys.stdout.write( f"\nRows that differ, objstats:     {ndiffer( con, oldband, newband )}\n"
+                                  f"Rows that differ, objstatscomb: {ndiffer( con, oldcomb, newcomb )}\n"
+                                  f"(Ties in mjd or flux can legitimately make a few rows differ.)\n" )
+
+        finally:
+            con.rollback()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
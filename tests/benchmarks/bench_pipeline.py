@@ -0,0 +1,153 @@
+"""Benchmark DBCon.execute_batch (pipelined queries) against sequential queries over a slow network.
+
+Run this from a shell container in the test environment (where
+/fastdb is on PYTHONPATH and the database is up), e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_pipeline.py -d 0 1 5 20
+
+In the test environment the database is close by, so round trips are
+cheap.  To see what happens when it isn't, this starts a TCP proxy in
+a thread that delays everything passing through it by half the
+requested round-trip time in each direction, and connects to the
+database through that.  For each delay, it runs the queries behind the
+/procver and /baseprocver endpoints, and a processing version lookup,
+both ways and prints the median latencies.  It only reads from the
+database.
+
+"""
+
+import sys
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+
+import db
+from util import FDBLogger
+
+
+class DelayProxy:
+    """A TCP proxy to the database that adds latency."""
+
+    def __init__( self, host, port ):
+        self.host = host
+        self.port = port
+        self.delay = 0.
+        self.loop = asyncio.new_event_loop()
+        sock = socket.socket()
+        sock.bind( ( '127.0.0.1', 0 ) )
+        self.listenport = sock.getsockname()[1]
+        sock.close()
+        started = threading.Event()
+        threading.Thread( target=self._run, args=( started, ), daemon=True ).start()
+        started.wait()
+
+
+    def _run( self, started ):
+        asyncio.set_event_loop( self.loop )
+        self.loop.run_until_complete( asyncio.start_server( self._handle, '127.0.0.1', self.listenport ) )
+        started.set()
+        self.loop.run_forever()
+
+
+    async def _pipe( self, reader, writer ):
+        try:
+            while True:
+                data = await reader.read( 65536 )
+                if len( data ) == 0:
+                    break
+                # call_later keeps chunks in order, since the delay is the same for all of them
+                self.loop.call_later( self.delay / 2., writer.write, data )
+        finally:
+            self.loop.call_later( self.delay / 2., writer.close )
+
+
+    async def _handle( self, client_reader, client_writer ):
+        server_reader, server_writer = await asyncio.open_connection( self.host, self.port )
+        await asyncio.gather( self._pipe( client_reader, server_writer ),
+                              self._pipe( server_reader, client_writer ) )
+
+
+def procver_sequential( con, pvid ):
+    con.execute( "SELECT description FROM processing_version_alias WHERE procver_id=%(pv)s", { 'pv': pvid } )
+    con.execute( "SELECT b.description,b._table,j.priority FROM base_processing_version b "
+                 "INNER JOIN base_procver_of_procver j ON b.id=j.base_procver_id WHERE j.procver_id=%(pv)s",
+                 { 'pv': pvid } )
+    con.execute( "SELECT description FROM processing_version" )
+    con.execute( "SELECT description FROM processing_version_alias" )
+
+
+def procver_batch( con, pvid ):
+    con.execute_batch( [ ( "SELECT description FROM processing_version_alias WHERE procver_id=%(pv)s",
+                           { 'pv': pvid } ),
+                         ( "SELECT b.description,b._table,j.priority FROM base_processing_version b "
+                           "INNER JOIN base_procver_of_procver j ON b.id=j.base_procver_id "
+                           "WHERE j.procver_id=%(pv)s",
+                           { 'pv': pvid } ),
+                         "SELECT description FROM processing_version",
+                         "SELECT description FROM processing_version_alias" ] )
+
+
+def lookup_sequential( con, names ):
+    # What ProcessingVersion.procver_id used to do: id, then description, then alias, one name at a time
+    for name in names:
+        for stmt in ( 'procver_by_description', 'procver_by_alias' ):
+            rows, _ = con.execute( db.PreparedStatements.query( stmt ), { 'pv': name } )
+            if len( rows ) > 0:
+                break
+
+
+def lookup_batch( con, names ):
+    db.ProcessingVersion.procver_ids( names, dbcon=con )
+
+
+def timeit( func, nrep ):
+    times = []
+    for i in range( nrep ):
+        t0 = time.perf_counter()
+        func()
+        times.append( time.perf_counter() - t0 )
+    return statistics.median( times )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_pipeline.py', description="Benchmark pipelined queries",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-d", "--delays", type=float, nargs='+', default=[ 0., 1., 5., 20. ],
+                         help="Simulated round-trip times (ms)" )
+    parser.add_argument( "-r", "--repeats", type=int, default=50, help="Times to repeat each method" )
+    parser.add_argument( "-p", "--processing-versions", nargs='+', default=[ 'default', 'realtime' ],
+                         help="Processing versions (descriptions or aliases) to look up" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.WARNING )
+
+    proxy = DelayProxy( db.dbhost, db.dbport )
+    db.dbhost = '127.0.0.1'
+    db.dbport = proxy.listenport
+
+    results = {}
+    with db.DBCon() as con:
+        pvid = db.ProcessingVersion.procver_id( args.processing_versions[0], dbcon=con )
+        for delay in args.delays:
+            proxy.delay = delay / 1000.
+            results[ ( delay, '/procver queries' ) ] = (
+                timeit( lambda: procver_sequential( con, pvid ), args.repeats ),
+                timeit( lambda: procver_batch( con, pvid ), args.repeats ) )
+            results[ ( delay, f'look up {len(args.processing_versions)} procvers' ) ] = (
+                timeit( lambda: lookup_sequential( con, args.processing_versions ), args.repeats ),
+                timeit( lambda: lookup_batch( con, args.processing_versions ), args.repeats ) )
+
+    sys.stdout.write( f"\n{'RTT (ms)':>8s} {'workload':24s} {'sequential (ms)':>16s} {'batch (ms)':>11s} "
+                      f"{'speedup':>8s}\n" )
+    for ( delay, workload ), ( seq, batch ) in results.items():
+        sys.stdout.write( f"{delay:8.1f} {workload:24s} {1000*seq:16.2f} {1000*batch:11.2f} {seq/batch:8.1f}\n" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark the prepared statements that the web server's hot paths use.
+
+Runs the queries behind /ltcv/getltcv (few-object lightcurves),
+/getdiaobjectinfo (ltcv.get_object_infos), processing version lookups, and
+the user lookup that every web request does, first as ordinary queries
+and then as prepared statements (see db.PreparedStatements).  Run this
+from a shell container in the test environment (where /fastdb is on
+PYTHONPATH and the database is up), against a database that has some
+lightcurves loaded, e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_prepared_statements.py -p realtime -r 500
+
+For each workload it prints p50 latencies both ways.  Then, for each
+statement that was prepared, it prints how long the server takes to
+plan it (from EXPLAIN (GENERIC_PLAN, SUMMARY)), how many executions
+used the cached generic plan rather than planning again (from
+pg_prepared_statements), and so the planning time saved.  It only reads
+from the database.
+
+"""
+
+import re
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+
+import db
+import ltcv
+from util import FDBLogger
+
+
+_placeholder_re = re.compile( r'%\((\w+)\)s' )
+
+
+def server_text( query ):
+    """The text of query as psycopg sends it to the server (with $n placeholders)."""
+    names = {}
+    return _placeholder_re.sub( lambda m: f"${names.setdefault( m.group(1), len(names) + 1 )}", query )
+
+
+def latencies( func, objsets, prepared ):
+    db._use_prepared_statements = prepared
+    times = []
+    # Use a fresh connection, so the prepared run pays for preparing
+    with db.DBCon() as con:
+        for objids in objsets:
+            t0 = time.perf_counter()
+            func( con, objids )
+            times.append( time.perf_counter() - t0 )
+    return np.array( times )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_prepared_statements.py', description="Benchmark prepared statements",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-p", "--processing-version", default='default', help="Processing version to search" )
+    parser.add_argument( "-r", "--repeats", type=int, default=200, help="Number of requests for each workload" )
+    parser.add_argument( "-n", "--nobjects", type=int, default=1, help="Number of objects per request" )
+    parser.add_argument( "-u", "--username", default='test', help="User to look up" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.WARNING )
+    pv = args.processing_version
+
+    workloads = {
+        'user lookup': lambda con, objids: con.execute_prepared( 'authuser_by_username',
+                                                                 { 'username': args.username } ),
+        'procver lookup': lambda con, objids: db.ProcessingVersion.procver_id( pv, dbcon=con ),
+        'object info': lambda con, objids: ltcv.get_object_infos( objids=objids, processing_version=pv,
+                                                                  dbcon=con ),
+        'lightcurve': lambda con, objids: ltcv.many_object_ltcvs( processing_version=pv, objids=objids,
+                                                                  dbcon=con ),
+    }
+
+    with db.DBCon() as con:
+        objsets = [ ltcv.random_rootids( pv, n=args.nobjects, dbcon=con ) for i in range( args.repeats ) ]
+    if any( len(o) == 0 for o in objsets ):
+        raise RuntimeError( f"No objects found in processing version {pv}" )
+
+    results = {}
+    plans = {}
+    try:
+        for name, func in workloads.items():
+            # Warm up the cache so the first run doesn't pay for reading pages off disk
+            latencies( func, objsets[:10], False )
+            results[ ( name, 'unprepared' ) ] = latencies( func, objsets, False )
+
+            # Run the prepared version by hand (rather than with latencies()) so that we
+            #   can look at pg_prepared_statements before the connection goes away.
+            db._use_prepared_statements = True
+            times = []
+            with db.DBCon() as con:
+                for objids in objsets:
+                    t0 = time.perf_counter()
+                    func( con, objids )
+                    times.append( time.perf_counter() - t0 )
+                results[ ( name, 'prepared' ) ] = np.array( times )
+
+                rows, _ = con.execute( "SELECT statement, generic_plans, custom_plans FROM pg_prepared_statements "
+                                       "WHERE NOT from_sql" )
+                onserver = { r[0]: ( r[1], r[2] ) for r in rows }
+                for stmt in db.PreparedStatements.stats().keys():
+                    text = server_text( db.PreparedStatements.query( stmt ) )
+                    if ( stmt in plans ) or ( text not in onserver ):
+                        continue
+                    explain, _ = con.execute( f"EXPLAIN (GENERIC_PLAN, SUMMARY, FORMAT JSON) {text}" )
+                    plans[ stmt ] = ( explain[0][0][0]['Planning Time'], *onserver[text] )
+    finally:
+        db._use_prepared_statements = True
+
+    sys.stdout.write( f"\n{args.repeats} requests of {args.nobjects} object(s) each\n"
+                      f"{'workload':16s} {'unprepared p50 (ms)':>20s} {'prepared p50 (ms)':>18s}\n" )
+    for name in workloads.keys():
+        sys.stdout.write( f"{name:16s} {1000*np.percentile(results[(name, 'unprepared')], 50):20.3f} "
+                          f"{1000*np.percentile(results[(name, 'prepared')], 50):18.3f}\n" )
+
+    sys.stdout.write( f"\n{'statement':48s} {'plan (ms)':>10s} {'generic':>8s} {'custom':>8s} "
+                      f"{'saved (ms)':>11s}\n" )
+    for stmt, ( planms, generic, custom ) in plans.items():
+        # The first generic plan had to be made; after that, every generic execution skipped planning
+        saved = planms * max( generic - 1, 0 )
+        sys.stdout.write( f"{stmt[:48]:48s} {planms:10.3f} {generic:8d} {custom:8d} {saved:11.1f}\n" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark picking a random object: ltcv.random_rootids vs. ORDER BY random().
+
+Run this from a shell container in the test environment (where
+/fastdb is on PYTHONPATH and the database is up), e.g.:
+
+   cd /code/tests/benchmarks
+   python bench_random_rootids.py -n 10000000
+
+It loads n fake root objects and diaobjects into a throwaway processing
+version, runs both methods a few times, and prints the timings.
+Everything happens in one transaction that is rolled back at the end,
+so it leaves nothing behind in the database (but it does need enough
+disk for n rows in each of root_diaobject and diaobject while it runs).
+
+"""
+
+import sys
+import time
+import uuid
+import logging
+import argparse
+import statistics
+
+import db
+import ltcv
+from util import FDBLogger
+
+
+def load_fake_objects( con, n ):
+    """Make a processing version with n objects in it; returns the processing version id."""
+    pvid = uuid.uuid4()
+    bpvid = uuid.uuid4()
+    con.execute_nofetch( "INSERT INTO processing_version(id, description) VALUES (%(id)s, %(desc)s)",
+                         { 'id': pvid, 'desc': f'bench_{pvid}' } )
+    con.execute_nofetch( "INSERT INTO base_processing_version(id, _table, description) "
+                         "VALUES (%(id)s, 'diaobject', %(desc)s)",
+                         { 'id': bpvid, 'desc': f'bench_{bpvid}' } )
+    con.execute_nofetch( "INSERT INTO base_procver_of_procver(base_procver_id, procver_id, _table, priority) "
+                         "VALUES (%(bpv)s, %(pv)s, 'diaobject', 0)",
+                         { 'bpv': bpvid, 'pv': pvid } )
+
+    t0 = time.perf_counter()
+    con.execute_nofetch( "CREATE TEMP TABLE bench_roots AS "
+                         "SELECT i, gen_random_uuid() AS id, random()*360. AS ra, random()*180.-90. AS dec "
+                         "FROM generate_series(1, %(n)s) i",
+                         { 'n': n }, explain=False, analyze=False )
+    con.execute_nofetch( "INSERT INTO root_diaobject(id, ra, dec) SELECT id, ra, dec FROM bench_roots",
+                         explain=False, analyze=False )
+    # Big offset so we don't collide with any real diaobjectids
+    con.execute_nofetch( "INSERT INTO diaobject(diaobjectid, rootid, base_procver_id, validitystartmjdtai) "
+                         "SELECT 4000000000000000000+i, id, %(bpv)s, 60000. FROM bench_roots",
+                         { 'bpv': bpvid }, explain=False, analyze=False )
+    con.execute_nofetch( "ANALYZE diaobject", explain=False, analyze=False )
+    FDBLogger.info( f"Loaded {n} objects in {time.perf_counter()-t0:.1f} s" )
+    return pvid
+
+
+def order_by_random( con, pvid ):
+    # What /ltcv/getrandomltcv used to do
+    rows, _ = con.execute( "SELECT diaobjectid FROM ( "
+                           "  SELECT DISTINCT ON (o.diaobjectid) o.diaobjectid FROM diaobject o "
+                           "  INNER JOIN base_procver_of_procver pv ON o.base_procver_id=pv.base_procver_id "
+                           "                                       AND pv.procver_id=%(pv)s "
+                           "  ORDER BY o.diaobjectid, pv.priority DESC "
+                           ") subq ORDER BY random() LIMIT 1",
+                           { 'pv': pvid }, explain=False )
+    return rows
+
+
+def timeit( func, nrep ):
+    times = []
+    for i in range( nrep ):
+        t0 = time.perf_counter()
+        func()
+        times.append( time.perf_counter() - t0 )
+    return statistics.median( times ), min( times ), max( times )
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_random_rootids.py', description="Benchmark random object sampling",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-n", "--nobjects", type=int, default=10_000_000, help="Number of fake objects to load" )
+    parser.add_argument( "-r", "--repeats", type=int, default=10, help="Times to repeat each sampling method" )
+    parser.add_argument( "--old-repeats", type=int, default=3, help="Times to repeat ORDER BY random()" )
+    args = parser.parse_args()
+
+    FDBLogger.setLevel( logging.INFO )
+
+    with db.DBCon() as con:
+        try:
+            pvid = load_fake_objects( con, args.nobjects )
+
+            results = {}
+            results['ORDER BY random() LIMIT 1'] = timeit( lambda: order_by_random( con, pvid ), args.old_repeats )
+            for n in ( 1, 100 ):
+                results[f'random_rootids n={n}'] = timeit( lambda: ltcv.random_rootids( pvid, n=n, dbcon=con ),
+                                                          args.repeats )
+
+            sys.stdout.write( f"\nRandom object sampling with {args.nobjects} objects\n"
+                              f"{'method':32s} {'median (s)':>12s} {'min (s)':>12s} {'max (s)':>12s}\n" )
+            for method, ( med, tmin, tmax ) in results.items():
+                sys.stdout.write( f"{method:32s} {med:12.4f} {tmin:12.4f} {tmax:12.4f}\n" )
+
+        finally:
+            con.rollback()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
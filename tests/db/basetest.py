@@ -356,6 +356,15 @@ class BaseTestDB:
             dictoflists = { k: [ d[k] for d in dicts ] for k in dicts[0].keys() }
             n = self.cls.bulk_insert_or_upsert( dictoflists )
             assert n == 2
+
+            # The reused temp table is emptied once the rows are in
+            with DB() as conn:
+                n = self.cls.bulk_insert_or_upsert( dictoflists, upsert=True, dbcon=conn )
+                assert n == 2
+                cursor = conn.cursor()
+                cursor.execute( f"SELECT COUNT(*) FROM temp_bulk_upsert_{self.cls.__tablename__}" )
+                assert cursor.fetchone()[0] == 0
+
             objs = self.cls.get_batch( [ self.obj1.pks, self.obj2.pks ] )
             assert len( objs ) == 2
             assert ( sorted( [ [ getattr(o, k) for k in self.cls._pk ] for o in objs ] )
@@ -1,6 +1,11 @@
 import pytest
+import uuid
+import time
+import multiprocessing
 
+import numpy as np
 import psycopg
+from psycopg import sql
 
 import db
 
@@ -122,3 +127,283 @@ def test_DBCon( test_user ):
         coldex = { cols[i]: i for i in range(len(cols)) }
         assert rows[0][coldex['username']] == 'test'
     # TODO : somehow verify that there is no connection to the database
+
+
+def test_temp_table():
+    db.TempTableManager.reset_stats()
+    cols = 'id int, val text'
+
+    with db.DBCon() as dbcon:
+        with dbcon.temp_table( 'test_tmp', cols ) as tab:
+            assert tab == 'test_tmp'
+            dbcon.execute_nofetch( f"INSERT INTO {tab}(id, val) VALUES (1, 'a'), (2, 'b')" )
+
+            # While that one is in use, asking for the same name gets a different table
+            with dbcon.temp_table( 'test_tmp', cols ) as tab2:
+                assert tab2 == 'test_tmp_1'
+                rows, _ = dbcon.execute( f"SELECT * FROM {tab2}" )
+                assert len(rows) == 0
+            rows, _ = dbcon.execute( f"SELECT * FROM {tab}" )
+            assert len(rows) == 2
+
+            # So does asking for the same name with different columns
+            with dbcon.temp_table( 'test_tmp', 'id bigint' ) as tab3:
+                assert tab3 == 'test_tmp_2'
+        dbcon.commit()
+
+        # Reusing gets the same table back, truncated
+        with dbcon.temp_table( 'test_tmp', cols ) as tab:
+            assert tab == 'test_tmp'
+            rows, _ = dbcon.execute( f"SELECT COUNT(*) FROM {tab}" )
+            assert rows[0][0] == 0
+
+        # A DBCon wrapping the same connection shares the tables
+        with db.DBCon( dbcon ) as othercon:
+            with othercon.temp_table( 'test_tmp', cols ) as tab:
+                assert tab == 'test_tmp'
+
+        # A table created in a transaction that's rolled back is remade
+        with dbcon.temp_table( 'test_tmp_rollback', cols ) as tab:
+            dbcon.execute_nofetch( f"INSERT INTO {tab}(id, val) VALUES (1, 'a')" )
+        dbcon.rollback()
+        with dbcon.temp_table( 'test_tmp_rollback', cols ) as tab:
+            rows, _ = dbcon.execute( f"SELECT COUNT(*) FROM {tab}" )
+            assert rows[0][0] == 0
+
+    # A new session has to make the table again
+    with db.DBCon() as dbcon:
+        with dbcon.temp_table( 'test_tmp', cols ) as tab:
+            assert tab == 'test_tmp'
+
+    stats = db.TempTableManager.stats()
+    assert stats['test_tmp'] == { 'created': 4, 'reused': 2 }
+    assert stats['test_tmp_rollback'] == { 'created': 2, 'reused': 0 }
+
+
+def test_query_stats():
+    fp1, norm1 = db.query_fingerprint( "SELECT * FROM  diaobject WHERE diaobjectid=%(id)s AND x IN (1, 2, 3) -- hi" )
+    fp2, norm2 = db.query_fingerprint( "select * from diaobject\nwhere diaobjectid=42 and x in ( 'a','b' )" )
+    assert fp1 == fp2
+    assert norm1 == norm2
+    assert norm1 == "select * from diaobject where diaobjectid=? and x in (?)"
+    assert db.query_is_read_only( norm1 )
+    assert not db.query_is_read_only( db.query_fingerprint( "INSERT INTO foo VALUES (1)" )[1] )
+    assert not db.query_is_read_only( db.query_fingerprint( "SELECT * INTO foo FROM bar" )[1] )
+
+    q = "SELECT id, username FROM authuser WHERE username=%(name)s"
+    fp, _ = db.query_fingerprint( q )
+    qs = db.QueryStats.instance()
+    orig_slow = db._slow_query_seconds
+    try:
+        before = qs.snapshot().get( fp, { 'calls': 0, 'slow_calls': 0, 'nrows': 0 } )
+        with db.DBCon() as dbcon:
+            for name in [ 'test', 'nobody', 'test' ]:
+                dbcon.execute( q, { 'name': name } )
+        after = qs.snapshot()[fp]
+        assert after['calls'] == before['calls'] + 3
+        assert after['slow_calls'] == before['slow_calls']
+        assert after['nrows'] >= before['nrows']
+
+        # Make everything slow; the first slow call should get EXPLAINed into the slow query log
+        db._slow_query_seconds = 0.
+        qs.lastsample.pop( fp, None )
+        with db.DBCon() as dbcon:
+            dbcon.execute( q, { 'name': 'test' } )
+            dbcon.execute( q, { 'name': 'test' } )
+        assert qs.snapshot()[fp]['slow_calls'] == after['slow_calls'] + 2
+
+        # The plan is added by a background thread
+        db._slow_query_seconds = None
+        t0 = time.perf_counter()
+        while True:
+            with db.DBCon() as dbcon:
+                rows, _ = dbcon.execute( "SELECT plan FROM slow_query_log WHERE fingerprint=%(fp)s", { 'fp': fp } )
+            assert len(rows) == 1
+            if rows[0][0] is not None:
+                break
+            assert time.perf_counter() - t0 < 10
+            time.sleep( 0.2 )
+        assert rows[0][0][0]['Plan']['Actual Rows'] is not None
+        assert 'Shared Hit Blocks' in rows[0][0][0]['Plan']
+
+        qs.flush()
+        assert len( qs.pending ) == 0
+        with db.DBCon() as dbcon:
+            rows, _ = dbcon.execute( "SELECT calls, slow_calls FROM query_stats WHERE fingerprint=%(fp)s",
+                                     { 'fp': fp } )
+            assert len(rows) == 1
+            assert rows[0][0] >= 5
+            assert rows[0][1] >= 2
+
+    finally:
+        db._slow_query_seconds = orig_slow
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "DELETE FROM slow_query_log WHERE fingerprint=%(fp)s", { 'fp': fp } )
+            dbcon.execute_nofetch( "DELETE FROM query_stats WHERE fingerprint=%(fp)s", { 'fp': fp } )
+            dbcon.commit()
+
+
+def _query_stats_child( queue ):
+    qs = db.QueryStats.instance()
+    queue.put( ( dict( qs.pending ), dict( qs.totals ) ) )
+
+
+def test_query_stats_fork():
+    qs = db.QueryStats.instance()
+    with qs._lock:
+        qs._add( qs.pending, 'test_query_stats_fork', 'select ?', 0.1, 0., 1, False )
+        qs._add( qs.totals, 'test_query_stats_fork', 'select ?', 0.1, 0., 1, False )
+    try:
+        # A forked child doesn't inherit (and so doesn't flush again) the parent's unflushed stats
+        ctx = multiprocessing.get_context( 'fork' )
+        queue = ctx.Queue()
+        proc = ctx.Process( target=_query_stats_child, args=( queue, ) )
+        proc.start()
+        pending, totals = queue.get( timeout=10 )
+        proc.join()
+        assert proc.exitcode == 0
+        assert pending == {}
+        assert totals == {}
+        assert 'test_query_stats_fork' in qs.pending
+    finally:
+        with qs._lock:
+            qs.pending.pop( 'test_query_stats_fork', None )
+            qs.totals.pop( 'test_query_stats_fork', None )
+
+
+def test_prepared_statements():
+    db.PreparedStatements.reset_stats()
+
+    with db.DBCon() as dbcon:
+        for i in range(3):
+            rows, _ = dbcon.execute_prepared( 'procver_by_description', { 'pv': 'this_procver_does_not_exist' } )
+            assert len(rows) == 0
+        rows, _ = dbcon.execute( "SELECT statement FROM pg_prepared_statements WHERE NOT from_sql" )
+        assert any( 'FROM processing_version WHERE description' in r[0] for r in rows )
+
+        # Registering on the fly
+        q = sql.SQL( "SELECT {col} FROM authuser WHERE username=%(name)s" ).format( col=sql.Identifier( 'id' ) )
+        rows, _ = dbcon.execute_prepared( 'test_authuser_id', { 'name': 'this_user_does_not_exist' }, query=q )
+        assert len(rows) == 0
+        rows, _ = dbcon.execute_prepared( 'test_authuser_id', { 'name': 'this_user_does_not_exist' }, query=q )
+        with pytest.raises( ValueError, match="A different query is already registered" ):
+            dbcon.execute_prepared( 'test_authuser_id', { 'name': 'x' },
+                                    query="SELECT username FROM authuser WHERE username=%(name)s" )
+        with pytest.raises( ValueError, match="Unknown prepared statement" ):
+            dbcon.execute_prepared( 'this_statement_does_not_exist' )
+
+    # Dict cursors work, and a new connection has to prepare again
+    with db.DBCon( dictcursor=True ) as dbcon:
+        rows = dbcon.execute_prepared( 'procver_by_description', { 'pv': 'this_procver_does_not_exist' } )
+        assert rows == []
+
+    stats = db.PreparedStatements.stats()
+    assert stats['procver_by_description'] == { 'executions': 4, 'prepares': 2 }
+    assert stats['test_authuser_id'] == { 'executions': 2, 'prepares': 1 }
+
+
+def test_execute_batch():
+    with db.DBCon() as dbcon:
+        res = dbcon.execute_batch( [ "SELECT 1 AS one",
+                                     ( "SELECT username FROM authuser WHERE username=%(name)s",
+                                       { 'name': 'this_user_does_not_exist' } ),
+                                     ( "SELECT x FROM generate_series(1, %(n)s) x", { 'n': 3 } ),
+                                     "CREATE TEMP TABLE test_batch( x int )" ] )
+        assert res == [ ( [ ( 1, ) ], [ 'one' ] ),
+                        ( [], [ 'username' ] ),
+                        ( [ ( 1, ), ( 2, ), ( 3, ) ], [ 'x' ] ),
+                        ( None, None ) ]
+
+        # The batch ran in the current transaction
+        rows, _ = dbcon.execute( "SELECT COUNT(*) FROM test_batch" )
+        assert rows[0][0] == 0
+
+        # If one fails, we hear about it
+        with pytest.raises( psycopg.errors.UndefinedTable ):
+            dbcon.execute_batch( [ "SELECT 1", "SELECT * FROM this_table_does_not_exist", "SELECT 2" ] )
+        dbcon.rollback()
+
+    db.PreparedStatements.reset_stats()
+    with db.DBCon( dictcursor=True ) as dbcon:
+        res = dbcon.execute_batch( [ ( 'procver_by_description', { 'pv': 'this_procver_does_not_exist' } ),
+                                     ( 'authuser_by_username', { 'username': 'this_user_does_not_exist' } ) ],
+                                   prepared=True )
+        assert res == [ [], [] ]
+        res = dbcon.execute_batch( [ ( 'procver_by_description', { 'pv': 'this_procver_does_not_exist' } ) ],
+                                   prepared=True )
+        assert res == [ [] ]
+    stats = db.PreparedStatements.stats()
+    assert stats['procver_by_description'] == { 'executions': 2, 'prepares': 1 }
+    assert stats['authuser_by_username'] == { 'executions': 1, 'prepares': 1 }
+
+
+def test_execute_columnar():
+    q = ( "SELECT x::smallint AS i2, x AS i4, x::bigint*10000000000 AS i8, (x/4.)::real AS f4, "
+          "       CASE WHEN x%%3=0 THEN NULL ELSE x/8. END::double precision AS f8, "
+          "       x%%2=0 AS b, x/3.::numeric AS num, "
+          "       '2000-01-01'::timestamp + x * interval '1 hour' AS ts, "
+          "       '2000-01-01'::date + x AS d, "
+          "       CASE WHEN x=2 THEN NULL ELSE 'row ' || x END AS t, "
+          "       ('00000000-0000-0000-0000-' || lpad(x::text, 12, '0'))::uuid AS u, "
+          "       jsonb_build_object('x', x) AS j "
+          "FROM generate_series(1, %(n)s) x ORDER BY x" )
+
+    with db.DBCon() as dbcon:
+        cols = dbcon.execute_columnar( q, { 'n': 5 } )
+        assert list( cols.keys() ) == [ 'i2', 'i4', 'i8', 'f4', 'f8', 'b', 'num', 'ts', 'd', 't', 'u', 'j' ]
+        assert cols['i2'].dtype == np.int16
+        assert cols['i4'].dtype == np.int32
+        assert cols['i8'].dtype == np.int64
+        assert cols['f4'].dtype == np.float32
+        assert cols['f8'].dtype == np.float64
+        assert cols['b'].dtype == np.bool_
+        assert cols['num'].dtype == np.float64
+        assert cols['ts'].dtype == np.dtype( 'datetime64[us]' )
+        assert cols['d'].dtype == np.dtype( 'datetime64[D]' )
+        assert ( cols['i4'] == np.arange( 1, 6 ) ).all()
+        assert ( cols['i8'] == np.arange( 1, 6 ) * 10000000000 ).all()
+        assert cols['f4'] == pytest.approx( np.arange( 1, 6 ) / 4., rel=1e-7 )
+        assert ( cols['b'] == np.array( [ False, True, False, True, False ] ) ).all()
+        assert cols['num'] == pytest.approx( np.arange( 1, 6 ) / 3., rel=1e-12 )
+        assert cols['ts'][1] == np.datetime64( '2000-01-01T02:00:00' )
+        assert cols['d'][4] == np.datetime64( '2000-01-06' )
+        assert isinstance( cols['f8'], np.ma.MaskedArray )
+        assert list( cols['f8'].mask ) == [ False, False, True, False, False ]
+        assert cols['f8'][3] == 0.5
+        assert cols['t'].dtype == object
+        assert list( cols['t'] ) == [ 'row 1', None, 'row 3', 'row 4', 'row 5' ]
+        assert cols['u'][4] == uuid.UUID( '00000000-0000-0000-0000-000000000005' )
+        assert cols['j'][2] == { 'x': 3 }
+
+        # All fixed-width columns, which are decoded in bulk except for the rows with NULLs
+        cols = dbcon.execute_columnar( "SELECT x, x*0.5::double precision AS y, "
+                                       "  CASE WHEN x%%1000=0 THEN NULL ELSE x END AS z "
+                                       "FROM generate_series(1, %(n)s) x ORDER BY x", { 'n': 100000 } )
+        assert ( cols['x'] == np.arange( 1, 100001 ) ).all()
+        assert ( cols['y'] == np.arange( 1, 100001 ) * 0.5 ).all()
+        assert cols['z'].mask.sum() == 100
+        assert ( cols['z'].compressed() == np.array( [ i for i in range( 1, 100001 ) if i % 1000 != 0 ] ) ).all()
+
+        # Chunks
+        chunks = list( dbcon.iter_columnar( "SELECT x FROM generate_series(1, 25) x ORDER BY x", chunksize=10 ) )
+        assert [ len( c['x'] ) for c in chunks ] == [ 10, 10, 5 ]
+        assert ( np.concatenate( [ c['x'] for c in chunks ] ) == np.arange( 1, 26 ) ).all()
+
+        # No rows
+        cols = dbcon.execute_columnar( "SELECT x::real AS x FROM generate_series(1, 0) x" )
+        assert cols['x'].dtype == np.float32
+        assert len( cols['x'] ) == 0
+        assert list( dbcon.iter_columnar( "SELECT x FROM generate_series(1, 0) x" ) ) == []
+
+        # Results match execute()
+        rows, colnames = dbcon.execute( q, { 'n': 5 } )
+        cols = dbcon.execute_columnar( q, { 'n': 5 } )
+        for i, c in enumerate( colnames ):
+            if c in ( 'i2', 'i4', 'i8', 'b', 't', 'u', 'j' ):
+                assert list( cols[c] ) == [ r[i] for r in rows ]
+
+        with pytest.raises( TypeError, match="Don't know how to fetch column p" ):
+            dbcon.execute_columnar( "SELECT point(1, 2) AS p" )
+
+        with pytest.raises( ValueError, match="return_format must be" ):
+            dbcon.execute_columnar( "SELECT 1", return_format='pandas' )
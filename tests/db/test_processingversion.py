@@ -93,6 +93,13 @@ class TestProcessingVersion( BaseTestDB ):
         with pytest.raises( ValueError, match="Unknown processing version foo" ):
             ProcessingVersion.procver_id( 'foo' )
 
+        assert ( ProcessingVersion.procver_ids( [ 'testprocver_pv2', gratuitous, 'testprocver_pv1' ] )
+                 == [ self.obj2.id, gratuitous, self.obj1.id ] )
+        pvs = ProcessingVersion.get_procvers( [ self.obj1.id, 'testprocver_pv2' ] )
+        assert [ pv.description for pv in pvs ] == [ 'testprocver_pv1', 'testprocver_pv2' ]
+        with pytest.raises( ValueError, match="Unknown processing version foo" ):
+            ProcessingVersion.procver_ids( [ 'testprocver_pv1', 'foo' ] )
+
     # THIS TEST HAS TO GO LAST because it runs the procver_collection fixture that's module scope
     def test_procver_functions( self, procver_collection ):
         bpvs, pvs, _pvinfo = procver_collection
@@ -1,11 +1,16 @@
 import pytest
 import sys
 import io
+import time
+import json
+import hashlib
 import pandas
 import itertools
 
+import db
+
 sys.path.insert( 0, '/code/client' )
-from fastdb_client import FASTDBClient
+from fastdb_client import FASTDBClient, SubmittedAsLongQuery
 
 
 @pytest.fixture
@@ -29,6 +34,52 @@ def test_short_query( test_user, test_sql_query_expecteddata ):
     assert founddata == test_sql_query_expecteddata
 
 
+def test_short_query_limits( test_user ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    res = fastdb.submit_short_sql_query( "SELECT x FROM generate_series(1, 100) x", max_rows=100 )
+    assert [ r['x'] for r in res ] == list( range( 1, 101 ) )
+
+    with pytest.raises( RuntimeError, match="Query returned more than 99 rows" ):
+        fastdb.submit_short_sql_query( "SELECT x FROM generate_series(1, 100) x", max_rows=99 )
+
+    with pytest.raises( RuntimeError, match="Query returned more than 1000 bytes" ):
+        fastdb.submit_short_sql_query( "SELECT repeat('x', 100) AS x FROM generate_series(1, 100) x",
+                                       max_bytes=1000 )
+
+    with pytest.raises( RuntimeError, match="Query took longer than 1.0 seconds" ):
+        fastdb.submit_short_sql_query( "SELECT pg_sleep(3)", timeout=1 )
+
+    # Connections go back to the pool in a usable state, and can't write
+    with pytest.raises( RuntimeError, match="permission denied for table authuser" ):
+        fastdb.submit_short_sql_query( [ "DELETE FROM authuser WHERE false", "SELECT 1" ] )
+    for i in range( 20 ):
+        res = fastdb.submit_short_sql_query( "SELECT current_setting('statement_timeout') AS t" )
+        assert res == [ { 't': '5min' } ]
+
+
+def test_short_query_arrow( test_user, test_sql_query_expecteddata ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    table = fastdb.submit_short_sql_query( "SELECT diasourceid, diaobjectid, visit, base_procver_id::text, psfflux "
+                                           "FROM diasource", return_format='arrow' )
+    assert str( table.schema.field( 'psfflux' ).type ) == 'float'
+    founddata = set( zip( *[ table.column( c ).to_pylist()
+                             for c in ( 'diasourceid', 'diaobjectid', 'visit', 'base_procver_id' ) ] ) )
+    assert founddata == test_sql_query_expecteddata
+
+    table = fastdb.submit_short_sql_query( "SELECT diasourceid FROM diasource WHERE diasourceid<0",
+                                           return_format='arrow' )
+    assert table.num_rows == 0
+    assert table.column_names == [ 'diasourceid' ]
+
+    table = fastdb.submit_short_sql_query( "SELECT x FROM generate_series(1, 3) x ; \n", return_format='arrow' )
+    assert table.column( 'x' ).to_pylist() == [ 1, 2, 3 ]
+
+    with pytest.raises( RuntimeError, match="Query returned more than 2 rows" ):
+        fastdb.submit_short_sql_query( "SELECT x FROM generate_series(1, 100) x", return_format='arrow', max_rows=2 )
+
+
 def test_synchronous_long_query( test_user, test_sql_query_expecteddata ):
     fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
 
@@ -37,3 +88,346 @@ def test_synchronous_long_query( test_user, test_sql_query_expecteddata ):
     df = pandas.read_csv( strio, sep=',', header=0 )
     founddata = set( ( r.diasourceid, r.diaobjectid, r.visit, r.base_procver_id ) for r in df.itertuples() )
     assert founddata == test_sql_query_expecteddata
+
+
+def test_long_query_download( test_user, test_sql_query_expecteddata, tmp_path ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    expected = fastdb.synchronous_long_sql_query( "SELECT * FROM diasource ORDER BY diasourceid",
+                                                  checkeach=1, maxwait=20 )
+    queryid = fastdb.submit_long_sql_query( "SELECT * FROM diasource ORDER BY diasourceid" )
+    t0 = time.perf_counter()
+    while fastdb.check_long_sql_query( queryid )['status'] != 'finished':
+        assert time.perf_counter() - t0 < 20
+        time.sleep( 1 )
+
+    info = fastdb.check_long_sql_query( queryid )
+    expectedbytes = expected.encode( 'utf-8' )
+    assert info['result_size'] == len( expectedbytes )
+    assert info['result_sha256'] == hashlib.sha256( expectedbytes ).hexdigest()
+
+    # Stream to a file
+    outfile = tmp_path / "results.csv"
+    assert fastdb.get_long_sql_query_result( queryid, outfile=outfile ) == outfile
+    assert outfile.read_bytes() == expectedbytes
+
+    # Resume a partial download
+    with open( outfile, "r+b" ) as ofp:
+        ofp.truncate( len( expectedbytes ) // 2 )
+    fastdb.get_long_sql_query_result( queryid, outfile=outfile )
+    assert outfile.read_bytes() == expectedbytes
+
+    # A file that isn't the start of the results is caught and deleted
+    outfile.write_bytes( b'x' * ( len( expectedbytes ) // 2 ) )
+    with pytest.raises( RuntimeError, match="Checksum of downloaded results" ):
+        fastdb.get_long_sql_query_result( queryid, outfile=outfile )
+    assert not outfile.exists()
+
+    # Compressed
+    assert fastdb.get_long_sql_query_result( queryid, compress=True ) == expected
+
+    # Ranges
+    url = f'{fastdb.url}/{fastdb.get_long_sql_query_results_url}{queryid}/'
+    res = fastdb.req.post( url, json={}, headers={ 'Range': 'bytes=10-19' } )
+    assert res.status_code == 206
+    assert res.content == expectedbytes[10:20]
+    assert res.headers['Content-Range'] == f'bytes 10-19/{len(expectedbytes)}'
+    assert res.headers['X-FASTDB-SHA256'] == info['result_sha256']
+    res = fastdb.req.post( url, json={}, headers={ 'Range': f'bytes={len(expectedbytes)}-' } )
+    assert res.status_code == 416
+
+
+def test_long_query_cache( test_user, test_sql_query_expecteddata ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    def wait_for( queryid ):
+        t0 = time.perf_counter()
+        while ( info := fastdb.check_long_sql_query( queryid ) )['status'] != 'finished':
+            assert info['status'] != 'error'
+            assert time.perf_counter() - t0 < 20
+            time.sleep( 1 )
+        return info
+
+    q = "SELECT * FROM diasource WHERE diasourceid>%(id)s ORDER BY diasourceid"
+    firstid = fastdb.submit_long_sql_query( q, { 'id': 0 }, usecache=True )
+    first = wait_for( firstid )
+    assert not first['cached']
+    expected = fastdb.get_long_sql_query_result( firstid )
+
+    # Same query, give or take whitespace: answered from the cache without being run
+    secondid = fastdb.submit_long_sql_query( "SELECT *\n  FROM diasource   WHERE diasourceid>%(id)s "
+                                             "ORDER BY diasourceid ;", { 'id': 0 }, usecache=True )
+    second = fastdb.check_long_sql_query( secondid )
+    assert second['status'] == 'finished'
+    assert second['cached']
+    assert second['result_sha256'] == first['result_sha256']
+    assert fastdb.get_long_sql_query_result( secondid ) == expected
+
+    # Different subdict isn't the same query
+    thirdid = fastdb.submit_long_sql_query( q, { 'id': 1 }, usecache=True )
+    assert not wait_for( thirdid )['cached']
+
+    # Without usecache, it's really run
+    fourthid = fastdb.submit_long_sql_query( q, { 'id': 0 } )
+    fourth = wait_for( fourthid )
+    assert not fourth['cached']
+    assert fourth['result_sha256'] == first['result_sha256']
+
+    # An identical query with a shorter timeout isn't waited for; this one
+    #   would time out, but the second one is run on its own and finishes.
+    q = "SELECT pg_sleep(2) AS s, %(id)s AS id"
+    shortid = fastdb.submit_long_sql_query( q, { 'id': 42 }, usecache=True, timeout=1, priority='low' )
+    longid = fastdb.submit_long_sql_query( q, { 'id': 42 }, usecache=True )
+    info = wait_for( longid )
+    assert not info['cached']
+    t0 = time.perf_counter()
+    while ( info := fastdb.check_long_sql_query( shortid ) )['status'] != 'error':
+        assert time.perf_counter() - t0 < 20
+        time.sleep( 1 )
+    assert 'statement timeout' in info['error']
+
+
+def test_long_query_parallel( test_user, test_sql_query_expecteddata, tmp_path ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    with pytest.raises( RuntimeError, match="must include {FASTDB_PARTITION}" ):
+        fastdb.submit_long_sql_query( "SELECT * FROM diasource", parallel={ 'nworkers': 3 } )
+
+    for parallel in ( { 'nworkers': 3, 'splitby': 'rootid', 'column': 'diaobjectid' },
+                      { 'nworkers': 4, 'splitby': 'q3c' } ):
+        parts = fastdb.synchronous_long_sql_query( "SELECT * FROM diasource WHERE {FASTDB_PARTITION}",
+                                                   checkeach=1, maxwait=20, parallel=parallel )
+        assert len( parts ) == parallel['nworkers']
+        dfs = [ pandas.read_csv( io.StringIO( p ), sep=',', header=0 ) for p in parts ]
+        founddata = [ ( r.diasourceid, r.diaobjectid, r.visit, r.base_procver_id )
+                      for df in dfs for r in df.itertuples() ]
+        assert len( founddata ) == len( test_sql_query_expecteddata )
+        assert set( founddata ) == test_sql_query_expecteddata
+
+    # To files
+    queryid = fastdb.submit_long_sql_query( "SELECT * FROM diasource WHERE {FASTDB_PARTITION}",
+                                            parallel={ 'nworkers': 2, 'column': 'diaobjectid' } )
+    t0 = time.perf_counter()
+    while fastdb.check_long_sql_query( queryid )['status'] != 'finished':
+        assert time.perf_counter() - t0 < 20
+        time.sleep( 1 )
+    files = fastdb.get_long_sql_query_result( queryid, outfile=tmp_path / "parts" )
+    assert files == [ tmp_path / "parts" / "part_000", tmp_path / "parts" / "part_001" ]
+    manifest = json.loads( ( tmp_path / "parts" / "manifest.json" ).read_text() )
+    assert manifest['nrows'] == len( test_sql_query_expecteddata )
+    assert [ p['nrows'] for p in manifest['parts'] ] == [ len( pandas.read_csv( f ) ) for f in files ]
+
+
+def test_long_query_limits_and_cancel( test_user ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    def wait_for( queryid, statuses ):
+        t0 = time.perf_counter()
+        while ( info := fastdb.check_long_sql_query( queryid ) )['status'] not in statuses:
+            assert time.perf_counter() - t0 < 20
+            time.sleep( 0.5 )
+        return info
+
+    with pytest.raises( RuntimeError, match="allowed to submit queries with priority high" ):
+        fastdb.submit_long_sql_query( "SELECT 1", priority='high' )
+    with pytest.raises( RuntimeError, match="timeout must be positive" ):
+        fastdb.submit_long_sql_query( "SELECT 1", timeout=1e9 )
+    with pytest.raises( RuntimeError, match="work_mem must be positive" ):
+        fastdb.submit_long_sql_query( "SELECT 1", work_mem=1e9 )
+
+    queryid = fastdb.submit_long_sql_query( "SELECT pg_sleep(10)", timeout=1, priority='low' )
+    info = wait_for( queryid, [ 'finished', 'error' ] )
+    assert info['status'] == 'error'
+    assert 'statement timeout' in info['error']
+    assert info['priority'] == 'low'
+    assert not info['cancelled']
+
+    queryid = fastdb.submit_long_sql_query( "SELECT pg_sleep(60)" )
+    wait_for( queryid, [ 'started' ] )
+    assert fastdb.cancel_long_sql_query( queryid ) == 'running'
+    info = fastdb.check_long_sql_query( queryid )
+    assert info['status'] == 'error'
+    assert info['cancelled']
+    assert info['error'] == 'Cancelled by test'
+    with pytest.raises( RuntimeError, match="has already errored out" ):
+        fastdb.cancel_long_sql_query( queryid )
+    # The backend really was cancelled
+    t0 = time.perf_counter()
+    while True:
+        with db.DBCon() as dbcon:
+            rows, _ = dbcon.execute( "SELECT COUNT(*) FROM pg_stat_activity "
+                                     "WHERE usename='postgres_ro' AND state='active' AND query LIKE 'FETCH%%'" )
+        if rows[0][0] == 0:
+            break
+        assert time.perf_counter() - t0 < 10
+        time.sleep( 0.5 )
+
+    try:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "INSERT INTO query_user_quota(userid, max_queued) VALUES (%(id)s, 1)",
+                                   { 'id': test_user.id } )
+            dbcon.commit()
+        queryid = fastdb.submit_long_sql_query( "SELECT pg_sleep(60)" )
+        with pytest.raises( RuntimeError, match="You already have 1 long queries queued or running" ):
+            fastdb.submit_long_sql_query( "SELECT 1" )
+        assert fastdb.cancel_long_sql_query( queryid ) in ( 'queued', 'running' )
+        fastdb.submit_long_sql_query( "SELECT 1" )
+    finally:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "DELETE FROM query_user_quota WHERE userid=%(id)s", { 'id': test_user.id } )
+            dbcon.commit()
+
+
+def test_long_query_progress( test_user, test_sql_query_expecteddata ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    queryid = fastdb.submit_long_sql_query( "SELECT * FROM diasource" )
+    t0 = time.perf_counter()
+    while ( info := fastdb.check_long_sql_query( queryid ) )['status'] != 'finished':
+        assert info['status'] != 'error'
+        if info['status'] == 'queued':
+            assert 'progress' not in info
+        assert time.perf_counter() - t0 < 20
+        time.sleep( 1 )
+
+    progress = info['progress']
+    assert progress['rows'] == len( test_sql_query_expecteddata )
+    assert progress['bytes'] == info['result_size']
+    assert progress['estimated_rows'] > 0
+    assert 0 < progress['fraction'] <= 1
+    assert progress['updated'] is not None
+
+    # Parallel parts add up
+    queryid = fastdb.submit_long_sql_query( "SELECT * FROM diasource WHERE {FASTDB_PARTITION}",
+                                            parallel={ 'nworkers': 3, 'column': 'diaobjectid' } )
+    t0 = time.perf_counter()
+    while ( info := fastdb.check_long_sql_query( queryid ) )['status'] != 'finished':
+        assert time.perf_counter() - t0 < 20
+        time.sleep( 1 )
+    assert info['progress']['rows'] == len( test_sql_query_expecteddata )
+    assert info['progress']['estimated_rows'] > 0
+
+
+def test_short_query_admission( test_user ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+    expensive = "SELECT COUNT(*) AS n FROM generate_series( 1, %(n)s ) x"
+
+    # Cheap enough
+    res = fastdb.submit_short_sql_query( expensive, { 'n': 1000 } )
+    assert res == [ { 'n': 1000 } ]
+
+    with pytest.raises( RuntimeError, match="estimated cost .* is more than the limit" ):
+        fastdb.submit_short_sql_query( expensive, { 'n': 1_000_000_000 } )
+    with pytest.raises( RuntimeError, match="estimated cost .* is more than the limit" ):
+        fastdb.submit_short_sql_query( expensive, { 'n': 1_000_000_000 }, return_format='arrow' )
+    # Earlier queries in a list count too
+    with pytest.raises( RuntimeError, match="estimated cost .* is more than the limit" ):
+        fastdb.submit_short_sql_query( [ expensive, "SELECT 1 AS one" ], [ { 'n': 1_000_000_000 }, {} ] )
+
+    with pytest.raises( SubmittedAsLongQuery ) as ex:
+        fastdb.submit_short_sql_query( expensive, { 'n': 1_000_000_000 }, if_expensive='long' )
+    queryid = ex.value.queryid
+    assert ex.value.cost > 1e6
+    assert fastdb.check_long_sql_query( queryid )['status'] in ( 'queued', 'started' )
+    fastdb.cancel_long_sql_query( queryid )
+
+    with db.DBCon() as dbcon:
+        rows, _ = dbcon.execute( "SELECT decision, queryid FROM query_admission_log WHERE userid=%(id)s "
+                                 "ORDER BY t", { 'id': test_user.id } )
+    assert [ r[0] for r in rows[-4:] ] == [ 'rejected', 'rejected', 'rejected', 'long' ]
+    assert str( rows[-1][1] ) == queryid
+
+    # Things that can't be EXPLAINed aren't admitted, except single utility statements
+    with pytest.raises( RuntimeError, match="its cost couldn't be estimated" ):
+        fastdb.submit_short_sql_query( "SELECT 1 AS one; SELECT pg_sleep(60)" )
+    with pytest.raises( RuntimeError, match="its cost couldn't be estimated" ):
+        fastdb.submit_short_sql_query( [ "SET enable_seqscan=off; SELECT pg_sleep(60)", "SELECT 1 AS one" ] )
+    with pytest.raises( RuntimeError, match="its cost couldn't be estimated" ):
+        fastdb.submit_short_sql_query( "CREATE TABLE test_short_query_admission( x int )" )
+    res = fastdb.submit_short_sql_query( [ "SET enable_seqscan=off;",
+                                           "SELECT current_setting('enable_seqscan') AS s" ] )
+    assert res == [ { 's': 'off' } ]
+
+    # Temp tables in a list of queries
+    for return_format in ( 0, 'arrow' ):
+        res = fastdb.submit_short_sql_query( [ "CREATE TEMP TABLE test_short_query_temp( x int )",
+                                               "INSERT INTO test_short_query_temp SELECT generate_series(1, 3)",
+                                               "SELECT x FROM test_short_query_temp ORDER BY x" ],
+                                             return_format=return_format )
+        if return_format == 'arrow':
+            assert res.column( 'x' ).to_pylist() == [ 1, 2, 3 ]
+        else:
+            assert res == [ { 'x': 1 }, { 'x': 2 }, { 'x': 3 } ]
+    res = fastdb.submit_short_sql_query( [ "CREATE TEMPORARY TABLE test_short_query_temp( x int )",
+                                           "DROP TABLE test_short_query_temp",
+                                           "SELECT 1 AS one" ] )
+    assert res == [ { 'one': 1 } ]
+
+
+def test_long_query_wait( test_user ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password' )
+
+    queryid = fastdb.submit_long_sql_query( "SELECT pg_sleep(3)" )
+    status = None
+    t0 = time.perf_counter()
+    while ( info := fastdb.wait_long_sql_query( queryid, timeout=10, status=status ) )['status'] != 'finished':
+        assert info['status'] != 'error'
+        assert info['status'] != status
+        assert time.perf_counter() - t0 < 20
+        status = info['status']
+    # Woken up by the query finishing, not by the timeout
+    assert time.perf_counter() - t0 < 10
+
+    # Already finished, so returns right away
+    t0 = time.perf_counter()
+    info = fastdb.wait_long_sql_query( queryid, timeout=10, status='finished' )
+    assert info['status'] == 'finished'
+    assert time.perf_counter() - t0 < 2
+
+    # Times out if nothing changes
+    queryid = fastdb.submit_long_sql_query( "SELECT pg_sleep(60)" )
+    try:
+        status = fastdb.check_long_sql_query( queryid )['status']
+        if status == 'queued':
+            status = fastdb.wait_long_sql_query( queryid, timeout=10, status='queued' )['status']
+        assert status == 'started'
+        t0 = time.perf_counter()
+        info = fastdb.wait_long_sql_query( queryid, timeout=2, status='started' )
+        assert info['status'] == 'started'
+        assert 2 <= time.perf_counter() - t0 < 5
+    finally:
+        fastdb.cancel_long_sql_query( queryid )
+
+
+def test_short_query_cache( test_user, test_sql_query_expecteddata, tmp_path ):
+    fastdb = FASTDBClient( 'http://webap:8080', username='test', password='test_password', cachedir=tmp_path )
+    q = "SELECT * FROM diasource ORDER BY diasourceid"
+
+    rows = fastdb.submit_short_sql_query( q, usecache=True )
+    assert len( rows ) == len( test_sql_query_expecteddata )
+    assert fastdb.submit_short_sql_query( q, usecache=True ) == rows
+    tab = fastdb.submit_short_sql_query( q, return_format='arrow', usecache=True )
+    assert fastdb.submit_short_sql_query( q, return_format='arrow', usecache=True ).equals( tab )
+    # Short queries aren't cached unless you ask
+    assert fastdb.submit_short_sql_query( q ) == rows
+    stats = fastdb.cache_stats()
+    assert stats['queries'] == 2
+    assert stats['query'] == { 'hits': 2, 'revalidated': 0, 'misses': 2, 'hit_rate': 0.5 }
+
+    # An import means the cached result might be out of date
+    try:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "INSERT INTO diasource_import_time(collection, t) "
+                                   "VALUES ('test_short_query_cache', NOW())" )
+            dbcon.commit()
+        fastdb._watermark_time = None
+        assert fastdb.submit_short_sql_query( q, usecache=True ) == rows
+        assert fastdb.cache_stats()['query']['misses'] == 3
+        assert fastdb.cache_stats()['queries'] == 2
+    finally:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "DELETE FROM diasource_import_time WHERE collection='test_short_query_cache'" )
+            dbcon.commit()
+
+    fastdb.clear_cache()
+    assert fastdb.cache_stats()['files'] == 0
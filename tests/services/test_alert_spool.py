@@ -0,0 +1,80 @@
+import time
+
+from services.alert_spool import AlertSpool
+
+
+def test_spool_drains_in_order_through_failures( tmp_path ):
+    stored = []
+    nfail = [ 3 ]
+
+    def store( **batch ):
+        if nfail[0] > 0:
+            nfail[0] -= 1
+            raise RuntimeError( "mongo is having a bad day" )
+        stored.append( batch['i'] )
+
+    spool = AlertSpool( tmp_path, store, max_bytes=4000, segment_bytes=1000, retry_sleeptime=0.01 )
+    spool.start()
+    try:
+        for i in range( 200 ):
+            spool.append( i=i, stuff=b'x' * 40 )
+            # Make sure we're actually honoring max_bytes
+            assert spool.nbytes_pending <= 4000
+        assert spool.stop( timeout=30 )
+    finally:
+        spool.close()
+
+    assert stored == list( range( 200 ) )
+    assert spool.n_store_failures == 3
+    # Only the (empty) active segment should be left
+    assert len( list( tmp_path.glob( "*.seg" ) ) ) == 1
+
+
+def test_spool_replays_after_crash( tmp_path ):
+    stored = []
+
+    def store( **batch ):
+        stored.append( batch['i'] )
+
+    # Write without ever draining, as if we died before mongo came back
+    spool = AlertSpool( tmp_path, store, segment_bytes=200 )
+    for i in range( 20 ):
+        spool.append( i=i )
+    spool.close()
+
+    # Tear the last record, as if we crashed in the middle of a write
+    lastseg = sorted( tmp_path.glob( "*.seg" ) )[-1]
+    with open( lastseg, "ab" ) as ofp:
+        ofp.write( b'\x40\x00\x00\x00garbage' )
+
+    spool = AlertSpool( tmp_path, store, segment_bytes=200 )
+    spool.start()
+    try:
+        spool.append( i=20 )
+        assert spool.stop( timeout=30 )
+    finally:
+        spool.close()
+
+    assert stored == list( range( 21 ) )
+
+    # A cursor from a partially drained spool should mean we don't replay what was already stored
+    stored.clear()
+    spool = AlertSpool( tmp_path, store, segment_bytes=10000 )
+    for i in range( 10 ):
+        spool.append( i=i )
+    spool.start()
+    t0 = time.monotonic()
+    while ( len( stored ) < 10 ) and ( time.monotonic() - t0 < 10 ):
+        time.sleep( 0.1 )
+    spool.stop( timeout=10 )
+    for i in range( 10, 15 ):
+        spool.append( i=i )
+    spool.close()
+
+    spool = AlertSpool( tmp_path, store, segment_bytes=10000 )
+    spool.start()
+    try:
+        assert spool.stop( timeout=30 )
+    finally:
+        spool.close()
+    assert stored == list( range( 15 ) )
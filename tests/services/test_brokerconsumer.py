@@ -16,6 +16,8 @@ from services.brokerconsumer import (
     AntaresConsumer,
     PittGoogleConsumer
 )
+from services.brokerconsumer_async import BrokerConsumerAsyncLauncher
+from kafka_consumer import KafkaConsumer
 from util import FDBLogger, env_as_bool
 import db
 
@@ -383,6 +385,92 @@ def test_BrokerConsumerLauncher( barf, alerts_30_to_90_sent_and_classified ):
         cleanup_mongodb( 'fastdb_test' )
 
 
+# Same as test_BrokerConsumerLauncher, but with everything running in one process
+def test_BrokerConsumerAsyncLauncher( barf, alerts_30_to_90_sent_and_classified ):
+    _nsent, tfirstalert = alerts_30_to_90_sent_and_classified
+
+    proc = None
+    try:
+        def launch_launcher( barf2 ):
+            bcl = BrokerConsumerAsyncLauncher( '/code/tests/services/brokerconsumer.yaml', barf=barf, barf2=barf2,
+                                               logtag='BrokerConsumerAsyncLauncher', verbose=True,
+                                               decode_workers=2, status_interval=5 )
+            bcl()
+
+        proc = multiprocessing.Process( target=launch_launcher, args=[f'{barf}-async'] )
+        FDBLogger.info( "Starting BrokerConsumerAsyncLauncher" )
+        t0 = time.monotonic()
+        proc.start()
+        proc.join()
+        t1 = time.monotonic()
+        FDBLogger.info( f"BrokerConsumerAsyncLauncher exited after {t1-t0} seconds." )
+        proc.close()
+        proc=None
+        assert t1 - t0 > 20
+        assert t1 - t0 < 25
+        check_mongodb( 'fastdb_test', tfirstalert )
+
+        cleanup_mongodb( 'fastdb_test' )
+
+        proc = multiprocessing.Process( target=launch_launcher, args=[f'{barf}-async-1'] )
+        FDBLogger.info( "Starting BrokerConsumerAsyncLauncher" )
+        t0 = time.monotonic()
+        proc.start()
+        FDBLogger.info( "Sleeping 5s for BrokerConsumerAsyncLauncher to do its thing" )
+        time.sleep( 5 )
+        FDBLogger.info( "Sending TERM to BrokerConsumerAsyncLauncher" )
+        proc.terminate()
+        proc.join()
+        t1 = time.monotonic()
+        FDBLogger.info( f"BrokerConsumerAsyncLauncher exited after {t1-t0} seconds." )
+        proc.close()
+        proc = None
+        assert t1 - t0 > 5
+        assert t1 - t0 < 10
+        check_mongodb( 'fastdb_test', tfirstalert )
+
+    finally:
+        if proc is not None:
+            proc.kill()
+        cleanup_mongodb( 'fastdb_test' )
+
+
+# With prefetch_batches, KafkaConsumer doesn't store offsets automatically,
+#   so make sure the async launcher stores them: a second run with the same
+#   group shouldn't get anything.
+def test_BrokerConsumerAsyncLauncher_prefetch( barf, alerts_30_to_90_sent_and_classified ):
+    _nsent, tfirstalert = alerts_30_to_90_sent_and_classified
+    barf2 = f'{barf}-async-prefetch'
+
+    proc = None
+    try:
+        def launch_launcher():
+            bcl = BrokerConsumerAsyncLauncher( '/code/tests/services/brokerconsumer_prefetch.yaml', barf=barf,
+                                               barf2=barf2, logtag='BrokerConsumerAsyncLauncher', verbose=True,
+                                               status_interval=5 )
+            bcl()
+
+        proc = multiprocessing.Process( target=launch_launcher )
+        proc.start()
+        proc.join()
+        proc.close()
+        proc = None
+        check_mongodb( 'fastdb_test', tfirstalert )
+
+        consumer = KafkaConsumer( 'kafka-server', f'test-{barf2}', consume_nmsgs=10, nomsg_sleeptime=1,
+                                  schemaless=True )
+        consumer.subscribe( [ f'classifications-{barf}' ] )
+        leftover = []
+        consumer.poll_loop( handler=lambda m: leftover.extend( m ), stopafternsleeps=2 )
+        consumer.close()
+        assert len( leftover ) == 0
+
+    finally:
+        if proc is not None:
+            proc.kill()
+        cleanup_mongodb( 'fastdb_test' )
+
+
 # TODO : write tests that use the "60days" fixtures?
 
 
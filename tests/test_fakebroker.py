@@ -64,3 +64,33 @@ def test_fakebroker( barf, snana_fits_ppdb_loaded, alerts_30days_sent_and_classi
                         else f"{row[0]}_{row[1]}" )
                       for row in cursor.fetchall() ]
         assert set( f"{a['diaSource']['diaObjectId']}_{a['diaSource']['visit']}" for a in brokeralerts ) == set( dbids )
+
+
+# Make sure that the prefetching poll loop gets the same messages as the
+#   plain one, and that offsets of messages that were prefetched but never
+#   handled don't get committed.
+def test_fakebroker_prefetch( barf, snana_fits_ppdb_loaded, alerts_30days_sent_and_classified ):
+    schema = util.get_alert_schema()
+    brokertopic = f'classifications-{barf}'
+    private_barf = "".join( random.choices( 'abcdefghijklmnopqrstuvwzyx', k=6 ) )
+    groupid = f'test_fakebroker_prefetch_{private_barf}'
+
+    consumer = KafkaConsumer( 'kafka-server', groupid, schema['brokermessage_schema_file'],
+                              consume_nmsgs=10, nomsg_sleeptime=1, prefetch=3, logger=util.logger )
+    consumer.subscribe( [ brokertopic ], reset=True )
+    firstmsgs = []
+    consumer.poll_loop( handler=lambda m: firstmsgs.extend( m ), stopafternmessages=30, stopafternsleeps=2 )
+    assert 30 <= len( firstmsgs ) < 154
+    consumer.close()
+
+    consumer = KafkaConsumer( 'kafka-server', groupid, schema['brokermessage_schema_file'],
+                              consume_nmsgs=10, nomsg_sleeptime=1, prefetch=3, logger=util.logger )
+    consumer.subscribe( [ brokertopic ] )
+    restmsgs = []
+    consumer.poll_loop( handler=lambda m: restmsgs.extend( m ), stopafternsleeps=2 )
+    consumer.close()
+
+    # Nothing lost, nothing handled twice
+    seen = [ ( m.partition(), m.offset() ) for m in firstmsgs + restmsgs ]
+    assert len( seen ) == 154
+    assert len( set( seen ) ) == 154
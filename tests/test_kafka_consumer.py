@@ -0,0 +1,44 @@
+import pytest
+
+from kafka_consumer import _BatchController
+
+
+def test_batch_controller():
+    bc = _BatchController( 100, 1., 10, 1000, 0.1, 5., target_handle_time=2. )
+
+    # Full batches, fast handler: grow batches, shrink timeout, up to the bounds
+    for i in range( 30 ):
+        nmsgs, timeout, _changed = bc.update( bc.nmsgs, 0.0001 * bc.nmsgs )
+    assert bc.state == "busy"
+    assert nmsgs == 1000
+    assert timeout == pytest.approx( 0.1 )
+    _, _, changed = bc.update( 1000, 0.1 )
+    assert not changed
+
+    # Slow handler: don't go past target_handle_time
+    nmsgs, _, changed = bc.update( 1000, 4. )
+    assert changed
+    assert bc.state == "handler-bound"
+    assert nmsgs == 500
+
+    # A big backlog counts as busy even if the batch wasn't full
+    bc = _BatchController( 100, 1., 10, 1000, 0.1, 5., target_handle_time=None )
+    nmsgs, _, _ = bc.update( 50, 0.1, backlog=10000 )
+    assert nmsgs == 150
+
+    # Thin stream: shrink towards what we're actually getting
+    for i in range( 30 ):
+        nmsgs, timeout, _ = bc.update( 3, 0.01 )
+    assert bc.state == "thin"
+    assert nmsgs == 10
+    assert timeout == pytest.approx( 0.1 )
+
+    # Nothing there: wait longer
+    for i in range( 30 ):
+        nmsgs, timeout, _ = bc.update( 0, 0. )
+    assert bc.state == "idle"
+    assert nmsgs == 10
+    assert timeout == pytest.approx( 5. )
+
+    with pytest.raises( ValueError ):
+        _BatchController( 100, 1., 0, 1000, 0.1, 5., 10 )
@@ -1,4 +1,5 @@
 import time
+import itertools
 import pytest
 
 import numpy as np
@@ -111,6 +112,35 @@ def test_objstats_view( objstats_realtime_view, set_of_lightcurves, check_db_row
             con.commit()
 
 
+def test_objstats_refresh( objstats_realtime_view, set_of_lightcurves, check_db_rows_vs_expected ):
+    ltcv.create_object_stats_materialized_view( 'realtime' )
+    t0 = ltcv.objstats_refreshed_at( 'realtime' )
+    assert t0 is not None
+
+    with db.DBCon() as con:
+        # The unique indexes that REFRESH ... CONCURRENTLY needs are there
+        rows, _ = con.execute( "SELECT indexname FROM pg_indexes WHERE indexname=ANY(%(idx)s)",
+                               { 'idx': [ 'idx_objstats_realtime_unique', 'idx_objstatscomb_realtime_unique' ] } )
+        assert len(rows) == 2
+
+        # A concurrent refresh doesn't block readers.  Hold a read lock on the view
+        #   in one connection while refreshing in another.
+        con.execute( "SELECT COUNT(*) FROM objstats_realtime" )
+        ltcv.create_object_stats_materialized_view( 'realtime', concurrently=True )
+        con.rollback()
+
+    t1 = ltcv.objstats_refreshed_at( 'realtime' )
+    assert t1 > t0
+    with db.DBCon( dictcursor=True ) as con:
+        rows = con.execute( "SELECT * FROM objstats_realtime" )
+        combrows = con.execute( "SELECT * FROM objstatscomb_realtime" )
+    check_db_rows_vs_expected( rows, combrows, expected_roots=[0,1,2] )
+
+    # A plain refresh still works too
+    ltcv.create_object_stats_materialized_view( 'realtime', concurrently=False )
+    assert ltcv.objstats_refreshed_at( 'realtime' ) > t1
+
+
 def test_get_object_infos( set_of_lightcurves, procver_collection ):
     bpvs, _pvs, _pvinfo = procver_collection
     roots = set_of_lightcurves
@@ -429,11 +459,14 @@ def test_many_object_ltcvs( procver_collection, set_of_lightcurves, lightcurve_c
         dbcon.echoqueries = True
         dbcon.alwaysexplain = True
         dbcon.alwaysanalyze = True
-        for ltcvreq in ltcvlist:
+        # few_objects_threshold=0 forces the temp table code; None means these
+        #   small requests go through the single-query code
+        for threshold, ltcvreq in itertools.product( [ 0, None ], ltcvlist ):
             for which in [ None, 'patch', 'detections', 'forced' ]:
                 for extra in extras:
                     kwargs = extra.copy()
                     kwargs['objids'] = ltcvreq[1]
+                    kwargs['few_objects_threshold'] = threshold
                     if ltcvreq[0] is not None:
                         kwargs['processing_version'] = ltcvreq[0]
                     if which is not None:
@@ -452,6 +485,7 @@ def test_many_object_ltcvs( procver_collection, set_of_lightcurves, lightcurve_c
                     tpd += time.perf_counter() - tp0
 
                     del kwargs['objids']
+                    del kwargs['few_objects_threshold']
                     if which is None:
                         kwargs['which'] = 'patch'
                     if ltcvreq[0] is not None:
@@ -0,0 +1,67 @@
+import pickle
+import urllib.request
+
+import pytest
+
+from metrics import MetricsRegistry, render_snapshots, serve_metrics
+
+
+def test_registry_and_render():
+    reg = MetricsRegistry( constlabels={ 'broker': 'test' } )
+    reg.inc( 'stuff_total', 3, helpstr="Stuff", topic='t', partition=0 )
+    reg.inc( 'stuff_total', 2, topic='t', partition=0 )
+    reg.inc( 'stuff_total', topic='t', partition=1 )
+    reg.set( 'lag', 42, topic='t', partition=0 )
+    reg.observe( 'time_seconds', 0.3, buckets=( 0.1, 1. ) )
+    reg.observe( 'time_seconds', 3., buckets=( 0.1, 1. ) )
+
+    assert reg.get( 'stuff_total', topic='t', partition=0 ) == 5
+    assert reg.get( 'lag', topic='t', partition=0 ) == 42
+    assert reg.get( 'nothing' ) is None
+    with pytest.raises( ValueError, match="is a counter" ):
+        reg.set( 'stuff_total', 1 )
+
+    text = reg.render()
+    lines = text.splitlines()
+    assert "# HELP stuff_total Stuff" in lines
+    assert "# TYPE stuff_total counter" in lines
+    assert 'stuff_total{broker="test",partition="0",topic="t"} 5' in lines
+    assert 'stuff_total{broker="test",partition="1",topic="t"} 1' in lines
+    assert "# TYPE lag gauge" in lines
+    assert 'lag{broker="test",partition="0",topic="t"} 42' in lines
+    assert "# TYPE time_seconds histogram" in lines
+    assert 'time_seconds_bucket{broker="test",le="0.1"} 0' in lines
+    assert 'time_seconds_bucket{broker="test",le="1"} 1' in lines
+    assert 'time_seconds_bucket{broker="test",le="+Inf"} 2' in lines
+    assert 'time_seconds_sum{broker="test"} 3.3' in lines
+    assert 'time_seconds_count{broker="test"} 2' in lines
+
+
+def test_merge_snapshots():
+    a = MetricsRegistry( constlabels={ 'broker': 'a' } )
+    b = MetricsRegistry( constlabels={ 'broker': 'b' } )
+    a.inc( 'n_total', 2 )
+    b.inc( 'n_total', 5 )
+    a.observe( 't_seconds', 0.5, buckets=( 1., ) )
+
+    # Snapshots have to survive a trip through a multiprocessing pipe
+    snaps = [ pickle.loads( pickle.dumps( r.snapshot() ) ) for r in ( a, b, a ) ]
+    lines = render_snapshots( snaps ).splitlines()
+    # a appears twice, so gets summed
+    assert 'n_total{broker="a"} 4' in lines
+    assert 'n_total{broker="b"} 5' in lines
+    assert 't_seconds_count{broker="a"} 2' in lines
+
+
+def test_serve_metrics():
+    reg = MetricsRegistry()
+    reg.inc( 'served_total' )
+    server = serve_metrics( reg.render, 0 )
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen( f"http://127.0.0.1:{port}/metrics" ) as res:
+            assert res.status == 200
+            assert res.headers['Content-Type'].startswith( 'text/plain' )
+            assert 'served_total 1' in res.read().decode( 'utf-8' ).splitlines()
+    finally:
+        server.shutdown()
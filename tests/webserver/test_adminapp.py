@@ -0,0 +1,55 @@
+import pytest
+
+import db
+
+
+def test_querystats( test_user, fastdb_client ):
+    with pytest.raises( RuntimeError, match="requires admin" ):
+        fastdb_client.post( '/admin/querystats' )
+
+    try:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "INSERT INTO authuser_admin(userid) VALUES (%(id)s)", { 'id': test_user.id } )
+            dbcon.commit()
+
+        # The webap has surely run queries by now, if only to log us in
+        res = fastdb_client.post( '/admin/querystats', json={ 'limit': 5 } )
+        assert res['status'] == 'ok'
+        assert 0 < len( res['querystats'] ) <= 5
+        times = [ r['total_time'] for r in res['querystats'] ]
+        assert times == sorted( times, reverse=True )
+        assert set( res['querystats'][0].keys() ) == { 'fingerprint', 'query', 'calls', 'slow_calls', 'total_time',
+                                                       'mean_time', 'total_fetch_time', 'max_time', 'nrows',
+                                                       'first_seen', 'last_seen' }
+
+        res = fastdb_client.post( '/admin/querystats', json={ 'orderby': 'calls' } )
+        calls = [ r['calls'] for r in res['querystats'] ]
+        assert calls == sorted( calls, reverse=True )
+
+        with pytest.raises( RuntimeError, match="orderby must be one of" ):
+            fastdb_client.post( '/admin/querystats', json={ 'orderby': 'kittens' } )
+
+        res = fastdb_client.post( '/admin/slowqueries' )
+        assert res['status'] == 'ok'
+        assert isinstance( res['slowqueries'], list )
+
+        res = fastdb_client.post( '/admin/querycache' )
+        assert res['status'] == 'ok'
+        assert set( res.keys() ) == { 'status', 'entries', 'bytes', 'hits', 'submissions', 'cache_hits', 'hit_rate' }
+        assert 0 <= res['cache_hits'] <= res['submissions']
+
+        res = fastdb_client.post( '/admin/admissions', json={ 'limit': 10 } )
+        assert res['status'] == 'ok'
+        assert set( res['counts'].keys() ) <= { 'rejected', 'long' }
+        assert len( res['admissions'] ) <= 10
+
+        res = fastdb_client.post( '/admin/queuestats', json={ 'days': 1 } )
+        assert res['status'] == 'ok'
+        assert isinstance( res['users'], list )
+        assert [ p['priority'] for p in res['priorities'] ] == sorted( [ p['priority'] for p in res['priorities'] ],
+                                                                       key=[ 'high', 'normal', 'low' ].index )
+
+    finally:
+        with db.DBCon() as dbcon:
+            dbcon.execute_nofetch( "DELETE FROM authuser_admin WHERE userid=%(id)s", { 'id': test_user.id } )
+            dbcon.commit()
@@ -1,8 +1,13 @@
 import pytest
+import sys
 import time
 
+import ltcv
 from util import FDBLogger
 
+sys.path.insert( 0, '/code/client' )
+from fastdb_client import FASTDBClient
+
 
 def test_getmanyltcvs( test_user, fastdb_client, set_of_lightcurves, lightcurve_checker ):
     roots = set_of_lightcurves
@@ -86,6 +91,78 @@ def test_getmanyltcvs( test_user, fastdb_client, set_of_lightcurves, lightcurve_
 
 
 
+def test_get_many_ltcvs_chunked( test_user, fastdb_client, set_of_lightcurves ):
+    # 201 and 2011 are both diaobjectids of root 1, so with chunksize=2 root 1 comes back from three chunks
+    objids = [ 0, 1, 2, 201, 2011 ]
+    single = fastdb_client.post( '/ltcv/getmanyltcvs/pvc_pv2', json={ 'objids': objids, 'return_object_info': 1 } )
+
+    for nworkers in [ 1, 3 ]:
+        ltcvs, objinfo = fastdb_client.get_many_ltcvs( objids, procver='pvc_pv2', return_format='json',
+                                                       chunksize=2, nworkers=nworkers, return_object_info=1 )
+        assert len( ltcvs ) == 3
+        assert sorted( ltcvs, key=lambda lc: lc['rootid'] ) == sorted( single['ltcvs'], key=lambda lc: lc['rootid'] )
+        assert set( objinfo.keys() ) == set( single['objinfo'].keys() )
+        assert sorted( objinfo['diaobjectid'] ) == sorted( single['objinfo']['diaobjectid'] )
+
+    npoints = sum( len( lc['mjd'] ) for lc in single['ltcvs'] )
+    df = fastdb_client.get_many_ltcvs( objids, procver='pvc_pv2', chunksize=2, which='detections' )
+    assert df.index.names == [ 'rootid', 'mjd' ]
+    assert set( df.index.get_level_values( 'rootid' ) ) == { lc['rootid'] for lc in single['ltcvs'] }
+    df = fastdb_client.get_many_ltcvs( objids, procver='pvc_pv2', chunksize=2 )
+    assert len( df ) == npoints
+    assert set( df.columns ) == set( single['ltcvs'][0].keys() ) - { 'rootid', 'mjd' }
+
+    tab = fastdb_client.get_many_ltcvs( objids, procver='pvc_pv2', return_format='arrow', chunksize=4 )
+    assert tab.num_rows == npoints
+    assert set( tab.column_names ) == set( single['ltcvs'][0].keys() )
+
+    with pytest.raises( RuntimeError, match="Unknown data parameters: {'foo'}" ):
+        fastdb_client.get_many_ltcvs( objids, procver='pvc_pv2', chunksize=2, foo='bar' )
+
+
+def test_get_many_ltcvs_cache( test_user, fastdb_client, set_of_lightcurves, tmp_path ):
+    roots = set_of_lightcurves
+    rootids = [ str( roots[i]['root'].id ) for i in [ 0, 1, 2 ] ]
+
+    def byroot( ltcvs ):
+        return sorted( ltcvs, key=lambda lc: lc['rootid'] )
+
+    # The server only sends back lightcurves whose etags have changed
+    res = fastdb_client.post( '/ltcv/getchangedltcvs/pvc_pv2', json={ 'objids': rootids } )
+    assert res['watermark'] == fastdb_client.post( '/importwatermark' )['watermark']
+    assert len( res['ltcvs'] ) == 3
+    assert set( res['etags'].keys() ) == set( rootids )
+    res2 = fastdb_client.post( '/ltcv/getchangedltcvs/pvc_pv2', json={ 'objids': rootids, 'etags': res['etags'] } )
+    assert res2['etags'] == res['etags']
+    assert res2['ltcvs'] == []
+    with pytest.raises( RuntimeError, match="getchangedltcvs doesn't do return_object_info" ):
+        fastdb_client.post( '/ltcv/getchangedltcvs/pvc_pv2', json={ 'objids': rootids, 'return_object_info': 1 } )
+
+    client = FASTDBClient( 'http://webap:8080', username='test', password='test_password', cachedir=tmp_path )
+    expected = byroot( client.get_many_ltcvs( rootids, procver='pvc_pv2', return_format='json', usecache=False ) )
+    assert byroot( res['ltcvs'] ) == expected
+
+    assert byroot( client.get_many_ltcvs( rootids, procver='pvc_pv2', return_format='json', chunksize=2 ) ) == expected
+    assert client.cache_stats()['ltcv'] == { 'hits': 0, 'revalidated': 0, 'misses': 3, 'hit_rate': 0. }
+    assert byroot( client.get_many_ltcvs( rootids, procver='pvc_pv2', return_format='json' ) ) == expected
+    assert client.cache_stats()['ltcv']['hits'] == 3
+
+    # Too old, so ask the server, which says they haven't changed
+    client.cache.max_age = 0
+    df = client.get_many_ltcvs( rootids, procver='pvc_pv2' )
+    assert len( df ) == sum( len( lc['mjd'] ) for lc in expected )
+    stats = client.cache_stats()
+    assert stats['ltcv'] == { 'hits': 3, 'revalidated': 3, 'misses': 3, 'hit_rate': 0.6666666666666666 }
+    assert stats['ltcvs'] == 3
+
+    # Different parameters are cached separately; diaobjectids aren't cached
+    client.get_many_ltcvs( rootids, procver='pvc_pv2', which='detections' )
+    client.get_many_ltcvs( [ 0, 1, 2 ], procver='pvc_pv2' )
+    stats = client.cache_stats()
+    assert stats['ltcvs'] == 6
+    assert stats['ltcv']['misses'] == 6
+
+
 def test_getltcv( test_user, fastdb_client, set_of_lightcurves, lightcurve_checker ):
     roots = set_of_lightcurves
     check_ltcv = lightcurve_checker
@@ -193,10 +270,42 @@ def test_getltcv( test_user, fastdb_client, set_of_lightcurves, lightcurve_check
 
 
 
-# TODO : test getrandomltcv ; that might require the ability to pass a random seed for a reproducible test.
-@pytest.mark.skip( reason="This test needs to be written" )
+def test_getrandomobjects( test_user, fastdb_client, procver_collection, set_of_lightcurves ):
+    roots = set_of_lightcurves
+    allroots = { str( r['root'].id ) for r in roots }
+
+    # Asking for more than there are should give us all of them
+    res = fastdb_client.post( '/ltcv/getrandomobjects/pvc_pv2/10' )
+    assert res['status'] == 'ok'
+    assert set( res['rootids'] ) == allroots
+    assert len( res['rootids'] ) == len( allroots )
+
+    seen = set()
+    for i in range( 20 ):
+        res = fastdb_client.post( '/ltcv/getrandomobjects/pvc_pv2' )
+        assert len( res['rootids'] ) == 1
+        seen.add( res['rootids'][0] )
+    assert seen.issubset( allroots )
+    # Not a rigorous test of randomness, but with 4 objects and 20 tries, we'd better see more than one
+    assert len( seen ) > 1
+
+    res = fastdb_client.post( '/ltcv/getrandomobjects/pvc_pv3/2' )
+    assert res['rootids'] == []
+
+    # Python API
+    rootids = ltcv.random_rootids( 'pvc_pv2', n=2 )
+    assert len( rootids ) == 2
+    assert { str(r) for r in rootids }.issubset( allroots )
+
+
 def test_getrandomltcv( test_user, fastdb_client, procver_collection, set_of_lightcurves ):
-    assert False
+    roots = set_of_lightcurves
+    allroots = { str( r['root'].id ) for r in roots }
+
+    res = fastdb_client.post( '/ltcv/getrandomltcv/pvc_pv2' )
+    assert isinstance( res, dict )
+    assert str( res['rootid'] ) in allroots
+    assert len( res['mjd'] ) > 0
 
 
 def test_gethottransients( test_user, fastdb_client, set_of_lightcurves, lightcurve_checker ):
@@ -1,4 +1,5 @@
 import re
+import datetime
 import uuid
 import pytest
 
@@ -166,6 +167,35 @@ def test_countthings( set_of_lightcurves, test_user, fastdb_client ):
         fastdb_client.retries = orig_retries
 
 
+def test_countthings_row_counts( set_of_lightcurves, test_user, fastdb_client ):
+    # An exact count stores the count in row_counts
+    res = fastdb_client.post( '/count/diasource/pvc_pv2', json={ 'exact': True } )
+    assert res['count'] == 52
+    res = fastdb_client.post( '/count/diasource/pvc_pv2' )
+    assert res['count'] == 52
+    assert res['reconciled_at'] is not None
+
+    # Importers bump the count; /count returns the bumped value without counting
+    with db.DBCon() as con:
+        pv = db.ProcessingVersion.get_procver( 'pvc_pv2', dbcon=con )
+        bpv = pv.highest_prio_base_procver( 'diasource', dbcon=con )
+        db.RowCount.bump( 'diasource', bpv.id, 3, dbcon=con, commit=True )
+    res = fastdb_client.post( '/count/diasource/pvc_pv2' )
+    assert res['count'] == 55
+
+    # Reconciliation puts it back and records the drift
+    nrows, drift = db.RowCount.reconcile( 'pvc_pv2', 'diasource' )
+    assert nrows == 52
+    assert drift == 3
+    res = fastdb_client.post( '/count/diasource/pvc_pv2' )
+    assert res['count'] == 52
+    with db.DBCon() as con:
+        rows, _ = con.execute( "SELECT previous_nrows, nrows, drift FROM row_count_reconciliation "
+                               "WHERE procver_id=%(pv)s AND tablename='diasource' ORDER BY t DESC LIMIT 1",
+                               { 'pv': pv.id } )
+    assert rows[0] == ( 55, 52, 3 )
+
+
 def test_getdiaobjectinfo( fastdb_client, procver_collection, set_of_lightcurves ):
     roots = set_of_lightcurves
 
@@ -299,6 +329,11 @@ def test_objectsearch( fastdb_client, procver_collection, objstats_realtime_view
             results = fastdb_client.post( f"/objectsearch/{test['pv']}", json=test['conditions'] )
             check_search_vs_expected( test['pv'], test['roots'], test['band'], results )
 
+        # The response says how fresh the objstats views are
+        res = fastdb_client.post( "/objectsearch/pvc_pv2", json=tests[0]['conditions'], return_format='raw' )
+        refreshed_at = datetime.datetime.fromisoformat( res.headers['X-FASTDB-Objstats-Refreshed-At'] )
+        assert refreshed_at == ltcv.objstats_refreshed_at( 'pvc_pv2' )
+
     finally:
         with db.DBCon() as con:
             for procver in made_procvers: